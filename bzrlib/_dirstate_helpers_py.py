@@ -272,6 +272,9 @@ def _read_dirblocks(state):
         current_block = state._dirblocks[0][1]
         current_dirname = ''
         append_entry = current_block.append
+        # The parent rows only mention a few revision ids, so keep one copy
+        # of each.
+        intern_revision_id = {}.setdefault
         for count in xrange(state._num_entries):
             dirname = next()
             name = next()
@@ -282,22 +285,31 @@ def _read_dirblocks(state):
                 current_dirname = dirname
                 state._dirblocks.append((current_dirname, current_block))
                 append_entry = current_block.append
+            current = (# Current Tree
+                next(),                # minikind
+                next(),                # fingerprint
+                _int(next()),          # size
+                next() == 'y',         # executable
+                next(),                # packed_stat or revision_id
+            )
+            minikind = next()
+            fingerprint = next()
+            if fingerprint == current[1]:
+                # An unchanged file has the same sha1 in both trees.
+                fingerprint = current[1]
+            size = _int(next())
+            executable = next() == 'y'
+            revision_id = next()
             # we know current_dirname == dirname, so re-use it to avoid
             # creating new strings
             entry = ((current_dirname, name, file_id),
-                     [(# Current Tree
-                         next(),                # minikind
-                         next(),                # fingerprint
-                         _int(next()),          # size
-                         next() == 'y',         # executable
-                         next(),                # packed_stat or revision_id
-                     ),
+                     [current,
                      ( # Parent 1
-                         next(),                # minikind
-                         next(),                # fingerprint
-                         _int(next()),          # size
-                         next() == 'y',         # executable
-                         next(),                # packed_stat or revision_id
+                         minikind,
+                         fingerprint,
+                         size,
+                         executable,
+                         intern_revision_id(revision_id, revision_id),
                      ),
                      ])
             trailing = next()
@@ -540,9 +540,11 @@ cdef class Reader:
     cdef char *end_cstr # End of text
     cdef char *cur_cstr # Pointer to the current record
     cdef char *next # Pointer to the end of this record
+    cdef object revision_ids # One copy of each parent revision id
 
     def __init__(self, text, state):
         self.state = state
+        self.revision_ids = {}
         self.text = text
         self.text_cstr = PyString_AsString(text)
         self.text_size = PyString_Size(text)
@@ -629,6 +631,8 @@ cdef class Reader:
         cdef object minikind
         cdef object fingerprint
         cdef object info
+        cdef object details
+        cdef object prev_details
 
         # Read the 'key' information (dirname, name, file_id)
         dirname_cstr = self.get_next(&cur_size)
@@ -686,6 +690,7 @@ cdef class Reader:
         #       Especially since this code is pretty much fixed at a max of
         #       4GB.
         trees = []
+        prev_details = None
         for i from 0 <= i < num_trees:
             minikind = self.get_next_str()
             fingerprint = self.get_next_str()
@@ -694,6 +699,12 @@ cdef class Reader:
             executable_cstr = self.get_next(&cur_size)
             is_executable = (executable_cstr[0] == c'y')
             info = self.get_next_str()
+            if i > 0:
+                # An unchanged file has the same sha1 in every tree, and the
+                # parent rows only mention a few revision ids: share them.
+                if fingerprint == prev_details[1]:
+                    fingerprint = prev_details[1]
+                info = self.revision_ids.setdefault(info, info)
             # TODO: If we want to use StaticTuple_New here we need to be pretty
             #       careful. We are relying on a bit of Pyrex
             #       automatic-conversion from 'int' to PyInt, and that doesn't
@@ -707,13 +718,18 @@ cdef class Reader:
             # Py_INCREF(is_executable); StaticTuple_SET_ITEM(tmp, 3, is_executable)
             # Py_INCREF(info); StaticTuple_SET_ITEM(tmp, 4, info)
             # PyList_Append(trees, tmp)
-            PyList_Append(trees, StaticTuple(
+            details = StaticTuple(
                 minikind,     # minikind
                 fingerprint,  # fingerprint
                 entry_size,   # size
                 is_executable,# executable
                 info,         # packed_stat or revision_id
-            ))
+            )
+            if i > 1 and details == prev_details:
+                # Merges leave most rows the same in every parent tree.
+                details = prev_details
+            PyList_Append(trees, details)
+            prev_details = details
 
         # The returned tuple is (key, [trees])
         ret = (path_name_file_id_key, trees)
@@ -909,10 +925,20 @@ cdef _update_entry(self, entry, abspath, stat_value):
     link_or_sha1 = None
     worth_saving = 1
     if minikind == c'f':
-        executable = self._is_executable(stat_value.st_mode,
-                                         saved_executable)
         if self._cutoff_time is None:
             self._sha_cutoff_time()
+        if (saved_minikind == c'f'
+            and saved_packed_stat == self.UNVERIFIED_STAT_PREFIX + packed_stat
+            and stat_value.st_mtime < self._cutoff_time
+            and stat_value.st_ctime < self._cutoff_time):
+            # The sha1 was observed while the file was too new to trust, and
+            # the file has not changed since.
+            entry[1][0] = ('f', saved_link_or_sha1, saved_file_size,
+                           saved_executable, packed_stat)
+            self._mark_modified([entry])
+            return saved_link_or_sha1
+        executable = self._is_executable(stat_value.st_mode,
+                                         saved_executable)
         if (stat_value.st_mtime < self._cutoff_time
             and stat_value.st_ctime < self._cutoff_time
             and len(entry[1]) > 1
@@ -1060,6 +1086,8 @@ cdef class ProcessEntryC:
     # A set of the ids we've output when doing partial output.
     cdef object seen_ids
     cdef object sha_file
+    # The DirReader used to walk the tree; None for the platform default.
+    cdef public object dir_reader
 
     def __init__(self, include_unchanged, use_filesystem_for_exec,
         search_specific_files, state, source_index, target_index,
@@ -1121,6 +1149,7 @@ cdef class ProcessEntryC:
         self.pathjoin = osutils.pathjoin
         self.fstat = os.fstat
         self.sha_file = osutils.sha_file
+        self.dir_reader = None
         if target_index != 0:
             # A lot of code in here depends on target_index == 0
             raise errors.BzrError('unsupported target index')
@@ -1605,7 +1634,7 @@ cdef class ProcessEntryC:
                 self.current_dir_info = None
             else:
                 self.dir_iterator = osutils._walkdirs_utf8(self.root_abspath,
-                    prefix=self.current_root)
+                    prefix=self.current_root, dir_reader=self.dir_reader)
                 self.path_index = 0
                 try:
                     self.current_dir_info = self.dir_iterator.next()
@@ -0,0 +1,396 @@
+# Copyright (C) 2011 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+"""Pyrex implementation of the least-recently-used (LRU) caches.
+
+This mirrors bzrlib._lru_cache_py, keeping the same attributes so the same
+tests apply, but the linked list is kept in C level attributes of the nodes
+and the bookkeeping avoids Python attribute lookups and method calls.
+"""
+
+cdef extern from "python-compat.h":
+    pass
+
+cdef extern from "Python.h":
+    ctypedef int Py_ssize_t # Required for older pyrex versions
+    ctypedef struct PyObject:
+        pass
+    PyObject *PyDict_GetItem(object d, object k)
+    int PyDict_SetItem(object d, object k, object v) except -1
+    int PyDict_DelItem(object d, object k) except -1
+    Py_ssize_t PyDict_Size(object d) except -1
+
+from bzrlib import (
+    symbol_versioning,
+    trace,
+    )
+from bzrlib._lru_cache_py import _null_key as _py_null_key
+
+cdef object _null_key
+_null_key = _py_null_key
+
+
+cdef class _LRUNode:
+    """A node in the doubly linked list of an LRUCache."""
+
+    cdef readonly object key
+    cdef public object value
+    # The size of value, as counted by an LRUSizeCache
+    cdef readonly Py_ssize_t size
+    cdef _LRUNode _prev
+    cdef _LRUNode _next
+
+    def __init__(self, key, value, size=0):
+        self.key = key
+        self.value = value
+        self.size = size
+        self._prev = None
+        self._next = None
+
+    property prev:
+        def __get__(self):
+            return self._prev
+
+    property next_key:
+        def __get__(self):
+            if self._next is None:
+                return _null_key
+            return self._next.key
+
+    def __repr__(self):
+        if self._prev is None:
+            prev_key = None
+        else:
+            prev_key = self._prev.key
+        return '%s(%r n:%r p:%r)' % (self.__class__.__name__, self.key,
+                                     self.next_key, prev_key)
+
+
+cdef class LRUCache:
+    """A class which manages a cache of entries, removing unused ones."""
+
+    cdef readonly object _cache
+    # The "HEAD" of the lru linked list
+    cdef readonly _LRUNode _most_recently_used
+    # The "TAIL" of the lru linked list
+    cdef readonly _LRUNode _least_recently_used
+    cdef readonly Py_ssize_t _max_cache
+    cdef readonly Py_ssize_t _after_cleanup_count
+    cdef readonly long _hits
+    cdef readonly long _misses
+    cdef readonly long _evictions
+
+    def __init__(self, max_cache=100, after_cleanup_count=None):
+        self._cache = {}
+        self._most_recently_used = None
+        self._least_recently_used = None
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._update_max_cache(max_cache, after_cleanup_count)
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def __getitem__(self, key):
+        cdef PyObject *temp
+        cdef _LRUNode node
+
+        temp = PyDict_GetItem(self._cache, key)
+        if temp == NULL:
+            self._misses = self._misses + 1
+            raise KeyError(key)
+        self._hits = self._hits + 1
+        node = <_LRUNode>temp
+        self._record_access(node)
+        return node.value
+
+    def __len__(self):
+        return PyDict_Size(self._cache)
+
+    def add(self, key, value, cleanup=None):
+        symbol_versioning.warn(symbol_versioning.deprecated_in((2, 5, 0))
+            % 'bzrlib.lru_cache.LRUCache.add', DeprecationWarning,
+            stacklevel=2)
+        if cleanup is not None:
+            raise ValueError("Per-node cleanup functions no longer supported")
+        return self.__setitem__(key, value)
+
+    def __setitem__(self, key, value):
+        """Add a new value to the cache"""
+        cdef PyObject *temp
+        cdef _LRUNode node
+
+        if key is _null_key:
+            raise ValueError('cannot use _null_key as a key')
+        temp = PyDict_GetItem(self._cache, key)
+        if temp == NULL:
+            node = _LRUNode(key, value)
+            PyDict_SetItem(self._cache, key, node)
+        else:
+            node = <_LRUNode>temp
+            node.value = value
+        self._record_access(node)
+        if PyDict_Size(self._cache) > self._max_cache:
+            # Trigger the cleanup
+            self.cleanup()
+
+    def cache_size(self):
+        """Get the number of entries we will cache."""
+        return self._max_cache
+
+    def get(self, key, default=None):
+        cdef PyObject *temp
+        cdef _LRUNode node
+
+        temp = PyDict_GetItem(self._cache, key)
+        if temp == NULL:
+            self._misses = self._misses + 1
+            return default
+        self._hits = self._hits + 1
+        node = <_LRUNode>temp
+        self._record_access(node)
+        return node.value
+
+    def keys(self):
+        """Get the list of keys currently cached.
+
+        Note that values returned here may not be available by the time you
+        request them later. This is simply meant as a peak into the current
+        state.
+
+        :return: An unordered list of keys that are currently cached.
+        """
+        return self._cache.keys()
+
+    def as_dict(self):
+        """Get a new dict with the same key:value pairs as the cache"""
+        cdef _LRUNode node
+
+        result = {}
+        for key, node in self._cache.iteritems():
+            result[key] = node.value
+        return result
+
+    def items(self):
+        symbol_versioning.warn(symbol_versioning.deprecated_in((2, 5, 0))
+            % 'bzrlib.lru_cache.LRUCache.items', DeprecationWarning,
+            stacklevel=2)
+        return self.as_dict()
+
+    def cleanup(self):
+        """Clear the cache until it shrinks to the requested size.
+
+        This does not completely wipe the cache, just makes sure it is under
+        the after_cleanup_count.
+        """
+        cdef _LRUNode node
+
+        # Make sure the cache is shrunk to the correct size
+        while PyDict_Size(self._cache) > self._after_cleanup_count:
+            node = self._least_recently_used
+            self._remove(node)
+            self._evictions = self._evictions + 1
+
+    def stats(self):
+        """Get statistics about how well the cache is doing.
+
+        :return: A dict with the number of lookups that found their key
+            ('hits') or did not ('misses'), the number of entries removed to
+            make room for others ('evictions') and the number of entries
+            currently cached ('entries').
+        """
+        return {'hits': self._hits, 'misses': self._misses,
+                'evictions': self._evictions,
+                'entries': PyDict_Size(self._cache)}
+
+    cdef _record_access(self, _LRUNode node):
+        """Move node to the front of the queue."""
+        if self._most_recently_used is None:
+            self._most_recently_used = node
+            self._least_recently_used = node
+            return
+        elif node is self._most_recently_used:
+            # Nothing to do, this node is already at the head of the queue
+            return
+        # REMOVE, new nodes are not linked yet
+        if node is self._least_recently_used:
+            self._least_recently_used = node._prev
+        if node._prev is not None:
+            node._prev._next = node._next
+        if node._next is not None:
+            node._next._prev = node._prev
+        # INSERT
+        node._next = self._most_recently_used
+        self._most_recently_used._prev = node
+        self._most_recently_used = node
+        node._prev = None
+
+    cdef _remove(self, _LRUNode node):
+        if node is self._least_recently_used:
+            self._least_recently_used = node._prev
+        if node is self._most_recently_used:
+            self._most_recently_used = node._next
+        PyDict_DelItem(self._cache, node.key)
+        if node._prev is not None:
+            node._prev._next = node._next
+        if node._next is not None:
+            node._next._prev = node._prev
+        # And remove this node's pointers
+        node._prev = None
+        node._next = None
+
+    def _remove_node(self, _LRUNode node):
+        self._remove(node)
+
+    def _remove_lru(self):
+        """Remove one entry from the lru, and handle consequences."""
+        cdef _LRUNode node
+
+        node = self._least_recently_used
+        self._remove(node)
+
+    def clear(self):
+        """Clear out all of the cache."""
+        cdef _LRUNode node
+
+        # Clean up in LRU order
+        while self._least_recently_used is not None:
+            node = self._least_recently_used
+            self._remove(node)
+
+    def resize(self, max_cache, after_cleanup_count=None):
+        """Change the number of entries that will be cached."""
+        self._update_max_cache(max_cache, after_cleanup_count)
+
+    cdef _update_max_cache(self, max_cache, after_cleanup_count):
+        self._max_cache = max_cache
+        if after_cleanup_count is None:
+            self._after_cleanup_count = self._max_cache * 8 / 10
+        else:
+            self._after_cleanup_count = min(after_cleanup_count,
+                                            self._max_cache)
+        self.cleanup()
+
+
+cdef class LRUSizeCache(LRUCache):
+    """An LRUCache that removes things based on the size of the values.
+
+    This differs in that it doesn't care how many actual items there are,
+    it just restricts the cache to be cleaned up after so much data is stored.
+
+    The size of items added will be computed using compute_size(value), which
+    defaults to len() if not supplied.
+    """
+
+    cdef readonly Py_ssize_t _value_size
+    cdef readonly Py_ssize_t _max_size
+    cdef readonly Py_ssize_t _after_cleanup_size
+    cdef readonly object _compute_size
+
+    def __init__(self, max_size=1024*1024, after_cleanup_size=None,
+                 compute_size=None):
+        """Create a new LRUSizeCache.
+
+        See bzrlib._lru_cache_py.LRUSizeCache for the parameters.
+        """
+        self._value_size = 0
+        if compute_size is None:
+            compute_size = len
+        self._compute_size = compute_size
+        self._update_max_size(max_size, after_cleanup_size)
+        LRUCache.__init__(self, max_cache=max(int(max_size/512), 1))
+
+    def __setitem__(self, key, value):
+        """Add a new value to the cache"""
+        cdef PyObject *temp
+        cdef _LRUNode node
+        cdef Py_ssize_t value_len
+
+        if key is _null_key:
+            raise ValueError('cannot use _null_key as a key')
+        temp = PyDict_GetItem(self._cache, key)
+        value_len = self._compute_size(value)
+        if value_len >= self._after_cleanup_size:
+            # The new value is 'too big to fit', as it would fill up/overflow
+            # the cache all by itself
+            trace.mutter('Adding the key %r to an LRUSizeCache failed.'
+                         ' value %d is too big to fit in a the cache'
+                         ' with size %d %d', key, value_len,
+                         self._after_cleanup_size, self._max_size)
+            if temp != NULL:
+                # We won't be replacing the old node, so just remove it
+                node = <_LRUNode>temp
+                self._remove(node)
+            return
+        if temp == NULL:
+            node = _LRUNode(key, value, value_len)
+            PyDict_SetItem(self._cache, key, node)
+        else:
+            node = <_LRUNode>temp
+            self._value_size = self._value_size - node.size
+            node.value = value
+            node.size = value_len
+        self._value_size = self._value_size + value_len
+        self._record_access(node)
+
+        if self._value_size > self._max_size:
+            # Time to cleanup
+            self.cleanup()
+
+    def cleanup(self):
+        """Clear the cache until it shrinks to the requested size.
+
+        This does not completely wipe the cache, just makes sure it is under
+        the after_cleanup_size.
+        """
+        cdef _LRUNode node
+
+        # Make sure the cache is shrunk to the correct size
+        while self._value_size > self._after_cleanup_size:
+            node = self._least_recently_used
+            self._remove(node)
+            self._evictions = self._evictions + 1
+
+    def stats(self):
+        """Get statistics about how well the cache is doing.
+
+        :return: The dict from LRUCache.stats(), with the total size of the
+            cached values ('bytes') and the size the cache may grow to
+            ('max_bytes').
+        """
+        stats = LRUCache.stats(self)
+        stats['bytes'] = self._value_size
+        stats['max_bytes'] = self._max_size
+        return stats
+
+    cdef _remove(self, _LRUNode node):
+        self._value_size = self._value_size - node.size
+        LRUCache._remove(self, node)
+
+    def resize(self, max_size, after_cleanup_size=None):
+        """Change the number of bytes that will be cached."""
+        self._update_max_size(max_size, after_cleanup_size)
+        max_cache = max(int(max_size/512), 1)
+        self._update_max_cache(max_cache, None)
+
+    cdef _update_max_size(self, max_size, after_cleanup_size):
+        self._max_size = max_size
+        if after_cleanup_size is None:
+            self._after_cleanup_size = self._max_size * 8 / 10
+        else:
+            self._after_cleanup_size = min(after_cleanup_size, self._max_size)
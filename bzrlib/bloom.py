@@ -0,0 +1,159 @@
+# Copyright (C) 2011 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Bloom filters over index keys.
+
+A bloom filter answers 'is this key possibly present?' without false
+negatives, which lets callers skip reading an index that definitely does not
+hold a key. Filters are stored next to pack indices as small sidecar files;
+readers that do not know about them simply never look at them.
+"""
+
+from __future__ import absolute_import
+
+import math
+import struct
+
+from bzrlib import (
+    errors,
+    osutils,
+    trace,
+    )
+
+
+_SIGNATURE = "Bazaar Bloom Filter 1\n"
+
+# Double hashing only gives num_bits * num_bits / 2 distinct bit patterns, so
+# filters for a handful of keys are padded to keep near their intended rate.
+_MIN_BITS = 512
+
+
+def _key_to_hashes(key, num_bits, num_hashes):
+    """Return the bit positions for key.
+
+    Uses double hashing from a single sha1 of the serialised key, so adding
+    or probing a key costs one digest regardless of num_hashes.
+    """
+    digest = osutils.sha_string('\x00'.join(key))
+    h1 = int(digest[:16], 16)
+    h2 = int(digest[16:32], 16) | 1
+    return [(h1 + i * h2) % num_bits for i in xrange(num_hashes)]
+
+
+class BloomFilter(object):
+    """A fixed size bloom filter over tuple keys."""
+
+    def __init__(self, num_bits, num_hashes, bits=None):
+        """Create a BloomFilter.
+
+        :param num_bits: The number of bits in the filter.
+        :param num_hashes: The number of bits set for each key.
+        :param bits: Optional bytes holding the filter contents, as returned
+            by to_bytes().
+        """
+        if num_bits < 8:
+            num_bits = 8
+        num_bytes = (num_bits + 7) // 8
+        self.num_bits = num_bytes * 8
+        self.num_hashes = max(1, num_hashes)
+        if bits is None:
+            self._bits = bytearray(num_bytes)
+        else:
+            if len(bits) != num_bytes:
+                raise errors.BzrError('Bloom filter has %d bytes, expected %d'
+                                      % (len(bits), num_bytes))
+            self._bits = bytearray(bits)
+
+    @classmethod
+    def for_capacity(klass, key_count, false_positive_rate):
+        """Create an empty filter sized for key_count keys.
+
+        :param key_count: The number of keys that will be added.
+        :param false_positive_rate: The desired chance (0 < rate < 1) of
+            reporting an absent key as present.
+        """
+        key_count = max(1, key_count)
+        ln2 = math.log(2)
+        num_bits = int(math.ceil(
+            -key_count * math.log(false_positive_rate) / (ln2 * ln2)))
+        num_hashes = int(round(float(num_bits) / key_count * ln2))
+        return klass(max(num_bits, _MIN_BITS), num_hashes)
+
+    def add(self, key):
+        bits = self._bits
+        for pos in _key_to_hashes(key, self.num_bits, self.num_hashes):
+            bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        bits = self._bits
+        for pos in _key_to_hashes(key, self.num_bits, self.num_hashes):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def to_bytes(self):
+        """Serialise the filter, including a header describing its shape."""
+        return '%sbits=%d\nhashes=%d\n%s' % (_SIGNATURE, self.num_bits,
+            self.num_hashes, str(self._bits))
+
+    @classmethod
+    def from_bytes(klass, bytes):
+        """Create a filter from the output of to_bytes().
+
+        :raises BzrError: If bytes is not a serialised bloom filter.
+        """
+        if not bytes.startswith(_SIGNATURE):
+            raise errors.BzrError('Not a bloom filter')
+        try:
+            bits_line, hashes_line, content = bytes[len(_SIGNATURE):].split(
+                '\n', 2)
+            num_bits = int(bits_line[len('bits='):])
+            num_hashes = int(hashes_line[len('hashes='):])
+        except ValueError:
+            raise errors.BzrError('Bloom filter header is corrupt')
+        return klass(num_bits, num_hashes, content)
+
+
+class LazyBloomFilter(object):
+    """A bloom filter read from a sidecar file on first use.
+
+    If the sidecar is missing or unreadable every key is reported as possibly
+    present, so callers fall back to consulting the index itself.
+    """
+
+    def __init__(self, transport, name):
+        self._transport = transport
+        self._name = name
+        self._filter = None
+        self._loaded = False
+
+    def _load(self):
+        self._loaded = True
+        try:
+            self._filter = BloomFilter.from_bytes(
+                self._transport.get_bytes(self._name))
+        except errors.NoSuchFile:
+            pass
+        except (errors.BzrError, errors.TransportError), e:
+            trace.mutter('ignoring unusable bloom filter %s: %s',
+                         self._name, e)
+
+    def __contains__(self, key):
+        if not self._loaded:
+            self._load()
+        if self._filter is None:
+            return True
+        return key in self._filter
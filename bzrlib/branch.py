@@ -998,6 +998,14 @@ class Branch(controldir.ControlComponent):
         self._partial_revision_id_to_revno_cache = {}
         self._tags_bytes = None
 
+    def _prefetch_tip_and_tags(self):
+        """Start reading the last revision info and the tags.
+
+        This is called while the branch is locked, when both are about to be
+        read.  Branches read over a network can overlap the two reads; by
+        default this does nothing.
+        """
+
     def _gen_revision_history(self):
         """Return sequence of revision hashes on to this branch.
 
@@ -3426,6 +3434,7 @@ class GenericInterBranch(InterBranch):
             result.target_branch = _override_hook_target
         self.source.lock_read()
         try:
+            self.source._prefetch_tip_and_tags()
             # We assume that during 'pull' the target repository is closer than
             # the source one.
             self.source.update_references(self.target)
@@ -19,17 +19,23 @@
 
 from __future__ import absolute_import
 
+import collections
 import cStringIO
+import sys
+import threading
+import weakref
 
 from bzrlib.lazy_import import lazy_import
 lazy_import(globals(), """
 import bisect
 import math
+import mmap
 import tempfile
 import zlib
 """)
 
 from bzrlib import (
+    bloom,
     chunk_writer,
     debug,
     errors,
@@ -56,6 +62,46 @@ _PAGE_SIZE = 4096
 # 4K per page: 4MB - 1000 entries
 _NODE_CACHE_SIZE = 1000
 
+# Should indices on local disk be read through mmap? Windows won't let mapped
+# files be removed, which we do to indices of obsolete packs.
+_USE_MMAP = (sys.platform != 'win32')
+
+# Each map holds a file descriptor open, so only this many indices are
+# mapped at once; the ones used longest ago are unmapped first. A pack has
+# up to 5 indices.
+_MAX_MAPPED_INDICES = 500
+# id(index):weak reference to it for the mapped indices, least recently used
+# first.
+_mapped_indices = collections.OrderedDict()
+_mapped_indices_lock = threading.Lock()
+
+
+def _use_mapped_index(index):
+    """Record that the map of index is used, unmapping others to stay in
+    budget.
+    """
+    key = id(index)
+    _mapped_indices_lock.acquire()
+    try:
+        ref = _mapped_indices.pop(key, None)
+        if ref is None or ref() is not index:
+            ref = weakref.ref(index)
+        _mapped_indices[key] = ref
+        if len(_mapped_indices) <= _MAX_MAPPED_INDICES:
+            return
+        # Indices that are gone or were unmapped by clear_cache hold no file
+        # descriptor, so don't count them.
+        for old_key, old_ref in _mapped_indices.items():
+            old_index = old_ref()
+            if old_index is None or not old_index._mmap:
+                del _mapped_indices[old_key]
+        while len(_mapped_indices) > _MAX_MAPPED_INDICES:
+            old_index = _mapped_indices.popitem(last=False)[1]()
+            if old_index is not None:
+                old_index._release_mmap()
+    finally:
+        _mapped_indices_lock.release()
+
 
 class _BuilderRow(object):
     """The stored state accumulated while writing out a row in the index.
@@ -448,6 +494,19 @@ class BTreeBuilder(index.GraphIndexBuilder):
         """
         return self._write_nodes(self.iter_all_entries())[0]
 
+    def bloom_filter(self, false_positive_rate):
+        """Build a bloom filter over all the keys added to the index.
+
+        :param false_positive_rate: The desired chance of the filter claiming
+            a key is present when it is not.
+        :return: A bloom.BloomFilter.
+        """
+        result = bloom.BloomFilter.for_capacity(self.key_count(),
+                                                false_positive_rate)
+        for node in self.iter_all_entries():
+            result.add(node[1])
+        return result
+
     def iter_all_entries(self):
         """Iterate over all keys within the index
 
@@ -695,6 +754,11 @@ class BTreeGraphIndex(object):
         self._name = name
         self._size = size
         self._file = None
+        # None until we have tried to map the file, False if it can't be.
+        self._mmap = None
+        # Set by the pack layer to a bloom filter over the keys when one is
+        # available; CombinedGraphIndex uses it to skip this index.
+        self._bloom_filter = None
         self._recommended_pages = self._compute_recommended_pages()
         self._root_node = None
         self._base_offset = offset
@@ -797,6 +861,12 @@ class BTreeGraphIndex(object):
         if 'index' in debug.debug_flags:
             trace.mutter('expanding: %s\toffsets: %s', self._name, offsets)
 
+        if self._get_mmap() is not None:
+            # Reading from the map costs no round trips, so only read the
+            # pages we were asked for.
+            if 'index' in debug.debug_flags:
+                trace.mutter('  not expanding mapped index')
+            return offsets
         if len(offsets) >= self._recommended_pages:
             # Don't add more, we are already requesting more than enough
             if 'index' in debug.debug_flags:
@@ -906,6 +976,7 @@ class BTreeGraphIndex(object):
         # round-trips in the future. We may re-evaluate this if InternalNode
         # memory starts to be an issue.
         self._leaf_node_cache.clear()
+        self._release_mmap()
 
     def external_references(self, ref_list_num):
         if self._root_node is None:
@@ -1509,6 +1580,50 @@ class BTreeGraphIndex(object):
         header_end = (len(signature) + sum(map(len, lines[0:4])) + 4)
         return header_end, bytes[header_end:]
 
+    def _get_mmap(self):
+        """Get a read-only mmap of the index, if it is on a local disk.
+
+        Pages are then decompressed straight out of the map, rather than out
+        of the copies made by transport.readv, and the OS only pages in the
+        parts of the file we actually use.
+
+        :return: The mmap, or None if the index can't be mapped.
+        """
+        if self._mmap is None:
+            self._mmap = False
+            if not _USE_MMAP or self._file is not None:
+                return None
+            try:
+                path = self._transport.local_abspath(self._name)
+            except errors.NotLocalUrl:
+                return None
+            try:
+                f = open(path, 'rb')
+                try:
+                    self._mmap = mmap.mmap(f.fileno(), 0,
+                                           access=mmap.ACCESS_READ)
+                finally:
+                    f.close()
+            except (EnvironmentError, ValueError), e:
+                # Empty files can't be mapped, and missing ones will be
+                # reported by the transport.
+                trace.mutter('not mapping index %s: %s', path, e)
+        mapped = self._mmap
+        if not mapped:
+            return None
+        _use_mapped_index(self)
+        return mapped
+
+    def _release_mmap(self):
+        """Drop the map of the index, closing its file descriptor.
+
+        The map is not closed explicitly, as a read from another thread may
+        still be using it: the buffers onto it keep it alive until then.
+        The index is mapped again when it is next read.
+        """
+        if self._mmap:
+            self._mmap = None
+
     def _read_nodes(self, nodes):
         """Read some nodes from disk into the LRU cache.
 
@@ -1526,6 +1641,9 @@ class BTreeGraphIndex(object):
         # be read in to data_ranges, either from 'bytes' or from the transport
         ranges = []
         base_offset = self._base_offset
+        mapped = self._get_mmap()
+        if mapped is not None and self._size is None:
+            self._size = len(mapped) - base_offset
         for index in nodes:
             offset = (index * _PAGE_SIZE)
             size = _PAGE_SIZE
@@ -1556,6 +1674,9 @@ class BTreeGraphIndex(object):
             # already have the whole file
             data_ranges = [(start, bytes[start:start+size])
                            for start, size in ranges]
+        elif mapped is not None:
+            data_ranges = [(start, buffer(mapped, start, size))
+                           for start, size in ranges]
         elif self._file is None:
             data_ranges = self._transport.readv(self._name, ranges)
         else:
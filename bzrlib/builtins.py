@@ -5103,6 +5103,112 @@ class cmd_pack(Command):
         repository.pack(clean_obsolete_packs=clean_obsolete_packs)
 
 
+class cmd_gc(Command):
+    __doc__ = """Remove unreferenced data from a repository.
+
+    Revisions removed with 'bzr uncommit' and never pushed anywhere, and data
+    left behind by interrupted commits or fetches, stay in the repository
+    until they are garbage collected. This command finds everything
+    reachable from the tips and tags of all branches using the repository
+    (and the parents of their working trees), then rewrites the pack files
+    where more than --dead-ratio of the data is no longer referenced.
+
+    Warning: Branches elsewhere that are stacked on this repository are not
+    seen. Revisions only they refer to are removed, which will break them.
+
+    The rewritten pack files are kept as a backup until the next pack, unless
+    --clean-obsolete-packs is given.
+    """
+
+    _see_also = ['pack', 'uncommit']
+    takes_args = ['branch_or_repo?']
+    takes_options = [
+        Option('dead-ratio', type=float,
+               help='Rewrite packs where more than this fraction of the data'
+                    ' is unreferenced (default 0.1).'),
+        Option('dry-run',
+               help='Report what would be removed without changing'
+                    ' anything.'),
+        Option('clean-obsolete-packs',
+               help='Delete obsolete packs to save disk space.'),
+        ]
+
+    def run(self, branch_or_repo='.', dead_ratio=0.1, dry_run=False,
+            clean_obsolete_packs=False):
+        dir = controldir.ControlDir.open_containing(branch_or_repo)[0]
+        try:
+            branch = dir.open_branch()
+            repository = branch.repository
+        except errors.NotBranchError:
+            repository = dir.open_repository()
+        self.add_cleanup(repository.lock_write().unlock)
+        tips = set()
+        for branch in repository.find_branches(using=True):
+            tips.add(branch.last_revision())
+            if branch.supports_tags():
+                tips.update(branch.tags.get_tag_dict().itervalues())
+            try:
+                tree = branch.bzrdir.open_workingtree()
+            except (errors.NoWorkingTree, errors.NotLocalUrl):
+                continue
+            tips.update(tree.get_parent_ids())
+        result = repository.collect_garbage(tips, dead_ratio=dead_ratio,
+            dry_run=dry_run, clean_obsolete_packs=clean_obsolete_packs)
+        self.outf.write(gettext(
+            '%d revisions, %d inventories, %d chk pages and %d texts are'
+            ' unreferenced.\n') % (result.get('revision', 0),
+            result.get('inventory', 0), result.get('chk', 0),
+            result.get('text', 0)))
+        if dry_run:
+            message = gettext('Would rewrite %d packs, removing about %d of'
+                              ' %d bytes.\n')
+        else:
+            message = gettext('Rewrote %d packs, removing about %d of'
+                              ' %d bytes.\n')
+        self.outf.write(message % (len(result['packs']),
+            result['dead_bytes'], result['total_bytes']))
+
+
+class cmd_watch_tree(Command):
+    __doc__ = """Watch a working tree so that status need not stat every file.
+
+    Until interrupted, this records the paths that change in the working
+    tree in .bzr/checkout/change-journal using Linux inotify. While it runs,
+    whole tree operations such as status, diff and commit only look at the
+    files changed since the previous one instead of every versioned file.
+
+    Changes the kernel does not report through inotify, such as writes
+    through a hard link from outside the tree or to a network filesystem
+    by another machine, are missed while the watcher runs.
+    """
+
+    _see_also = ['status']
+    takes_args = ['dir?']
+
+    def run(self, dir=u'.'):
+        from bzrlib import change_journal
+        from bzrlib.workingtree_4 import DirStateWorkingTree
+        tree = WorkingTree.open_containing(dir)[0]
+        if not isinstance(tree, DirStateWorkingTree):
+            raise errors.BzrCommandError(gettext(
+                'Only dirstate working trees can be watched.'))
+        watcher = change_journal.InotifyWatcher(tree.basedir,
+            tree._transport.local_abspath('.'))
+        watcher.start()
+        try:
+            import signal
+            signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop())
+            self.outf.write(gettext('Watching %s for changes.\n')
+                            % (tree.basedir,))
+            self.outf.flush()
+            try:
+                watcher.run()
+            except KeyboardInterrupt:
+                pass
+        finally:
+            watcher.close()
+
+
 class cmd_plugins(Command):
     __doc__ = """List the installed plugins.
 
@@ -5543,10 +5649,15 @@ class cmd_serve(Command):
                 ),
         Option('client-timeout', type=float,
                help='Override the default idle client timeout (5min).'),
+        Option('workers', type=int,
+               help='Serve from this many processes sharing the listening '
+                    'socket.  SIGUSR1 restarts them gracefully and SIGUSR2 '
+                    'logs their statistics.'),
         ]
 
     def run(self, listen=None, port=None, inet=False, directory=None,
-            allow_writes=False, protocol=None, client_timeout=None):
+            allow_writes=False, protocol=None, client_timeout=None,
+            workers=None):
         from bzrlib import transport
         if directory is None:
             directory = os.getcwd()
@@ -5556,7 +5667,10 @@ class cmd_serve(Command):
         if not allow_writes:
             url = 'readonly+' + url
         t = transport.get_transport_from_url(url)
-        protocol(t, listen, port, inet, client_timeout)
+        if workers:
+            protocol(t, listen, port, inet, client_timeout, workers=workers)
+        else:
+            protocol(t, listen, port, inet, client_timeout)
 
 
 class cmd_join(Command):
@@ -2270,6 +2270,19 @@ register_metadir(controldir.format_registry, 'development5-subtree',
     alias=False,
     )
 
+register_metadir(controldir.format_registry, 'development-chunked',
+    'bzrlib.repofmt.groupcompress_repo.RepositoryFormat2aChunked',
+    help='Development format, 2a variant storing large files as '
+        'content-defined chunks, each stored once. Repositories in this '
+        'format can only be read by bzr.dev. Please read '
+        'http://doc.bazaar.canonical.com/latest/developers/development-repo.html '
+        'before use.',
+    branch_format='bzrlib.branch.BzrBranchFormat7',
+    tree_format='bzrlib.workingtree_4.WorkingTreeFormat6',
+    experimental=True,
+    hidden=True,
+    )
+
 register_metadir(controldir.format_registry, 'development-colo',
     'bzrlib.repofmt.groupcompress_repo.RepositoryFormat2a',
     help='The 2a format with experimental support for colocated branches.\n',
@@ -0,0 +1,615 @@
+# Copyright (C) 2016 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""A journal of the paths changed in a working tree.
+
+A long running watcher (see InotifyWatcher and ``bzr watch-tree``) appends
+the relative path of everything that changes in a working tree to
+``.bzr/checkout/change-journal``.  Whole tree iter_changes calls can then
+re-use the stat values saved in the dirstate for every path that has not
+been journaled since the dirstate was last brought up to date, rather than
+lstat()ing the whole tree.
+
+The journal starts with a header naming the watcher's pid and a random
+session token, followed by one record per line:
+
+  ``D <path>``   the path (and possibly its contents) changed.
+  ``O``          changes may have been missed; nothing before this line can
+                 be trusted.
+  ``C <cookie>`` the watcher saw the cookie file ``<cookie>`` being created
+                 in the control directory.
+
+Readers synchronise with the watcher by creating a cookie file and waiting
+for its ``C`` record: once it is present every change made before the
+cookie was created is in the journal.
+
+After a complete walk whose results are saved in the dirstate, the tree
+records the session and journal offset of that walk, together with a
+fingerprint of the saved dirstate, in ``.bzr/checkout/change-journal-base``.
+A later walk only trusts the journal when the base still matches both the
+running watcher's session and the dirstate it has in memory.
+
+When has_changes() finds a tree unchanged, the same kind of record is kept in
+``.bzr/checkout/change-journal-clean``. While the saved dirstate still
+matches it and the watcher has journaled nothing since, the tree is known to
+still match its basis.
+"""
+
+from __future__ import absolute_import
+
+import binascii
+import errno
+import os
+import stat
+import struct
+import time
+
+from bzrlib import (
+    errors,
+    osutils,
+    trace,
+    )
+
+
+JOURNAL_NAME = 'change-journal'
+BASE_NAME = 'change-journal-base'
+CLEAN_NAME = 'change-journal-clean'
+COOKIE_PREFIX = 'change-journal-cookie-'
+
+_SIGNATURE = 'Bazaar change journal 1\n'
+
+
+def _pid_is_alive(pid):
+    """Is there a process with the given pid?"""
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        if e.errno == errno.ESRCH:
+            return False
+        if e.errno == errno.EPERM:
+            # Exists, but belongs to someone else.
+            return True
+        raise
+    return True
+
+
+def _read_header(f):
+    """Read the journal header from f.
+
+    :return: (pid, session) or None if the header is incomplete or invalid.
+    """
+    if f.readline() != _SIGNATURE:
+        return None
+    pid_line = f.readline()
+    session_line = f.readline()
+    if (not pid_line.startswith('pid ') or not pid_line.endswith('\n')
+        or not session_line.startswith('session ')
+        or not session_line.endswith('\n')):
+        return None
+    try:
+        pid = int(pid_line[4:-1])
+    except ValueError:
+        return None
+    return pid, session_line[8:-1]
+
+
+def parse_records(data):
+    """Return the set of paths marked dirty by the records in data.
+
+    :return: A set of utf8 paths, or None if the records include an
+        overflow, in which case any path may have changed.
+    """
+    dirty = set()
+    for line in data.split('\n'):
+        if line.startswith('D '):
+            dirty.add(line[2:])
+        elif line == 'O':
+            return None
+    return dirty
+
+
+def read_changes(control_dir, base=None, timeout=2.0):
+    """Synchronise with the tree's watcher and read the changes it recorded.
+
+    :param control_dir: The local path of the tree's control directory.
+    :param base: None, or the (session, offset) the caller's cached data is
+        known to be valid at.
+    :param timeout: How long to wait for the watcher, in seconds.
+    :return: None if no watcher is running for this tree, otherwise a tuple
+        (session, offset, dirty).  Every change made before this call
+        returned is recorded before offset.  dirty is the set of paths
+        changed between base and offset, or None if the base does not apply
+        to this journal or changes may have been missed since it.
+    """
+    journal_path = osutils.pathjoin(control_dir, JOURNAL_NAME)
+    try:
+        f = open(journal_path, 'rb')
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    try:
+        header = _read_header(f)
+        if header is None:
+            return None
+        pid, session = header
+        if not _pid_is_alive(pid):
+            return None
+        records_start = f.tell()
+        f.seek(0, 2)
+        end = f.tell()
+        if (base is not None and base[0] == session
+            and records_start <= base[1] <= end):
+            start = base[1]
+        else:
+            start = None
+            # Only the cookie needs to be found.
+            records_start = end
+        cookie = COOKIE_PREFIX + osutils.rand_chars(16)
+        cookie_path = osutils.pathjoin(control_dir, cookie)
+        open(cookie_path, 'wb').close()
+        try:
+            data = _wait_for_cookie(f, records_start, cookie, timeout)
+        finally:
+            osutils.delete_any(cookie_path)
+        if data is None:
+            trace.mutter('timed out waiting for the change journal watcher'
+                         ' (pid %d)', pid)
+            return None
+    finally:
+        f.close()
+    offset = records_start + len(data)
+    if start is None:
+        dirty = None
+    else:
+        dirty = parse_records(data)
+    return session, offset, dirty
+
+
+def _wait_for_cookie(f, start, cookie, timeout):
+    """Read the journal from start until cookie is acknowledged.
+
+    :return: The records from start up to and including the cookie's, or None
+        if the watcher did not acknowledge it in time.
+    """
+    marker = '\nC %s\n' % (cookie,)
+    deadline = time.time() + timeout
+    delay = 0.0005
+    while True:
+        f.seek(start)
+        # start is always at the beginning of a line.
+        data = '\n' + f.read()
+        pos = data.find(marker)
+        if pos != -1:
+            return data[1:pos + len(marker)]
+        now = time.time()
+        if now >= deadline:
+            return None
+        time.sleep(min(delay, deadline - now))
+        delay = min(delay * 2, 0.05)
+
+
+def format_base(session, offset, fingerprint):
+    """Serialise a change journal base record."""
+    return '%s %d %s\n' % (session, offset, fingerprint)
+
+
+def parse_base(bytes):
+    """Parse the output of format_base.
+
+    :return: (session, offset, fingerprint), or None if bytes is not a valid
+        base record.
+    """
+    parts = bytes.rstrip('\n').split(' ', 2)
+    if len(parts) != 3:
+        return None
+    try:
+        offset = int(parts[1])
+    except ValueError:
+        return None
+    return parts[0], offset, parts[2]
+
+
+def state_fingerprint(crc, num_entries, journal_size=0):
+    """Return the fingerprint of a dirstate with the given header values.
+
+    :param journal_size: The amount of hash journal data applied on top of
+        the dirstate file.
+    """
+    return '%d/%d/%d' % (crc, num_entries, journal_size)
+
+
+def read_state_fingerprint(path):
+    """Return the fingerprint of the dirstate file saved at path."""
+    f = open(path, 'rb')
+    try:
+        f.readline()
+        crc_line = f.readline()
+        num_entries_line = f.readline()
+    finally:
+        f.close()
+    if (not crc_line.startswith('crc32: ')
+        or not num_entries_line.startswith('num_entries: ')):
+        return None
+    try:
+        journal_size = os.path.getsize(path + '.journal')
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        journal_size = 0
+    return state_fingerprint(int(crc_line[7:-1]), int(num_entries_line[13:-1]),
+                             journal_size)
+
+
+class _CachedStat(object):
+    """A stat value rebuilt from the packed stat saved in the dirstate.
+
+    Packing it again gives back the saved packed stat, so the dirstate's
+    cached sha1 is reused for it.
+    """
+
+    __slots__ = ['st_size', 'st_mtime', 'st_ctime', 'st_dev', 'st_ino',
+                 'st_mode']
+
+    def __init__(self, packed_stat, _unpack=struct.Struct('>6L').unpack,
+                 _a2b=binascii.a2b_base64):
+        (self.st_size, self.st_mtime, self.st_ctime, self.st_dev,
+         self.st_ino, self.st_mode) = _unpack(_a2b(packed_stat))
+
+
+class JournalDirReader(osutils.DirReader):
+    """A DirReader which only lstats the paths a change journal lists.
+
+    Directories are still listed, but a versioned path which is not in dirty
+    gets the stat value saved for it in the dirstate.
+    """
+
+    def __init__(self, state, dirty, base_reader=None):
+        """Create a JournalDirReader.
+
+        :param state: The DirState, with its dirblocks read, whose saved stat
+            values are up to date for every path not in dirty.
+        :param dirty: A set of the utf8 paths which may have changed.
+        :param base_reader: The DirReader to take the starting directory
+            encoding from.
+        """
+        self._state = state
+        self._dirty = dirty
+        if base_reader is None:
+            base_reader = osutils._get_selected_dir_reader()
+        self._base_reader = base_reader
+
+    def top_prefix_to_starting_dir(self, top, prefix=""):
+        """See DirReader.top_prefix_to_starting_dir."""
+        return self._base_reader.top_prefix_to_starting_dir(top, prefix)
+
+    def _cached_stats(self, dirname):
+        """Return a dict of the reusable packed stats for dirname's children.
+        """
+        state = self._state
+        if dirname == '':
+            # Block 0 only holds the root; its children are in block 1.
+            block_index = 1
+        else:
+            block_index, present = state._find_block_index_from_key(
+                (dirname, '', ''))
+            if not present:
+                return {}
+        cached = {}
+        nullstat = state.NULLSTAT
+        unverified = state.UNVERIFIED_STAT_PREFIX
+        for entry in state._dirblocks[block_index][1]:
+            minikind, fingerprint, size, executable, packed_stat = entry[1][0]
+            if (minikind in 'fdl' and packed_stat != nullstat
+                and size < 0x100000000):
+                if packed_stat.startswith(unverified):
+                    packed_stat = packed_stat[len(unverified):]
+                cached[entry[0][1]] = packed_stat
+        return cached
+
+    def read_dir(self, prefix, top):
+        """See DirReader.read_dir."""
+        if prefix:
+            relprefix = prefix + '/'
+        else:
+            relprefix = ''
+        cached = self._cached_stats(prefix)
+        dirty = self._dirty
+        _lstat = os.lstat
+        _kind_from_mode = osutils.file_kind_from_stat_mode
+        if isinstance(top, unicode):
+            top_slash = top + u'/'
+        else:
+            top_slash = top + '/'
+        dirblock = []
+        append = dirblock.append
+        for name in os.listdir(top):
+            if isinstance(name, unicode):
+                name_utf8 = name.encode('utf8')
+            else:
+                try:
+                    name_utf8 = osutils.safe_utf8(name)
+                except errors.BzrBadParameterNotUnicode:
+                    raise errors.BadFilenameEncoding(relprefix + name,
+                                                     osutils._fs_enc)
+            relpath = relprefix + name_utf8
+            abspath = top_slash + name
+            packed_stat = cached.get(name_utf8)
+            if packed_stat is not None and relpath not in dirty:
+                statvalue = _CachedStat(packed_stat)
+            else:
+                statvalue = _lstat(abspath)
+            kind = _kind_from_mode(statvalue.st_mode)
+            append((relpath, name_utf8, kind, statvalue, abspath))
+        return dirblock
+
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+_TREE_EVENTS = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+                | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+                | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+_CONTROL_EVENTS = IN_CREATE | IN_ONLYDIR | IN_DONT_FOLLOW
+
+_inotify_event = struct.Struct('iIII')
+
+
+def _load_inotify():
+    """Return the C library, if it provides inotify.
+
+    :raises errors.ChangeJournalUnavailable: if inotify is not available.
+    """
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init
+        libc.inotify_add_watch
+    except (ImportError, OSError, AttributeError), e:
+        raise errors.ChangeJournalUnavailable(str(e))
+    return libc
+
+
+class InotifyWatcher(object):
+    """Journal the changes made to a working tree using Linux inotify.
+
+    Call start() to publish the journal, then run() until stop() is called
+    from another thread or the process is interrupted, then close().
+    """
+
+    def __init__(self, basedir, control_dir, max_journal_size=16 << 20):
+        """Create an InotifyWatcher.
+
+        :param basedir: The local path of the working tree.
+        :param control_dir: The local path of the tree's control directory.
+        :param max_journal_size: Start a new journal session once the
+            journal grows past this many bytes.
+        """
+        self._libc = _load_inotify()
+        self.basedir = osutils.safe_unicode(basedir).encode(osutils._fs_enc)
+        self.control_dir = osutils.safe_unicode(control_dir).encode(
+            osutils._fs_enc)
+        self.max_journal_size = max_journal_size
+        self.session = None
+        self._journal_path = osutils.pathjoin(self.control_dir, JOURNAL_NAME)
+        self._fd = None
+        self._journal_fd = None
+        self._journal_size = 0
+        self._last_dirty = None
+        # wd -> native relpath ('' for the tree root)
+        self._watches = {}
+        self._control_wd = None
+        self._stopped = False
+
+    def _add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self._fd, path, mask)
+        if wd < 0:
+            import ctypes
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def _watch_dir(self, relpath, mark_dirty):
+        """Watch relpath and everything below it.
+
+        :param mark_dirty: Journal every path found, for directories which
+            may have gained content before they were watched.
+        """
+        pending = [relpath]
+        while pending:
+            relpath = pending.pop()
+            abspath = osutils.pathjoin(self.basedir, relpath)
+            try:
+                wd = self._add_watch(abspath, _TREE_EVENTS)
+                names = os.listdir(abspath)
+            except OSError, e:
+                if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                    # Gone again already; its parent records that.
+                    continue
+                raise
+            self._watches[wd] = relpath
+            for name in names:
+                if relpath:
+                    child = relpath + '/' + name
+                else:
+                    if name == '.bzr':
+                        continue
+                    child = name
+                if mark_dirty:
+                    self._record_dirty(child)
+                try:
+                    st = os.lstat(osutils.pathjoin(self.basedir, child))
+                except OSError, e:
+                    if e.errno == errno.ENOENT:
+                        continue
+                    raise
+                if stat.S_ISDIR(st.st_mode):
+                    pending.append(child)
+
+    def _open_journal(self):
+        """Publish a new, empty journal with a fresh session."""
+        self.session = osutils.rand_chars(20)
+        tmp_path = self._journal_path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+                     | os.O_APPEND | getattr(os, 'O_BINARY', 0), 0644)
+        header = '%spid %d\nsession %s\n' % (_SIGNATURE, os.getpid(),
+                                             self.session)
+        os.write(fd, header)
+        os.rename(tmp_path, self._journal_path)
+        if self._journal_fd is not None:
+            os.close(self._journal_fd)
+        self._journal_fd = fd
+        self._journal_size = len(header)
+        self._last_dirty = None
+
+    def _write(self, record):
+        os.write(self._journal_fd, record)
+        self._journal_size += len(record)
+
+    def _record_dirty(self, relpath):
+        if relpath == self._last_dirty:
+            return
+        self._last_dirty = relpath
+        if '\n' in relpath:
+            self._write('O\n')
+            return
+        if osutils._fs_enc not in ('utf-8', 'ascii'):
+            try:
+                relpath = relpath.decode(osutils._fs_enc).encode('utf-8')
+            except UnicodeDecodeError:
+                self._write('O\n')
+                return
+        self._write('D %s\n' % (relpath,))
+
+    def _record_overflow(self):
+        self._last_dirty = None
+        self._write('O\n')
+
+    def start(self):
+        """Start watching the tree and publish the journal."""
+        fd = self._libc.inotify_init()
+        if fd < 0:
+            import ctypes
+            err = ctypes.get_errno()
+            raise errors.ChangeJournalUnavailable(os.strerror(err))
+        self._fd = fd
+        self._control_wd = self._add_watch(self.control_dir, _CONTROL_EVENTS)
+        self._watch_dir('', False)
+        # Only publish once everything is watched: no reader can have a base
+        # for this session yet, so earlier changes do not matter.
+        self._open_journal()
+
+    def stop(self):
+        """Ask run() to return."""
+        self._stopped = True
+
+    def close(self):
+        """Stop watching and remove the journal."""
+        if self._journal_fd is not None:
+            os.close(self._journal_fd)
+            self._journal_fd = None
+            osutils.delete_any(self._journal_path)
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def run(self, poll_interval=0.2):
+        """Journal changes until stop() is called or the tree goes away."""
+        import select
+        while not self._stopped:
+            try:
+                readable = select.select([self._fd], [], [], poll_interval)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not readable:
+                continue
+            if not self.process_events(os.read(self._fd, 65536)):
+                break
+
+    def process_events(self, buf):
+        """Journal the inotify events in buf.
+
+        :return: False if the tree itself went away.
+        """
+        pos = 0
+        size = _inotify_event.size
+        while pos < len(buf):
+            wd, mask, cookie, length = _inotify_event.unpack_from(buf, pos)
+            pos += size
+            name = buf[pos:pos + length].rstrip('\0')
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                self._record_overflow()
+                continue
+            if wd == self._control_wd:
+                if name.startswith(COOKIE_PREFIX):
+                    self._last_dirty = None
+                    self._write('C %s\n' % (name,))
+                elif mask & IN_IGNORED:
+                    # The control directory is gone.
+                    self._record_overflow()
+                    return False
+                continue
+            relpath = self._watches.get(wd)
+            if relpath is None:
+                continue
+            if mask & IN_IGNORED:
+                del self._watches[wd]
+                if relpath == '':
+                    self._record_overflow()
+                    return False
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if relpath == '':
+                    self._record_overflow()
+                    return False
+                continue
+            if not name:
+                continue
+            if relpath:
+                relpath = relpath + '/' + name
+            elif name == '.bzr':
+                continue
+            else:
+                relpath = name
+            self._record_dirty(relpath)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    self._watch_dir(relpath, True)
+                except OSError, e:
+                    # Out of watches: the journal can no longer be complete.
+                    trace.warning('Cannot watch %s: %s', relpath, e)
+                    self._record_overflow()
+                    return False
+        if self._journal_size > self.max_journal_size:
+            self._open_journal()
+        return True
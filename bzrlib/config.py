@@ -2676,6 +2676,17 @@ Whether revisions associated with tags should be fetched.
 """))
 option_registry.register_lazy(
     'bzr.transform.orphan_policy', 'bzrlib.transform', 'opt_transform_orphan')
+option_registry.register(
+    Option('bzr.groupcompress.block_cache_size', default=u'100MB',
+           from_unicode=int_SI_from_store, invalid='warning',
+           help='''\
+Memory budget for decompressed groupcompress blocks.
+
+Blocks read from 2a repositories are cached in a single cache shared by the
+whole process, so that repositories opened on the same location can reuse
+blocks another one has decompressed. 0 gives each repository its own
+smaller cache instead.
+'''))
 option_registry.register(
     Option('bzr.workingtree.worth_saving_limit', default=10,
            from_unicode=int_from_store,  invalid='warning',
@@ -2697,6 +2708,16 @@ This bug tracker will be used for example when marking bugs
 as fixed using ``bzr commit --fixes``, if no explicit
 bug tracker was specified.
 '''))
+option_registry.register(
+    Option('build_tree.write_workers', default=0,
+           from_unicode=int_from_store, invalid='warning',
+           help='''\
+How many threads to write files with when building a new working tree.
+
+Checkouts and branches write the contents of their files on this many
+threads while the next texts are read from the repository. With the
+default of 0 one thread per CPU is used; 1 writes files one at a time.
+'''))
 option_registry.register(
     Option('check_signatures', default=CHECK_IF_POSSIBLE,
            from_unicode=signature_policy_from_unicode,
@@ -2736,6 +2757,27 @@ If true (default), working tree metadata changes are flushed through the
 OS buffers to physical disk.  This is somewhat slower, but means data
 should not be lost if the machine crashes.  See also repository.fdatasync.
 '''))
+option_registry.register(
+    Option('dirstate.journal_ratio', default=0.1,
+           from_unicode=float_from_store, invalid='warning',
+           help='''\
+How large the dirstate hash journal may grow, relative to the dirstate.
+
+When only cached file hashes changed, they are appended to a journal next
+to the dirstate instead of rewriting the whole file. Once the journal would
+grow past this fraction of the dirstate size, the dirstate is rewritten and
+the journal removed. 0 disables the journal.
+'''))
+option_registry.register(
+    Option('dirstate.sha1_workers', default=0,
+           from_unicode=int_from_store, invalid='warning',
+           help='''\
+How many threads to hash changed files with when comparing a working tree.
+
+When status, diff or commit find many files whose stat no longer matches
+the dirstate, their contents are hashed on this many threads. With the
+default of 0 one thread per CPU is used; 1 hashes files one at a time.
+'''))
 option_registry.register(
     ListOption('debug_flags', default=[],
            help='Debug flags to activate.'))
@@ -2857,6 +2899,18 @@ The default value for ``push --strict``.
 If present, defines the ``--strict`` option default value for checking
 uncommitted changes before sending a merge directive.
 '''))
+option_registry.register(
+    Option('repository.consolidate_indices', default=False,
+           from_unicode=bool_from_store, invalid='warning',
+           help='''\
+Whether autopack merges indices instead of rewriting packs.
+
+Autopack normally limits the number of packs by copying the contents of
+several packs into a new one, which can make a commit slow. When this is
+true, pack repositories using B+Tree indices instead merge the indices of
+those packs into one, leaving their contents in place. Lookups then search
+fewer indices, and recompressing the data is left to ``bzr pack``.
+'''))
 option_registry.register(
     Option('repository.fdatasync', default=True,
            from_unicode=bool_from_store,
@@ -2867,6 +2921,40 @@ If true (default), repository changes are flushed through the OS buffers
 to physical disk.  This is somewhat slower, but means data should not be
 lost if the machine crashes.  See also dirstate.fdatasync.
 '''))
+option_registry.register(
+    Option('repository.bloom_filter_rate', default=0.0,
+           from_unicode=float_from_store, invalid='warning',
+           help='''\
+False positive rate of the bloom filters kept next to pack indices.
+
+When set (e.g. to 0.01), each new pack using B+Tree indices gets a small
+bloom filter per index, and lookups for keys that are not in a pack skip
+reading its index. Clients that don't know about the filters ignore them.
+The default of 0 neither writes nor reads the filters.
+'''))
+option_registry.register(
+    Option('repository.pack_stats', default=True,
+           from_unicode=bool_from_store, invalid='warning',
+           help='''\
+Whether new packs record statistics about their content.
+
+When true (default), each pack gets a small sidecar holding the number
+of records and their compressed and uncompressed bytes per index, and the
+range of its revision timestamps. Repository statistics are then gathered
+by reading one sidecar per pack rather than every index. Packs written by
+fetches get their revision timestamps the first time statistics are
+gathered. Sidecars are only written to repositories on local disk.
+'''))
+option_registry.register(
+    Option('repository.pack_workers', default=1,
+           from_unicode=int_from_store, invalid='warning',
+           help='''\
+How many processes to compress with when packing a 2a repository.
+
+With the default of 1, ``bzr pack`` and autopack compress all the texts in
+a single process. Larger values split the texts into independent ranges
+which are compressed in parallel. 0 means use one process per CPU.
+'''))
 option_registry.register_lazy('smtp_server',
     'bzrlib.smtp_connection', 'smtp_server')
 option_registry.register_lazy('smtp_password',
@@ -2895,6 +2983,28 @@ option_registry.register(
            default=300.0, from_unicode=float_from_store,
            help="If we wait for a new request from a client for more than"
                 " X seconds, consider the client idle, and hangup."))
+option_registry.register(
+    Option('serve.request_threads',
+           default=0, from_unicode=int_from_store, invalid='warning',
+           help="""\
+How many requests bzr serve runs at once.
+
+By default each client connection is served by its own thread. When this is
+set, one event loop serves every connection, and hands their requests to a
+pool of this many threads. The event loop needs poll(), so on platforms
+without it, such as Windows, this is ignored with a warning.
+"""))
+option_registry.register(
+    Option('serve.cached_objects',
+           default=20, from_unicode=int_from_store, invalid='warning',
+           help="""\
+How many opened branches and repositories bzr serve keeps for reuse.
+
+Read-only requests reuse a branch or repository opened by an earlier request
+for the same location, from any connection, as long as its format, pack-names
+and last-revision files have not changed. 0 opens them again for every
+request.
+"""))
 option_registry.register(
     Option('stacked_on_location',
            default=None,
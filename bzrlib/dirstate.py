@@ -273,6 +273,15 @@ class SHA1Provider(object):
         """
         raise NotImplementedError(self.stat_and_sha1)
 
+    def stat_and_sha1_job(self, abspath):
+        """Prepare to call stat_and_sha1 from another thread.
+
+        :return: A callable taking no arguments which returns
+            stat_and_sha1(abspath) and is safe to call from any thread, or
+            None if the file has to be hashed by calling stat_and_sha1.
+        """
+        return None
+
 
 class DefaultSHA1Provider(SHA1Provider):
     """A SHA1Provider that reads directly from the filesystem."""
@@ -291,6 +300,153 @@ class DefaultSHA1Provider(SHA1Provider):
             file_obj.close()
         return statvalue, sha1
 
+    def stat_and_sha1_job(self, abspath):
+        """See SHA1Provider.stat_and_sha1_job."""
+        return lambda: self.stat_and_sha1(abspath)
+
+
+class SHA1Prefetcher(SHA1Provider):
+    """Hash the files a dirstate walk is about to compare on a thread pool.
+
+    As each directory is read, the files whose stat no longer matches their
+    dirstate entry are handed to a pool of threads to hash, so that the walk
+    finds their sha1 ready rather than reading them one at a time. hashlib
+    and file reads release the GIL. The walk still consumes the results in
+    its own order, so the dirstate is updated exactly as without it.
+
+    Nothing is prefetched until the walk has hashed a few files itself, so
+    trees whose stat cache is up to date pay nothing.
+    """
+
+    # How many files the walk must hash before prefetching starts.
+    activation_hashes = 8
+
+    def __init__(self, state, workers):
+        """Create a SHA1Prefetcher.
+
+        :param state: The DirState about to be walked.
+        :param workers: The number of threads to hash with.
+        """
+        self._state = state
+        self._workers = workers
+        self._provider = state._sha1_provider
+        self._sha1_file = state._sha1_file
+        self._pool = None
+        # abspath -> AsyncResult of stat_and_sha1
+        self._pending = {}
+        self._hashed = 0
+
+    def sha1(self, abspath):
+        """See SHA1Provider.sha1."""
+        result = self._pending.pop(abspath, None)
+        if result is not None:
+            return result.get()[1]
+        self._hashed += 1
+        return self._provider.sha1(abspath)
+
+    def stat_and_sha1(self, abspath):
+        """See SHA1Provider.stat_and_sha1."""
+        result = self._pending.pop(abspath, None)
+        if result is not None:
+            return result.get()
+        self._hashed += 1
+        return self._provider.stat_and_sha1(abspath)
+
+    def dir_reader(self, dir_reader=None):
+        """Get a DirReader that starts hashing the changed files it reads.
+
+        :param dir_reader: The DirReader to wrap, None for the default.
+        """
+        if dir_reader is None:
+            dir_reader = osutils._get_selected_dir_reader()
+        return _PrefetchingDirReader(self, dir_reader)
+
+    def prefetch(self, dirname, dirblock):
+        """Start hashing the files in dirblock that the walk will hash.
+
+        :param dirname: The utf8 path of the directory.
+        :param dirblock: The directory contents, as returned by
+            DirReader.read_dir.
+        """
+        if self._hashed < self.activation_hashes:
+            return
+        state = self._state
+        if dirname == '':
+            # Block 0 only holds the root; its children are in block 1.
+            block_index = 1
+        else:
+            block_index, present = state._find_block_index_from_key(
+                (dirname, '', ''))
+            if not present:
+                return
+        packed_stats = {}
+        for entry in state._dirblocks[block_index][1]:
+            details = entry[1]
+            # update_entry only hashes files it can compare with a parent.
+            if (details[0][0] == 'f' and len(details) > 1
+                and details[1][0] == 'f'):
+                packed_stats[entry[0][1]] = details[0][4]
+        if not packed_stats:
+            return
+        jobs = []
+        for relpath, name, kind, stat_value, abspath in dirblock:
+            if kind != 'file':
+                continue
+            saved_packed_stat = packed_stats.get(name)
+            if saved_packed_stat is None:
+                continue
+            packed_stat = pack_stat(stat_value)
+            if (packed_stat == saved_packed_stat
+                or state.UNVERIFIED_STAT_PREFIX + packed_stat
+                   == saved_packed_stat):
+                continue
+            job = self._provider.stat_and_sha1_job(abspath)
+            if job is not None:
+                jobs.append((abspath, job))
+        if not jobs or (self._pool is None and len(jobs) < 2):
+            return
+        if self._pool is None:
+            from multiprocessing.pool import ThreadPool
+            self._pool = ThreadPool(self._workers)
+        for abspath, job in jobs:
+            self._pending[abspath] = self._pool.apply_async(job)
+
+    def hashing(self, changes):
+        """Yield from changes with this prefetcher hashing for the state."""
+        state = self._state
+        state._sha1_provider = self
+        if self._sha1_file == self._provider.sha1:
+            state._sha1_file = self.sha1
+        try:
+            for change in changes:
+                yield change
+        finally:
+            state._sha1_provider = self._provider
+            state._sha1_file = self._sha1_file
+            self._pending.clear()
+            if self._pool is not None:
+                # Drop whatever the walk did not get to.
+                self._pool.terminate()
+                self._pool = None
+
+
+class _PrefetchingDirReader(osutils.DirReader):
+    """A DirReader which hands what it reads to a SHA1Prefetcher."""
+
+    def __init__(self, prefetcher, dir_reader):
+        self._prefetcher = prefetcher
+        self._dir_reader = dir_reader
+
+    def top_prefix_to_starting_dir(self, top, prefix=""):
+        """See DirReader.top_prefix_to_starting_dir."""
+        return self._dir_reader.top_prefix_to_starting_dir(top, prefix)
+
+    def read_dir(self, prefix, top):
+        """See DirReader.read_dir."""
+        dirblock = self._dir_reader.read_dir(prefix, top)
+        self._prefetcher.prefetch(prefix, dirblock)
+        return dirblock
+
 
 class DirState(object):
     """Record directory and metadata state for fast access.
@@ -346,10 +502,16 @@ class DirState(object):
     # A pack_stat (the x's) that is just noise and will never match the output
     # of base64 encode.
     NULLSTAT = 'x' * 32
+    # Prefixed to the pack_stat of a file whose sha1 was observed while the
+    # file was too new to trust it. update_entry trusts the sha1 once the
+    # cutoff has passed, as long as the stat is still the same. '?' is not in
+    # the base64 alphabet, so older versions never match it.
+    UNVERIFIED_STAT_PREFIX = '?'
     NULL_PARENT_DETAILS = static_tuple.StaticTuple('a', '', 0, False, '')
 
     HEADER_FORMAT_2 = '#bazaar dirstate flat format 2\n'
     HEADER_FORMAT_3 = '#bazaar dirstate flat format 3\n'
+    JOURNAL_HEADER = '#bazaar dirstate journal 1\n'
 
     def __init__(self, path, sha1_provider, worth_saving_limit=0):
         """Create a  DirState object.
@@ -408,6 +570,14 @@ class DirState(object):
         self._worth_saving_limit = worth_saving_limit
         self._config_stack = config.LocationStack(urlutils.local_path_to_url(
             path))
+        # Hash changes are appended to the journal rather than rewriting the
+        # whole dirstate file. _journal_offset is the end of the valid data in
+        # the journal, or None if there is no journal for the file on disk.
+        self._journal_filename = path + '.journal'
+        self._journal_offset = None
+        # True for the states returned by _partial_state, which only hold
+        # some of the entries and so can never rewrite the dirstate file.
+        self._partially_loaded = False
 
     def __repr__(self):
         return "%s(%r)" % \
@@ -1008,6 +1178,95 @@ class DirState(object):
             processed_dirs.update(pending_dirs)
         return found
 
+    def _partial_state(self, paths):
+        """Get a DirState holding just the entries needed to work on paths.
+
+        The entries are found by bisecting the file on disk, so only a few
+        pages of a large dirstate need to be read and parsed. The result
+        shares this dirstate's file and lock, and holds the entries for
+        paths, their children, the targets of their renames and the parent
+        directories of all of those. It can save hash changes to the
+        journal (see _save_partial_state) but nothing else.
+
+        :param paths: A list of utf8 paths.
+        :return: A DirState with those entries in its dirblocks.
+        """
+        self._requires_lock()
+        if self._dirblock_state != DirState.NOT_IN_MEMORY:
+            raise AssertionError("bad dirblock state %r" % self._dirblock_state)
+        state = self.__class__(self._filename, self._sha1_provider,
+                               worth_saving_limit=self._worth_saving_limit)
+        state._config_stack = self._config_stack
+        state._lock_token = self._lock_token
+        state._lock_state = self._lock_state
+        state._state_file = self._state_file
+        state._partially_loaded = True
+        self._state_file.seek(0)
+        found = state._bisect_recursive(sorted(paths))
+        searched = set(paths)
+        while True:
+            for key in found:
+                searched.add(osutils.pathjoin(key[0], key[1]))
+            # The parent directories of every entry are needed to work out
+            # parent ids, as are the paths that entries were renamed to.
+            wanted = set()
+            for key, trees_info in found.iteritems():
+                for tree_info in trees_info:
+                    if tree_info[0] == 'r':
+                        wanted.add(tree_info[1])
+                parent = key[0]
+                while parent not in wanted:
+                    wanted.add(parent)
+                    if not parent:
+                        break
+                    parent = osutils.split(parent)[0]
+            wanted.difference_update(searched)
+            if not wanted:
+                break
+            searched.update(wanted)
+            recursive = []
+            for path, entries in state._bisect(sorted(wanted)).iteritems():
+                for entry in entries:
+                    found[entry[0]] = entry[1]
+                    kinds = set(tree_info[0] for tree_info in entry[1])
+                    kinds.difference_update('ar')
+                    if 'd' in kinds and len(kinds) > 1:
+                        # A directory in only some trees: its children
+                        # are reported too.
+                        recursive.append(path)
+            if recursive:
+                found.update(state._bisect_recursive(sorted(recursive)))
+        blocks = {}
+        for key, trees_info in found.iteritems():
+            blocks.setdefault(key[0], []).append((key, trees_info))
+        root_entries = blocks.pop('', [])
+        dirblocks = [
+            ('', sorted([e for e in root_entries if not e[0][1]])),
+            ('', sorted([e for e in root_entries if e[0][1]]))]
+        for dirname in sorted(blocks, key=lambda dirname: dirname.split('/')):
+            dirblocks.append((dirname, sorted(blocks[dirname])))
+        state._dirblocks = dirblocks
+        state._dirblock_state = DirState.IN_MEMORY_UNMODIFIED
+        state._read_journal()
+        return state
+
+    def _save_partial_state(self, state):
+        """Save the hash changes made to a state from _partial_state.
+
+        Nothing is saved if this dirstate has been read in the meantime, as
+        it may have journaled changes of its own.
+        """
+        if self._dirblock_state != DirState.NOT_IN_MEMORY:
+            return
+        state._lock_token = self._lock_token
+        state._state_file = self._state_file
+        try:
+            state.save()
+        finally:
+            # Saving may have swapped the lock for a new one.
+            self._lock_token = state._lock_token
+            self._state_file = state._state_file
+
     def _discard_merge_parents(self):
         """Discard any parents trees beyond the first.
 
@@ -1881,9 +2140,21 @@ class DirState(object):
                 self._sha_cutoff_time()
             if (stat_value.st_mtime < self._cutoff_time
                 and stat_value.st_ctime < self._cutoff_time):
-                entry[1][0] = ('f', sha1, stat_value.st_size, entry[1][0][3],
-                               pack_stat(stat_value))
-                self._mark_modified([entry])
+                packed_stat = pack_stat(stat_value)
+            else:
+                # Too new for the cutoff cached when the lock was taken. But
+                # if it is older than the cutoff as of now, any later change
+                # will give it a different stat, so keep the sha1 for
+                # update_entry to verify once the cached cutoff has passed.
+                cutoff = self._current_cutoff_time()
+                if not (stat_value.st_mtime < cutoff
+                        and stat_value.st_ctime < cutoff):
+                    return
+                packed_stat = self.UNVERIFIED_STAT_PREFIX + pack_stat(
+                    stat_value)
+            entry[1][0] = ('f', sha1, stat_value.st_size, entry[1][0][3],
+                           packed_stat)
+            self._mark_modified([entry])
 
     def _sha_cutoff_time(self):
         """Return cutoff time.
@@ -1895,13 +2166,30 @@ class DirState(object):
         # time.time() isn't super expensive (approx 3.38us), but
         # when you call it 50,000 times it adds up.
         # For comparison, os.lstat() costs 7.2us if it is hot.
-        self._cutoff_time = int(time.time()) - 3
+        self._cutoff_time = self._current_cutoff_time()
         return self._cutoff_time
 
+    def _current_cutoff_time(self):
+        """Return the cutoff time as of now, without caching it."""
+        return int(time.time()) - 3
+
     def _lstat(self, abspath, entry):
         """Return the os.lstat value for this path."""
         return os.lstat(abspath)
 
+    def _sha1_prefetcher(self):
+        """Get a SHA1Prefetcher for walking this dirstate.
+
+        :return: None if the dirstate.sha1_workers option leaves hashing to a
+            single thread.
+        """
+        workers = self._config_stack.get('dirstate.sha1_workers')
+        if workers == 0:
+            workers = osutils.local_concurrency()
+        if workers < 2:
+            return None
+        return SHA1Prefetcher(self, workers)
+
     def _sha1_file_and_mutter(self, abspath):
         # when -Dhashcache is turned on, this is monkey-patched in to log
         # file reads
@@ -1946,7 +2234,8 @@ class DirState(object):
     def get_lines(self):
         """Serialise the entire dirstate to a sequence of lines."""
         if (self._header_state == DirState.IN_MEMORY_UNMODIFIED and
-            self._dirblock_state == DirState.IN_MEMORY_UNMODIFIED):
+            self._dirblock_state == DirState.IN_MEMORY_UNMODIFIED and
+            self._journal_offset is None):
             # read what's on disk.
             self._state_file.seek(0)
             return self._state_file.readlines()
@@ -2010,9 +2299,28 @@ class DirState(object):
                     ),
                     ])
             return fields_to_entry_1_parent
-        elif num_present_parents == 2:
+        # With several parents, most rows have the same details in each
+        # parent tree, and only mention a few revision ids.
+        intern_revision_id = {}.setdefault
+        if num_present_parents == 2:
             def fields_to_entry_2_parents(fields, _int=int):
                 path_name_file_id_key = (fields[0], fields[1], fields[2])
+                parent_1 = ( # Parent 1
+                    fields[8],                # minikind
+                    fields[9],                # fingerprint
+                    _int(fields[10]),         # size
+                    fields[11] == 'y',        # executable
+                    intern_revision_id(fields[12], fields[12]),
+                )
+                parent_2 = ( # Parent 2
+                    fields[13],               # minikind
+                    fields[14],               # fingerprint
+                    _int(fields[15]),         # size
+                    fields[16] == 'y',        # executable
+                    intern_revision_id(fields[17], fields[17]),
+                )
+                if parent_2 == parent_1:
+                    parent_2 = parent_1
                 return (path_name_file_id_key, [
                     ( # Current tree
                         fields[3],                # minikind
@@ -2021,31 +2329,30 @@ class DirState(object):
                         fields[6] == 'y',         # executable
                         fields[7],                # packed_stat or revision_id
                     ),
-                    ( # Parent 1
-                        fields[8],                # minikind
-                        fields[9],                # fingerprint
-                        _int(fields[10]),         # size
-                        fields[11] == 'y',        # executable
-                        fields[12],               # packed_stat or revision_id
-                    ),
-                    ( # Parent 2
-                        fields[13],               # minikind
-                        fields[14],               # fingerprint
-                        _int(fields[15]),         # size
-                        fields[16] == 'y',        # executable
-                        fields[17],               # packed_stat or revision_id
-                    ),
+                    parent_1,
+                    parent_2,
                     ])
             return fields_to_entry_2_parents
         else:
             def fields_to_entry_n_parents(fields, _int=int):
                 path_name_file_id_key = (fields[0], fields[1], fields[2])
-                trees = [(fields[cur],                # minikind
-                          fields[cur+1],              # fingerprint
-                          _int(fields[cur+2]),        # size
-                          fields[cur+3] == 'y',       # executable
-                          fields[cur+4],              # stat or revision_id
-                         ) for cur in xrange(3, len(fields)-1, 5)]
+                trees = [(fields[3],                  # minikind
+                          fields[4],                  # fingerprint
+                          _int(fields[5]),            # size
+                          fields[6] == 'y',           # executable
+                          fields[7],                  # packed_stat
+                         )]
+                for cur in xrange(8, len(fields)-1, 5):
+                    details = (fields[cur],                # minikind
+                               fields[cur+1],              # fingerprint
+                               _int(fields[cur+2]),        # size
+                               fields[cur+3] == 'y',       # executable
+                               intern_revision_id(fields[cur+4],
+                                                  fields[cur+4]),
+                              )
+                    if details == trees[-1]:
+                        details = trees[-1]
+                    trees.append(details)
                 return path_name_file_id_key, trees
             return fields_to_entry_n_parents
 
@@ -2385,11 +2692,146 @@ class DirState(object):
 
         This populates self._dirblocks, and sets self._dirblock_state to
         IN_MEMORY_UNMODIFIED. It is not currently ready for incremental block
-        loading.
+        loading. Hash changes recorded in the journal are applied on top.
         """
         self._read_header_if_needed()
         if self._dirblock_state == DirState.NOT_IN_MEMORY:
             _read_dirblocks(self)
+            self._read_journal()
+
+    def _disk_fingerprint(self):
+        """Identify the dirstate file currently on disk.
+
+        :return: A string made of the crc, entry count and size of the file,
+            used to tie a journal to the file it was written against.
+        """
+        self._state_file.seek(0)
+        self._state_file.readline()
+        crc_line = self._state_file.readline()
+        num_entries_line = self._state_file.readline()
+        size = os.fstat(self._state_file.fileno()).st_size
+        return '%s/%s/%d' % (crc_line[len('crc32: '):-1],
+                             num_entries_line[len('num_entries: '):-1], size)
+
+    def _journal_base_line(self):
+        return 'base: %s\n' % (self._disk_fingerprint(),)
+
+    def _find_entry_by_key(self, key):
+        """Return the entry for key, or None if it is not in the dirstate."""
+        block_index, present = self._find_block_index_from_key(key)
+        if not present:
+            return None
+        block = self._dirblocks[block_index][1]
+        entry_index, present = self._find_entry_index(key, block)
+        if not present:
+            return None
+        return block[entry_index]
+
+    def _read_journal(self):
+        """Apply the hash changes journaled since the dirstate was written.
+
+        A journal written against another version of the dirstate file (for
+        instance one rewritten by an older bzr) is ignored, and so is any
+        torn record at its end.
+        """
+        self._journal_offset = None
+        try:
+            f = open(self._journal_filename, 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        header = self.JOURNAL_HEADER + self._journal_base_line()
+        if not data.startswith(header):
+            return
+        offset = len(header)
+        fields = []
+        while True:
+            # Each record is '<length> <crc32>\n' followed by the
+            # NULL terminated fields of the changed entries.
+            record_start = data.find('\n', offset) + 1
+            if not record_start:
+                break
+            try:
+                length, crc = map(int, data[offset:record_start - 1].split(' '))
+            except ValueError:
+                break
+            payload = data[record_start:record_start + length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                break
+            fields.extend(payload.split('\0')[:-1])
+            offset = record_start + length
+        self._journal_offset = offset
+        for pos in xrange(0, len(fields) - 7, 8):
+            entry = self._find_entry_by_key(tuple(fields[pos:pos + 3]))
+            if entry is None:
+                continue
+            entry[1][0] = (fields[pos + 3], fields[pos + 4],
+                           int(fields[pos + 5]), fields[pos + 6] == 'y',
+                           fields[pos + 7])
+
+    def _append_to_journal(self):
+        """Save the changed hash cache entries by appending to the journal.
+
+        :return: True if the changes were journaled, False if the whole
+            dirstate file needs to be written instead.
+        """
+        if (self._header_state != DirState.IN_MEMORY_UNMODIFIED
+            or self._dirblock_state != DirState.IN_MEMORY_HASH_MODIFIED
+            or not self._known_hash_changes):
+            return False
+        ratio = self._config_stack.get('dirstate.journal_ratio')
+        if ratio <= 0:
+            return False
+        fields = []
+        for key in sorted(self._known_hash_changes):
+            entry = self._find_entry_by_key(key)
+            if entry is None:
+                continue
+            details = entry[1][0]
+            fields.extend(key)
+            fields.extend((details[0], details[1], str(details[2]),
+                           DirState._to_yesno[details[3]], details[4]))
+        payload = ''.join([field + '\0' for field in fields])
+        record = '%d %d\n%s' % (len(payload), zlib.crc32(payload), payload)
+        if self._journal_offset is None:
+            record = self.JOURNAL_HEADER + self._journal_base_line() + record
+            offset = 0
+        else:
+            offset = self._journal_offset
+        limit = os.fstat(self._state_file.fileno()).st_size * ratio
+        if offset + len(record) > limit:
+            # Fold the journal into a rewritten dirstate file.
+            return False
+        if offset:
+            f = open(self._journal_filename, 'r+b')
+        else:
+            f = open(self._journal_filename, 'wb')
+        try:
+            f.seek(offset)
+            f.write(record)
+            # Drop anything left behind by an interrupted append.
+            f.truncate()
+            f.flush()
+            if self._config_stack.get('dirstate.fdatasync'):
+                osutils.fdatasync(f.fileno())
+        finally:
+            f.close()
+        self._journal_offset = offset + len(record)
+        return True
+
+    def _remove_journal(self):
+        """Remove the journal, now that the dirstate file includes it."""
+        self._journal_offset = None
+        try:
+            os.unlink(self._journal_filename)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
 
     def _read_header(self):
         """This reads in the metadata header, and the parent ids.
@@ -2495,12 +2937,17 @@ class DirState(object):
                 # We couldn't grab a write lock, so we switch back to a read one
                 return
         try:
-            lines = self.get_lines()
-            self._state_file.seek(0)
-            self._state_file.writelines(lines)
-            self._state_file.truncate()
-            self._state_file.flush()
-            self._maybe_fdatasync()
+            if not self._append_to_journal():
+                if self._partially_loaded:
+                    trace.mutter('Not saving partially loaded DirState.')
+                    return
+                lines = self.get_lines()
+                self._state_file.seek(0)
+                self._state_file.writelines(lines)
+                self._state_file.truncate()
+                self._state_file.flush()
+                self._maybe_fdatasync()
+                self._remove_journal()
             self._mark_unmodified()
         finally:
             if grabbed_write_lock:
@@ -3319,6 +3766,7 @@ class DirState(object):
         self._end_of_header = None
         self._cutoff_time = None
         self._split_path_cache = {}
+        self._journal_offset = None
 
     def lock_read(self):
         """Acquire a read lock on the dirstate."""
@@ -3408,10 +3856,20 @@ def py_update_entry(state, entry, abspath, stat_value,
     link_or_sha1 = None
     worth_saving = True
     if minikind == 'f':
-        executable = state._is_executable(stat_value.st_mode,
-                                         saved_executable)
         if state._cutoff_time is None:
             state._sha_cutoff_time()
+        if (saved_minikind == 'f'
+            and saved_packed_stat == state.UNVERIFIED_STAT_PREFIX + packed_stat
+            and stat_value.st_mtime < state._cutoff_time
+            and stat_value.st_ctime < state._cutoff_time):
+            # The sha1 was observed while the file was too new to trust, and
+            # the file has not changed since.
+            entry[1][0] = ('f', saved_link_or_sha1, saved_file_size,
+                           saved_executable, packed_stat)
+            state._mark_modified([entry])
+            return saved_link_or_sha1
+        executable = state._is_executable(stat_value.st_mode,
+                                         saved_executable)
         if (stat_value.st_mtime < state._cutoff_time
             and stat_value.st_ctime < state._cutoff_time
             and len(entry[1]) > 1
@@ -3467,7 +3925,8 @@ class ProcessEntryPython(object):
         "partial", "use_filesystem_for_exec", "utf8_decode",
         "searched_specific_files", "search_specific_files",
         "searched_exact_paths", "search_specific_file_parents", "seen_ids",
-        "state", "source_index", "target_index", "want_unversioned", "tree"]
+        "state", "source_index", "target_index", "want_unversioned", "tree",
+        "dir_reader"]
 
     def __init__(self, include_unchanged, use_filesystem_for_exec,
         search_specific_files, state, source_index, target_index,
@@ -3505,6 +3964,8 @@ class ProcessEntryPython(object):
             raise errors.BzrError('unsupported target index')
         self.want_unversioned = want_unversioned
         self.tree = tree
+        # The DirReader used to walk the tree; None for the platform default.
+        self.dir_reader = None
 
     def _process_entry(self, entry, path_info, pathjoin=osutils.pathjoin):
         """Compare an entry and real disk to generate delta information.
@@ -3904,7 +4365,8 @@ class ProcessEntryPython(object):
             if root_dir_info and root_dir_info[2] == 'tree-reference':
                 current_dir_info = None
             else:
-                dir_iterator = osutils._walkdirs_utf8(root_abspath, prefix=current_root)
+                dir_iterator = osutils._walkdirs_utf8(root_abspath,
+                    prefix=current_root, dir_reader=self.dir_reader)
                 try:
                     current_dir_info = dir_iterator.next()
                 except OSError, e:
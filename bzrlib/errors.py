@@ -1810,6 +1810,14 @@ class DependencyNotPresent(BzrError):
         BzrError.__init__(self, library=library, error=error)
 
 
+class ChangeJournalUnavailable(BzrError):
+
+    _fmt = 'Cannot watch the working tree for changes: %(reason)s'
+
+    def __init__(self, reason):
+        BzrError.__init__(self, reason=reason)
+
+
 class GpgmeNotInstalled(DependencyNotPresent):
 
     _fmt = 'python-gpgme is not installed, it is needed to verify signatures'
@@ -3171,6 +3179,18 @@ class UnsuspendableWriteGroup(BzrError):
         self.repository = repository
 
 
+class WriteGroupsInProgress(BzrError):
+
+    _fmt = ("Repository %(repository)s has write groups in progress "
+            "(%(uploads)s), so unreferenced content cannot be removed. "
+            "Retry once no other process is writing to it; files left in "
+            "upload/ by interrupted writers can then be deleted.")
+
+    def __init__(self, repository, uploads):
+        self.repository = repository
+        self.uploads = ', '.join(uploads)
+
+
 class LossyPushToSameVCS(BzrError):
 
     _fmt = ("Lossy push not possible between %(source_branch)r and "
@@ -183,6 +183,11 @@ class Globster(object):
     Also, the extension patterns are more likely to find a match and
     so are matched first, then the basename patterns, then the fullpath
     patterns.
+
+    Extension and basename patterns are matched against the basename alone,
+    which is split off once per filename. Those without any glob characters
+    (such as '*.o' or 'node_modules') are looked up in dicts rather than
+    run as part of a regex.
     """
     # We want to _add_patterns in a specific order (as per type_list below)
     # starting with the shortest and going to the longest.
@@ -205,6 +210,14 @@ class Globster(object):
         },
     }
 
+    # Characters that make an extension or basename pattern more than a
+    # literal string.
+    _glob_chars = lazy_regex.lazy_compile(ur'[*?[\\]')
+
+    # Set by Globster.__init__; _OrderedGlobster has to try its patterns in
+    # order so it leaves this unset.
+    _basename_matching = False
+
     def __init__(self, patterns):
         self._regex_patterns = []
         pattern_lists = {
@@ -219,18 +232,54 @@ class Globster(object):
         for t in Globster.pattern_types:
             self._add_patterns(pattern_lists[t], pi[t]["translator"],
                 pi[t]["prefix"])
+        self._init_basename_matching(pattern_lists)
 
-    def _add_patterns(self, patterns, translator, prefix=''):
+    def _init_basename_matching(self, pattern_lists):
+        """Prepare matching extension and basename patterns on basenames.
+
+        The regexes built by _add_patterns have to find the basename
+        themselves, which gets expensive for long paths and many patterns.
+        """
+        self._literal_extensions = {}
+        self._literal_basenames = {}
+        extension_globs = []
+        for pat in pattern_lists["extension"]:
+            if self._glob_chars.search(pat, 2):
+                extension_globs.append(pat)
+            else:
+                self._literal_extensions.setdefault(pat[2:], pat)
+        basename_globs = []
+        for pat in pattern_lists["basename"]:
+            if self._glob_chars.search(pat):
+                basename_globs.append(pat)
+            else:
+                self._literal_basenames.setdefault(pat, pat)
+        self._extension_regexes = self._compile_patterns(extension_globs,
+            _sub_extension, r'(?:.*\.)')
+        self._basename_regexes = self._compile_patterns(basename_globs,
+            _sub_basename)
+        self._fullpath_regexes = self._compile_patterns(
+            pattern_lists["fullpath"], _sub_fullpath)
+        self._basename_matching = True
+
+    def _compile_patterns(self, patterns, translator, prefix=''):
+        """Build (regex, patterns) pairs for up to 99 patterns each."""
+        regex_patterns = []
         while patterns:
             grouped_rules = [
                 '(%s)' % translator(pat) for pat in patterns[:99]]
             joined_rule = '%s(?:%s)$' % (prefix, '|'.join(grouped_rules))
             # Explicitly use lazy_compile here, because we count on its
             # nicer error reporting.
-            self._regex_patterns.append((
+            regex_patterns.append((
                 lazy_regex.lazy_compile(joined_rule, re.UNICODE),
                 patterns[:99]))
             patterns = patterns[99:]
+        return regex_patterns
+
+    def _add_patterns(self, patterns, translator, prefix=''):
+        self._regex_patterns.extend(
+            self._compile_patterns(patterns, translator, prefix))
 
     def match(self, filename):
         """Searches for a pattern that matches the given filename.
@@ -238,6 +287,10 @@ class Globster(object):
         :return A matching pattern or None if there is no matching pattern.
         """
         try:
+            # '.' in the regexes does not match a newline, so such names
+            # take the slow path rather than reimplementing that here.
+            if self._basename_matching and u'\n' not in filename:
+                return self._match_basename_first(filename)
             for regex, patterns in self._regex_patterns:
                 match = regex.match(filename)
                 if match:
@@ -257,6 +310,40 @@ class Globster(object):
             raise e
         return None
 
+    def _match_basename_first(self, filename):
+        """Match filename, checking the patterns in the usual category order.
+
+        Within the extension patterns, the shortest matching extension wins
+        like it would with the combined regexes. Literal patterns are checked
+        before the globs of their category though, so when both match it may
+        be a different pattern that is returned.
+        """
+        basename = filename[filename.rfind(u'/') + 1:]
+        literal_extensions = self._literal_extensions
+        if literal_extensions:
+            pos = basename.rfind(u'.')
+            while pos != -1:
+                pattern = literal_extensions.get(basename[pos + 1:])
+                if pattern is not None:
+                    return pattern
+                pos = basename.rfind(u'.', 0, pos)
+        for regex, patterns in self._extension_regexes:
+            match = regex.match(basename)
+            if match:
+                return patterns[match.lastindex -1]
+        pattern = self._literal_basenames.get(basename)
+        if pattern is not None:
+            return pattern
+        for regex, patterns in self._basename_regexes:
+            match = regex.match(basename)
+            if match:
+                return patterns[match.lastindex -1]
+        for regex, patterns in self._fullpath_regexes:
+            match = regex.match(filename)
+            if match:
+                return patterns[match.lastindex -1]
+        return None
+
     @staticmethod
     def identify(pattern):
         """Returns pattern category.
@@ -312,6 +399,9 @@ class ExceptionGlobster(object):
             else:
                 ignores[0].append(p)
         self._ignores = [Globster(i) for i in ignores]
+        if not ignores[1] and not ignores[2]:
+            # Without exceptions there is nothing to check them against.
+            self.match = self._ignores[0].match
         
     def match(self, filename):
         """Searches for a pattern that matches the given filename.
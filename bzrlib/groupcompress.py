@@ -18,6 +18,8 @@
 
 from __future__ import absolute_import
 
+import collections
+import threading
 import time
 import zlib
 
@@ -102,6 +104,9 @@ class GroupCompressBlock(object):
     GCB_LZ_HEADER = 'gcb1l\n'
     GCB_KNOWN_HEADERS = (GCB_HEADER, GCB_LZ_HEADER)
 
+    # Set when the block is shared between threads, see _SharedBlockCache
+    _content_lock = None
+
     def __init__(self):
         # map by key? or just order in file?
         self._compressor_name = None
@@ -124,6 +129,16 @@ class GroupCompressBlock(object):
         :param num_bytes: Ensure that we have extracted at least num_bytes of
             content. If None, consume everything
         """
+        if self._content_lock is None:
+            self._expand_content(num_bytes)
+        else:
+            self._content_lock.acquire()
+            try:
+                self._expand_content(num_bytes)
+            finally:
+                self._content_lock.release()
+
+    def _expand_content(self, num_bytes):
         if self._content_length is None:
             raise AssertionError('self._content_length should never be None')
         if num_bytes is None:
@@ -1080,6 +1095,149 @@ def cleanup_pack_group(versioned_files):
     versioned_files.stream.close()
 
 
+def _should_start_new_block(prefix, last_prefix, max_fulltext_prefix,
+                            max_fulltext_len, end_point):
+    """Should the text just added to a group be moved to a new group?
+
+    :param prefix: The prefix (file id) of the text just compressed, or None.
+    :param last_prefix: The prefix of the text compressed before it.
+    :param max_fulltext_prefix: The prefix of the largest fulltext in the
+        group so far.
+    :param max_fulltext_len: The length of the largest fulltext in the group.
+    :param end_point: The size of the group including the new text.
+    """
+    if (prefix == max_fulltext_prefix
+        and end_point < 2 * max_fulltext_len):
+        # As long as we are on the same file_id, we will fill at least
+        # 2 * max_fulltext_len
+        return False
+    elif end_point > 4*1024*1024:
+        return True
+    elif (prefix is not None and prefix != last_prefix
+          and end_point > 2*1024*1024):
+        return True
+    return False
+
+
+def _compress_text_range(texts, settings):
+    """Compress a range of fulltexts into groupcompress blocks.
+
+    This is the worker side of
+    GroupCompressVersionedFiles._insert_record_stream_parallel, and it may be
+    run in another process, so it only deals in plain python objects.
+
+    :param texts: A list of (key, sha1, bytes) tuples. sha1 may be None.
+    :param settings: The settings to create the GroupCompressor with.
+    :return: A list of (block_bytes, entries) with one item per block
+        created, where entries is a list of (key, sha1, start, end) for each
+        text in the block, in the order they were given.
+    """
+    result = []
+    compressor = GroupCompressor(settings)
+    entries = []
+    last_prefix = None
+    max_fulltext_len = 0
+    max_fulltext_prefix = None
+    for key, sha1, bytes in texts:
+        if len(key) > 1:
+            prefix = key[0]
+            soft = (prefix == last_prefix)
+        else:
+            prefix = None
+            soft = False
+        if max_fulltext_len < len(bytes):
+            max_fulltext_len = len(bytes)
+            max_fulltext_prefix = prefix
+        (found_sha1, start_point, end_point,
+         type) = compressor.compress(key, bytes, sha1, soft=soft)
+        start_new_block = _should_start_new_block(prefix, last_prefix,
+            max_fulltext_prefix, max_fulltext_len, end_point)
+        last_prefix = prefix
+        if start_new_block:
+            compressor.pop_last()
+            bytes_len, chunks = compressor.flush().to_chunks()
+            result.append((''.join(chunks), entries))
+            entries = []
+            compressor = GroupCompressor(settings)
+            max_fulltext_len = len(bytes)
+            (found_sha1, start_point, end_point,
+             type) = compressor.compress(key, bytes, sha1)
+        entries.append((key, found_sha1, start_point, end_point))
+    if entries:
+        bytes_len, chunks = compressor.flush().to_chunks()
+        result.append((''.join(chunks), entries))
+    return result
+
+
+class _BlockReadPlan(object):
+    """How to read the blocks holding a set of keys.
+
+    The plan is made once for all the keys of a stream, so the blocks that
+    are not cached are read with one readv per pack instead of one per
+    batch, and each block is decompressed up to the last byte any of the keys
+    needs from it in a single step.
+
+    :ivar last_bytes: A dict mapping the read memo of each block to the end
+        of the last record needed from it.
+    """
+
+    def __init__(self, gcvf, locations, keys):
+        """Plan the reads for keys.
+
+        :param locations: The build details of keys, from
+            _GCGraphIndex.get_build_details.
+        :param keys: The keys to plan for, in the order they will be
+            requested.
+        """
+        self._gcvf = gcvf
+        self.last_bytes = {}
+        to_read = []
+        for key in keys:
+            index_memo = locations[key][0]
+            read_memo = index_memo[0:3]
+            end = index_memo[4]
+            last_byte = self.last_bytes.get(read_memo)
+            if last_byte is None:
+                self.last_bytes[read_memo] = end
+                if read_memo not in gcvf._group_cache:
+                    to_read.append(read_memo)
+            elif end > last_byte:
+                self.last_bytes[read_memo] = end
+        # get_raw_records only starts reading when first iterated.
+        self._to_read = collections.deque(to_read)
+        self._pending = set(to_read)
+        self._raw_records = gcvf._access.get_raw_records(to_read)
+
+    def _read_block(self, read_memo):
+        """Return the planned block for read_memo.
+
+        The blocks of any memos planned before read_memo are read and cached
+        on the way, as they share the readv.
+        """
+        while self._to_read:
+            next_memo = self._to_read.popleft()
+            self._pending.discard(next_memo)
+            block = GroupCompressBlock.from_bytes(self._raw_records.next())
+            self._gcvf._group_cache[next_memo] = block
+            if next_memo == read_memo:
+                return block
+        raise AssertionError('%r is not in the read plan' % (read_memo,))
+
+    def get_blocks(self, read_memos):
+        """Get GroupCompressBlocks for read_memos.
+
+        :return: a series of (read_memo, block) pairs, in the order of
+            read_memos, as GroupCompressVersionedFiles._get_blocks does.
+        """
+        for read_memo in read_memos:
+            if read_memo in self._pending:
+                yield read_memo, self._read_block(read_memo)
+            else:
+                # Not planned, or planned while cached and evicted since.
+                for result in self._gcvf._get_blocks([read_memo]):
+                    yield result
+
+
 class _BatchingBlockFetcher(object):
     """Fetch group compress blocks in batches.
 
@@ -1097,6 +1255,16 @@ class _BatchingBlockFetcher(object):
         self.last_read_memo = None
         self.manager = None
         self._get_compressor_settings = get_compressor_settings
+        self._plan = None
+
+    def plan_reads(self, keys):
+        """Plan the block reads for all the keys that will be added.
+
+        Batches then take their blocks from a single read of each pack, so
+        keys should be added in the order given here, which should be the
+        order of their blocks in the packs.
+        """
+        self._plan = _BlockReadPlan(self.gcvf, self.locations, keys)
 
     def add_key(self, key):
         """Add another to key to fetch.
@@ -1150,7 +1318,10 @@ class _BatchingBlockFetcher(object):
         if self.manager is None and not self.keys:
             return
         # Fetch all memos in this batch.
-        blocks = self.gcvf._get_blocks(self.memos_to_get)
+        if self._plan is None:
+            blocks = self.gcvf._get_blocks(self.memos_to_get)
+        else:
+            blocks = self._plan.get_blocks(self.memos_to_get)
         # Turn blocks into factories and yield them.
         memos_to_get_stack = list(self.memos_to_get)
         memos_to_get_stack.reverse()
@@ -1178,6 +1349,11 @@ class _BatchingBlockFetcher(object):
                     block = self.batch_memos[read_memo]
                 self.manager = _LazyGroupContentManager(block,
                     get_compressor_settings=self._get_compressor_settings)
+                if self._plan is not None:
+                    # Decompress what later batches need from this block at
+                    # the same time.
+                    self.manager._last_byte = self._plan.last_bytes.get(
+                        read_memo, 0)
                 self.last_read_memo = read_memo
             start, end = index_memo[3:5]
             self.manager.add_factory(key, parents, start, end)
@@ -1190,6 +1366,161 @@ class _BatchingBlockFetcher(object):
         self.total_bytes = 0
 
 
+class _SharedBlockCache(object):
+    """A size bounded cache of GroupCompressBlocks shared by the process.
+
+    Blocks are cached by the location of the pack they were read from, so
+    every GroupCompressVersionedFiles reading a given pack (the texts,
+    inventories and chk_bytes of a repository, and any other repository
+    object opened on the same transport) finds the blocks the others have
+    already read and decompressed.
+
+    :ivar hits: How many lookups found their block.
+    :ivar misses: How many lookups did not find their block.
+    :ivar evictions: How many blocks were dropped to stay within budget.
+    """
+
+    def __init__(self, max_size):
+        self._lock = threading.Lock()
+        self._cache = LRUSizeCache(max_size=max_size)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the cached block for key, or None."""
+        self._lock.acquire()
+        try:
+            block = self._cache.get(key)
+            if block is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return block
+        finally:
+            self._lock.release()
+
+    def add(self, key, block):
+        """Cache a block, which may now be used by several threads."""
+        if block._content_lock is None:
+            block._content_lock = threading.Lock()
+        self._lock.acquire()
+        try:
+            old_len = len(self._cache)
+            had_key = key in self._cache
+            self._cache[key] = block
+            evicted = old_len - len(self._cache)
+            if not had_key:
+                evicted += 1
+            if evicted > 0:
+                self.evictions += evicted
+                if 'memory' in debug.debug_flags:
+                    trace.mutter('block cache: %s', self.stats_summary())
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._cache.clear()
+        finally:
+            self._lock.release()
+
+    def __contains__(self, key):
+        # Not a lookup, so the counters are left alone.
+        return key in self._cache
+
+    def __len__(self):
+        return len(self._cache)
+
+    def stats_summary(self):
+        return ('%d hits, %d misses, %d evictions, %d blocks, %d/%d bytes'
+                % (self.hits, self.misses, self.evictions, len(self._cache),
+                   self._cache._value_size, self._cache._max_size))
+
+
+_shared_block_cache = None
+
+
+def _get_shared_block_cache():
+    """Return the process wide block cache, or None if it is disabled.
+
+    The cache is created on first use, with the size from the
+    ``bzr.groupcompress.block_cache_size`` option.
+    """
+    global _shared_block_cache
+    if _shared_block_cache is None:
+        max_size = config.GlobalStack().get(
+            'bzr.groupcompress.block_cache_size')
+        if max_size is None or max_size <= 0:
+            return None
+        _shared_block_cache = _SharedBlockCache(max_size)
+    return _shared_block_cache
+
+
+class _SharedGroupCache(object):
+    """A view of the process wide block cache for one pack access object.
+
+    This translates the (index, offset, length) read memos used by a
+    GroupCompressVersionedFiles into keys naming the pack file, and
+    otherwise behaves enough like the LRUSizeCache it replaces.
+    """
+
+    def __init__(self, shared_cache, access):
+        self._shared_cache = shared_cache
+        self._access = access
+
+    def _shared_key(self, read_memo):
+        index, offset, length = read_memo
+        transport, name = self._access._indices[index]
+        return (transport.base, name, offset, length)
+
+    def __getitem__(self, read_memo):
+        try:
+            key = self._shared_key(read_memo)
+        except KeyError:
+            # The index is no longer in use, a reload will sort it out.
+            raise KeyError(read_memo)
+        block = self._shared_cache.get(key)
+        if block is None:
+            raise KeyError(read_memo)
+        return block
+
+    def __setitem__(self, read_memo, block):
+        try:
+            key = self._shared_key(read_memo)
+        except KeyError:
+            return
+        self._shared_cache.add(key, block)
+
+    def __contains__(self, read_memo):
+        try:
+            key = self._shared_key(read_memo)
+        except KeyError:
+            return False
+        return key in self._shared_cache
+
+    def __len__(self):
+        return len(self._shared_cache)
+
+    def clear(self):
+        # The blocks may be in use by other repositories, and the shared
+        # budget already bounds the memory, so there is nothing to do.
+        pass
+
+
+def shared_group_cache(access):
+    """Get a block cache for a GroupCompressVersionedFiles using access.
+
+    :return: A view onto the process wide block cache, or a private
+        LRUSizeCache if the shared cache is disabled.
+    """
+    shared_cache = _get_shared_block_cache()
+    if shared_cache is None:
+        return LRUSizeCache(max_size=50*1024*1024)
+    return _SharedGroupCache(shared_cache, access)
+
+
 class GroupCompressVersionedFiles(VersionedFilesWithFallbacks):
     """A group-compress based VersionedFiles implementation."""
 
@@ -1204,6 +1535,9 @@ class GroupCompressVersionedFiles(VersionedFilesWithFallbacks):
     _DEFAULT_MAX_BYTES_TO_INDEX = 1024 * 1024
     _DEFAULT_COMPRESSOR_SETTINGS = {'max_bytes_to_index':
                                      _DEFAULT_MAX_BYTES_TO_INDEX}
+    # When compressing in parallel, how many bytes of fulltext make up the
+    # range of texts handed to a single worker.
+    _PARALLEL_RANGE_SIZE = 16 * 1024 * 1024
 
     def __init__(self, index, access, delta=True, _unadded_refs=None,
                  _group_cache=None):
@@ -1592,6 +1926,12 @@ class GroupCompressVersionedFiles(VersionedFilesWithFallbacks):
         #  - the total bytes to retrieve for this batch > BATCH_SIZE
         batcher = _BatchingBlockFetcher(self, locations,
             get_compressor_settings=self._get_compressor_settings)
+        if ordering == 'unordered':
+            # The keys are sorted by their position in the packs, so all their
+            # blocks can be read in one go.
+            batcher.plan_reads([key for source, keys in source_keys
+                                if source is self
+                                for key in keys if key in locations])
         for source, keys in source_keys:
             if source is self:
                 for key in keys:
@@ -1801,18 +2141,8 @@ class GroupCompressVersionedFiles(VersionedFilesWithFallbacks):
                                                nostore_sha=nostore_sha)
             # delta_ratio = float(len(bytes)) / (end_point - start_point)
             # Check if we want to continue to include that text
-            if (prefix == max_fulltext_prefix
-                and end_point < 2 * max_fulltext_len):
-                # As long as we are on the same file_id, we will fill at least
-                # 2 * max_fulltext_len
-                start_new_block = False
-            elif end_point > 4*1024*1024:
-                start_new_block = True
-            elif (prefix is not None and prefix != last_prefix
-                  and end_point > 2*1024*1024):
-                start_new_block = True
-            else:
-                start_new_block = False
+            start_new_block = _should_start_new_block(prefix, last_prefix,
+                max_fulltext_prefix, max_fulltext_len, end_point)
             last_prefix = prefix
             if start_new_block:
                 self._compressor.pop_last()
@@ -1838,6 +2168,108 @@ class GroupCompressVersionedFiles(VersionedFilesWithFallbacks):
             flush()
         self._compressor = None
 
+    def _insert_record_stream_parallel(self, stream, pool, random_id=False,
+                                       max_pending=2):
+        """Insert a record stream, compressing the groups in a worker pool.
+
+        The stream is cut into ranges of about _PARALLEL_RANGE_SIZE bytes of
+        fulltext, preferably at a change of prefix. Each range is compressed
+        independently by _compress_text_range, and the resulting blocks are
+        written and indexed here, in stream order. Existing blocks are never
+        reused, as for _insert_record_stream(reuse_blocks=False).
+
+        :param stream: A stream of records to insert.
+        :param pool: The pool to compress in; any object with an apply_async
+            method like multiprocessing.Pool's.
+        :param max_pending: How many ranges may be queued in the pool before
+            we wait for the oldest one to be written out.
+        :return: An iterator over the sha1 of the inserted records.
+        """
+        adapters = {}
+        def get_adapter(adapter_key):
+            try:
+                return adapters[adapter_key]
+            except KeyError:
+                adapter_factory = adapter_registry.get(adapter_key)
+                adapter = adapter_factory(self)
+                adapters[adapter_key] = adapter
+                return adapter
+        settings = self._get_compressor_settings()
+        as_st = static_tuple.StaticTuple.from_sequence
+        def write_range(async_result, range_parents):
+            """Write out the blocks of one range, returning their sha1s."""
+            sha1s = []
+            parents_iter = iter(range_parents)
+            for block_bytes, entries in async_result.get():
+                _, start, length = self._access.add_raw_records(
+                    [(None, len(block_bytes))], block_bytes)[0]
+                nodes = []
+                for key, sha1, start_point, end_point in entries:
+                    parents = parents_iter.next()
+                    if key[-1] is None:
+                        key = key[:-1] + ('sha1:' + sha1,)
+                    if parents is not None:
+                        parents = as_st([as_st(p) for p in parents])
+                    nodes.append((as_st(key),
+                        "%d %d %d %d" % (start, length, start_point,
+                                         end_point),
+                        static_tuple.StaticTuple(parents)))
+                    sha1s.append(sha1)
+                self._index.add_records(nodes, random_id=random_id)
+            return sha1s
+        pending = []
+        texts = []
+        range_parents = []
+        range_bytes = 0
+        last_prefix = None
+        inserted_keys = set()
+        for record in stream:
+            if record.storage_kind == 'absent':
+                raise errors.RevisionNotPresent(record.key, self)
+            if random_id:
+                if record.key in inserted_keys:
+                    trace.note(gettext('Insert claimed random_id=True,'
+                               ' but then inserted %r two times'), record.key)
+                    continue
+                inserted_keys.add(record.key)
+            try:
+                bytes = record.get_bytes_as('fulltext')
+            except errors.UnavailableRepresentation:
+                adapter_key = record.storage_kind, 'fulltext'
+                adapter = get_adapter(adapter_key)
+                bytes = adapter.get_bytes(record)
+            if len(record.key) > 1:
+                prefix = record.key[0]
+            else:
+                prefix = None
+            if texts and (range_bytes > 4 * self._PARALLEL_RANGE_SIZE
+                or (range_bytes > self._PARALLEL_RANGE_SIZE
+                    and (prefix is None or prefix != last_prefix))):
+                pending.append((pool.apply_async(_compress_text_range,
+                                                 (texts, settings)),
+                                range_parents))
+                texts = []
+                range_parents = []
+                range_bytes = 0
+                while len(pending) > max_pending:
+                    for sha1 in write_range(*pending.pop(0)):
+                        yield sha1
+            last_prefix = prefix
+            if record.parents is None:
+                parents = None
+            else:
+                parents = tuple([tuple(p) for p in record.parents])
+            texts.append((tuple(record.key), record.sha1, bytes))
+            range_parents.append(parents)
+            range_bytes += len(bytes)
+        if texts:
+            pending.append((pool.apply_async(_compress_text_range,
+                                             (texts, settings)),
+                            range_parents))
+        for async_result, range_parents in pending:
+            for sha1 in write_range(async_result, range_parents):
+                yield sha1
+
     def iter_lines_added_or_present_in_keys(self, keys, pb=None):
         """Iterate over the lines in the versioned files from keys.
 
@@ -1889,6 +2321,191 @@ class GroupCompressVersionedFiles(VersionedFilesWithFallbacks):
         return result
 
 
+# ChunkedGroupCompressVersionedFiles splits texts of at least this many bytes
+# into content-defined chunks.
+_CHUNKING_MIN_TEXT_SIZE = 1024 * 1024
+_CHUNK_MIN_SIZE = 16 * 1024
+_CHUNK_MAX_SIZE = 1024 * 1024
+# How many bytes before a candidate boundary decide whether it is used.
+_CHUNK_WINDOW = 48
+# One candidate boundary in 1024 is used.
+_CHUNK_BOUNDARY_MASK = 0x3ff
+_CHUNKED_TEXT_SIGNATURE = 'bzr chunked text 1\n'
+
+
+def _content_defined_chunks(bytes):
+    """Split bytes into chunks whose boundaries depend only on their content.
+
+    The candidate boundaries are the newlines in bytes, found with str.find,
+    and a candidate ends a chunk when the crc32 of the _CHUNK_WINDOW bytes
+    up to it matches _CHUNK_BOUNDARY_MASK. Inserting or removing data only
+    moves the boundaries near the change, so the same content gives the same
+    chunks wherever it appears in a text.
+
+    :return: A list of strings which join to bytes.
+    """
+    chunks = []
+    start = 0
+    length = len(bytes)
+    while start < length:
+        end = min(start + _CHUNK_MAX_SIZE, length)
+        cut = end
+        pos = bytes.find('\n', start + _CHUNK_MIN_SIZE - 1, end)
+        while pos != -1:
+            window = bytes[pos + 1 - _CHUNK_WINDOW:pos + 1]
+            if not zlib.crc32(window) & _CHUNK_BOUNDARY_MASK:
+                cut = pos + 1
+                break
+            pos = bytes.find('\n', pos + 1, end)
+        chunks.append(bytes[start:cut])
+        start = cut
+    return chunks
+
+
+class ChunkedGroupCompressVersionedFiles(GroupCompressVersionedFiles):
+    """A GroupCompressVersionedFiles that stores large texts as chunk lists.
+
+    Texts of at least _CHUNKING_MIN_TEXT_SIZE bytes are split with
+    _content_defined_chunks, and each chunk is stored once, keyed by its
+    sha1, in a separate chunk store (the chk_bytes of the repository). The
+    text itself is stored as the list of its chunk keys, so a large file that
+    is renamed, copied or re-added only costs a new list.
+
+    Stored texts that start with _CHUNKED_TEXT_SIGNATURE are always chunk
+    lists: texts which happen to start with it are chunked whatever their
+    size.
+    """
+
+    def __init__(self, index, access, chunk_store, delta=True,
+                 _unadded_refs=None, _group_cache=None):
+        """Create a ChunkedGroupCompressVersionedFiles object.
+
+        :param chunk_store: The VersionedFiles to store chunks in.
+        See GroupCompressVersionedFiles.__init__ for the other parameters.
+        """
+        super(ChunkedGroupCompressVersionedFiles, self).__init__(index,
+            access, delta=delta, _unadded_refs=_unadded_refs,
+            _group_cache=_group_cache)
+        self._chunk_store = chunk_store
+
+    def without_fallbacks(self):
+        """Return a clone of this object without any fallbacks configured."""
+        return ChunkedGroupCompressVersionedFiles(self._index, self._access,
+            self._chunk_store, self._delta,
+            _unadded_refs=dict(self._unadded_refs),
+            _group_cache=self._group_cache)
+
+    def _add_chunks(self, bytes):
+        """Store the chunks of bytes that are not already stored.
+
+        :return: The chunk list to store in place of bytes.
+        """
+        chunks = _content_defined_chunks(bytes)
+        keys = [('sha1:' + osutils.sha_string(chunk),) for chunk in chunks]
+        # Chunks only present in a fallback are stored again, so that texts
+        # can be read without the fallback, as for chk pages.
+        seen = set(self._chunk_store._index.get_parent_map(keys))
+        records = []
+        for key, chunk in zip(keys, chunks):
+            if key in seen:
+                continue
+            seen.add(key)
+            records.append(FulltextContentFactory(key, None, key[0][5:],
+                                                  chunk))
+        if records:
+            self._chunk_store.insert_record_stream(records)
+        return _CHUNKED_TEXT_SIGNATURE + ''.join(
+            [key[0] + '\n' for key in keys])
+
+    def _expand_chunks(self, chunk_list):
+        """Return the text stored as chunk_list."""
+        keys = [(line,) for line in
+                chunk_list[len(_CHUNKED_TEXT_SIGNATURE):].split('\n')[:-1]]
+        chunks = {}
+        for record in self._chunk_store.get_record_stream(keys, 'unordered',
+                                                          True):
+            if record.storage_kind == 'absent':
+                raise errors.RevisionNotPresent(record.key, self._chunk_store)
+            chunks[record.key] = record.get_bytes_as('fulltext')
+        return ''.join([chunks[key] for key in keys])
+
+    def get_record_stream(self, keys, ordering, include_delta_closure):
+        """See VersionedFiles.get_record_stream().
+
+        All records are returned as fulltexts, with chunk lists expanded.
+        """
+        if self._immediate_fallback_vfs:
+            # Records from fallbacks are already expanded.
+            keys = list(keys)
+            local_keys = set(self._index.get_parent_map(keys))
+            local_keys.update([key for key in keys
+                               if key in self._unadded_refs])
+        else:
+            local_keys = None
+        for record in super(ChunkedGroupCompressVersionedFiles,
+            self).get_record_stream(keys, ordering, include_delta_closure):
+            if record.storage_kind == 'absent' or (
+                local_keys is not None and record.key not in local_keys):
+                yield record
+                continue
+            bytes = record.get_bytes_as('fulltext')
+            if bytes.startswith(_CHUNKED_TEXT_SIGNATURE):
+                yield FulltextContentFactory(record.key, record.parents, None,
+                                             self._expand_chunks(bytes))
+            else:
+                yield FulltextContentFactory(record.key, record.parents,
+                                             record.sha1, bytes)
+
+    def _chunk_record_stream(self, stream, nostore_sha, chunked_sha1s):
+        """Replace the large texts in stream by chunk lists.
+
+        :param chunked_sha1s: A dict updated with the sha1 of each chunk list
+            mapped to that of the text it replaces.
+        """
+        adapters = {}
+        for record in stream:
+            if record.storage_kind == 'absent':
+                yield record
+                continue
+            try:
+                bytes = record.get_bytes_as('fulltext')
+            except errors.UnavailableRepresentation:
+                adapter_key = record.storage_kind, 'fulltext'
+                try:
+                    adapter = adapters[adapter_key]
+                except KeyError:
+                    adapter = adapter_registry.get(adapter_key)(self)
+                    adapters[adapter_key] = adapter
+                bytes = adapter.get_bytes(record)
+            if (len(bytes) < _CHUNKING_MIN_TEXT_SIZE
+                and not bytes.startswith(_CHUNKED_TEXT_SIGNATURE)):
+                yield FulltextContentFactory(record.key, record.parents,
+                                             record.sha1, bytes)
+                continue
+            sha1 = osutils.sha_string(bytes)
+            if sha1 == nostore_sha:
+                raise errors.ExistingContent()
+            chunk_list = self._add_chunks(bytes)
+            chunked_sha1s[osutils.sha_string(chunk_list)] = sha1
+            yield FulltextContentFactory(record.key, record.parents, None,
+                                         chunk_list)
+
+    def _insert_record_stream(self, stream, random_id=False, nostore_sha=None,
+                              reuse_blocks=True):
+        """See GroupCompressVersionedFiles._insert_record_stream.
+
+        Blocks are never reused: one from another store may hold large texts
+        that are not chunked.
+        """
+        chunked_sha1s = {}
+        stream = self._chunk_record_stream(stream, nostore_sha, chunked_sha1s)
+        for sha1 in super(ChunkedGroupCompressVersionedFiles,
+            self)._insert_record_stream(stream, random_id=random_id,
+                                        nostore_sha=nostore_sha,
+                                        reuse_blocks=False):
+            yield chunked_sha1s.pop(sha1, sha1)
+
+
 class _GCBuildDetails(object):
     """A blob of data about the build details.
 
@@ -1249,6 +1249,18 @@ class GraphIndex(object):
             pass
 
 
+def _keys_maybe_in(index, keys):
+    """Return the subset of keys that might be present in index.
+
+    If the index has a bloom filter, keys it rules out are dropped, otherwise
+    keys is returned unaltered.
+    """
+    bloom_filter = getattr(index, '_bloom_filter', None)
+    if bloom_filter is None:
+        return keys
+    return set([key for key in keys if key in bloom_filter])
+
+
 class CombinedGraphIndex(object):
     """A GraphIndex made up from smaller GraphIndices.
 
@@ -1364,8 +1376,11 @@ class CombinedGraphIndex(object):
                 for index in self._indices:
                     if not keys:
                         break
+                    index_keys = _keys_maybe_in(index, keys)
+                    if not index_keys:
+                        continue
                     index_hit = False
-                    for node in index.iter_entries(keys):
+                    for node in index.iter_entries(index_keys):
                         keys.remove(node[1])
                         yield node
                         index_hit = True
@@ -1523,6 +1538,13 @@ class CombinedGraphIndex(object):
                 #     len(parent_map), len(index_missing_keys))
                 while search_keys:
                     sub_generation += 1
+                    maybe_keys = _keys_maybe_in(index, search_keys)
+                    if len(maybe_keys) != len(search_keys):
+                        index_missing_keys.update(
+                            search_keys.difference(maybe_keys))
+                        search_keys = maybe_keys
+                        if not search_keys:
+                            break
                     # TODO: ref_list_num should really be a parameter, since
                     #       CombinedGraphIndex does not know what the ref lists
                     #       mean.
@@ -23,6 +23,7 @@ from __future__ import absolute_import
 
 from bzrlib.lazy_import import lazy_import
 lazy_import(globals(), """
+import collections
 import operator
 import os
 import re
@@ -38,7 +39,9 @@ from bzrlib import (
     trace,
     transport as _mod_transport,
     tree,
+    ui,
     )
+from bzrlib.i18n import gettext
 """)
 
 from bzrlib.decorators import needs_read_lock, needs_write_lock
@@ -333,7 +336,7 @@ class MutableTree(tree.Tree):
         The intent of this function is to allow trees that have a hashcache to
         update the hashcache during commit. If the observed file is too new
         (based on the stat_value) to be safely hash-cached the tree will ignore
-        it.
+        it, or keep it aside until it can be trusted.
 
         The default implementation does nothing.
 
@@ -398,6 +401,11 @@ class MutableTree(tree.Tree):
 
 class MutableInventoryTree(MutableTree, tree.InventoryTree):
 
+    # How many additions smart_add may apply to the tree at once while it is
+    # still walking, or None to apply them all at the end. Only worth setting
+    # where applying a delta costs about as much as the delta is big.
+    _smart_add_batch_size = None
+
     @needs_tree_write_lock
     def apply_inventory_delta(self, changes):
         """Apply changes to the inventory as an atomic operation.
@@ -449,7 +457,11 @@ class MutableInventoryTree(MutableTree, tree.InventoryTree):
                 conflicts_related.update(c.associated_filenames())
         else:
             conflicts_related = None
-        adder = _SmartAddHelper(self, action, conflicts_related)
+        if save:
+            batch_size = self._smart_add_batch_size
+        else:
+            batch_size = None
+        adder = _SmartAddHelper(self, action, conflicts_related, batch_size)
         adder.add(file_list, recurse=recurse)
         if save:
             invdelta = adder.get_inventory_delta()
@@ -554,8 +566,24 @@ class _SmartAddHelper(object):
     """Helper for MutableTree.smart_add."""
 
     def get_inventory_delta(self):
+        """Return the part of the inventory delta not applied yet."""
         return self._invdelta.values()
 
+    def _apply_batch(self):
+        """Apply the inventory delta gathered so far to the tree.
+
+        This keeps the memory used by huge adds down. Every entry's parent is
+        added before it, so each batch is a valid delta on its own, and if
+        the add is interrupted, running it again carries on from the
+        batches already applied.
+        """
+        for inv_path in self._user_paths:
+            entry = self._invdelta.get(inv_path)
+            if entry is not None:
+                self._applied_user_entries[inv_path] = entry
+        self.tree.apply_inventory_delta(self._invdelta.values())
+        self._invdelta.clear()
+
     def _get_ie(self, inv_path):
         """Retrieve the most up to date inventory entry for a path.
 
@@ -642,13 +670,23 @@ class _SmartAddHelper(object):
                 yield (path, inv_path, this_ie, None)
             prev_dir = path
         
-    def __init__(self, tree, action, conflicts_related=None):
+    def __init__(self, tree, action, conflicts_related=None, batch_size=None):
+        """Create a _SmartAddHelper.
+
+        :param batch_size: If not None, apply the inventory delta to the tree
+            whenever this many entries are pending while walking directories.
+        """
         self.tree = tree
         if action is None:
             self.action = add.AddAction()
         else:
             self.action = action
+        self._batch_size = batch_size
         self._invdelta = {}
+        # The paths added before walking, which the walk looks up in the
+        # delta, and those of them already applied to the tree.
+        self._user_paths = ()
+        self._applied_user_entries = {}
         self.added = []
         self.ignored = {}
         if conflicts_related is None:
@@ -657,7 +695,6 @@ class _SmartAddHelper(object):
             self.conflicts_related = conflicts_related
 
     def add(self, file_list, recurse=True):
-        from bzrlib.inventory import InventoryEntry
         if not file_list:
             # no paths supplied: add the entire tree.
             # FIXME: this assumes we are running in a working tree subdir :-/
@@ -699,10 +736,25 @@ class _SmartAddHelper(object):
             # no need to walk any directories at all.
             return
 
-        things_to_add = list(self._gather_dirs_to_add(user_dirs))
+        things_to_add = collections.deque(self._gather_dirs_to_add(user_dirs))
+        self._user_paths = list(self._invdelta)
+        pb = ui.ui_factory.nested_progress_bar()
+        try:
+            self._add_queued(things_to_add, pb)
+        finally:
+            pb.finished()
+
+    def _add_queued(self, things_to_add, pb):
+        """Add the paths in the things_to_add queue, and what is below them.
 
+        Entries are dropped from the queue as they are done, so that a huge
+        add only holds on to what it has yet to look at.
+        """
+        from bzrlib.inventory import InventoryEntry
         illegalpath_re = re.compile(r'[\r\n]')
-        for directory, inv_path, this_ie, parent_ie in things_to_add:
+        while things_to_add:
+            directory, inv_path, this_ie, parent_ie = things_to_add.popleft()
+            pb.update(gettext('Adding files'), len(self.added))
             # directory is tree-relative
             abspath = self.tree.abspath(directory)
 
@@ -766,6 +818,13 @@ class _SmartAddHelper(object):
             if kind == 'directory' and not sub_tree:
                 if this_ie.kind != 'directory':
                     this_ie = self._convert_to_directory(this_ie, inv_path)
+            # Apply the delta as soon as it reaches the batch size, so that
+            # a long run of files cannot grow it further.
+            if (self._batch_size is not None
+                and len(self._invdelta) >= self._batch_size):
+                self._apply_batch()
+
+            if kind == 'directory' and not sub_tree:
 
                 for subf in sorted(os.listdir(abspath)):
                     inv_f, _ = osutils.normalized_filename(subf)
@@ -781,6 +840,8 @@ class _SmartAddHelper(object):
                         continue
                     sub_invp = osutils.pathjoin(inv_path, inv_f)
                     entry = self._invdelta.get(sub_invp)
+                    if entry is None:
+                        entry = self._applied_user_entries.get(sub_invp)
                     if entry is not None:
                         sub_ie = entry[3]
                     else:
@@ -1821,13 +1821,14 @@ class DirReader(object):
 _selected_dir_reader = None
 
 
-def _walkdirs_utf8(top, prefix=""):
+def _walkdirs_utf8(top, prefix="", dir_reader=None):
     """Yield data about all the directories in a tree.
 
     This yields the same information as walkdirs() only each entry is yielded
     in utf-8. On platforms which have a filesystem encoding of utf8 the paths
     are returned as exact byte-strings.
 
+    :param dir_reader: A DirReader to use instead of the platform's default.
     :return: yields a tuple of (dir_info, [file_info])
         dir_info is (utf8_relpath, path-from-top)
         file_info is (utf8_relpath, utf8_name, kind, lstat, path-from-top)
@@ -1835,6 +1836,27 @@ def _walkdirs_utf8(top, prefix=""):
         path-from-top might be unicode or utf8, but it is the correct path to
         pass to os functions to affect the file in question. (such as os.lstat)
     """
+    if dir_reader is None:
+        dir_reader = _get_selected_dir_reader()
+    # 0 - relpath, 1- basename, 2- kind, 3- stat, 4-toppath
+    # But we don't actually uses 1-3 in pending, so set them to None
+    pending = [[dir_reader.top_prefix_to_starting_dir(top, prefix)]]
+    read_dir = dir_reader.read_dir
+    _directory = _directory_kind
+    while pending:
+        relroot, _, _, _, top = pending[-1].pop()
+        if not pending[-1]:
+            pending.pop()
+        dirblock = sorted(read_dir(relroot, top))
+        yield (relroot, top), dirblock
+        # push the user specified dirs from dirblock
+        next = [d for d in reversed(dirblock) if d[2] == _directory]
+        if next:
+            pending.append(next)
+
+
+def _get_selected_dir_reader():
+    """Get the fastest DirReader available for this platform."""
     global _selected_dir_reader
     if _selected_dir_reader is None:
         if sys.platform == "win32" and win32utils.winver == 'Windows NT':
@@ -1859,22 +1881,7 @@ def _walkdirs_utf8(top, prefix=""):
     if _selected_dir_reader is None:
         # Fallback to the python version
         _selected_dir_reader = UnicodeDirReader()
-
-    # 0 - relpath, 1- basename, 2- kind, 3- stat, 4-toppath
-    # But we don't actually uses 1-3 in pending, so set them to None
-    pending = [[_selected_dir_reader.top_prefix_to_starting_dir(top, prefix)]]
-    read_dir = _selected_dir_reader.read_dir
-    _directory = _directory_kind
-    while pending:
-        relroot, _, _, _, top = pending[-1].pop()
-        if not pending[-1]:
-            pending.pop()
-        dirblock = sorted(read_dir(relroot, top))
-        yield (relroot, top), dirblock
-        # push the user specified dirs from dirblock
-        next = [d for d in reversed(dirblock) if d[2] == _directory]
-        if next:
-            pending.append(next)
+    return _selected_dir_reader
 
 
 class UnicodeDirReader(DirReader):
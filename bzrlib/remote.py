@@ -94,6 +94,15 @@ class _RpcHelper(object):
         except errors.ErrorFromSmartServer, err:
             self._translate_error(err, **err_context)
 
+    def _read_pipelined_response(self, pipelined_call, **err_context):
+        """Read the response to a call made with _client.call_pipelined."""
+        try:
+            response, response_handler = pipelined_call.read_response()
+        except errors.ErrorFromSmartServer, err:
+            self._translate_error(err, **err_context)
+        response_handler.cancel_read_body()
+        return response
+
 
 def response_tuple_to_repo_format(response):
     """Convert a response tuple describing a repository format to a format."""
@@ -1490,6 +1499,43 @@ class RemoteRepository(_mod_repository.Repository, _RpcHelper,
 
         return result
 
+    def gather_storage_stats(self):
+        """See Repository.gather_storage_stats()."""
+        path = self.bzrdir._path_for_remote_call(self._client)
+        try:
+            response_tuple, response_handler = self._client.call_expecting_body(
+                'Repository.gather_storage_stats', path)
+        except errors.UnknownSmartMethod:
+            self._ensure_real()
+            return self._real_repository.gather_storage_stats()
+        except errors.ErrorFromSmartServer, err:
+            if err.error_verb == 'UnsupportedOperation':
+                raise errors.UnsupportedOperation(self.gather_storage_stats,
+                    self)
+            self._translate_error(err)
+        if response_tuple[0] != 'ok':
+            raise errors.UnexpectedSmartServerResponse(response_tuple)
+        body = response_handler.read_body_bytes()
+        result = {'earliest': None, 'latest': None, 'indices': {}}
+        for line in body.split('\n'):
+            if not line:
+                continue
+            key, val_text = line.split(': ')
+            if key in ('packs', 'size'):
+                result[key] = int(val_text)
+            elif key in ('earliest', 'latest'):
+                result[key] = float(val_text)
+            elif key.startswith('index '):
+                records, compressed, uncompressed = val_text.split(' ')
+                if uncompressed == '-':
+                    uncompressed = None
+                else:
+                    uncompressed = int(uncompressed)
+                result['indices'][key[len('index '):]] = {
+                    'records': int(records), 'compressed': int(compressed),
+                    'uncompressed': uncompressed}
+        return result
+
     def find_branches(self, using=False):
         """See Repository.find_branches()."""
         # should be an API call to the server.
@@ -2584,6 +2630,13 @@ class RemoteRepository(_mod_repository.Repository, _RpcHelper,
         if response != ('ok', ):
             raise errors.UnexpectedSmartServerResponse(response)
 
+    def collect_garbage(self, revision_ids, dead_ratio=0.1, dry_run=False,
+                        clean_obsolete_packs=False):
+        self._ensure_real()
+        return self._real_repository.collect_garbage(revision_ids,
+            dead_ratio=dead_ratio, dry_run=dry_run,
+            clean_obsolete_packs=clean_obsolete_packs)
+
     @property
     def revisions(self):
         """Decorate the real repository for now.
@@ -3455,6 +3508,9 @@ class RemoteBranch(branch.Branch, _RpcHelper, lock._RelockDebugMixin):
 
     def _clear_cached_state(self):
         super(RemoteBranch, self)._clear_cached_state()
+        # Calls sent by _prefetch_tip_and_tags, not read yet.
+        self._pending_last_revision_info = None
+        self._pending_tags_bytes = None
         if self._real_branch is not None:
             self._real_branch._clear_cached_state()
 
@@ -3545,7 +3601,13 @@ class RemoteBranch(branch.Branch, _RpcHelper, lock._RelockDebugMixin):
         if medium._is_remote_before((1, 13)):
             return self._vfs_get_tags_bytes()
         try:
-            response = self._call('Branch.get_tags_bytes', self._remote_path())
+            if self._pending_tags_bytes is not None:
+                pending_call = self._pending_tags_bytes
+                self._pending_tags_bytes = None
+                response = self._read_pipelined_response(pending_call)
+            else:
+                response = self._call('Branch.get_tags_bytes',
+                                      self._remote_path())
         except errors.UnknownSmartMethod:
             medium._remember_remote_is_before((1, 13))
             return self._vfs_get_tags_bytes()
@@ -3725,8 +3787,32 @@ class RemoteBranch(branch.Branch, _RpcHelper, lock._RelockDebugMixin):
             missing_parent = parent_map[missing_parent]
         raise errors.RevisionNotPresent(missing_parent, self.repository)
 
+    def _prefetch_tip_and_tags(self):
+        """See Branch._prefetch_tip_and_tags.
+
+        Both calls are sent before either response is read, saving a round
+        trip.
+        """
+        if (not self.is_locked()
+            or self._last_revision_info_cache is not None
+            or self._tags_bytes is not None
+            or self._client._medium._is_remote_before((1, 13))
+            or not self.supports_tags()):
+            return
+        path = self._remote_path()
+        self._pending_last_revision_info = self._client.call_pipelined(
+            'Branch.last_revision_info', path)
+        self._pending_tags_bytes = self._client.call_pipelined(
+            'Branch.get_tags_bytes', path)
+
     def _read_last_revision_info(self):
-        response = self._call('Branch.last_revision_info', self._remote_path())
+        if self._pending_last_revision_info is not None:
+            pending_call = self._pending_last_revision_info
+            self._pending_last_revision_info = None
+            response = self._read_pipelined_response(pending_call)
+        else:
+            response = self._call('Branch.last_revision_info',
+                                  self._remote_path())
         if response[0] != 'ok':
             raise SmartProtocolError('unexpected response code %s' % (response,))
         revno = int(response[1])
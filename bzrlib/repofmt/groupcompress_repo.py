@@ -26,6 +26,7 @@ from bzrlib import (
     chk_serializer,
     debug,
     errors,
+    groupcompress,
     index as _mod_index,
     inventory,
     osutils,
@@ -162,6 +163,8 @@ class GCPack(NewPack):
         self._state = 'open'
         # no name until we finish writing the content
         self.name = None
+        # See NewPack.__init__.
+        self.revision_timestamps = None
 
     def _check_references(self):
         """Make sure our external references are present.
@@ -191,6 +194,11 @@ class ResumedGCPack(ResumedPack):
 class GCCHKPacker(Packer):
     """This class understand what it takes to collect a GCCHK repo."""
 
+    # Can the texts be compressed in a pool of worker processes? Subclasses
+    # that rely on texts being inserted as soon as they are streamed should
+    # set this to False.
+    _supports_parallel_compression = True
+
     def __init__(self, pack_collection, packs, suffix, revision_ids=None,
                  reload_func=None):
         super(GCCHKPacker, self).__init__(pack_collection, packs, suffix,
@@ -206,6 +214,9 @@ class GCCHKPacker(Packer):
         self._text_refs = None
         # set by .pack() if self.revision_ids is not None
         self.revision_keys = None
+        # The pool compressing texts, see _start_compression_pool
+        self._pool = None
+        self._pool_size = 1
 
     def _get_progress_stream(self, source_vf, keys, message, pb):
         def pb_stream():
@@ -400,13 +411,55 @@ class GCCHKPacker(Packer):
         child_pb = ui.ui_factory.nested_progress_bar()
         try:
             stream = vf_to_stream(source_vf, keys, message, child_pb)
-            for _ in target_vf._insert_record_stream(stream,
-                                                     random_id=True,
-                                                     reuse_blocks=False):
-                pass
+            self._insert_stream(target_vf, stream)
         finally:
             child_pb.finished()
 
+    def _insert_stream(self, target_vf, stream):
+        """Recompress stream into target_vf, in parallel when possible."""
+        if self._pool is None:
+            inserter = target_vf._insert_record_stream(stream,
+                random_id=True, reuse_blocks=False)
+        else:
+            inserter = target_vf._insert_record_stream_parallel(stream,
+                self._pool, random_id=True, max_pending=2 * self._pool_size)
+        for _ in inserter:
+            pass
+
+    def _start_compression_pool(self):
+        """Start the pool of processes to compress texts in, if wanted.
+
+        The number of processes is set by the repository.pack_workers
+        option. With a single worker, no pool is used and texts are
+        compressed in this process.
+        """
+        if not self._supports_parallel_compression:
+            return
+        workers = self._pack_collection.config_stack.get(
+            'repository.pack_workers')
+        if workers == 0:
+            workers = osutils.local_concurrency()
+        if workers <= 1:
+            return
+        try:
+            import multiprocessing
+            self._pool = multiprocessing.Pool(workers)
+        except (ImportError, OSError), e:
+            trace.mutter('Could not start %d compression workers: %s',
+                         workers, e)
+            return
+        self._pool_size = workers
+        trace.mutter('compressing with %d worker processes', workers)
+
+    def _stop_compression_pool(self):
+        if self._pool is None:
+            return
+        # Every result has been written by the time we get here, unless we
+        # are unwinding from an error, so there is nothing left to wait for.
+        self._pool.terminate()
+        self._pool.join()
+        self._pool = None
+
     def _copy_revision_texts(self):
         source_vf, target_vf = self._build_vfs('revision', True, False)
         if not self.revision_keys:
@@ -457,10 +510,7 @@ class GCCHKPacker(Packer):
         try:
             for stream in self._get_chk_streams(source_vf, total_keys,
                                                 pb=child_pb):
-                for _ in target_vf._insert_record_stream(stream,
-                                                         random_id=True,
-                                                         reuse_blocks=False):
-                    pass
+                self._insert_stream(target_vf, stream)
         finally:
             child_pb.finished()
 
@@ -484,14 +534,20 @@ class GCCHKPacker(Packer):
 
     def _create_pack_from_packs(self):
         self.pb.update('repacking', 0, 7)
-        self.new_pack = self.open_pack()
-        # Is this necessary for GC ?
-        self.new_pack.set_write_cache_size(1024*1024)
-        self._copy_revision_texts()
-        self._copy_inventory_texts()
-        self._copy_chk_texts()
-        self._copy_text_texts()
-        self._copy_signature_texts()
+        # Start the workers before opening the new pack, so they don't
+        # inherit its write stream.
+        self._start_compression_pool()
+        try:
+            self.new_pack = self.open_pack()
+            # Is this necessary for GC ?
+            self.new_pack.set_write_cache_size(1024*1024)
+            self._copy_revision_texts()
+            self._copy_inventory_texts()
+            self._copy_chk_texts()
+            self._copy_text_texts()
+            self._copy_signature_texts()
+        finally:
+            self._stop_compression_pool()
         self.new_pack._check_references()
         if not self._use_pack(self.new_pack):
             self.new_pack.abort()
@@ -518,6 +574,8 @@ class GCCHKReconcilePacker(GCCHKPacker):
     regenerated.
     """
 
+    _supports_parallel_compression = False
+
     def __init__(self, *args, **kwargs):
         super(GCCHKReconcilePacker, self).__init__(*args, **kwargs)
         self._data_changed = False
@@ -604,6 +662,8 @@ class GCCHKCanonicalizingPacker(GCCHKPacker):
     https://bugs.launchpad.net/bzr/+bug/522637).
     """
 
+    _supports_parallel_compression = False
+
     def __init__(self, *args, **kwargs):
         super(GCCHKCanonicalizingPacker, self).__init__(*args, **kwargs)
         self._data_changed = False
@@ -701,6 +761,110 @@ class GCCHKCanonicalizingPacker(GCCHKPacker):
         return new_pack.data_inserted() and self._data_changed
 
 
+class GCCHKGarbageCollectingPacker(GCCHKPacker):
+    """A packer that only copies the keys still referenced by the repository.
+
+    The keys to keep are found by _find_reachable_keys, which walks the whole
+    repository, so the packs being rewritten do not need to hold the
+    inventories that reference their content.
+    """
+
+    def __init__(self, pack_collection, packs, suffix, live_keys,
+                 reload_func=None):
+        """Create a GCCHKGarbageCollectingPacker.
+
+        :param live_keys: A dict mapping the index names ('revision',
+            'inventory', 'chk', 'text' and 'signature') to the set of keys
+            to keep in that index.
+        """
+        super(GCCHKGarbageCollectingPacker, self).__init__(pack_collection,
+            packs, suffix, reload_func=reload_func)
+        self._live_keys = live_keys
+
+    def _copy_live_keys(self, index_name, parents, delta, message, pb_offset):
+        source_vf, target_vf = self._build_vfs(index_name, parents, delta)
+        live_keys = self._live_keys[index_name]
+        keys = [key for key in source_vf.keys() if key in live_keys]
+        self._copy_stream(source_vf, target_vf, keys, message,
+                          self._get_progress_stream, pb_offset)
+
+    def _copy_revision_texts(self):
+        self._copy_live_keys('revision', True, False, 'revisions', 1)
+
+    def _copy_inventory_texts(self):
+        self._copy_live_keys('inventory', True, True, 'inventories', 2)
+
+    def _copy_chk_texts(self):
+        self._copy_live_keys('chk', False, False, 'chk', 3)
+
+    def _copy_text_texts(self):
+        self._copy_live_keys('text', True, True, 'texts', 4)
+
+    def _copy_signature_texts(self):
+        self._copy_live_keys('signature', False, False, 'signatures', 5)
+
+
+def _find_reachable_keys(repo, revision_ids, pb=None):
+    """Find the keys in repo that the ancestry of revision_ids refers to.
+
+    The revision graph is walked once, then each inventory and each CHK page
+    it refers to is read once, collecting the text keys from the leaves of
+    the id_to_entry maps.
+
+    :return: A dict mapping the index names of a pack ('revision',
+        'inventory', 'chk', 'text' and 'signature') to the set of keys still
+        referenced in that index.
+    """
+    revision_keys = set()
+    graph = repo.get_graph()
+    for revision_id, parents in graph.iter_ancestry(revision_ids):
+        if parents is None or revision_id == _mod_revision.NULL_REVISION:
+            # Ghosts and the origin have nothing stored
+            continue
+        revision_keys.add((revision_id,))
+    if pb is not None:
+        pb.update('finding referenced inventories')
+    id_roots = set()
+    p_id_roots = set()
+    for record in repo.inventories.get_record_stream(revision_keys,
+                                                     'unordered', True):
+        if record.storage_kind == 'absent':
+            continue
+        chk_inv = inventory.CHKInventory.deserialise(None,
+            record.get_bytes_as('fulltext'), record.key)
+        id_roots.add(chk_inv.id_to_entry.key())
+        p_id_roots.add(chk_inv.parent_id_basename_to_file_id.key())
+    chk_keys = set()
+    text_keys = set()
+    def walk(root_keys, parse_leaf_nodes):
+        pending = root_keys.difference(chk_keys)
+        while pending:
+            chk_keys.update(pending)
+            if pb is not None:
+                pb.update('finding referenced chk pages', len(chk_keys))
+            next_keys = set()
+            for record in repo.chk_bytes.get_record_stream(pending,
+                                                           'unordered', True):
+                if record.storage_kind == 'absent':
+                    continue
+                node = chk_map._deserialise(record.get_bytes_as('fulltext'),
+                                            record.key, search_key_func=None)
+                if isinstance(node, chk_map.InternalNode):
+                    next_keys.update(node._items.itervalues())
+                elif parse_leaf_nodes:
+                    for file_id, bytes in node.iteritems(None):
+                        text_keys.add(chk_map._bytes_to_text_key(bytes))
+            pending = next_keys.difference(chk_keys)
+    walk(id_roots, True)
+    walk(p_id_roots, False)
+    if repo._format._chunked_texts:
+        # The chunks of large texts are only referenced from the texts, so
+        # the chk pages not reached from an inventory are all kept.
+        chk_keys.update(repo.chk_bytes.keys())
+    return {'revision': revision_keys, 'inventory': revision_keys,
+            'chk': chk_keys, 'text': text_keys, 'signature': revision_keys}
+
+
 class GCRepositoryPackCollection(RepositoryPackCollection):
 
     pack_factory = GCPack
@@ -708,6 +872,138 @@ class GCRepositoryPackCollection(RepositoryPackCollection):
     normal_packer_class = GCCHKPacker
     optimising_packer_class = GCCHKPacker
 
+    def _index_content_stats(self, index):
+        """See RepositoryPackCollection._index_content_stats."""
+        records = uncompressed = 0
+        # start:length of the compressed blocks, which hold many records
+        blocks = {}
+        for node in index.iter_all_entries():
+            # The value is 'start length basis_end delta_end'
+            bits = node[2].split(' ')
+            records += 1
+            blocks[bits[0]] = int(bits[1])
+            uncompressed += int(bits[3]) - int(bits[2])
+        return records, sum(blocks.itervalues()), uncompressed
+
+    def _pack_dead_bytes(self, pack, live_keys):
+        """Estimate how many bytes of pack are taken by unreferenced keys.
+
+        Each group compress block is charged to its keys in proportion to the
+        size of their content within the block.
+
+        :return: A tuple (dead_bytes, total_bytes, dead_keys), where dead_keys
+            maps each index name to the number of unreferenced keys in it.
+        """
+        # read_memo -> [live content, dead content]
+        blocks = {}
+        dead_keys = {}
+        for index_name in ('revision', 'inventory', 'chk', 'text',
+                           'signature'):
+            index = getattr(pack, index_name + '_index')
+            if index is None:
+                continue
+            live = live_keys[index_name]
+            dead_count = 0
+            for entry in index.iter_all_entries():
+                key, value = entry[1], entry[2]
+                bits = value.split(' ')
+                read_memo = (int(bits[0]), int(bits[1]))
+                content = int(bits[3]) - int(bits[2])
+                sizes = blocks.setdefault(read_memo, [0, 0])
+                if key in live:
+                    sizes[0] += content
+                else:
+                    sizes[1] += content
+                    dead_count += 1
+            dead_keys[index_name] = dead_count
+        dead_bytes = total_bytes = 0
+        for (start, length), (live, dead) in blocks.iteritems():
+            total_bytes += length
+            if dead:
+                dead_bytes += length * dead // (live + dead)
+        return dead_bytes, total_bytes, dead_keys
+
+    def collect_garbage(self, live_keys, dead_ratio, dry_run=False,
+                        clean_obsolete_packs=False):
+        """Rewrite the packs holding mostly unreferenced content.
+
+        Packs where the fraction of bytes taken by keys not in live_keys is
+        above dead_ratio are combined into a single new pack holding only
+        their live keys. Packs below the threshold are left untouched.
+
+        The pack-names lock (see lock_names()) must be held while live_keys
+        is computed and this method runs. That does not stop a writer that
+        already has a write group open from referring to content that is
+        being removed, so WriteGroupsInProgress is raised if any pack is
+        being uploaded, both before anything is rewritten and again before
+        the old packs are obsoleted.
+
+        :param live_keys: A dict mapping index names to the keys to keep, as
+            returned by _find_reachable_keys.
+        :param dead_ratio: The fraction (0 <= ratio < 1) of unreferenced bytes
+            above which a pack is rewritten.
+        :param dry_run: If True, only report what would be done.
+        :return: A dict with the number of dead keys per index name, the
+            names of the packs to rewrite ('packs'), and the number of dead
+            and total bytes in the repository ('dead_bytes' and
+            'total_bytes').
+        """
+        self.ensure_loaded()
+        self._check_no_write_groups()
+        result = {'packs': [], 'dead_bytes': 0, 'total_bytes': 0}
+        to_rewrite = []
+        for pack in self.all_packs():
+            dead_bytes, total_bytes, dead_keys = self._pack_dead_bytes(pack,
+                live_keys)
+            result['dead_bytes'] += dead_bytes
+            result['total_bytes'] += total_bytes
+            for index_name, count in dead_keys.iteritems():
+                result[index_name] = result.get(index_name, 0) + count
+            if dead_bytes and dead_bytes > total_bytes * dead_ratio:
+                to_rewrite.append(pack)
+        result['packs'] = sorted(pack.name for pack in to_rewrite)
+        trace.mutter('Collecting garbage in %s: %d of %d bytes unreferenced,'
+                     ' rewriting %d packs.', self, result['dead_bytes'],
+                     result['total_bytes'], len(to_rewrite))
+        if dry_run or not to_rewrite:
+            return result
+        packer = GCCHKGarbageCollectingPacker(self, to_rewrite, '.gc',
+                                              live_keys)
+        try:
+            new_pack = packer.pack()
+        except errors.RetryWithNewPacks:
+            if packer.new_pack is not None:
+                packer.new_pack.abort()
+            raise
+        try:
+            self._check_no_write_groups()
+        except errors.WriteGroupsInProgress:
+            # The new pack has not been named in pack-names yet, so it can
+            # simply be moved out of the way.
+            if new_pack is not None:
+                self._remove_pack_from_memory(new_pack)
+                self._obsolete_packs([new_pack])
+            raise
+        # If nothing in the packs was live, pack() wrote no new pack, but the
+        # old packs are still obsoleted.
+        for pack in to_rewrite:
+            self._remove_pack_from_memory(pack)
+        self._save_pack_names(clear_obsolete_packs=True,
+                              obsolete_packs=to_rewrite)
+        if clean_obsolete_packs:
+            self._clear_obsolete_packs()
+        return result
+
+    def _check_no_write_groups(self):
+        """Raise WriteGroupsInProgress if any pack is being uploaded.
+
+        Every open write group has a file in the upload directory, whichever
+        process opened it.
+        """
+        uploads = self._upload_transport.list_dir('.')
+        if uploads:
+            raise errors.WriteGroupsInProgress(self.repo, sorted(uploads))
+
     def _check_new_inventories(self):
         """Detect missing inventories or chk root entries for the new revisions
         in this write group.
@@ -820,34 +1116,52 @@ class CHKInventoryRepository(PackRepository):
                 add_callback=self._pack_collection.inventory_index.add_callback,
                 parents=True, is_locked=self.is_locked,
                 inconsistency_fatal=False),
-            access=self._pack_collection.inventory_index.data_access)
+            access=self._pack_collection.inventory_index.data_access,
+            _group_cache=groupcompress.shared_group_cache(
+                self._pack_collection.inventory_index.data_access))
         self.revisions = GroupCompressVersionedFiles(
             _GCGraphIndex(self._pack_collection.revision_index.combined_index,
                 add_callback=self._pack_collection.revision_index.add_callback,
                 parents=True, is_locked=self.is_locked,
                 track_external_parent_refs=True, track_new_keys=True),
             access=self._pack_collection.revision_index.data_access,
-            delta=False)
+            delta=False,
+            _group_cache=groupcompress.shared_group_cache(
+                self._pack_collection.revision_index.data_access))
         self.signatures = GroupCompressVersionedFiles(
             _GCGraphIndex(self._pack_collection.signature_index.combined_index,
                 add_callback=self._pack_collection.signature_index.add_callback,
                 parents=False, is_locked=self.is_locked,
                 inconsistency_fatal=False),
             access=self._pack_collection.signature_index.data_access,
-            delta=False)
-        self.texts = GroupCompressVersionedFiles(
-            _GCGraphIndex(self._pack_collection.text_index.combined_index,
-                add_callback=self._pack_collection.text_index.add_callback,
-                parents=True, is_locked=self.is_locked,
-                inconsistency_fatal=False),
-            access=self._pack_collection.text_index.data_access)
+            delta=False,
+            _group_cache=groupcompress.shared_group_cache(
+                self._pack_collection.signature_index.data_access))
         # No parents, individual CHK pages don't have specific ancestry
         self.chk_bytes = GroupCompressVersionedFiles(
             _GCGraphIndex(self._pack_collection.chk_index.combined_index,
                 add_callback=self._pack_collection.chk_index.add_callback,
                 parents=False, is_locked=self.is_locked,
                 inconsistency_fatal=False),
-            access=self._pack_collection.chk_index.data_access)
+            access=self._pack_collection.chk_index.data_access,
+            _group_cache=groupcompress.shared_group_cache(
+                self._pack_collection.chk_index.data_access))
+        text_index = _GCGraphIndex(
+            self._pack_collection.text_index.combined_index,
+            add_callback=self._pack_collection.text_index.add_callback,
+            parents=True, is_locked=self.is_locked,
+            inconsistency_fatal=False)
+        text_group_cache = groupcompress.shared_group_cache(
+            self._pack_collection.text_index.data_access)
+        if self._format._chunked_texts:
+            # Large texts are stored as lists of chunks kept in chk_bytes.
+            self.texts = groupcompress.ChunkedGroupCompressVersionedFiles(
+                text_index, self._pack_collection.text_index.data_access,
+                self.chk_bytes, _group_cache=text_group_cache)
+        else:
+            self.texts = GroupCompressVersionedFiles(text_index,
+                access=self._pack_collection.text_index.data_access,
+                _group_cache=text_group_cache)
         search_key_name = self._format._serializer.search_key_name
         search_key_func = chk_map.search_key_registry.get(search_key_name)
         self.chk_bytes._search_key_func = search_key_func
@@ -1100,6 +1414,31 @@ class CHKInventoryRepository(PackRepository):
         reconciler.reconcile()
         return reconciler
 
+    @needs_write_lock
+    def collect_garbage(self, revision_ids, dead_ratio=0.1, dry_run=False,
+                        clean_obsolete_packs=False):
+        """Remove the content not referenced from the ancestry of revision_ids.
+
+        See Repository.collect_garbage.
+        """
+        collection = self._pack_collection
+        # Hold the pack-names lock from marking to sweeping, so that no pack
+        # can be added or removed meanwhile. Writers with a write group open
+        # are refused by the collection.
+        collection.lock_names()
+        try:
+            collection.reload_pack_names()
+            collection._check_no_write_groups()
+            pb = ui.ui_factory.nested_progress_bar()
+            try:
+                live_keys = _find_reachable_keys(self, revision_ids, pb=pb)
+            finally:
+                pb.finished()
+            return collection.collect_garbage(live_keys, dead_ratio,
+                dry_run=dry_run, clean_obsolete_packs=clean_obsolete_packs)
+        finally:
+            collection._unlock_names()
+
     def _reconcile_pack(self, collection, packs, extension, revs, pb):
         packer = GCCHKReconcilePacker(collection, packs, extension)
         return packer.pack(pb)
@@ -1384,6 +1723,8 @@ class RepositoryFormat2a(RepositoryFormatPack):
     _fetch_uses_deltas = False # essentially ignored by the groupcompress code.
     fast_deltas = True
     pack_compresses = True
+    # Are large texts split into chunks stored in chk_bytes?
+    _chunked_texts = False
 
     def _get_matching_bzrdir(self):
         return controldir.format_registry.make_bzrdir('2a')
@@ -1427,3 +1768,33 @@ class RepositoryFormat2aSubtree(RepositoryFormat2a):
 
     experimental = True
     supports_tree_reference = True
+
+
+class RepositoryFormat2aChunked(RepositoryFormat2a):
+    """A 2a repository format that deduplicates large texts.
+
+    Texts of 1MB or more are split into content-defined chunks, each stored
+    once in chk_bytes, so large files that move between paths or are re-added
+    are not stored again.
+    """
+
+    _chunked_texts = True
+
+    def _get_matching_bzrdir(self):
+        return controldir.format_registry.make_bzrdir('development-chunked')
+
+    def _ignore_setting_bzrdir(self, format):
+        pass
+
+    _matchingbzrdir = property(_get_matching_bzrdir, _ignore_setting_bzrdir)
+
+    @classmethod
+    def get_format_string(cls):
+        return ('Bazaar development format 9 (2a with chunked texts)\n')
+
+    def get_format_description(self):
+        """See RepositoryFormat.get_format_description()."""
+        return ("Development repository format 9 - chunked texts, "
+                "group compression and chk inventories")
+
+    experimental = True
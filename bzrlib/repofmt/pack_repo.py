@@ -22,9 +22,12 @@ import sys
 from bzrlib.lazy_import import lazy_import
 lazy_import(globals(), """
 from itertools import izip
+import heapq
+import itertools
 import time
 
 from bzrlib import (
+    bloom,
     chk_map,
     cleanup,
     config,
@@ -116,6 +119,70 @@ class PackRootCommitBuilder(VersionedFileRootCommitBuilder):
         return set([key[1] for key in self._file_graph.heads(keys)])
 
 
+def _bloom_name(index_name):
+    """Get the name of the bloom filter sidecar for an index.
+
+    e.g. the filter for 'NAME.tix' is 'NAME.tbf'.
+    """
+    return index_name[:-2] + 'bf'
+
+
+def _stats_name(pack_name):
+    """Get the name of the content statistics sidecar for a pack."""
+    return pack_name + '.stats'
+
+
+_STATS_SIGNATURE = 'Bazaar pack stats 1\n'
+
+
+def _serialise_pack_stats(stats):
+    """Serialise the statistics of a pack, as built by _compute_pack_stats."""
+    lines = [_STATS_SIGNATURE,
+             'pack_bytes %d\n' % stats['pack_bytes'],
+             'index_bytes %d\n' % stats['index_bytes']]
+    if stats['earliest'] is not None:
+        lines.append('timestamps %.3f %.3f\n'
+                     % (stats['earliest'], stats['latest']))
+    for index_type, index_stats in sorted(stats['indices'].iteritems()):
+        uncompressed = index_stats['uncompressed']
+        if uncompressed is None:
+            uncompressed = '-'
+        lines.append('index %s %d %d %s\n' % (index_type,
+            index_stats['records'], index_stats['compressed'], uncompressed))
+    return ''.join(lines)
+
+
+def _deserialise_pack_stats(bytes):
+    """Parse the output of _serialise_pack_stats.
+
+    :raises BzrError: If bytes are not pack statistics.
+    """
+    if not bytes.startswith(_STATS_SIGNATURE):
+        raise errors.BzrError('Not pack statistics')
+    stats = {'earliest': None, 'latest': None, 'indices': {}}
+    try:
+        for line in bytes[len(_STATS_SIGNATURE):].splitlines():
+            fields = line.split(' ')
+            if fields[0] in ('pack_bytes', 'index_bytes'):
+                stats[fields[0]] = int(fields[1])
+            elif fields[0] == 'timestamps':
+                stats['earliest'] = float(fields[1])
+                stats['latest'] = float(fields[2])
+            elif fields[0] == 'index':
+                if fields[4] == '-':
+                    uncompressed = None
+                else:
+                    uncompressed = int(fields[4])
+                stats['indices'][fields[1]] = {'records': int(fields[2]),
+                    'compressed': int(fields[3]),
+                    'uncompressed': uncompressed}
+    except (ValueError, IndexError):
+        raise errors.BzrError('Pack statistics are corrupt')
+    if 'pack_bytes' not in stats or 'index_bytes' not in stats:
+        raise errors.BzrError('Pack statistics are corrupt')
+    return stats
+
+
 class Pack(object):
     """An in memory proxy for a pack and its indices.
 
@@ -427,6 +494,9 @@ class NewPack(Pack):
         self._state = 'open'
         # no name until we finish writing the content
         self.name = None
+        # The (earliest, latest) timestamps of the revisions in this pack, if
+        # known, for its statistics.
+        self.revision_timestamps = None
 
     def abort(self):
         """Cancel creating this pack."""
@@ -475,6 +545,14 @@ class NewPack(Pack):
         self.finish_content()
         if not suspend:
             self._check_references()
+        stats = None
+        # Suspended packs can gain content when resumed, so only finished
+        # packs get statistics.
+        if not suspend and self._pack_collection._pack_stats_enabled():
+            # The writable indices are replaced as they are written out, so
+            # summarise them first, while they are still in memory.
+            stats = self._pack_collection._compute_pack_stats(self,
+                self._writer.current_offset)
         # write indices
         # XXX: It'd be better to write them all to temporary names, then
         # rename them all into place, so that the window when only some are
@@ -492,6 +570,13 @@ class NewPack(Pack):
             self.index_sizes.append(None)
             self._write_index('chk', self.chk_index,
                 'content hash bytes', suspend)
+        if stats is not None:
+            stats['index_bytes'] = sum(self.index_sizes)
+            if self.revision_timestamps is not None:
+                stats['earliest'], stats['latest'] = self.revision_timestamps
+            self.index_transport.put_bytes_non_atomic(_stats_name(self.name),
+                _serialise_pack_stats(stats), mode=self._file_mode)
+            self._pack_collection._pack_stats[self.name] = stats
         self.write_stream.close(
             want_fdatasync=self._pack_collection.config_stack.get('repository.fdatasync'))
         # Note that this will clobber an existing pack with the same name,
@@ -550,6 +635,15 @@ class NewPack(Pack):
         write_stream.close(
             want_fdatasync=self._pack_collection.config_stack.get('repository.fdatasync'))
         self.index_sizes[self.index_offset(index_type)] = len(index_bytes)
+        bloom_filter = None
+        # Suspended packs are moved into place index by index on resume, so
+        # only finished packs get filters.
+        false_positive_rate = self._pack_collection._bloom_filter_rate()
+        if (not suspend and false_positive_rate
+            and getattr(index, 'bloom_filter', None) is not None):
+            bloom_filter = index.bloom_filter(false_positive_rate)
+            transport.put_bytes_non_atomic(_bloom_name(index_name),
+                bloom_filter.to_bytes(), mode=self._file_mode)
         if 'pack' in debug.debug_flags:
             # XXX: size might be interesting?
             mutter('%s: create_pack: wrote %s index: %s%s t+%6.3fs',
@@ -560,6 +654,71 @@ class NewPack(Pack):
         # the index layer to make its finish() error if add_node is
         # subsequently used. RBC
         self._replace_index_with_readonly(index_type)
+        if bloom_filter is not None:
+            getattr(self, index_type + '_index')._bloom_filter = bloom_filter
+
+
+def _iter_sorted_nodes(ordinal, index):
+    """Yield (key, ordinal, value, refs) for the nodes of a B+Tree index.
+
+    BTreeGraphIndex.iter_all_entries returns the nodes in key order, so the
+    output of several of these can be merged with heapq.merge.
+    """
+    for node in index.iter_all_entries():
+        yield node[1], ordinal, node[2], node[3:]
+
+
+class ConsolidatedIndex(object):
+    """One index answering queries for the indices of several packs.
+
+    Autopack can merge the indices of several packs into one B+Tree rather
+    than rewriting the packs themselves. Each value in the merged index is
+    prefixed by the position of the pack holding the data, and results are
+    reported against that pack's own index so that the data can be read in
+    place.
+    """
+
+    def __init__(self, index, member_indices, member_names):
+        """Create a ConsolidatedIndex.
+
+        :param index: The merged index.
+        :param member_indices: The indices of the packs whose entries are in
+            index, in the order they are numbered in its values.
+        :param member_names: The names of those packs.
+        """
+        self._index = index
+        self.member_indices = member_indices
+        self.member_names = member_names
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self._index)
+
+    def _convert(self, node):
+        ordinal, value = node[2].split(' ', 1)
+        return (self.member_indices[int(ordinal)], node[1], value) + node[3:]
+
+    def clear_cache(self):
+        self._index.clear_cache()
+
+    def iter_all_entries(self):
+        return itertools.imap(self._convert, self._index.iter_all_entries())
+
+    def iter_entries(self, keys):
+        return itertools.imap(self._convert, self._index.iter_entries(keys))
+
+    def iter_entries_prefix(self, keys):
+        return itertools.imap(self._convert,
+                              self._index.iter_entries_prefix(keys))
+
+    def key_count(self):
+        return self._index.key_count()
+
+    def _find_ancestors(self, keys, ref_list_num, parent_map, missing_keys):
+        return self._index._find_ancestors(keys, ref_list_num, parent_map,
+                                           missing_keys)
+
+    def validate(self):
+        self._index.validate()
 
 
 class AggregateIndex(object):
@@ -586,6 +745,8 @@ class AggregateIndex(object):
         """
         self._reload_func = reload_func
         self.index_to_pack = {}
+        # Maps each pack index answered through a ConsolidatedIndex to it.
+        self._consolidated = {}
         self.combined_index = CombinedGraphIndex([], reload_func=reload_func)
         self.data_access = _DirectPackAccess(self.index_to_pack,
                                              reload_func=reload_func,
@@ -625,10 +786,44 @@ class AggregateIndex(object):
         self.data_access.set_writer(pack._writer, index, pack.access_tuple())
         self.add_callback = index.add_nodes
 
+    def add_consolidated_index(self, consolidated, name):
+        """Answer queries for several packs from one ConsolidatedIndex.
+
+        The indices of the member packs stay known to data_access, but are no
+        longer searched individually.
+
+        :param consolidated: A ConsolidatedIndex over indices already added
+            to this aggregate.
+        :param name: A name for the consolidated index.
+        """
+        combined = self.combined_index
+        pos = None
+        for member in consolidated.member_indices:
+            member_pos = combined._indices.index(member)
+            del combined._indices[member_pos]
+            del combined._index_names[member_pos]
+            if pos is None or member_pos < pos:
+                pos = member_pos
+            self._consolidated[member] = consolidated
+        combined.insert_index(pos, consolidated, name)
+
+    def remove_consolidated_index(self, consolidated):
+        """Search the members of consolidated individually again."""
+        combined = self.combined_index
+        pos = combined._indices.index(consolidated)
+        name = combined._index_names[pos]
+        del combined._indices[pos]
+        del combined._index_names[pos]
+        members = zip(consolidated.member_indices, consolidated.member_names)
+        for member, member_name in reversed(members):
+            del self._consolidated[member]
+            combined.insert_index(pos, member, member_name)
+
     def clear(self):
         """Reset all the aggregate data to nothing."""
         self.data_access.set_writer(None, None, (None, None))
         self.index_to_pack.clear()
+        self._consolidated.clear()
         del self.combined_index._indices[:]
         del self.combined_index._index_names[:]
         self.add_callback = None
@@ -638,6 +833,9 @@ class AggregateIndex(object):
 
         :param index: An index from the pack parameter.
         """
+        consolidated = self._consolidated.get(index)
+        if consolidated is not None:
+            self.remove_consolidated_index(consolidated)
         del self.index_to_pack[index]
         pos = self.combined_index._indices.index(index)
         del self.combined_index._indices[pos]
@@ -729,6 +927,9 @@ class Packer(object):
         new_pack.inventory_index.set_optimize(combine_backing_indices=False)
         new_pack.text_index.set_optimize(combine_backing_indices=False)
         new_pack.signature_index.set_optimize(combine_backing_indices=False)
+        if self._pack_collection._pack_stats_enabled():
+            new_pack.revision_timestamps = \
+                self._pack_collection._merged_revision_timestamps(self.packs)
         return new_pack
 
     def _copy_revision_texts(self):
@@ -811,6 +1012,9 @@ class RepositoryPackCollection(object):
         self._packs_at_load = None
         # when a pack is being created by this object, the state of that pack.
         self._new_pack = None
+        # the timestamps of the revisions added to the new pack, as far as
+        # they are known without parsing the inserted records.
+        self._new_revision_timestamps = []
         # aggregated revision index data
         flush = self._flush_new_pack
         self.revision_index = AggregateIndex(self.reload_pack_names, flush)
@@ -833,6 +1037,13 @@ class RepositoryPackCollection(object):
                 set(all_combined).difference([combined_idx]))
         # resumed packs
         self._resumed_packs = []
+        # name:(pack names, index sizes) of the consolidated indices on disk
+        self._consolidations = {}
+        # name:(pack names, {index type: ConsolidatedIndex}) of those in use
+        self._applied_consolidations = {}
+        # pack name:statistics, for packs whose statistics have been read.
+        # Packs are named by their content, so entries never go stale.
+        self._pack_stats = {}
         self.config_stack = config.LocationStack(self.transport.base)
 
     def __repr__(self):
@@ -894,6 +1105,8 @@ class RepositoryPackCollection(object):
     def _do_autopack(self):
         # XXX: Should not be needed when the management of indices is sane.
         total_revisions = self.revision_index.combined_index.key_count()
+        if self._consolidation_enabled():
+            return self._do_consolidating_autopack(total_revisions)
         total_packs = len(self._names)
         if self._max_pack_count(total_revisions) >= total_packs:
             return None
@@ -929,6 +1142,53 @@ class RepositoryPackCollection(object):
         mutter('Auto-packing repository %s completed', self)
         return result
 
+    def _do_consolidating_autopack(self, total_revisions):
+        """Bound the number of indices searched, without rewriting packs.
+
+        Packs are grouped just as a normal autopack would, but the indices of
+        each group are merged rather than its contents repacked. Recompressing
+        the data is left to an explicit pack().
+
+        :return: The new pack names if indices were consolidated, None
+            otherwise.
+        """
+        units = []
+        covered = set()
+        for pack_names, _ in self._applied_consolidations.itervalues():
+            packs = [self.get_pack_by_name(name) for name in pack_names]
+            units.append(
+                (sum([pack.get_revision_count() for pack in packs]), packs))
+            covered.update(pack_names)
+        total_indices = len(units)
+        for pack in self.all_packs():
+            if pack.name in covered:
+                continue
+            total_indices += 1
+            revision_count = pack.get_revision_count()
+            if revision_count == 0:
+                # See _do_autopack
+                continue
+            units.append((revision_count, [pack]))
+        if self._max_pack_count(total_revisions) >= total_indices:
+            return None
+        pack_operations = self.plan_autopack_combinations(units,
+            self.pack_distribution(total_revisions))
+        if not pack_operations:
+            return None
+        mutter('Consolidating indices of repository %s, which has %d packs'
+            ' searched through %d indices, containing %d revisions.',
+            self, len(self._names), total_indices, total_revisions)
+        # The consolidated indices may only name packs listed in pack-names.
+        result = self._save_pack_names()
+        for revision_count, groups in pack_operations:
+            packs = [pack for group in groups for pack in group]
+            if [pack for pack in packs if pack.name not in self._names]:
+                # Someone else repacked meanwhile
+                continue
+            self._consolidate_indices(packs)
+        mutter('Consolidating indices of repository %s completed', self)
+        return result
+
     def _execute_pack_operations(self, pack_operations, packer_class,
             reload_func=None):
         """Execute a series of pack operations.
@@ -1000,6 +1260,8 @@ class RepositoryPackCollection(object):
             except RetryPackOperations:
                 continue
             break
+        if self._consolidations:
+            self._save_consolidations()
 
         if clean_obsolete_packs:
             self._clear_obsolete_packs()
@@ -1093,6 +1355,9 @@ class RepositoryPackCollection(object):
             result = False
         # populate all the metadata.
         self.all_packs()
+        if result and self._consolidation_enabled():
+            self._consolidations = dict(self._iter_disk_consolidations())
+            self._apply_consolidations()
         return result
 
     def _parse_index_sizes(self, value):
@@ -1188,8 +1453,388 @@ class RepositoryPackCollection(object):
                                   unlimited_cache=is_chk)
         if is_chk and self._index_class is btree_index.BTreeGraphIndex: 
             index._leaf_factory = btree_index._gcchk_factory
+        if not resume and self._bloom_filter_rate():
+            index._bloom_filter = bloom.LazyBloomFilter(transport,
+                _bloom_name(index_name))
         return index
 
+    def _bloom_filter_rate(self):
+        """Return the false positive rate for index bloom filters.
+
+        :return: The configured rate, or 0 if bloom filters are neither
+            written nor read.
+        """
+        if self._index_class is not btree_index.BTreeGraphIndex:
+            return 0
+        rate = self.config_stack.get('repository.bloom_filter_rate')
+        if rate is None or not 0 < rate < 1:
+            return 0
+        return rate
+
+    def _pack_stats_enabled(self):
+        """Should packs written to this collection get statistics sidecars?
+
+        Maintaining them costs an extra request for every pack written,
+        combined or obsoleted, so they are only kept on local disk.
+        """
+        if not self.config_stack.get('repository.pack_stats'):
+            return False
+        try:
+            self._index_transport.local_abspath('.')
+        except errors.NotLocalUrl:
+            return False
+        return True
+
+    def _index_content_stats(self, index):
+        """Summarise the records in an index of a pack.
+
+        Knit records are compressed one by one and their expanded size is not
+        recorded, so the uncompressed size is None.
+
+        :return: A tuple (records, compressed bytes, uncompressed bytes).
+        """
+        records = compressed = 0
+        for node in index.iter_all_entries():
+            # The value is a flag byte then 'offset length'
+            records += 1
+            compressed += int(node[2][1:].split(' ')[1])
+        return records, compressed, None
+
+    def _compute_pack_stats(self, pack, pack_bytes):
+        """Summarise the content of pack from its indices.
+
+        :param pack_bytes: The size of the pack file.
+        :return: A dict with the size of the pack file ('pack_bytes'), of its
+            indices ('index_bytes', None until they are written), the range of
+            revision timestamps ('earliest' and 'latest', None if unknown) and
+            for each index type in 'indices', a dict of the number of
+            'records' and their 'compressed' and 'uncompressed' bytes.
+        """
+        indices = {}
+        for index_type in pack.index_definitions:
+            index = getattr(pack, index_type + '_index')
+            if index is None:
+                continue
+            records, compressed, uncompressed = self._index_content_stats(
+                index)
+            indices[index_type] = {'records': records,
+                'compressed': compressed, 'uncompressed': uncompressed}
+        return {'pack_bytes': pack_bytes, 'index_bytes': None,
+                'earliest': None, 'latest': None, 'indices': indices}
+
+    def _read_pack_stats(self, pack_name):
+        """Read the statistics sidecar of a pack.
+
+        :return: The statistics, or None if the pack has no usable sidecar.
+        """
+        stats = self._pack_stats.get(pack_name)
+        if stats is not None:
+            return stats
+        try:
+            stats = _deserialise_pack_stats(self._index_transport.get_bytes(
+                _stats_name(pack_name)))
+        except errors.NoSuchFile:
+            return None
+        except (errors.BzrError, errors.TransportError), e:
+            mutter('ignoring unusable pack statistics for %s: %s',
+                   pack_name, e)
+            return None
+        self._pack_stats[pack_name] = stats
+        return stats
+
+    def _merged_revision_timestamps(self, packs):
+        """Get the range of revision timestamps over packs.
+
+        :return: A tuple (earliest, latest), or None if it is not known for
+            every pack.
+        """
+        earliest = latest = None
+        for pack in packs:
+            stats = self._read_pack_stats(pack.name)
+            if stats is None:
+                return None
+            if stats['earliest'] is None:
+                if 'revision' in stats['indices'] and (
+                    stats['indices']['revision']['records']):
+                    return None
+                continue
+            if earliest is None or stats['earliest'] < earliest:
+                earliest = stats['earliest']
+            if latest is None or stats['latest'] > latest:
+                latest = stats['latest']
+        if earliest is None:
+            return None
+        return earliest, latest
+
+    def _note_revision_timestamp(self, timestamp):
+        """Record the timestamp of a revision added to the new pack."""
+        if self._new_pack is not None:
+            self._new_revision_timestamps.append(timestamp)
+
+    def _pack_revision_timestamps(self, pack):
+        """Get the range of timestamps of the revisions in pack.
+
+        This reads every revision in the pack, so it is only done once per
+        pack, by gather_stats, for packs whose revisions were fetched as
+        records rather than added one by one.
+        """
+        keys = [node[1] for node in pack.revision_index.iter_all_entries()]
+        earliest = latest = None
+        serializer = self.repo._serializer
+        for record in self.repo.revisions.get_record_stream(keys,
+                                                            'unordered', True):
+            if record.storage_kind == 'absent':
+                continue
+            try:
+                timestamp = serializer.read_revision_from_string(
+                    record.get_bytes_as('fulltext')).timestamp
+            except Exception, e:
+                # The statistics are advisory, so an unreadable revision only
+                # leaves the range unknown.
+                mutter('cannot read the timestamp of %r: %s', record.key, e)
+                return None
+            if earliest is None or timestamp < earliest:
+                earliest = timestamp
+            if latest is None or timestamp > latest:
+                latest = timestamp
+        if earliest is None:
+            return None
+        return earliest, latest
+
+    def _fill_pack_stats(self, pack, stats):
+        """Complete the statistics of a pack and write its sidecar.
+
+        Packs written before the sidecars existed have none, and packs
+        written by fetches do not know their revision timestamps. Packers
+        cannot merge the timestamps of sources without them.
+
+        :param stats: The statistics read from the sidecar of pack, or None.
+        :return: The statistics of pack.
+        """
+        if stats is None:
+            stats = self._compute_pack_stats(pack,
+                self._pack_transport.stat(pack.file_name()).st_size)
+            stats['index_bytes'] = sum(self._names[pack.name])
+        if not self._pack_stats_enabled():
+            return stats
+        if stats['earliest'] is None:
+            timestamps = self._pack_revision_timestamps(pack)
+            if timestamps is not None:
+                stats['earliest'], stats['latest'] = timestamps
+        self._pack_stats[pack.name] = stats
+        try:
+            self._index_transport.put_bytes_non_atomic(_stats_name(pack.name),
+                _serialise_pack_stats(stats),
+                mode=self.repo.bzrdir._get_file_mode())
+        except (errors.PathError, errors.TransportError), e:
+            # The sidecar only saves work, so failing to write it is harmless.
+            mutter("couldn't write pack statistics for %s: %s", pack.name, e)
+        return stats
+
+    def gather_stats(self):
+        """Summarise the content of all the packs in the collection.
+
+        Statistics are kept in a small sidecar per pack (see
+        repository.pack_stats), so this costs one read per pack rather than
+        reading every index. Packs without one are summarised from their
+        indices, and fetched packs have their revisions read for their
+        timestamps, the first time; the sidecar is completed then.
+
+        :return: A dict with the number of packs ('packs'), their total size
+            including indices ('size'), the range of revision timestamps
+            ('earliest' and 'latest', over the packs that know them) and for
+            each index type in 'indices', a dict of the number of 'records'
+            and their 'compressed' and 'uncompressed' bytes (None if not
+            known for every pack). Keys stored in several packs are counted
+            once per pack.
+        """
+        self.ensure_loaded()
+        result = {'packs': 0, 'size': 0, 'earliest': None, 'latest': None,
+                  'indices': {}}
+        for pack in self.all_packs():
+            stats = self._read_pack_stats(pack.name)
+            if stats is None or (stats['earliest'] is None
+                and stats['indices'].get('revision', {}).get('records')):
+                stats = self._fill_pack_stats(pack, stats)
+            result['packs'] += 1
+            result['size'] += stats['pack_bytes'] + stats['index_bytes']
+            if stats['earliest'] is not None:
+                if (result['earliest'] is None
+                    or stats['earliest'] < result['earliest']):
+                    result['earliest'] = stats['earliest']
+                if (result['latest'] is None
+                    or stats['latest'] > result['latest']):
+                    result['latest'] = stats['latest']
+            for index_type, index_stats in stats['indices'].iteritems():
+                totals = result['indices'].setdefault(index_type,
+                    {'records': 0, 'compressed': 0, 'uncompressed': 0})
+                totals['records'] += index_stats['records']
+                totals['compressed'] += index_stats['compressed']
+                if (totals['uncompressed'] is None
+                    or index_stats['uncompressed'] is None):
+                    totals['uncompressed'] = None
+                else:
+                    totals['uncompressed'] += index_stats['uncompressed']
+        return result
+
+    def _consolidation_enabled(self):
+        """Should autopack consolidate indices rather than rewrite packs?"""
+        if self._index_class is not btree_index.BTreeGraphIndex:
+            return False
+        return self.config_stack.get('repository.consolidate_indices')
+
+    def _consolidated_index_types(self):
+        """Return (index type, suffix, size offset) for each index of a pack.
+        """
+        result = []
+        for index_type, (suffix, offset) in Pack.index_definitions.items():
+            if index_type == 'chk' and self.chk_index is None:
+                continue
+            result.append((index_type, suffix, offset))
+        return sorted(result, key=lambda item: item[2])
+
+    def _iter_disk_consolidations(self):
+        """Iterate over the consolidated-indices index.
+
+        :return: An iterator of (name, (pack names, index sizes)).
+        """
+        num_sizes = len(self._consolidated_index_types())
+        index = self._index_class(self.transport, 'consolidated-indices',
+                                  None)
+        try:
+            for node in index.iter_all_entries():
+                fields = node[2].split(' ')
+                sizes = tuple([int(digits) for digits in fields[:num_sizes]])
+                yield node[1][0], (tuple(fields[num_sizes:]), sizes)
+        except errors.NoSuchFile:
+            return
+
+    def _apply_consolidations(self):
+        """Search packs through their consolidated indices where possible."""
+        covered = set()
+        for pack_names, _ in self._applied_consolidations.itervalues():
+            covered.update(pack_names)
+        # Prefer whichever consolidations cover the most packs.
+        candidates = sorted(self._consolidations.items(),
+                            key=lambda item: -len(item[1][0]))
+        for name, (pack_names, sizes) in candidates:
+            if (name in self._applied_consolidations
+                or covered.intersection(pack_names)
+                or [n for n in pack_names if n not in self._names]):
+                continue
+            packs = [self.get_pack_by_name(n) for n in pack_names]
+            consolidated = {}
+            for index_type, suffix, offset in (
+                self._consolidated_index_types()):
+                index = self._index_class(self._index_transport,
+                    'consolidated-' + name + suffix, sizes[offset],
+                    unlimited_cache=(index_type == 'chk'))
+                members = [getattr(pack, index_type + '_index')
+                           for pack in packs]
+                consolidated[index_type] = ConsolidatedIndex(index, members,
+                                                             pack_names)
+                getattr(self, index_type + '_index').add_consolidated_index(
+                    consolidated[index_type], 'consolidated-' + name)
+            self._applied_consolidations[name] = (pack_names, consolidated)
+            covered.update(pack_names)
+
+    def _unapply_consolidation(self, name):
+        """Stop searching packs through the consolidation name."""
+        pack_names, consolidated = self._applied_consolidations.pop(name)
+        for index_type, consolidated_index in consolidated.iteritems():
+            getattr(self, index_type + '_index').remove_consolidated_index(
+                consolidated_index)
+
+    def _consolidate_indices(self, packs):
+        """Merge the indices of packs into one consolidated index per type.
+
+        No pack content is read or written: the consolidated indices refer to
+        the data where it already is.
+
+        :param packs: The packs to consolidate, which must all be listed in
+            pack-names.
+        """
+        pack_names = tuple([pack.name for pack in packs])
+        name = osutils.md5(' '.join(pack_names)).hexdigest()
+        index_types = self._consolidated_index_types()
+        sizes = [None] * len(index_types)
+        written = []
+        try:
+            for index_type, suffix, offset in index_types:
+                members = [getattr(pack, index_type + '_index')
+                           for pack in packs]
+                # Reads the root node, which holds the index options.
+                members[0].key_count()
+                builder = self._index_builder_class(
+                    reference_lists=members[0].node_ref_lists,
+                    key_elements=members[0]._key_length)
+                last_key = None
+                for key, ordinal, value, refs in heapq.merge(*[
+                    _iter_sorted_nodes(ordinal, member)
+                    for ordinal, member in enumerate(members)]):
+                    # Duplicate keys hold the same content, take the first.
+                    if key == last_key:
+                        continue
+                    last_key = key
+                    builder.add_node(key, '%d %s' % (ordinal, value), *refs)
+                index_name = 'consolidated-' + name + suffix
+                sizes[offset] = self._index_transport.put_file(index_name,
+                    builder.finish(), mode=self.repo.bzrdir._get_file_mode())
+                written.append(index_name)
+        except errors.NoSuchFile, e:
+            # A pack was removed by someone else, not worth a retry.
+            mutter("couldn't consolidate indices, skipping it:\n%s" % (e,))
+            for index_name in written:
+                self._index_transport.delete(index_name)
+            return
+        self._save_consolidations((name, (pack_names, tuple(sizes))))
+
+    def _save_consolidations(self, new_consolidation=None):
+        """Update the consolidated-indices index.
+
+        Consolidations of packs that are gone, or that new_consolidation
+        supersedes, are dropped and their indices obsoleted.
+
+        :param new_consolidation: Optionally a (name, (pack names, sizes))
+            to add.
+        """
+        self.lock_names()
+        try:
+            consolidations = dict(self._iter_disk_consolidations())
+            superseded = set()
+            if new_consolidation is not None:
+                consolidations[new_consolidation[0]] = new_consolidation[1]
+                superseded.update(new_consolidation[1][0])
+            dropped = []
+            builder = self._index_builder_class()
+            for name, (pack_names, sizes) in consolidations.items():
+                if ((new_consolidation is None
+                     or name != new_consolidation[0])
+                    and (superseded.intersection(pack_names)
+                         or [n for n in pack_names if n not in self._names])):
+                    dropped.append(name)
+                    del consolidations[name]
+                    continue
+                builder.add_node((name,), ' '.join(
+                    [str(size) for size in sizes] + list(pack_names)))
+            self.transport.put_file('consolidated-indices', builder.finish(),
+                mode=self.repo.bzrdir._get_file_mode())
+        finally:
+            self._unlock_names()
+        self._consolidations = consolidations
+        for name in dropped:
+            if name in self._applied_consolidations:
+                self._unapply_consolidation(name)
+            for _, suffix, _ in self._consolidated_index_types():
+                index_name = 'consolidated-' + name + suffix
+                try:
+                    self._index_transport.move(index_name,
+                        '../obsolete_packs/' + index_name)
+                except (errors.PathError, errors.TransportError), e:
+                    mutter("couldn't rename obsolete index, skipping it:\n%s"
+                           % (e,))
+        self._apply_consolidations()
+
     def _max_pack_count(self, total_revisions):
         """Return the maximum number of packs to use for total revisions.
 
@@ -1221,6 +1866,10 @@ class RepositoryPackCollection(object):
         :param packs: The packs to obsolete.
         :param return: None.
         """
+        # The optional sidecars are moved whatever the configuration says now,
+        # as it may have changed since they were written. Only B+Tree indices
+        # ever get bloom filters.
+        blooms = self._index_class is btree_index.BTreeGraphIndex
         for pack in packs:
             try:
                 try:
@@ -1252,6 +1901,28 @@ class RepositoryPackCollection(object):
                 except (errors.PathError, errors.TransportError), e:
                     mutter("couldn't rename obsolete index, skipping it:\n%s"
                            % (e,))
+                if not blooms:
+                    continue
+                # Bloom filters are optional, so they may well be absent.
+                bloom_name = _bloom_name(pack.name + suffix)
+                try:
+                    self._index_transport.move(bloom_name,
+                        '../obsolete_packs/' + bloom_name)
+                except errors.NoSuchFile:
+                    pass
+                except (errors.PathError, errors.TransportError), e:
+                    mutter("couldn't rename obsolete bloom filter, skipping"
+                           " it:\n%s" % (e,))
+            # Statistics are optional too.
+            stats_name = _stats_name(pack.name)
+            try:
+                self._index_transport.move(stats_name,
+                    '../obsolete_packs/' + stats_name)
+            except errors.NoSuchFile:
+                pass
+            except (errors.PathError, errors.TransportError), e:
+                mutter("couldn't rename obsolete pack statistics, skipping"
+                       " it:\n%s" % (e,))
 
     def pack_distribution(self, total_revisions):
         """Generate a list of the number of revisions to put in each pack.
@@ -1280,6 +1951,11 @@ class RepositoryPackCollection(object):
         """
         self._names.pop(pack.name)
         self._packs_by_name.pop(pack.name)
+        for name, (pack_names, _) in self._applied_consolidations.items():
+            if pack.name in pack_names:
+                # The aggregate indices stop using it when the pack's
+                # indices are removed.
+                del self._applied_consolidations[name]
         self._remove_pack_indices(pack)
         self.packs.remove(pack)
 
@@ -1318,6 +1994,8 @@ class RepositoryPackCollection(object):
         # information about packs.
         self._names = None
         self.packs = []
+        self._consolidations = {}
+        self._applied_consolidations = {}
         self._packs_by_name = {}
         self._packs_at_load = None
 
@@ -1400,6 +2078,8 @@ class RepositoryPackCollection(object):
                 self._names[name] = sizes
                 self.get_pack_by_name(name)
                 added.append(name)
+        if self._consolidations:
+            self._apply_consolidations()
         return removed, added, modified
 
     def _save_pack_names(self, clear_obsolete_packs=False, obsolete_packs=None):
@@ -1478,6 +2158,15 @@ class RepositoryPackCollection(object):
          modified) = self._syncronize_pack_names_from_disk_nodes(disk_nodes)
         if removed or added or modified:
             return True
+        if self._consolidation_enabled():
+            consolidations = dict(self._iter_disk_consolidations())
+            if consolidations != self._consolidations:
+                self._consolidations = consolidations
+                for name in self._applied_consolidations.keys():
+                    if name not in consolidations:
+                        self._unapply_consolidation(name)
+                self._apply_consolidations()
+                return True
         return False
 
     def _restart_autopack(self):
@@ -1529,6 +2218,7 @@ class RepositoryPackCollection(object):
             raise errors.NotWriteLocked(self)
         self._new_pack = self.pack_factory(self, upload_suffix='.pack',
             file_mode=self.repo.bzrdir._get_file_mode())
+        self._new_revision_timestamps = []
         # allow writing: queue writes to a new index
         self.revision_index.add_writable_index(self._new_pack.revision_index,
             self._new_pack)
@@ -1608,6 +2298,13 @@ class RepositoryPackCollection(object):
         self._remove_pack_indices(self._new_pack)
         any_new_content = False
         if self._new_pack.data_inserted():
+            timestamps = self._new_revision_timestamps
+            if (timestamps
+                and len(timestamps) == self._new_pack.get_revision_count()):
+                # Every new revision was added with its timestamp, so the
+                # statistics do not need to read them back.
+                self._new_pack.revision_timestamps = (min(timestamps),
+                                                      max(timestamps))
             # get all the data to disk and read to use
             self._new_pack.finish()
             self.allocate(self._new_pack)
@@ -1723,6 +2420,10 @@ class PackRepository(MetaDirVersionedFileRepository):
     def _start_write_group(self):
         self._pack_collection._start_write_group()
 
+    def _add_revision(self, revision):
+        super(PackRepository, self)._add_revision(revision)
+        self._pack_collection._note_revision_timestamp(revision.timestamp)
+
     def _commit_write_group(self):
         hint = self._pack_collection._commit_write_group()
         self.revisions._index._key_dependencies.clear()
@@ -1820,6 +2521,20 @@ class PackRepository(MetaDirVersionedFileRepository):
         """
         self._pack_collection.pack(hint=hint, clean_obsolete_packs=clean_obsolete_packs)
 
+    @needs_read_lock
+    def gather_stats(self, revid=None, committers=None):
+        """See Repository.gather_stats()."""
+        result = super(PackRepository, self).gather_stats(revid, committers)
+        if self._pack_collection._pack_stats_enabled():
+            # With the statistics sidecars the size costs one read per pack.
+            result['size'] = self._pack_collection.gather_stats()['size']
+        return result
+
+    @needs_read_lock
+    def gather_storage_stats(self):
+        """See Repository.gather_storage_stats()."""
+        return self._pack_collection.gather_stats()
+
     @needs_write_lock
     def reconcile(self, other=None, thorough=False):
         """Reconcile this repository."""
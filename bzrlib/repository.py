@@ -538,6 +538,24 @@ class Repository(_RelockDebugMixin, controldir.ControlComponent):
                 last_revision.timezone)
         return result
 
+    def gather_storage_stats(self):
+        """Gather statistics about how the repository content is stored.
+
+        Unlike gather_stats this describes the storage as a whole, for
+        sizing the repository, and is meant to be cheap enough to poll.
+
+        :return: A dictionary of statistics. For pack repositories this
+            contains:
+            packs: The number of packs.
+            size: The total size of the packs and their indices in bytes.
+            earliest, latest: The range of revision timestamps, or None.
+            indices: A dict per index type ('revision', 'inventory', 'text',
+                'signature' and 'chk') of the number of 'records' and their
+                'compressed' and 'uncompressed' bytes.
+        :raises UnsupportedOperation: If the repository cannot do this.
+        """
+        raise errors.UnsupportedOperation(self.gather_storage_stats, self)
+
     def find_branches(self, using=False):
         """Find branches underneath this repository.
 
@@ -1044,6 +1062,32 @@ class Repository(_RelockDebugMixin, controldir.ControlComponent):
             the pack operation.
         """
 
+    def collect_garbage(self, revision_ids, dead_ratio=0.1, dry_run=False,
+                        clean_obsolete_packs=False):
+        """Remove content not referenced from the ancestry of revision_ids.
+
+        Revisions, inventories and texts left behind by aborted write groups
+        or by uncommitted revisions are found by walking everything reachable
+        from revision_ids; storage holding more than dead_ratio unreferenced
+        data is rewritten without it.
+
+        Content used only by branches elsewhere that are stacked on this
+        repository is not seen, so the caller must pass every revision that
+        is still wanted.
+
+        :param revision_ids: The tips of all the revisions to keep.
+        :param dead_ratio: The fraction of unreferenced data above which
+            storage is rewritten.
+        :param dry_run: If True, only report what would be removed.
+        :param clean_obsolete_packs: Delete the rewritten storage immediately
+            rather than keeping it until the next pack.
+        :return: A dict of statistics about the unreferenced content.
+        :raises UnsupportedOperation: If the repository cannot do this.
+        :raises WriteGroupsInProgress: If a write group is open on the
+            repository, in this process or another.
+        """
+        raise errors.UnsupportedOperation(self.collect_garbage, self)
+
     def get_transaction(self):
         return self.control_files.get_transaction()
 
@@ -1615,6 +1659,11 @@ format_registry.register_lazy(
     'bzrlib.repofmt.groupcompress_repo',
     'RepositoryFormat2aSubtree',
     )
+format_registry.register_lazy(
+    'Bazaar development format 9 (2a with chunked texts)\n',
+    'bzrlib.repofmt.groupcompress_repo',
+    'RepositoryFormat2aChunked',
+    )
 
 
 class InterRepository(InterObject):
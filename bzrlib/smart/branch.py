@@ -28,7 +28,28 @@ from bzrlib.smart.request import (
     FailedSmartServerResponse,
     SmartServerRequest,
     SuccessfulSmartServerResponse,
+    file_state,
     )
+from bzrlib.smart.repository import _repository_state
+
+
+def _open_branch(transport):
+    controldir = ControlDir.open_from_transport(transport)
+    if controldir.get_branch_reference() is not None:
+        raise errors.NotBranchError(transport.base)
+    return controldir.open_branch(ignore_fallbacks=True)
+
+
+def _branch_state(branch):
+    """The state of the files a branch was opened from."""
+    repository_state = _repository_state(branch.repository)
+    if repository_state is None:
+        return None
+    branch_state = file_state(branch._transport,
+                              ['format', 'last-revision', 'branch.conf'])
+    if branch_state is None:
+        return None
+    return branch_state + repository_state
 
 
 class SmartServerBranchRequest(SmartServerRequest):
@@ -47,10 +68,8 @@ class SmartServerBranchRequest(SmartServerRequest):
         :return: A SmartServerResponse from self.do_with_branch().
         """
         transport = self.transport_from_client_path(path)
-        controldir = ControlDir.open_from_transport(transport)
-        if controldir.get_branch_reference() is not None:
-            raise errors.NotBranchError(transport.base)
-        branch = controldir.open_branch(ignore_fallbacks=True)
+        branch = self.open_cached('branch', transport, _open_branch,
+                                  _branch_state)
         return self.do_with_branch(branch, *args)
 
 
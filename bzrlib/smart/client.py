@@ -40,7 +40,9 @@ class _SmartClient(object):
         """
         self._medium = medium
         if headers is None:
-            self._headers = {'Software version': bzrlib.__version__}
+            self._headers = {'Software version': bzrlib.__version__,
+                             protocol.COMPRESSION_HEADER:
+                                protocol.COMPRESSION_ZLIB}
         else:
             self._headers = dict(headers)
 
@@ -71,6 +73,18 @@ class _SmartClient(object):
         return self._call_and_read_response(
             method, args, expect_response_body=True)
 
+    def call_pipelined(self, method, *args):
+        """Send a call without waiting for the responses to earlier ones.
+
+        The call's response is read when it is asked for, so several calls
+        can be made before any of their responses are read.
+
+        :return: A _PipelinedCall, whose read_response method returns what
+            call_expecting_body would.
+        """
+        return _PipelinedCall(
+            _SmartClientRequest(self, method, args, expect_response_body=True))
+
     def call_with_body_bytes(self, method, args, body):
         """Call a method on the remote server with body bytes."""
         if type(method) is not str:
@@ -202,6 +216,13 @@ class _SmartClientRequest(object):
             self._send_no_retry(encoder)
             response_tuple = response_handler.read_response_tuple(
                 expect_body=self.expect_response_body)
+        if protocol_version == 3:
+            headers = response_handler.headers
+            self.client._medium._remote_compression = (
+                headers.get(protocol.COMPRESSION_HEADER))
+            self.client._medium._remote_pipelining = (
+                headers.get(protocol.PIPELINING_HEADER)
+                == protocol.PIPELINING_IN_ORDER)
         return (response_tuple, response_handler)
 
     def _call_determining_protocol_version(self):
@@ -241,6 +262,8 @@ class _SmartClientRequest(object):
         request = self.client._medium.get_request()
         if version == 3:
             request_encoder = protocol.ProtocolThreeRequester(request)
+            request_encoder.set_peer_compression(
+                self.client._medium._remote_compression)
             response_handler = message.ConventionalResponseHandler()
             response_proto = protocol.ProtocolThreeDecoder(
                 response_handler, expect_version_marker=True)
@@ -315,6 +338,48 @@ class _SmartClientRequest(object):
             encoder.call(self.method, *self.args)
 
 
+class _PipelinedCall(object):
+    """A call made with _SmartClient.call_pipelined.
+
+    The request is sent straight away if the medium can pipeline requests and
+    the server said it serves pipelined requests.  Otherwise it is sent when
+    its response is asked for.
+    """
+
+    def __init__(self, smart_request):
+        self._smart_request = smart_request
+        self._response_handler = None
+        medium = smart_request.client._medium
+        if (medium._supports_pipelining and medium._protocol_version == 3
+            and medium._remote_pipelining):
+            smart_request._run_call_hooks()
+            response_handler = smart_request._send(3)
+            response_handler._medium_request.pipeline(
+                response_handler.buffer_response)
+            self._response_handler = response_handler
+
+    def read_response(self):
+        """Read the response to the call.
+
+        :return: (response_tuple, response_handler), as call_expecting_body
+            does.
+        """
+        if self._response_handler is None:
+            return self._smart_request.call_and_read_response()
+        try:
+            response_tuple = self._response_handler.read_response_tuple(
+                expect_body=True)
+        except errors.ConnectionReset, e:
+            self._smart_request.client._medium.reset()
+            if not self._smart_request._is_safe_to_send_twice():
+                raise
+            trace.warning('ConnectionReset reading response for %r, retrying'
+                          % (self._smart_request.method,))
+            trace.log_exception_quietly()
+            return self._smart_request.call_and_read_response()
+        return (response_tuple, self._response_handler)
+
+
 class SmartClientHooks(hooks.Hooks):
 
     def __init__(self):
@@ -26,6 +26,7 @@ bzrlib/transport/smart/__init__.py.
 
 from __future__ import absolute_import
 
+import collections
 import errno
 import os
 import sys
@@ -276,7 +277,10 @@ class SmartServerStreamMedium(SmartMedium):
 
         :returns: a SmartServerRequestProtocol.
         """
-        self._wait_for_bytes_with_timeout(self._client_timeout)
+        if self._push_back_buffer is None:
+            # A pipelined request may have been read with the previous one
+            # already, so only wait when there is nothing buffered.
+            self._wait_for_bytes_with_timeout(self._client_timeout)
         if self.finished:
             # We're stopping, so don't try to do any more work
             return None
@@ -420,6 +424,62 @@ class SmartServerSocketStreamMedium(SmartServerStreamMedium):
                             osutils.timer_func() - tstart))
 
 
+class SmartServerSocketEventMedium(SmartServerSocketStreamMedium):
+    """Serves a socket whose incoming bytes are read by an event loop.
+
+    Rather than blocking on the socket in serve(), the event loop reads
+    whatever bytes have arrived and passes them to process_bytes(), which
+    serves the requests they complete.  Responses are still written straight
+    to the socket.
+    """
+
+    def __init__(self, sock, backing_transport, root_client_path='/',
+                 timeout=None):
+        SmartServerSocketStreamMedium.__init__(self, sock, backing_transport,
+            root_client_path=root_client_path, timeout=timeout)
+        self._protocol = None
+        # The start of a request whose protocol version line is incomplete.
+        self._partial_line = ''
+
+    def in_request(self):
+        """Has part of a request been received that is not served yet?"""
+        return self._protocol is not None or self._partial_line != ''
+
+    def process_bytes(self, bytes):
+        """Serve the requests completed by bytes received from the client.
+
+        :return: False once the connection should be closed, because the
+            medium was stopped or an error occurred, otherwise True.
+        """
+        while True:
+            if self._protocol is None:
+                if not bytes or (self.finished and not self._partial_line):
+                    break
+                bytes = self._partial_line + bytes
+                if '\n' not in bytes:
+                    # Not enough to tell which protocol version is used.
+                    self._partial_line = bytes
+                    break
+                self._partial_line = ''
+                protocol_factory, bytes = _get_protocol_factory_for_bytes(
+                    bytes)
+                self._protocol = protocol_factory(self.backing_transport,
+                    self._write_out, self.root_client_path)
+            try:
+                self._protocol.accept_bytes(bytes)
+            except KeyboardInterrupt:
+                raise
+            except Exception, e:
+                self._protocol = None
+                self.terminate_due_to_error()
+                return False
+            if self._protocol.next_read_size():
+                break
+            bytes = self._protocol.unused_data
+            self._protocol = None
+        return not self.finished or self.in_request()
+
+
 class SmartServerPipeStreamMedium(SmartServerStreamMedium):
 
     def __init__(self, in_file, out_file, backing_transport, timeout=None):
@@ -725,6 +785,10 @@ _vfs_refuser = None
 class SmartClientMedium(SmartMedium):
     """Smart client is a medium for sending smart protocol requests over."""
 
+    # Whether requests can be sent before the responses to earlier ones have
+    # been read.  See SmartClientStreamMediumRequest.pipeline.
+    _supports_pipelining = False
+
     def __init__(self, base):
         super(SmartClientMedium, self).__init__()
         self.base = base
@@ -736,6 +800,12 @@ class SmartClientMedium(SmartMedium):
         # _remote_version_is_before tracks the bzr version the remote side
         # can be based on what we've seen so far.
         self._remote_version_is_before = None
+        # The compression the remote side decodes request bodies in, as it
+        # said in its last protocol three response.
+        self._remote_compression = None
+        # Whether the remote side said it serves pipelined requests, in its
+        # last protocol three response.
+        self._remote_pipelining = False
         # Install debug hook function if debug flag is set.
         if 'hpss' in debug.debug_flags:
             global _debug_counter
@@ -854,9 +924,14 @@ class SmartClientStreamMedium(SmartClientMedium):
     receive bytes.
     """
 
+    _supports_pipelining = True
+
     def __init__(self, base):
         SmartClientMedium.__init__(self, base)
         self._current_request = None
+        # The requests whose responses are awaited in the order they were
+        # sent, see SmartClientStreamMediumRequest.pipeline.
+        self._pipelined_requests = collections.deque()
 
     def accept_bytes(self, bytes):
         self._accept_bytes(bytes)
@@ -890,6 +965,10 @@ class SmartClientStreamMedium(SmartClientMedium):
         """
         self.disconnect()
         self._current_request = None
+        # Their responses will never arrive.
+        for request in self._pipelined_requests:
+            request._connection_lost = True
+        self._pipelined_requests.clear()
 
 
 class SmartSimplePipesClientMedium(SmartClientStreamMedium):
@@ -1166,6 +1245,39 @@ class SmartClientStreamMediumRequest(SmartClientMediumRequest):
         if self._medium._current_request is not None:
             raise errors.TooManyConcurrentRequests(self._medium)
         self._medium._current_request = self
+        self._drain = None
+        self._connection_lost = False
+
+    def pipeline(self, drain):
+        """Allow new requests to be sent before this response is read.
+
+        Responses arrive in the order their requests were sent, so before a
+        later request reads its response, this one has to be read: drain is
+        called to read it all if it has not been read by then.
+
+        :param drain: A callable that reads the response to this request,
+            until finished_reading is called.
+        """
+        if self._state != "reading":
+            raise errors.WritingNotComplete(self)
+        if self._medium._current_request is not self:
+            raise AssertionError()
+        self._medium._current_request = None
+        self._drain = drain
+        self._medium._pipelined_requests.append(self)
+
+    def _wait_for_response(self):
+        """Read the responses to the requests pipelined before this one."""
+        if self._connection_lost:
+            raise errors.ConnectionReset(
+                "Connection lost before the response was read.")
+        pipelined_requests = self._medium._pipelined_requests
+        while pipelined_requests and pipelined_requests[0] is not self:
+            earlier_request = pipelined_requests[0]
+            earlier_request._drain()
+            if pipelined_requests and pipelined_requests[0] is earlier_request:
+                raise AssertionError(
+                    "%r did not read its whole response" % (earlier_request,))
 
     def _accept_bytes(self, bytes):
         """See SmartClientMediumRequest._accept_bytes.
@@ -1175,12 +1287,28 @@ class SmartClientStreamMediumRequest(SmartClientMediumRequest):
         """
         self._medium._accept_bytes(bytes)
 
+    def _read_bytes(self, count):
+        self._wait_for_response()
+        return self._medium.read_bytes(count)
+
+    def _read_line(self):
+        self._wait_for_response()
+        return self._medium._get_line()
+
     def _finished_reading(self):
         """See SmartClientMediumRequest._finished_reading.
 
         This clears the _current_request on self._medium to allow a new
         request to be created.
         """
+        pipelined_requests = self._medium._pipelined_requests
+        if self._drain is not None:
+            if self._connection_lost:
+                return
+            if not pipelined_requests or pipelined_requests[0] is not self:
+                raise AssertionError()
+            pipelined_requests.popleft()
+            return
         if self._medium._current_request is not self:
             raise AssertionError()
         self._medium._current_request = None
@@ -103,6 +103,10 @@ class ConventionalRequestHandler(MessageHandler):
         self._should_finish_body = False
         self._response_sent = False
 
+    def headers_received(self, headers):
+        MessageHandler.headers_received(self, headers)
+        self.responder.request_headers_received(headers)
+
     def protocol_error(self, exception):
         if self.responder.response_sent:
             # We can only send one response to a request, no matter how many
@@ -274,6 +278,10 @@ class ConventionalResponseHandler(MessageHandler, ResponseHandler):
         if next_read_size == 0:
             # a complete request has been read.
             self.finished_reading = True
+            unused_data = self._protocol_decoder.unused_data
+            if unused_data:
+                # The start of the responses to pipelined requests.
+                self._medium_request._medium._push_back(unused_data)
             self._medium_request.finished_reading()
             return
         bytes = self._medium_request.read_bytes(next_read_size)
@@ -336,12 +344,19 @@ class ConventionalResponseHandler(MessageHandler, ResponseHandler):
                     mutter('              %d byte part read', len(bytes_part))
                 yield bytes_part
             self._read_more()
+        # The response may have been read already by buffer_response.
+        while self._bytes_parts:
+            yield self._bytes_parts.popleft()
         if self._body_stream_status == 'E':
             _raise_smart_server_error(self._body_error_args)
 
     def cancel_read_body(self):
         self._wait_for_response_end()
 
+    def buffer_response(self):
+        """Read the rest of the response, keeping it to be read later."""
+        self._wait_for_response_end()
+
 
 def _raise_smart_server_error(error_tuple):
     """Raise exception based on tuple received from smart server
@@ -26,6 +26,7 @@ import struct
 import sys
 import thread
 import time
+import zlib
 
 import bzrlib
 from bzrlib import (
@@ -47,6 +48,38 @@ RESPONSE_VERSION_TWO = 'bzr response 2\n'
 MESSAGE_VERSION_THREE = 'bzr message 3 (bzr 1.6)\n'
 RESPONSE_VERSION_THREE = REQUEST_VERSION_THREE = MESSAGE_VERSION_THREE
 
+# The protocol three header saying which compression the sender can decode
+# bytes parts in.  Bytes parts are only compressed when sent to a peer that
+# has said it can decode them.
+COMPRESSION_HEADER = 'Compression'
+COMPRESSION_ZLIB = 'zlib'
+
+# The protocol three response header saying the server reads requests sent
+# before the responses to earlier ones were read, answering them in order.
+PIPELINING_HEADER = 'Pipelining'
+PIPELINING_IN_ORDER = 'in-order'
+
+# Bytes parts smaller than this are not worth compressing.
+_MIN_COMPRESS_SIZE = 512
+# Larger bytes parts are only compressed if this much of their start
+# compresses well.
+_COMPRESS_SAMPLE_SIZE = 64 * 1024
+# Compressed bytes parts are only sent if at most this fraction of the size.
+_MAX_COMPRESS_RATIO = 0.9
+# Compressed bytes parts may not expand to more than this, so a peer cannot
+# make us allocate much more than it sends.  Larger parts are sent as they are.
+_MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+# The kinds of network records which are compressed already.  Bytes parts
+# holding a pack record of one of them are sent as they are.
+_COMPRESSED_RECORD_KINDS = frozenset([
+    'groupcompress-block',
+    'knit-annotated-delta-gz',
+    'knit-annotated-ft-gz',
+    'knit-delta-closure',
+    'knit-delta-gz',
+    'knit-ft-gz',
+    ])
+
 
 def _recv_tuple(from_file):
     req_line = from_file.readline()
@@ -882,6 +915,37 @@ def build_server_protocol_three(backing_transport, write_func,
     return ProtocolThreeDecoder(message_handler)
 
 
+def _is_compressed_record(bytes):
+    """Does bytes hold a pack record of a compressed network record kind?"""
+    if not bytes.startswith('B'):
+        return False
+    end_of_headers = bytes.find('\n\n', 0, 1024)
+    if end_of_headers == -1:
+        return False
+    start = end_of_headers + 2
+    end = bytes.find('\n', start, start + 64)
+    return end != -1 and bytes[start:end] in _COMPRESSED_RECORD_KINDS
+
+
+def _compress_bytes_part(bytes):
+    """Compress the bytes of a bytes part, if that is worthwhile.
+
+    :return: The compressed bytes, or None to send bytes as they are.
+    """
+    if (len(bytes) < _MIN_COMPRESS_SIZE
+        or len(bytes) > _MAX_DECOMPRESSED_SIZE
+        or _is_compressed_record(bytes)):
+        return None
+    if len(bytes) > _COMPRESS_SAMPLE_SIZE:
+        sample = bytes[:_COMPRESS_SAMPLE_SIZE]
+        if len(zlib.compress(sample, 1)) > len(sample) * _MAX_COMPRESS_RATIO:
+            return None
+    compressed = zlib.compress(bytes, 1)
+    if len(compressed) > len(bytes) * _MAX_COMPRESS_RATIO:
+        return None
+    return compressed
+
+
 class ProtocolThreeDecoder(_StatefulDecoder):
 
     response_marker = RESPONSE_VERSION_THREE
@@ -901,6 +965,9 @@ class ProtocolThreeDecoder(_StatefulDecoder):
             self._number_needed_bytes = 4
         self.decoding_failed = False
         self.request_handler = self.message_handler = message_handler
+        # Compressed bytes parts are only accepted from a peer whose headers
+        # said it can send them.
+        self._accept_compressed = False
 
     def accept_bytes(self, bytes):
         self._number_needed_bytes = None
@@ -996,6 +1063,8 @@ class ProtocolThreeDecoder(_StatefulDecoder):
         if type(decoded) is not dict:
             raise errors.SmartProtocolError(
                 'Header object %r is not a dict' % (decoded,))
+        self._accept_compressed = (
+            decoded.get(COMPRESSION_HEADER) == COMPRESSION_ZLIB)
         self.state_accept = self._state_accept_expecting_message_part
         try:
             self.message_handler.headers_received(decoded)
@@ -1010,6 +1079,8 @@ class ProtocolThreeDecoder(_StatefulDecoder):
             self.state_accept = self._state_accept_expecting_structure
         elif message_part_kind == 'b':
             self.state_accept = self._state_accept_expecting_bytes
+        elif message_part_kind == 'z' and self._accept_compressed:
+            self.state_accept = self._state_accept_expecting_compressed_bytes
         elif message_part_kind == 'e':
             self.done()
         else:
@@ -1034,6 +1105,30 @@ class ProtocolThreeDecoder(_StatefulDecoder):
         except:
             raise errors.SmartMessageHandlerError(sys.exc_info())
 
+    def _state_accept_expecting_compressed_bytes(self):
+        prefixed_bytes = self._extract_length_prefixed_bytes()
+        decompressor = zlib.decompressobj()
+        try:
+            # Data after the end of the stream is left in unused_data, so the
+            # extra byte shows whether the stream was complete.
+            bytes = decompressor.decompress(prefixed_bytes + '\0',
+                                            _MAX_DECOMPRESSED_SIZE + 1)
+        except zlib.error, e:
+            raise errors.SmartProtocolError(
+                'Bad compressed bytes part: %s' % (e,))
+        if len(bytes) > _MAX_DECOMPRESSED_SIZE:
+            raise errors.SmartProtocolError(
+                'Compressed bytes part expands to more than %d bytes'
+                % (_MAX_DECOMPRESSED_SIZE,))
+        if decompressor.unused_data != '\0':
+            raise errors.SmartProtocolError(
+                'Bad compressed bytes part: truncated or trailing data')
+        self.state_accept = self._state_accept_expecting_message_part
+        try:
+            self.message_handler.bytes_part_received(bytes)
+        except:
+            raise errors.SmartMessageHandlerError(sys.exc_info())
+
     def _state_accept_expecting_structure(self):
         structure = self._extract_prefixed_bencoded_data()
         self.state_accept = self._state_accept_expecting_message_part
@@ -1080,6 +1175,7 @@ class _ProtocolThreeEncoder(object):
         self._buf = []
         self._buf_len = 0
         self._real_write_func = write_func
+        self._compress_parts = False
 
     def _write_func(self, bytes):
         # TODO: Another possibility would be to turn this into an async model.
@@ -1098,6 +1194,14 @@ class _ProtocolThreeEncoder(object):
             del self._buf[:]
             self._buf_len = 0
 
+    def set_peer_compression(self, compression):
+        """Compress bytes parts if the peer can decode them.
+
+        :param compression: The value of the peer's COMPRESSION_HEADER, or
+            None if it did not send one.
+        """
+        self._compress_parts = (compression == COMPRESSION_ZLIB)
+
     def _serialise_offsets(self, offsets):
         """Serialise a readv offset list."""
         txt = []
@@ -1131,6 +1235,13 @@ class _ProtocolThreeEncoder(object):
         self.flush()
 
     def _write_prefixed_body(self, bytes):
+        if self._compress_parts:
+            compressed = _compress_bytes_part(bytes)
+            if compressed is not None:
+                self._write_func('z')
+                self._write_func(struct.pack('!L', len(compressed)))
+                self._write_func(compressed)
+                return
         self._write_func('b')
         self._write_func(struct.pack('!L', len(bytes)))
         self._write_func(bytes)
@@ -1150,11 +1261,17 @@ class ProtocolThreeResponder(_ProtocolThreeEncoder):
     def __init__(self, write_func):
         _ProtocolThreeEncoder.__init__(self, write_func)
         self.response_sent = False
-        self._headers = {'Software version': bzrlib.__version__}
+        self._headers = {'Software version': bzrlib.__version__,
+                         COMPRESSION_HEADER: COMPRESSION_ZLIB,
+                         PIPELINING_HEADER: PIPELINING_IN_ORDER}
         if 'hpss' in debug.debug_flags:
             self._thread_id = thread.get_ident()
             self._response_start_time = None
 
+    def request_headers_received(self, headers):
+        """Called with the headers of the request being responded to."""
+        self.set_peer_compression(headers.get(COMPRESSION_HEADER))
+
     def _trace(self, action, message, extra_bytes=None, include_time=False):
         if self._response_start_time is None:
             self._response_start_time = osutils.timer_func()
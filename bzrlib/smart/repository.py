@@ -43,6 +43,7 @@ from bzrlib.smart.request import (
     FailedSmartServerResponse,
     SmartServerRequest,
     SuccessfulSmartServerResponse,
+    file_state,
     )
 from bzrlib.repository import _strip_NULL_ghosts, network_format_registry
 from bzrlib import revision as _mod_revision
@@ -53,6 +54,19 @@ from bzrlib.versionedfile import (
     )
 
 
+def _open_repository(transport):
+    return BzrDir.open_from_transport(transport).open_repository()
+
+
+def _repository_state(repository):
+    """The state of the files a repository was opened from.
+
+    Only pack repositories are reused, which read pack-names again when they
+    are locked anyway.
+    """
+    return file_state(repository._transport, ['format', 'pack-names'])
+
+
 class SmartServerRepositoryRequest(SmartServerRequest):
     """Common base class for Repository requests."""
 
@@ -70,9 +84,9 @@ class SmartServerRepositoryRequest(SmartServerRequest):
         :return: A SmartServerResponse from self.do_repository_request().
         """
         transport = self.transport_from_client_path(path)
-        bzrdir = BzrDir.open_from_transport(transport)
         # Save the repository for use with do_body.
-        self._repository = bzrdir.open_repository()
+        self._repository = self.open_cached('repository', transport,
+            _open_repository, _repository_state)
         return self.do_repository_request(self._repository, *args)
 
     def do_repository_request(self, repository, *args):
@@ -442,6 +456,48 @@ class SmartServerRepositoryGatherStats(SmartServerRepositoryRequest):
         return SuccessfulSmartServerResponse(('ok', ), body)
 
 
+class SmartServerRepositoryGatherStorageStats(SmartServerRepositoryRequest):
+    """Summarise how the content of a repository is stored.
+
+    New in 2.7.
+    """
+
+    def do_repository_request(self, repository):
+        """Return the result of repository.gather_storage_stats().
+
+        :param repository: The repository to query in.
+        :return: A SmartServerResponse ('ok',), with a body looking like
+              packs: 2
+              size: 23456
+              earliest: 1234.230
+              latest: 2345.700
+              index revision: 2 812 -
+              index text: 3 1520 4096
+
+            where each index line gives the number of records and their
+            compressed and uncompressed bytes, '-' if unknown. The earliest
+            and latest lines are omitted if unknown. A failure
+            ('UnsupportedOperation',) if the repository cannot gather these
+            statistics.
+        """
+        try:
+            stats = repository.gather_storage_stats()
+        except errors.UnsupportedOperation:
+            return FailedSmartServerResponse(('UnsupportedOperation',))
+        body = 'packs: %d\nsize: %d\n' % (stats['packs'], stats['size'])
+        if stats['earliest'] is not None:
+            body += 'earliest: %.3f\nlatest: %.3f\n' % (stats['earliest'],
+                stats['latest'])
+        for index_type, index_stats in sorted(stats['indices'].iteritems()):
+            uncompressed = index_stats['uncompressed']
+            if uncompressed is None:
+                uncompressed = '-'
+            body += 'index %s: %d %d %s\n' % (index_type,
+                index_stats['records'], index_stats['compressed'],
+                uncompressed)
+        return SuccessfulSmartServerResponse(('ok', ), body)
+
+
 class SmartServerRepositoryGetRevisionSignatureText(
         SmartServerRepositoryRequest):
     """Return the signature text of a revision.
@@ -34,6 +34,7 @@ from __future__ import absolute_import
 
 
 import threading
+import weakref
 
 from bzrlib import (
     debug,
@@ -46,7 +47,7 @@ from bzrlib import (
     )
 from bzrlib.lazy_import import lazy_import
 lazy_import(globals(), """
-from bzrlib import bzrdir
+from bzrlib import bzrdir, config, groupcompress, lru_cache
 from bzrlib.bundle import serializer
 
 import tempfile
@@ -116,6 +117,15 @@ class SmartServerRequest(object):
                 root_client_path += '/'
         self._root_client_path = root_client_path
         self._body_chunks = []
+        # (key, state, object) for each object open_cached returned.
+        self._cached_objects = []
+
+    # Whether the request may reuse branches and repositories opened by
+    # earlier requests, which SmartServerRequestHandler sets for read-only
+    # requests.
+    _reuse_objects = False
+    # The _ObjectCache they are reused from.
+    _object_cache = None
 
     def _check_enabled(self):
         """Raises DisabledMethod if this method is disabled."""
@@ -208,6 +218,152 @@ class SmartServerRequest(object):
         relpath = self.translate_client_path(client_path)
         return self._backing_transport.clone(relpath)
 
+    def open_cached(self, kind, transport, open_func, get_state):
+        """Open an object at transport, or reuse one opened there before.
+
+        Objects are only reused by read-only requests, see _ObjectCache.
+
+        :param kind: The kind of object, such as 'branch'.
+        :param open_func: Opens the object at the transport passed to it.
+        :param get_state: Returns a value that changes whenever the files the
+            object passed to it was opened from change, or None if the object
+            should not be reused.  See file_state.
+        """
+        if self._reuse_objects and self._object_cache is None:
+            self._object_cache = _get_object_cache(self._jail_root)
+        if self._object_cache is None:
+            return open_func(transport)
+        key = (kind, transport.base)
+        entry = self._object_cache.take(key, get_state)
+        if entry is None:
+            obj = open_func(transport)
+            state = get_state(obj)
+            if state is None:
+                return obj
+        else:
+            state, obj = entry
+        self._cached_objects.append((key, state, obj))
+        return obj
+
+    def release_cached_objects(self):
+        """Let later requests reuse the objects open_cached returned.
+
+        This is called once the response has been sent, as the response body
+        may be read from them until then.
+        """
+        cached_objects = self._cached_objects
+        self._cached_objects = []
+        for key, state, obj in cached_objects:
+            if obj.is_locked():
+                # The request did not finish with it.
+                continue
+            self._object_cache.put(key, state, obj)
+
+
+def file_state(transport, names):
+    """Return the state of some files, for SmartServerRequest.open_cached.
+
+    :return: A tuple of the size, modification time and inode of each file,
+        or None if one of them cannot be stat'ed or has no modification time.
+    """
+    state = []
+    for name in names:
+        try:
+            st = transport.stat(name)
+        except (errors.NoSuchFile, errors.TransportNotPossible):
+            return None
+        mtime = getattr(st, 'st_mtime', None)
+        if mtime is None:
+            return None
+        state.append((st.st_size, mtime, getattr(st, 'st_ino', None)))
+    return tuple(state)
+
+
+class _ObjectCache(object):
+    """Branches and repositories opened by read-only requests, for reuse.
+
+    Opening a branch or repository reads its format files, pack-names and
+    index roots again, and throws away the index pages read by the last
+    request.  Read-only requests instead take the object an earlier request
+    opened at the same location, on any connection, if the files it was
+    opened from have not changed since.  Objects are used by one request at a
+    time, and put back once their request has sent its response.
+
+    :ivar hits: How many objects were reused.
+    :ivar misses: How many times there was no object to reuse, or it was out
+        of date.
+    """
+
+    def __init__(self, max_size):
+        self._lock = threading.Lock()
+        # Maps keys to (state, object), or to None while the object is used.
+        self._idle = lru_cache.LRUCache(max_cache=max_size)
+        self.hits = 0
+        self.misses = 0
+
+    def take(self, key, get_state):
+        """Take the object cached for key, if it is still up to date.
+
+        :return: (state, object), or None.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._idle.get(key)
+            if entry is not None:
+                self._idle[key] = None
+        finally:
+            self._lock.release()
+        if entry is not None and get_state(entry[1]) != entry[0]:
+            entry = None
+        self._lock.acquire()
+        try:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        finally:
+            self._lock.release()
+        return entry
+
+    def put(self, key, state, obj):
+        """Cache an object which is no longer used."""
+        self._lock.acquire()
+        try:
+            self._idle[key] = (state, obj)
+        finally:
+            self._lock.release()
+
+    def stats_summary(self):
+        return '%d hits, %d misses' % (self.hits, self.misses)
+
+
+# The _ObjectCache for each server, keyed by the jail root of its requests.
+_object_caches = weakref.WeakKeyDictionary()
+_object_caches_lock = threading.Lock()
+
+
+def _get_object_cache(jail_root):
+    """Return the object cache for requests jailed to jail_root.
+
+    :return: An _ObjectCache, or None if the ``serve.cached_objects`` option
+        disables caching.
+    """
+    _object_caches_lock.acquire()
+    try:
+        try:
+            return _object_caches[jail_root]
+        except KeyError:
+            pass
+        max_size = config.GlobalStack().get('serve.cached_objects')
+        if max_size is None or max_size <= 0:
+            cache = None
+        else:
+            cache = _ObjectCache(max_size)
+        _object_caches[jail_root] = cache
+        return cache
+    finally:
+        _object_caches_lock.release()
+
 
 class SmartServerResponse(object):
     """A response to a client request.
@@ -347,6 +503,23 @@ class SmartServerRequestHandler(object):
         if result is not None:
             self.response = result
             self.finished_reading = True
+            if self._command._cached_objects:
+                self._release_cached_objects(result)
+
+    def _release_cached_objects(self, response):
+        """Release the command's cached objects once response is sent."""
+        if response.body_stream is None:
+            self._command.release_cached_objects()
+        else:
+            response.body_stream = self._release_after_stream(
+                response.body_stream)
+
+    def _release_after_stream(self, body_stream):
+        for chunk in body_stream:
+            yield chunk
+        # Not reached if the stream is abandoned, in which case the objects
+        # are not reused.
+        self._command.release_cached_objects()
 
     def _call_converting_errors(self, callable, args, kwargs):
         """Call callable converting errors to Response objects."""
@@ -389,6 +562,9 @@ class SmartServerRequestHandler(object):
                         '%s %s' % (cmd, repr(args)[1:-1]))
         self._command = command(
             self._backing_transport, self._root_client_path, self._jail_root)
+        get_info = getattr(self._commands, 'get_info', None)
+        if get_info is not None and get_info(cmd) == 'read':
+            self._command._reuse_objects = True
         self._run_handler_code(self._command.execute, args, {})
 
     def end_received(self):
@@ -398,6 +574,12 @@ class SmartServerRequestHandler(object):
         self._run_handler_code(self._command.do_end, (), {})
         if 'hpss' in debug.debug_flags:
             self._trace('end', '', include_time=True)
+            block_cache = groupcompress._shared_block_cache
+            if block_cache is not None:
+                self._trace('block cache', block_cache.stats_summary())
+            object_cache = self._command._object_cache
+            if object_cache is not None:
+                self._trace('object cache', object_cache.stats_summary())
 
     def post_body_error_received(self, error_args):
         # Just a no-op at the moment.
@@ -683,6 +865,9 @@ request_handlers.register_lazy(
 request_handlers.register_lazy(
     'Repository.gather_stats', 'bzrlib.smart.repository',
     'SmartServerRepositoryGatherStats', info='read')
+request_handlers.register_lazy(
+    'Repository.gather_storage_stats', 'bzrlib.smart.repository',
+    'SmartServerRepositoryGatherStorageStats', info='read')
 request_handlers.register_lazy(
     'Repository.get_parent_map', 'bzrlib.smart.repository',
     'SmartServerRepositoryGetParentMap', info='read')
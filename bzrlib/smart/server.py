@@ -18,9 +18,14 @@
 
 from __future__ import absolute_import
 
+import collections
 import errno
+import mmap
 import os.path
+import select
+import signal
 import socket
+import struct
 import sys
 import time
 import threading
@@ -28,6 +33,7 @@ import threading
 from bzrlib.hooks import Hooks
 from bzrlib import (
     errors,
+    osutils,
     trace,
     transport as _mod_transport,
 )
@@ -64,6 +70,8 @@ class SmartTCPServer(object):
     _ACCEPT_TIMEOUT = 1.0
     _SHUTDOWN_POLL_TIMEOUT = 1.0
     _LOG_WAITING_TIMEOUT = 10.0
+    # How many connections may wait to be accepted.
+    _LISTEN_BACKLOG = 1
 
     _timer = time.time
 
@@ -87,6 +95,9 @@ class SmartTCPServer(object):
         # This is set to indicate we want to wait for clients to finish before
         # we disconnect.
         self._gracefully_stopping = False
+        # The _WorkerStats this server reports to when it is a prefork worker.
+        self._stats = None
+        self._connections_accepted = 0
 
     def start_server(self, host, port):
         """Create the server listening socket.
@@ -117,7 +128,7 @@ class SmartTCPServer(object):
             raise errors.CannotBindAddress(host, port, message)
         self._sockname = self._server_socket.getsockname()
         self.port = self._sockname[1]
-        self._server_socket.listen(1)
+        self._server_socket.listen(self._LISTEN_BACKLOG)
         self._server_socket.settimeout(self._ACCEPT_TIMEOUT)
         # Once we start accept()ing connections, we set started.
         self._started = threading.Event()
@@ -204,27 +215,7 @@ class SmartTCPServer(object):
         self._started.set()
         try:
             try:
-                while not self._should_terminate:
-                    try:
-                        conn, client_addr = self._server_socket.accept()
-                    except self._socket_timeout:
-                        # just check if we're asked to stop
-                        pass
-                    except self._socket_error, e:
-                        # if the socket is closed by stop_background_thread
-                        # we might get a EBADF here, or if we get a signal we
-                        # can get EINTR, any other socket errors should get
-                        # logged.
-                        if e.args[0] not in (errno.EBADF, errno.EINTR):
-                            trace.warning(gettext("listening socket error: %s")
-                                          % (e,))
-                    else:
-                        if self._should_terminate:
-                            conn.close()
-                            break
-                        self.serve_conn(conn, thread_name_suffix)
-                    # Cleanout any threads that have finished processing.
-                    self._poll_active_connections()
+                self._serve_connections(thread_name_suffix)
             except KeyboardInterrupt:
                 # dont log when CTRL-C'd.
                 raise
@@ -245,6 +236,30 @@ class SmartTCPServer(object):
             self._wait_for_clients_to_disconnect()
         self._fully_stopped.set()
 
+    def _serve_connections(self, thread_name_suffix):
+        """Accept and serve connections until asked to terminate."""
+        while not self._should_terminate:
+            try:
+                conn, client_addr = self._server_socket.accept()
+            except self._socket_timeout:
+                # just check if we're asked to stop
+                pass
+            except self._socket_error, e:
+                # if the socket is closed by stop_background_thread
+                # we might get a EBADF here, or if we get a signal we
+                # can get EINTR, any other socket errors should get
+                # logged.
+                if e.args[0] not in (errno.EBADF, errno.EINTR):
+                    trace.warning(gettext("listening socket error: %s")
+                                  % (e,))
+            else:
+                if self._should_terminate:
+                    conn.close()
+                    break
+                self.serve_conn(conn, thread_name_suffix)
+            # Cleanout any threads that have finished processing.
+            self._poll_active_connections()
+
     def get_url(self):
         """Return the url of the server"""
         return "bzr://%s:%s/" % (self._sockname[0], self._sockname[1])
@@ -270,6 +285,12 @@ class SmartTCPServer(object):
             if thread.isAlive():
                 still_active.append((handler, thread))
         self._active_connections = still_active
+        self._update_stats()
+
+    def _update_stats(self):
+        if self._stats is not None:
+            self._stats.update(self._connections_accepted,
+                               len(self._active_connections))
 
     def serve_conn(self, conn, thread_name_suffix):
         # For WIN32, where the timeout value from the listening socket
@@ -281,6 +302,8 @@ class SmartTCPServer(object):
         connection_thread = threading.Thread(
             None, handler.serve, name=thread_name)
         self._active_connections.append((handler, connection_thread))
+        self._connections_accepted += 1
+        self._update_stats()
         connection_thread.setDaemon(True)
         connection_thread.start()
         return connection_thread
@@ -353,6 +376,491 @@ class SmartServerHooks(Hooks):
 SmartTCPServer.hooks = SmartServerHooks()
 
 
+class SmartEventTCPServer(SmartTCPServer):
+    """A SmartTCPServer that serves all its connections from one event loop.
+
+    Rather than a thread blocking on each connection, a single loop polls
+    them all and hands the bytes that arrive to a fixed pool of threads,
+    which run the requests.  Idle and slow clients then cost a socket each
+    rather than a thread each.
+
+    Each entry in _active_connections is a (handler, None) tuple, as no
+    thread belongs to a single connection.
+    """
+
+    # Bursts of clients connecting at once are accepted without any being
+    # turned away.
+    _LISTEN_BACKLOG = socket.SOMAXCONN
+
+    def __init__(self, backing_transport, root_client_path='/',
+                 client_timeout=None, request_threads=4):
+        """Construct a new server.
+
+        :param request_threads: The number of requests to run at once.
+        """
+        SmartTCPServer.__init__(self, backing_transport,
+            root_client_path=root_client_path, client_timeout=client_timeout)
+        self._request_threads = request_threads
+        # fd -> handler for every open connection
+        self._connections = {}
+        # fd -> time it became idle, for connections the loop is reading
+        self._idle_since = {}
+        # The fds whose bytes a request thread is processing.
+        self._busy = set()
+        # (fd, keep_open) for each batch of bytes the request threads have
+        # finished with, guarded by _lock.
+        self._done = collections.deque()
+        self._lock = threading.Lock()
+        self._wake_r = self._wake_w = None
+        self._next_sweep = 0
+
+    def start_server(self, host, port):
+        SmartTCPServer.start_server(self, host, port)
+        # Set up the loop now, as stop_background_thread may close the
+        # listening socket as soon as serve() has started.
+        self._server_fd = self._server_socket.fileno()
+        self._wake_r, self._wake_w = os.pipe()
+        self._poller = select.poll()
+        self._poller.register(self._wake_r, select.POLLIN)
+        self._poller.register(self._server_fd, select.POLLIN)
+
+    def _make_handler(self, conn):
+        return medium.SmartServerSocketEventMedium(
+            conn, self.backing_transport, self.root_client_path,
+            timeout=self._client_timeout)
+
+    def _serve_connections(self, thread_name_suffix):
+        """Run the event loop until asked to terminate."""
+        from multiprocessing.pool import ThreadPool
+        self._pool = ThreadPool(self._request_threads)
+        try:
+            while not self._should_terminate:
+                self._serve_events(self._ACCEPT_TIMEOUT)
+            self._poller.unregister(self._server_fd)
+        except:
+            self._shut_down_event_loop()
+            raise
+        if not self._gracefully_stopping:
+            self._shut_down_event_loop()
+
+    def _serve_events(self, timeout):
+        """Wait up to timeout seconds for something to happen, and handle it.
+        """
+        try:
+            events = self._poller.poll(timeout * 1000)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            events = []
+        for fd, event in events:
+            if fd == self._wake_r:
+                os.read(self._wake_r, 4096)
+            elif fd == self._server_fd:
+                self._accept_connection()
+            elif fd in self._idle_since:
+                self._read_connection(fd)
+        self._finish_processed_bytes()
+        self._close_idle_connections()
+
+    def _accept_connection(self):
+        try:
+            conn, client_addr = self._server_socket.accept()
+        except self._socket_timeout:
+            return
+        except self._socket_error, e:
+            if e.args[0] not in (errno.EBADF, errno.EINTR, errno.EAGAIN):
+                trace.warning(gettext("listening socket error: %s") % (e,))
+            return
+        if self._should_terminate:
+            conn.close()
+            return
+        self.serve_conn(conn, '')
+
+    def serve_conn(self, conn, thread_name_suffix):
+        # For WIN32, where the timeout value from the listening socket
+        # propagates to the newly accepted socket.
+        conn.setblocking(True)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        handler = self._make_handler(conn)
+        fd = conn.fileno()
+        self._connections[fd] = handler
+        self._active_connections.append((handler, None))
+        self._connections_accepted += 1
+        self._update_stats()
+        self._idle_since[fd] = self._timer()
+        self._poller.register(fd, select.POLLIN)
+        return handler
+
+    def _read_connection(self, fd):
+        """Read what a client sent, and pass it to a request thread."""
+        handler = self._connections[fd]
+        # The socket is readable, so this does not block.
+        bytes = handler.read_bytes(osutils.MAX_SOCKET_CHUNK)
+        if not bytes:
+            self._close_connection(fd)
+            return
+        # Stop reading until the request thread is done with these bytes.
+        self._poller.unregister(fd)
+        del self._idle_since[fd]
+        self._busy.add(fd)
+        self._pool.apply_async(self._process_bytes, (fd, handler, bytes))
+
+    def _process_bytes(self, fd, handler, bytes):
+        """Serve the requests bytes complete, in a request thread."""
+        keep_open = False
+        try:
+            keep_open = handler.process_bytes(bytes)
+        finally:
+            self._lock.acquire()
+            try:
+                if self._wake_w is None:
+                    # The event loop has shut down.
+                    handler._disconnect_client()
+                else:
+                    self._done.append((fd, keep_open))
+                    os.write(self._wake_w, '\0')
+            finally:
+                self._lock.release()
+
+    def _finish_processed_bytes(self):
+        """Start reading again from connections the request threads are
+        done with, or close them.
+        """
+        while self._done:
+            fd, keep_open = self._done.popleft()
+            self._busy.discard(fd)
+            handler = self._connections[fd]
+            if (not keep_open or (self._gracefully_stopping
+                                  and not handler.in_request())):
+                self._close_connection(fd)
+            else:
+                self._idle_since[fd] = self._timer()
+                self._poller.register(fd, select.POLLIN)
+
+    def _close_idle_connections(self):
+        """Close connections that timed out between requests.
+
+        When stopping gracefully, close every connection between requests.
+        """
+        now = self._timer()
+        if not self._gracefully_stopping:
+            if now < self._next_sweep:
+                return
+            self._next_sweep = now + self._ACCEPT_TIMEOUT
+        for fd, idle_since in self._idle_since.items():
+            handler = self._connections[fd]
+            if handler.in_request():
+                continue
+            if self._gracefully_stopping:
+                self._close_connection(fd)
+            elif now - idle_since >= handler._client_timeout:
+                e = errors.ConnectionTimeout(
+                    'disconnecting client after %.1f seconds'
+                    % (handler._client_timeout,))
+                trace.note('%s' % (e,))
+                self._close_connection(fd)
+
+    def _close_connection(self, fd):
+        handler = self._connections.pop(fd)
+        if self._idle_since.pop(fd, None) is not None:
+            self._poller.unregister(fd)
+        self._active_connections.remove((handler, None))
+        self._update_stats()
+        handler._disconnect_client()
+
+    def _poll_active_connections(self, timeout=0.0):
+        """Run the event loop for up to timeout seconds.
+
+        This lets the requests of connected clients finish when stopping
+        gracefully.
+        """
+        self._serve_events(timeout)
+
+    def _wait_for_clients_to_disconnect(self):
+        try:
+            SmartTCPServer._wait_for_clients_to_disconnect(self)
+        finally:
+            self._shut_down_event_loop()
+
+    def _shut_down_event_loop(self):
+        """Stop the request threads and close the remaining connections.
+
+        Requests that are running are left to finish, and close their
+        connection when they do; this waits for them.
+        """
+        self._pool.close()
+        self._lock.acquire()
+        try:
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+            self._wake_r = self._wake_w = None
+            while self._done:
+                self._busy.discard(self._done.popleft()[0])
+            for fd, handler in self._connections.items():
+                if fd not in self._busy:
+                    handler._disconnect_client()
+        finally:
+            self._lock.release()
+        self._pool.join()
+        self._connections = {}
+        self._idle_since = {}
+        self._busy = set()
+        self._active_connections = []
+        self._update_stats()
+
+
+class _WorkerStats(object):
+    """The counters of one prefork worker, kept in memory shared with the
+    parent process so it can report them.
+    """
+
+    # pid, start time, connections accepted, connections active
+    _struct = struct.Struct('=LdLL')
+    size = _struct.size
+
+    def __init__(self, buf, offset):
+        self._buf = buf
+        self._offset = offset
+        self.pid = 0
+        self.started = 0.0
+
+    def start(self, pid, started):
+        self.pid = pid
+        self.started = started
+        self.update(0, 0)
+
+    def update(self, connections, active):
+        self._buf[self._offset:self._offset + self.size] = self._struct.pack(
+            self.pid, self.started, connections, active)
+
+    def clear(self):
+        self.pid = 0
+        self.started = 0.0
+        self.update(0, 0)
+
+    def read(self):
+        """Return (pid, started, connections, active) as last written."""
+        return self._struct.unpack(
+            self._buf[self._offset:self._offset + self.size])
+
+
+class PreforkingSmartServer(object):
+    """Serves the listening socket of a SmartTCPServer from worker processes.
+
+    Each worker is a fork of this process running the server's serve loop,
+    so requests for different clients are run on different cores.  The
+    kernel hands each new connection to one of the workers.
+
+    This process only supervises the workers: it replaces any that die,
+    and on SIGHUP asks them all to stop gracefully and waits for them.
+    SIGUSR1 restarts the workers gracefully: the running ones finish their
+    clients and exit while new ones take over the socket.  SIGUSR2 logs the
+    statistics of each worker, which get_worker_stats() also returns.
+    """
+
+    # How often to check on the workers, in seconds.
+    _SUPERVISE_INTERVAL = 1.0
+
+    def __init__(self, server, workers):
+        """Construct a new preforking server.
+
+        :param server: The SmartTCPServer to run in each worker, after its
+            start_server has been called.
+        :param workers: The number of worker processes to run.
+        """
+        self.server = server
+        self.workers = workers
+        self.port = server.port
+        # pid -> _WorkerStats, for the running workers and for those
+        # finishing their clients before they exit.
+        self._workers = {}
+        self._draining = {}
+        # Draining workers need slots too, while their replacements run.
+        self._stats_buffer = mmap.mmap(-1, 2 * workers * _WorkerStats.size)
+        self._free_stats = [
+            _WorkerStats(self._stats_buffer, i * _WorkerStats.size)
+            for i in range(2 * workers)]
+        self._should_terminate = False
+        self._restart_requested = False
+        self._report_requested = False
+        self._started = threading.Event()
+        self._stopped = threading.Event()
+        self._fully_stopped = threading.Event()
+
+    def get_url(self):
+        return self.server.get_url()
+
+    def get_worker_stats(self):
+        """Return the statistics of the workers.
+
+        :return: A list of (pid, started, connections, active) tuples, one
+            for each worker, giving its start time, how many connections it
+            has accepted and how many it is serving.
+        """
+        stats = []
+        for pid, worker_stats in sorted(self._workers.items()
+                                        + self._draining.items()):
+            if worker_stats is not None:
+                stats.append(worker_stats.read())
+        return stats
+
+    def _stop_gracefully(self):
+        trace.note(gettext('Requested to stop gracefully'))
+        self._should_terminate = True
+        self._drain_workers()
+        self._stopped.set()
+
+    def _request_restart(self, signum, frame):
+        self._restart_requested = True
+
+    def _request_report(self, signum, frame):
+        self._report_requested = True
+
+    def serve(self):
+        # See SmartTCPServer.serve for why this needs a local reference.
+        stop_gracefully = self._stop_gracefully
+        signals.register_on_hangup(id(self), stop_gracefully)
+        old_handlers = [
+            (signal.SIGUSR1, signal.signal(signal.SIGUSR1,
+                                           self._request_restart)),
+            (signal.SIGUSR2, signal.signal(signal.SIGUSR2,
+                                           self._request_report)),
+            ]
+        self._started.set()
+        try:
+            try:
+                self._supervise()
+            except:
+                self._terminate_workers()
+                raise
+        finally:
+            for signum, handler in old_handlers:
+                signal.signal(signum, handler)
+            signals.unregister_on_hangup(id(self))
+            try:
+                self.server._server_socket.close()
+            except self.server._socket_error:
+                pass
+            self._stopped.set()
+        self._fully_stopped.set()
+
+    def _supervise(self):
+        """Keep the workers running until asked to stop and they have."""
+        while True:
+            if self._restart_requested:
+                self._restart_requested = False
+                trace.note(gettext('Restarting %d worker(s)')
+                           % (len(self._workers),))
+                self._drain_workers()
+            if self._report_requested:
+                self._report_requested = False
+                self._report_stats()
+            self._reap_workers()
+            if not self._should_terminate:
+                while len(self._workers) < self.workers:
+                    self._start_worker()
+            else:
+                # Catch a worker forked as the request to stop arrived.
+                self._drain_workers()
+                if not self._draining:
+                    break
+            time.sleep(self._SUPERVISE_INTERVAL)
+
+    def _start_worker(self):
+        worker_stats = None
+        if self._free_stats:
+            worker_stats = self._free_stats.pop()
+        pid = os.fork()
+        if pid == 0:
+            self._run_worker(worker_stats)
+        self._workers[pid] = worker_stats
+
+    def _run_worker(self, worker_stats):
+        """Serve connections in a newly forked worker, then exit."""
+        exit_code = 1
+        try:
+            try:
+                signals.unregister_on_hangup(id(self))
+                signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+                signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+                if worker_stats is not None:
+                    worker_stats.start(os.getpid(), time.time())
+                self.server._stats = worker_stats
+                self.server.serve()
+                exit_code = 0
+            except KeyboardInterrupt:
+                pass
+            except:
+                trace.report_exception(sys.exc_info(), sys.stderr)
+        finally:
+            # Never return into the caller of serve in the parent.
+            os._exit(exit_code)
+
+    def _drain_workers(self):
+        """Ask the running workers to finish their clients and exit."""
+        for pid in self._workers:
+            self._signal_worker(pid, signal.SIGHUP)
+        self._draining.update(self._workers)
+        self._workers = {}
+
+    def _terminate_workers(self):
+        """Kill the workers and wait for them to exit."""
+        self._draining.update(self._workers)
+        self._workers = {}
+        for pid in self._draining:
+            self._signal_worker(pid, signal.SIGTERM)
+        while self._draining:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            self._release_worker(self._draining.pop(pid, None))
+
+    def _signal_worker(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError, e:
+            # It has already exited, and will be reaped.
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _reap_workers(self):
+        """Collect the workers that have exited."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            if pid in self._workers:
+                trace.warning(gettext(
+                    'worker %d exited unexpectedly with status %d')
+                    % (pid, status))
+                worker_stats = self._workers.pop(pid)
+            else:
+                worker_stats = self._draining.pop(pid, None)
+            self._release_worker(worker_stats)
+
+    def _release_worker(self, worker_stats):
+        if worker_stats is not None:
+            worker_stats.clear()
+            self._free_stats.append(worker_stats)
+
+    def _report_stats(self):
+        now = time.time()
+        for pid, started, connections, active in self.get_worker_stats():
+            trace.note(gettext('worker %d: up %d seconds, %d connection(s) '
+                               'accepted, %d active')
+                       % (pid, now - started, connections, active))
+
+
 def _local_path_for_transport(transport):
     """Return a local path for transport, if reasonably possible.
     
@@ -433,7 +941,8 @@ class BzrServerFactory(object):
     def _get_stdin_stdout(self):
         return sys.stdin, sys.stdout
 
-    def _make_smart_server(self, host, port, inet, timeout):
+    def _make_smart_server(self, host, port, inet, timeout,
+                           request_threads=0):
         if timeout is None:
             c = config.GlobalStack()
             timeout = c.get('serve.client_timeout')
@@ -446,8 +955,12 @@ class BzrServerFactory(object):
                 host = medium.BZR_DEFAULT_INTERFACE
             if port is None:
                 port = medium.BZR_DEFAULT_PORT
-            smart_server = SmartTCPServer(self.transport,
-                                          client_timeout=timeout)
+            if request_threads:
+                smart_server = SmartEventTCPServer(self.transport,
+                    client_timeout=timeout, request_threads=request_threads)
+            else:
+                smart_server = SmartTCPServer(self.transport,
+                                              client_timeout=timeout)
             smart_server.start_server(host, port)
             trace.note(gettext('listening on port: %s') % smart_server.port)
         self.smart_server = smart_server
@@ -471,9 +984,32 @@ class BzrServerFactory(object):
             signals.restore_sighup_handler(orig)
         self.cleanups.append(restore_signals)
 
-    def set_up(self, transport, host, port, inet, timeout):
+    def _make_workers(self, workers):
+        self.smart_server = PreforkingSmartServer(self.smart_server, workers)
+
+    def set_up(self, transport, host, port, inet, timeout, workers=None):
+        if workers:
+            if inet:
+                raise errors.BzrCommandError(
+                    gettext('--workers cannot be used with --inet.'))
+            if getattr(os, 'fork', None) is None:
+                raise errors.BzrCommandError(
+                    gettext('--workers is not supported on this platform.'))
+        request_threads = 0
+        if not inet:
+            request_threads = config.GlobalStack().get(
+                'serve.request_threads')
+            # The event loop needs poll(), which Windows does not have.
+            if request_threads and getattr(select, 'poll', None) is None:
+                trace.warning(gettext(
+                    'serve.request_threads is not supported on this platform,'
+                    ' serving each connection on its own thread.'))
+                request_threads = 0
         self._make_backing_transport(transport)
-        self._make_smart_server(host, port, inet, timeout)
+        self._make_smart_server(host, port, inet, timeout,
+                                request_threads=request_threads)
+        if workers:
+            self._make_workers(workers)
         self._change_globals()
 
     def tear_down(self):
@@ -481,16 +1017,18 @@ class BzrServerFactory(object):
             cleanup()
 
 
-def serve_bzr(transport, host=None, port=None, inet=False, timeout=None):
+def serve_bzr(transport, host=None, port=None, inet=False, timeout=None,
+              workers=None):
     """This is the default implementation of 'bzr serve'.
 
     It creates a TCP or pipe smart server on 'transport, and runs it.  The
     transport will be decorated with a chroot and pathfilter (using
-    os.path.expanduser).
+    os.path.expanduser).  If workers is given, the TCP server is run by that
+    many worker processes.
     """
     bzr_server = BzrServerFactory()
     try:
-        bzr_server.set_up(transport, host, port, inet, timeout)
+        bzr_server.set_up(transport, host, port, inet, timeout, workers)
         bzr_server.smart_server.serve()
     except:
         hook_caught_exception = False
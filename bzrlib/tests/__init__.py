@@ -67,6 +67,7 @@ from bzrlib import (
     i18n,
     debug,
     errors,
+    groupcompress,
     hooks,
     lock as _mod_lock,
     lockdir,
@@ -1029,6 +1030,8 @@ class TestCase(testtools.TestCase):
         # between tests.  We should get rid of this altogether: bug 656694. --
         # mbp 20101008
         self.overrideAttr(bzrlib.trace, '_verbosity_level', 0)
+        # Don't share decompressed blocks between tests.
+        self.overrideAttr(groupcompress, '_shared_block_cache', None)
         self._log_files = set()
         # Each key in the ``_counters`` dict holds a value for a different
         # counter. When the test ends, addDetail() should be used to output the
@@ -1985,9 +1988,10 @@ class TestCase(testtools.TestCase):
 
     def _run_bzr_core(self, args, retcode, encoding, stdin,
             working_dir):
-        # Clear chk_map page cache, because the contents are likely to mask
-        # locking errors.
+        # Clear chk_map page cache and the shared groupcompress block cache,
+        # because the contents are likely to mask locking errors.
         chk_map.clear_cache()
+        groupcompress._shared_block_cache = None
         if encoding is None:
             encoding = osutils.get_user_encoding()
         stdout = StringIOWrapper()
@@ -3960,6 +3964,7 @@ def _test_suite_testmod_names():
         'bzrlib.tests.test_atomicfile',
         'bzrlib.tests.test_bad_files',
         'bzrlib.tests.test_bisect_multi',
+        'bzrlib.tests.test_bloom',
         'bzrlib.tests.test_branch',
         'bzrlib.tests.test_branchbuilder',
         'bzrlib.tests.test_btree_index',
@@ -3968,6 +3973,7 @@ def _test_suite_testmod_names():
         'bzrlib.tests.test_bzrdir',
         'bzrlib.tests.test__chunks_to_lines',
         'bzrlib.tests.test_cache_utf8',
+        'bzrlib.tests.test_change_journal',
         'bzrlib.tests.test_chk_map',
         'bzrlib.tests.test_chk_serializer',
         'bzrlib.tests.test_chunk_writer',
@@ -68,6 +68,7 @@ def load_tests(basic_tests, module, loader):
                      'test_filesystem_cicp',
                      'test_filtered_view_ops',
                      'test_find_merge_base',
+                     'test_gc',
                      'test_help',
                      'test_hooks',
                      'test_ignore',
@@ -0,0 +1,71 @@
+# Copyright (C) 2012 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+
+"""Tests of the 'bzr gc' command."""
+
+from bzrlib import tests
+
+
+class TestGC(tests.TestCaseWithTransport):
+
+    def make_uncommitted_tree(self):
+        tree = self.make_branch_and_tree('tree', format='2a')
+        self.build_tree_contents([('tree/file', 'content\n')])
+        tree.add(['file'])
+        tree.commit('one', rev_id='one')
+        self.build_tree_contents([('tree/file', 'changed\n')])
+        tree.commit('two', rev_id='two')
+        self.run_bzr('uncommit --force', working_dir='tree')
+        self.run_bzr('revert', working_dir='tree')
+        return tree
+
+    def test_gc_removes_uncommitted(self):
+        tree = self.make_uncommitted_tree()
+        out, err = self.run_bzr('gc --dead-ratio 0 tree')
+        self.assertEqual(
+            '1 revisions, 1 inventories, 1 chk pages and 1 texts are'
+            ' unreferenced.\n', out.splitlines(True)[0])
+        self.assertStartsWith(out.splitlines()[1], 'Rewrote 1 packs,')
+        repo = tree.bzrdir.open_repository()
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        self.assertFalse(repo.has_revision('two'))
+        self.assertTrue(repo.has_revision('one'))
+
+    def test_gc_dry_run(self):
+        tree = self.make_uncommitted_tree()
+        out, err = self.run_bzr('gc --dead-ratio 0 --dry-run tree')
+        self.assertStartsWith(out.splitlines()[1], 'Would rewrite 1 packs,')
+        repo = tree.bzrdir.open_repository()
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        self.assertTrue(repo.has_revision('two'))
+
+    def test_gc_keeps_tagged(self):
+        tree = self.make_uncommitted_tree()
+        tree.branch.tags.set_tag('keep', 'two')
+        out, err = self.run_bzr('gc --dead-ratio 0 tree')
+        self.assertStartsWith(out,
+            '0 revisions, 0 inventories, 0 chk pages and 0 texts')
+        repo = tree.bzrdir.open_repository()
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        self.assertTrue(repo.has_revision('two'))
+
+    def test_gc_unsupported_format(self):
+        self.make_repository('repo', format='1.9')
+        self.run_bzr_error(['not supported'], 'gc repo')
@@ -31,6 +31,7 @@ from bzrlib import (
     upgrade,
     urlutils,
     )
+from bzrlib.repofmt import pack_repo
 from bzrlib.tests.matchers import ContainsNoVfsCalls
 from bzrlib.transport import memory
 
@@ -568,6 +569,7 @@ Branch history:
 
 Repository:
          0 revisions
+         0 KiB
 """ % (info.describe_format(repo.bzrdir, repo, branch, None),
        format.get_branch_format().get_format_description(),
        format.repository_format.get_format_description(),
@@ -1313,6 +1315,11 @@ Location:
             verbose_info = '         0 committers\n'
         else:
             verbose_info = ''
+        if isinstance(lco_tree.branch.repository, pack_repo.PackRepository):
+            # Pack repositories on local disk report their size.
+            repository_data = '         0 KiB\n'
+        else:
+            repository_data = ''
 
         self.assertEqualDiff(
 """%s (format: %s)
@@ -1342,7 +1349,7 @@ Branch history:
 %s
 Repository:
          0 revisions
-""" %  (description,
+%s""" %  (description,
         format,
         tree_data,
         branch_data,
@@ -1351,6 +1358,7 @@ Repository:
         lco_tree.branch.repository._format.get_format_description(),
         expected_lock_output,
         verbose_info,
+        repository_data,
         ), out)
         self.assertEqual('', err)
 
@@ -1542,6 +1550,7 @@ Branch history:
 
 Repository:
          0 revisions
+         0 KiB
 """, out)
         self.assertEqual("", err)
 
@@ -34,5 +34,7 @@ class TestSmartServerPing(tests.TestCaseWithTransport):
         self.assertLength(1, self.hpss_connections)
         self.assertEquals(out,
             "Response: ('ok', '2')\n"
-            "Headers: {'Software version': '%s'}\n" % (bzrlib.version_string,))
+            "Headers: {'Pipelining': 'in-order', 'Software version': '%s', "
+            "'Compression': 'zlib'}\n"
+            % (bzrlib.version_string,))
         self.assertEquals(err, "")
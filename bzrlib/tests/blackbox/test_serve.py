@@ -18,6 +18,7 @@
 """Tests of the bzr serve command."""
 
 import os
+import select
 import signal
 import sys
 import thread
@@ -38,6 +39,7 @@ from bzrlib.controldir import ControlDir
 from bzrlib.smart import client, medium
 from bzrlib.smart.server import (
     BzrServerFactory,
+    SmartEventTCPServer,
     SmartTCPServer,
     )
 from bzrlib.tests import (
@@ -340,6 +342,45 @@ class TestBzrServe(TestBzrServeBase):
         # And the server should be stopping
         self.assertEqual(0, process.wait())
 
+    def test_bzr_serve_workers(self):
+        self.make_branch('.')
+        process, url = self.start_server_port(['--workers', '2'])
+        # Once a worker serves us, the signals are handled.
+        self.make_read_requests(Branch.open(url))
+        process.send_signal(signal.SIGUSR2)
+        lines = [process.stderr.readline(), process.stderr.readline()]
+        for line in lines:
+            self.assertContainsRe(line, r'^worker \d+: up \d+ seconds, '
+                                        r'\d+ connection\(s\) accepted, '
+                                        r'\d+ active\n$')
+        self.assertServerFinishesCleanly(process)
+
+    def test_bzr_serve_workers_graceful_restart(self):
+        self.make_branch('.')
+        process, url = self.start_server_port(['--workers', '2'])
+        # Once a worker serves us, the signals are handled.
+        branch = Branch.open(url)
+        self.make_read_requests(branch)
+        process.send_signal(signal.SIGUSR1)
+        self.assertEqual('Restarting 2 worker(s)\n',
+                         process.stderr.readline())
+        # Both old workers are asked to stop, and the one serving us waits
+        # for us to finish.
+        lines = []
+        while lines.count('Requested to stop gracefully\n') < 2:
+            line = process.stderr.readline()
+            self.assertNotEqual('', line)
+            lines.append(line)
+        branch.bzrdir.root_transport.disconnect()
+        # And the new ones serve the clients.
+        self.make_read_requests(Branch.open(url))
+        process.send_signal(signal.SIGHUP)
+        self.assertEqual(0, process.wait())
+
+    def test_bzr_serve_workers_with_inet(self):
+        self.run_bzr_error(['--workers cannot be used with --inet'],
+                           ['serve', '--inet', '--workers', '2'])
+
 
 class TestCmdServeChrooting(TestBzrServeBase):
 
@@ -413,6 +454,32 @@ class TestUserdirExpansion(TestCaseWithMemoryTransport):
         bzr_server = self.make_test_server('/foo')
         self.assertFalse(bzr_server.smart_server.backing_transport.has('~user'))
 
+    def make_tcp_server(self):
+        bzr_server = BzrServerFactory()
+        bzr_server.set_up(self.get_transport(), 'localhost', 0, inet=False,
+                          timeout=4.0)
+        self.addCleanup(bzr_server.tear_down)
+        self.addCleanup(bzr_server.smart_server._server_socket.close)
+        return bzr_server
+
+    def test_request_threads_use_event_loop(self):
+        config.GlobalStack().set('serve.request_threads', 4)
+        bzr_server = self.make_tcp_server()
+        self.assertIsInstance(bzr_server.smart_server, SmartEventTCPServer)
+
+    def test_request_threads_without_poll(self):
+        config.GlobalStack().set('serve.request_threads', 4)
+        self.overrideAttr(select, 'poll')
+        del select.poll
+        warnings = []
+        self.overrideAttr(trace, 'warning',
+                          lambda *args: warnings.append(args[0] % args[1:]))
+        bzr_server = self.make_tcp_server()
+        self.assertIs(SmartTCPServer, type(bzr_server.smart_server))
+        self.assertEqual(['serve.request_threads is not supported on this'
+                          ' platform, serving each connection on its own'
+                          ' thread.'], warnings)
+
     def test_get_base_path(self):
         """cmd_serve will turn the --directory option into a LocalTransport
         (optionally decorated with 'readonly+').  BzrServerFactory can
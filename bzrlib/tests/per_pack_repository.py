@@ -173,6 +173,156 @@ class TestPackRepository(TestCaseWithTransport):
             stat = trans.stat('indices/%s%s' % (name, suffix))
             self.assertEqual(size, stat.st_size)
 
+    def test_bloom_filters_written_when_configured(self):
+        format = self.get_format()
+        tree = self.make_branch_and_tree('.', format=format)
+        repo = tree.branch.repository
+        if repo._pack_collection._index_class is not BTreeGraphIndex:
+            raise TestNotApplicable('bloom filters need B+Tree indices')
+        repo._pack_collection.config_stack.set(
+            'repository.bloom_filter_rate', 0.01)
+        trans = repo.bzrdir.get_repository_transport(None)
+        tree.commit('first')
+        tree.commit('second')
+        names = repo._pack_collection.names()
+        for name in names:
+            for suffix in ['.rbf', '.ibf', '.tbf', '.sbf']:
+                self.assertTrue(trans.has('indices/%s%s' % (name, suffix)))
+        repo.pack()
+        # the filters of the old packs go with them
+        self.assertEqual([], [f for f in trans.list_dir('indices')
+                              if f[:32] in names])
+        repo = repo.bzrdir.open_repository()
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        pack = repo._pack_collection.get_pack_by_name(
+            repo._pack_collection.names()[0])
+        self.assertFalse(('missing-revision',) in
+                         pack.revision_index._bloom_filter)
+        self.assertEqual(2, len(repo.all_revision_ids()))
+
+    def test_sidecars_obsoleted_after_being_disabled(self):
+        format = self.get_format()
+        tree = self.make_branch_and_tree('.', format=format)
+        repo = tree.branch.repository
+        if repo._pack_collection._index_class is BTreeGraphIndex:
+            repo._pack_collection.config_stack.set(
+                'repository.bloom_filter_rate', 0.01)
+        trans = repo.bzrdir.get_repository_transport(None)
+        tree.commit('first')
+        tree.commit('second')
+        names = repo._pack_collection.names()
+        repo._pack_collection.config_stack.set(
+            'repository.bloom_filter_rate', 0)
+        repo._pack_collection.config_stack.set('repository.pack_stats',
+                                               False)
+        repo.pack()
+        # The sidecars written before still go with their packs
+        self.assertEqual([], [f for f in trans.list_dir('indices')
+                              if f[:32] in names])
+        obsolete = trans.list_dir('obsolete_packs')
+        for name in names:
+            self.assertTrue('%s.stats' % (name,) in obsolete)
+
+    def test_pack_stats_written(self):
+        format = self.get_format()
+        tree = self.make_branch_and_tree('.', format=format)
+        repo = tree.branch.repository
+        trans = repo.bzrdir.get_repository_transport(None)
+        self.build_tree_contents([('file', 'content\n' * 100)])
+        tree.add(['file'])
+        tree.commit('first', rev_id='first', timestamp=1000000000.0)
+        tree.commit('second', rev_id='second', timestamp=1000001000.0)
+        names = repo._pack_collection.names()
+        for name in names:
+            self.assertTrue(trans.has('indices/%s.stats' % (name,)))
+        repo = repo.bzrdir.open_repository()
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        # The sidecars are complete, so gathering reads nothing else.
+        repo._pack_collection._pack_revision_timestamps = None
+        stats = repo.gather_storage_stats()
+        self.assertEqual(2, stats['packs'])
+        self.assertEqual(1000000000.0, stats['earliest'])
+        self.assertEqual(1000001000.0, stats['latest'])
+        self.assertEqual(2, stats['indices']['revision']['records'])
+        self.assertEqual(2, stats['indices']['inventory']['records'])
+        self.assertEqual(0, stats['indices']['signature']['records'])
+        self.assertTrue(stats['indices']['text']['compressed'] > 0)
+        size = 0
+        for name in names:
+            size += trans.stat('packs/%s.pack' % (name,)).st_size
+            for suffix in ['.rix', '.iix', '.tix', '.six']:
+                size += trans.stat('indices/%s%s' % (name, suffix)).st_size
+            if repo.chk_bytes is not None:
+                size += trans.stat('indices/%s.cix' % (name,)).st_size
+        self.assertEqual(size, stats['size'])
+        self.assertEqual({'revisions': 2, 'size': size}, repo.gather_stats())
+        repo = repo.bzrdir.open_repository()
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        self.assertEqual(stats, repo.gather_storage_stats())
+
+    def test_pack_stats_count_duplicate_revisions(self):
+        format = self.get_format()
+        source = self.make_branch_and_tree('source', format=format)
+        source.commit('first', rev_id='first')
+        source.commit('second', rev_id='second')
+        repo = self.make_repository('repo', format=format)
+        # A writer that locked the repository before first was fetched does
+        # not see it, so it stores first in a second pack too.
+        other = repo.bzrdir.open_repository()
+        other.lock_write()
+        repo.fetch(source.branch.repository, revision_id='first')
+        other.fetch(source.branch.repository, revision_id='second')
+        other.unlock()
+        repo = repo.bzrdir.open_repository()
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        self.assertEqual(2, len(repo._pack_collection.names()))
+        self.assertEqual(3, repo.gather_storage_stats()['indices'][
+            'revision']['records'])
+        self.assertEqual(2, repo.gather_stats()['revisions'])
+
+    def test_pack_stats_survive_pack(self):
+        format = self.get_format()
+        tree = self.make_branch_and_tree('.', format=format)
+        repo = tree.branch.repository
+        trans = repo.bzrdir.get_repository_transport(None)
+        tree.commit('first', timestamp=1000000000.0)
+        tree.commit('second', timestamp=1000001000.0)
+        names = repo._pack_collection.names()
+        repo.pack()
+        # The statistics of the old packs go with them
+        self.assertEqual([], [f for f in trans.list_dir('indices')
+                              if f[:32] in names])
+        repo = repo.bzrdir.open_repository()
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        stats = repo.gather_storage_stats()
+        self.assertEqual(1, stats['packs'])
+        self.assertEqual(2, stats['indices']['revision']['records'])
+        self.assertEqual(1000000000.0, stats['earliest'])
+        self.assertEqual(1000001000.0, stats['latest'])
+
+    def test_pack_stats_without_sidecars(self):
+        format = self.get_format()
+        tree = self.make_branch_and_tree('.', format=format)
+        repo = tree.branch.repository
+        repo._pack_collection.config_stack.set('repository.pack_stats',
+                                               False)
+        trans = repo.bzrdir.get_repository_transport(None)
+        tree.commit('first')
+        name = repo._pack_collection.names()[0]
+        self.assertFalse(trans.has('indices/%s.stats' % (name,)))
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        stats = repo.gather_storage_stats()
+        self.assertEqual(1, stats['packs'])
+        self.assertEqual(1, stats['indices']['revision']['records'])
+        self.assertEqual(None, stats['earliest'])
+        self.assertEqual(1, repo.gather_stats()['revisions'])
+
     def test_pulling_nothing_leads_to_no_new_names(self):
         format = self.get_format()
         tree1 = self.make_branch_and_tree('1', format=format)
@@ -207,7 +357,7 @@ class TestPackRepository(TestCaseWithTransport):
         tree = tree.bzrdir.open_workingtree()
         check_result = tree.branch.repository.check(
             [tree.branch.last_revision()])
-        nb_files = 5 # .pack, .rix, .iix, .tix, .six
+        nb_files = 6 # .pack, .rix, .iix, .tix, .six, .stats
         if tree.branch.repository._format.supports_chks:
             nb_files += 1 # .cix
         # We should have 10 x nb_files files in the obsolete_packs directory.
@@ -978,7 +1128,7 @@ class TestPackRepositoryStacking(TestCaseWithTransport):
         tree = tree.bzrdir.open_workingtree()
         check_result = tree.branch.repository.check(
             [tree.branch.last_revision()])
-        nb_files = 5 # .pack, .rix, .iix, .tix, .six
+        nb_files = 6 # .pack, .rix, .iix, .tix, .six, .stats
         if tree.branch.repository._format.supports_chks:
             nb_files += 1 # .cix
         # We should have 10 x nb_files files in the obsolete_packs directory.
@@ -21,6 +21,7 @@ import os
 import sys
 
 from bzrlib import (
+    add,
     errors,
     ignores,
     osutils,
@@ -209,6 +210,53 @@ class TestSmartAddTree(per_workingtree.TestCaseWithWorkingTree):
             self.assertEqual(None, wt.path2id(path.rstrip('/')),
                     'Accidentally added path: %s' % (path,))
 
+    def test_add_in_batches(self):
+        """Adding in small batches versions the same paths."""
+        paths = ['file1', 'dir1/', 'dir1/file2', 'dir1/subdir/',
+                 'dir1/subdir/file3', 'dir2/', 'dir2/file4']
+        self.build_tree(paths)
+        wt = self.make_branch_and_tree('.')
+        self.overrideAttr(wt, '_smart_add_batch_size', 1)
+        added, ignored = wt.smart_add(['dir1/subdir/file3', 'dir1', '.'])
+        self.assertEqual(sorted(p.rstrip('/') for p in paths), sorted(added))
+        wt.lock_read()
+        self.addCleanup(wt.unlock)
+        self.assertEqual(sorted([''] + added),
+            sorted(path for path, ie in wt.iter_entries_by_dir()))
+
+    def test_add_batches_bounded(self):
+        """No batch grows past the batch size, even in a flat directory."""
+        self.build_tree(['dir/'] + ['dir/file%d' % i for i in range(10)])
+        wt = self.make_branch_and_tree('.')
+        self.overrideAttr(wt, '_smart_add_batch_size', 3)
+        sizes = []
+        orig_apply = wt.apply_inventory_delta
+        def apply_inventory_delta(delta):
+            sizes.append(len(delta))
+            return orig_apply(delta)
+        wt.apply_inventory_delta = apply_inventory_delta
+        added, ignored = wt.smart_add(['.'])
+        self.assertEqual(11, len(added))
+        self.assertEqual(11, sum(sizes))
+        self.assertTrue(max(sizes) <= 3, sizes)
+
+    def test_add_interrupted_between_batches(self):
+        """Batches applied before an add fails are kept, and can be resumed."""
+        self.build_tree(['dir/', 'dir/a', 'dir/b', 'dir/c', 'dir/d'])
+        wt = self.make_branch_and_tree('.')
+        self.overrideAttr(wt, '_smart_add_batch_size', 2)
+        class InterruptingAction(add.AddAction):
+            def __call__(self, inv, parent_ie, path, kind):
+                if path == 'dir/c':
+                    raise KeyboardInterrupt()
+                return None
+        self.assertRaises(KeyboardInterrupt, wt.smart_add, ['dir'],
+                          action=InterruptingAction())
+        self.assertNotEqual(None, wt.path2id('dir/a'))
+        self.assertEqual(None, wt.path2id('dir/b'))
+        added, ignored = wt.smart_add(['dir'])
+        self.assertEqual(['dir/b', 'dir/c', 'dir/d'], added)
+
     def test_add_file_in_unknown_dir(self):
         # Test that parent directory addition is implicit
         tree = self.make_branch_and_tree('.')
@@ -720,6 +720,33 @@ class TestReadDirblocks(test_dirstate.TestCaseWithDirState):
         self.assertEqual(dirstate.DirState.IN_MEMORY_UNMODIFIED,
                          state._dirblock_state)
 
+    def test_shares_parent_strings(self):
+        def sha_cutoff_time(state):
+            state._cutoff_time = time.time() + 60
+        self.overrideAttr(dirstate.DirState, '_sha_cutoff_time',
+                          sha_cutoff_time)
+        tree = self.make_branch_and_tree('tree')
+        self.build_tree_contents([('tree/a', 'a\n'), ('tree/b', 'b\n')])
+        tree.add(['a', 'b'])
+        tree.commit('one')
+        tree.lock_read()
+        try:
+            # Make sure the working tree rows have the sha1s.
+            tree.current_dirstate()._worth_saving_limit = 0
+            list(tree.iter_changes(tree.basis_tree()))
+        finally:
+            tree.unlock()
+        tree.lock_read()
+        self.addCleanup(tree.unlock)
+        state = tree.current_dirstate()
+        state._read_header_if_needed()
+        self.get_read_dirblocks()(state)
+        a_entry = state._get_entry(0, path_utf8='a')
+        b_entry = state._get_entry(0, path_utf8='b')
+        self.assertEqual(a_entry[1][0][1], a_entry[1][1][1])
+        self.assertIs(a_entry[1][0][1], a_entry[1][1][1])
+        self.assertIs(a_entry[1][1][4], b_entry[1][1][4])
+
     def test_trailing_garbage(self):
         tree, state, expected = self.create_basic_dirstate()
         # On Unix, we can write extra data as long as we haven't read yet, but
@@ -851,7 +878,9 @@ class TestUpdateEntry(test_dirstate.TestCaseWithDirState):
         oldval = entry[1][0][1]
         oldstat = entry[1][0][4]
         self.build_tree(['a'])
-        statvalue = os.lstat('a')
+        statvalue = test_dirstate._FakeStat.from_stat(os.lstat('a'))
+        # Changed in the current second, so it may still change unnoticed.
+        statvalue.st_mtime = statvalue.st_ctime = time.time() + 10
         self.assertEqual(dirstate.DirState.IN_MEMORY_UNMODIFIED,
                          state._dirblock_state)
         state._observed_sha1(entry, "foo", statvalue)
@@ -860,6 +889,81 @@ class TestUpdateEntry(test_dirstate.TestCaseWithDirState):
         self.assertEqual(dirstate.DirState.IN_MEMORY_UNMODIFIED,
                          state._dirblock_state)
 
+    def get_state_with_unverified_a(self):
+        """Create a DirState with an unverified sha1 for 'a'."""
+        state, entry = self.get_state_with_a()
+        state.save()
+        self.build_tree(['a'])
+        statvalue = test_dirstate._FakeStat.from_stat(os.lstat('a'))
+        statvalue.st_mtime = statvalue.st_ctime = int(time.time()) - 10
+        # Too new to cache the sha1 outright.
+        state._cutoff_time = statvalue.st_mtime - 10
+        state._observed_sha1(entry, "foo", statvalue)
+        return state, entry, statvalue
+
+    def test_observed_sha1_unverified_margin(self):
+        state, entry = self.get_state_with_a()
+        state.save()
+        oldval = entry[1][0][1]
+        self.build_tree(['a'])
+        statvalue = test_dirstate._FakeStat.from_stat(os.lstat('a'))
+        statvalue.st_mtime = statvalue.st_ctime = 1000000000
+        state._cutoff_time = statvalue.st_mtime - 10
+        # Changed in the cutoff second itself: not kept, as a later change
+        # may not alter the stat on a filesystem with a coarse clock.
+        state._current_cutoff_time = lambda: statvalue.st_mtime
+        state._observed_sha1(entry, "foo", statvalue)
+        self.assertEqual(oldval, entry[1][0][1])
+        self.assertEqual(dirstate.DirState.IN_MEMORY_UNMODIFIED,
+                         state._dirblock_state)
+        state._current_cutoff_time = lambda: statvalue.st_mtime + 1
+        state._observed_sha1(entry, "foo", statvalue)
+        self.assertEqual('foo', entry[1][0][1])
+        self.assertEqual('?' + dirstate.pack_stat(statvalue), entry[1][0][4])
+
+    def test_current_cutoff_time(self):
+        state, entry = self.get_state_with_a()
+        self.overrideAttr(time, 'time', lambda: 1000000000.5)
+        self.assertEqual(1000000000 - 3, state._current_cutoff_time())
+
+    def test_observed_sha1_unverified(self):
+        state, entry, statvalue = self.get_state_with_unverified_a()
+        self.assertEqual(('f', 'foo', statvalue.st_size, False,
+                          '?' + dirstate.pack_stat(statvalue)),
+                         entry[1][0])
+        self.assertEqual(dirstate.DirState.IN_MEMORY_HASH_MODIFIED,
+                         state._dirblock_state)
+
+    def test_update_entry_unverified_sha1(self):
+        state, entry, statvalue = self.get_state_with_unverified_a()
+        state.save()
+        # Once the cutoff has passed, the unverified sha1 is trusted without
+        # reading the file.
+        state._cutoff_time = statvalue.st_mtime + 10
+        del state._log[:]
+        self.assertEqual('foo', self.update_entry(state, entry, abspath='a',
+                                                  stat_value=statvalue))
+        self.assertEqual([], state._log)
+        self.assertEqual(('f', 'foo', statvalue.st_size, False,
+                          dirstate.pack_stat(statvalue)),
+                         entry[1][0])
+        self.assertEqual(dirstate.DirState.IN_MEMORY_HASH_MODIFIED,
+                         state._dirblock_state)
+
+    def test_update_entry_unverified_sha1_changed(self):
+        state, entry, statvalue = self.get_state_with_unverified_a()
+        state._cutoff_time = statvalue.st_mtime + 10
+        statvalue.st_mtime += 1
+        self.assertEqual(None, self.update_entry(state, entry, abspath='a',
+                                                 stat_value=statvalue))
+        self.assertEqual(('f', '', statvalue.st_size, False,
+                          dirstate.DirState.NULLSTAT), entry[1][0])
+
+    def test_update_entry_unverified_sha1_too_new(self):
+        state, entry, statvalue = self.get_state_with_unverified_a()
+        self.assertEqual(None, self.update_entry(state, entry, abspath='a',
+                                                 stat_value=statvalue))
+
     def test_update_entry(self):
         state, _ = self.get_state_with_a()
         tree = self.make_branch_and_tree('tree')
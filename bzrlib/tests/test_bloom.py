@@ -0,0 +1,121 @@
+# Copyright (C) 2011 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for bloom filters over index keys."""
+
+from bzrlib import (
+    bloom,
+    btree_index,
+    errors,
+    tests,
+    )
+
+
+class TestBloomFilter(tests.TestCase):
+
+    def make_filter(self, keys, false_positive_rate=0.01):
+        result = bloom.BloomFilter.for_capacity(len(keys),
+                                                false_positive_rate)
+        for key in keys:
+            result.add(key)
+        return result
+
+    def test_added_keys_are_present(self):
+        keys = [('file-%d' % i, 'rev-%d' % i) for i in range(500)]
+        bloom_filter = self.make_filter(keys)
+        for key in keys:
+            self.assertTrue(key in bloom_filter)
+
+    def test_false_positive_rate(self):
+        bloom_filter = self.make_filter([('key-%d' % i,) for i in range(1000)])
+        false_positives = len([i for i in range(10000)
+                               if ('other-%d' % i,) in bloom_filter])
+        # 1% is expected, allow plenty of slack
+        self.assertTrue(false_positives < 300, false_positives)
+
+    def test_false_positive_rate_few_keys(self):
+        false_positives = 0
+        for i in range(100):
+            bloom_filter = self.make_filter([('key-%d' % i,), ('rev-%d' % i,)])
+            false_positives += len([j for j in range(100)
+                                    if ('other-%d' % j,) in bloom_filter])
+        self.assertTrue(false_positives < 300, false_positives)
+
+    def test_for_capacity_sizes(self):
+        bloom_filter = bloom.BloomFilter.for_capacity(1000, 0.01)
+        # ~9.6 bits and ~7 hashes per key for a 1% rate
+        self.assertEqual(9592, bloom_filter.num_bits)
+        self.assertEqual(7, bloom_filter.num_hashes)
+
+    def test_round_trip(self):
+        keys = [('key-%d' % i,) for i in range(100)]
+        bloom_filter = self.make_filter(keys)
+        bytes = bloom_filter.to_bytes()
+        self.assertStartsWith(bytes, 'Bazaar Bloom Filter 1\n')
+        loaded = bloom.BloomFilter.from_bytes(bytes)
+        self.assertEqual(bloom_filter.num_bits, loaded.num_bits)
+        self.assertEqual(bloom_filter.num_hashes, loaded.num_hashes)
+        self.assertEqual(bytes, loaded.to_bytes())
+        for key in keys:
+            self.assertTrue(key in loaded)
+
+    def test_from_bytes_rejects_garbage(self):
+        self.assertRaises(errors.BzrError, bloom.BloomFilter.from_bytes,
+                          'not a bloom filter')
+        self.assertRaises(errors.BzrError, bloom.BloomFilter.from_bytes,
+                          'Bazaar Bloom Filter 1\nbits=8\nhashes=1\n12')
+
+
+class TestLazyBloomFilter(tests.TestCaseWithMemoryTransport):
+
+    def test_loads_on_first_use(self):
+        bloom_filter = bloom.BloomFilter.for_capacity(1, 0.01)
+        bloom_filter.add(('present',))
+        t = self.get_transport()
+        t.put_bytes('filter', bloom_filter.to_bytes())
+        lazy = bloom.LazyBloomFilter(t, 'filter')
+        t.delete('filter')
+        self.assertTrue(('present',) in lazy)
+        # now loaded, it no longer tracks the file
+        t.put_bytes('filter', bloom_filter.to_bytes())
+        lazy = bloom.LazyBloomFilter(t, 'filter')
+        self.assertTrue(('present',) in lazy)
+        t.delete('filter')
+        self.assertFalse(('absent',) in lazy)
+
+    def test_missing_file_allows_everything(self):
+        lazy = bloom.LazyBloomFilter(self.get_transport(), 'missing')
+        self.assertTrue(('anything',) in lazy)
+
+    def test_corrupt_file_allows_everything(self):
+        t = self.get_transport()
+        t.put_bytes('filter', 'garbage')
+        lazy = bloom.LazyBloomFilter(t, 'filter')
+        self.assertTrue(('anything',) in lazy)
+
+
+class TestBTreeBuilderBloomFilter(tests.TestCase):
+
+    def test_bloom_filter_covers_spilled_keys(self):
+        builder = btree_index.BTreeBuilder(key_elements=2, spill_at=10)
+        keys = [('file-%d' % i, 'rev') for i in range(25)]
+        for key in keys:
+            builder.add_node(key, 'value')
+        bloom_filter = builder.bloom_filter(0.01)
+        for key in keys:
+            self.assertTrue(key in bloom_filter)
+        self.assertEqual(bloom.BloomFilter.for_capacity(25, 0.01).num_bits,
+                         bloom_filter.num_bits)
@@ -17,6 +17,7 @@
 
 """Tests for btree indices."""
 
+import os
 import pprint
 import zlib
 
@@ -1200,6 +1201,105 @@ class TestBTreeIndex(BTreeTestCase):
         entries = set(index.iter_entries([n[0] for n in nodes]))
         self.assertEqual(500, len(entries))
 
+    def make_local_index(self, nodes, name='index'):
+        builder = btree_index.BTreeBuilder(key_elements=1, reference_lists=0)
+        for node in nodes:
+            builder.add_node(*node)
+        trans = self.get_transport()
+        size = trans.put_file(name, builder.finish())
+        return btree_index.BTreeGraphIndex(trans, name, size)
+
+    def test_local_index_is_mapped(self):
+        self.overrideAttr(btree_index, '_USE_MMAP', True)
+        nodes = self.make_nodes(500, 1, 0)
+        index = self.make_local_index(nodes)
+        self.assertEqual(500, index.key_count())
+        self.assertIsNot(None, index._get_mmap())
+        self.assertEqual(sorted((index, ) + node[:2] for node in nodes),
+                         sorted(index.iter_all_entries()))
+
+    def test_mapped_index_reads_only_requested_pages(self):
+        self.overrideAttr(btree_index, '_USE_MMAP', True)
+        nodes = self.make_nodes(500, 1, 0)
+        index = self.make_local_index(nodes)
+        self.assertEqual([(index, nodes[100][0], nodes[100][1])],
+                         list(index.iter_entries([nodes[100][0]])))
+        # Just the root and the one leaf holding the key, no neighbours
+        self.assertIsNot(None, index._root_node)
+        self.assertEqual(1, len(index._leaf_node_cache))
+
+    def test_non_local_index_is_not_mapped(self):
+        self.overrideAttr(btree_index, '_USE_MMAP', True)
+        index = self.make_index(nodes=self.make_nodes(10, 1, 0))
+        self.assertEqual(10, index.key_count())
+        self.assertIs(None, index._get_mmap())
+        self.assertIs(False, index._mmap)
+
+    def test_mapped_indices_are_limited(self):
+        fd_dir = '/proc/self/fd'
+        if not os.path.isdir(fd_dir):
+            raise tests.TestNotApplicable('cannot count open file descriptors')
+        self.overrideAttr(btree_index, '_USE_MMAP', True)
+        self.overrideAttr(btree_index, '_MAX_MAPPED_INDICES', 10)
+        self.overrideAttr(btree_index, '_mapped_indices',
+                          btree_index._mapped_indices.__class__())
+        trans = self.get_transport()
+        nodes = self.make_nodes(10, 1, 0)
+        indices = []
+        fds_before = len(os.listdir(fd_dir))
+        for i in range(50):
+            builder = btree_index.BTreeBuilder(key_elements=1,
+                                               reference_lists=0)
+            for node in nodes:
+                builder.add_node(*node)
+            name = 'index-%d' % (i,)
+            size = trans.put_file(name, builder.finish())
+            index = btree_index.BTreeGraphIndex(trans, name, size)
+            self.assertEqual(10, index.key_count())
+            indices.append(index)
+        self.assertLength(10, [index for index in indices if index._mmap])
+        self.assertTrue(len(os.listdir(fd_dir)) <= fds_before + 10)
+        # Unmapped indices are mapped again when they are needed.
+        self.assertIsNot(None, indices[0]._get_mmap())
+        self.assertLength(10, [index for index in indices if index._mmap])
+
+    def test_least_recently_used_index_is_unmapped(self):
+        self.overrideAttr(btree_index, '_USE_MMAP', True)
+        self.overrideAttr(btree_index, '_MAX_MAPPED_INDICES', 2)
+        self.overrideAttr(btree_index, '_mapped_indices',
+                          btree_index._mapped_indices.__class__())
+        nodes = self.make_nodes(10, 1, 0)
+        index1, index2, index3 = [self.make_local_index(nodes, name)
+                                  for name in ('index1', 'index2', 'index3')]
+        # Remapping index1 leaves a single entry for it.
+        for i in range(3):
+            self.assertIsNot(None, index1._get_mmap())
+            index1.clear_cache()
+        self.assertIsNot(None, index1._get_mmap())
+        self.assertLength(1, btree_index._mapped_indices)
+        self.assertIsNot(None, index2._get_mmap())
+        # Using index1 again makes index2 the one to unmap.
+        self.assertIsNot(None, index1._get_mmap())
+        self.assertIsNot(None, index3._get_mmap())
+        self.assertIsNot(None, index1._mmap)
+        self.assertIs(None, index2._mmap)
+        self.assertIsNot(None, index3._mmap)
+        self.assertLength(2, btree_index._mapped_indices)
+
+    def test_clear_cache_unmaps(self):
+        self.overrideAttr(btree_index, '_USE_MMAP', True)
+        index = self.make_local_index(self.make_nodes(10, 1, 0))
+        self.assertEqual(10, index.key_count())
+        self.assertIsNot(None, index._get_mmap())
+        index.clear_cache()
+        self.assertIs(None, index._mmap)
+
+    def test_mmap_disabled(self):
+        self.overrideAttr(btree_index, '_USE_MMAP', False)
+        index = self.make_local_index(self.make_nodes(10, 1, 0))
+        self.assertEqual(10, index.key_count())
+        self.assertIs(None, index._get_mmap())
+
 
 class TestBTreeNodes(BTreeTestCase):
 
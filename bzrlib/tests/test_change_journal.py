@@ -0,0 +1,370 @@
+# Copyright (C) 2016 Canonical Ltd
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the working tree change journal."""
+
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from bzrlib import (
+    change_journal,
+    dirstate,
+    errors,
+    tests,
+    )
+from bzrlib.tests import features
+
+
+class _InotifyFeature(features.Feature):
+
+    def _probe(self):
+        try:
+            change_journal._load_inotify()
+        except errors.ChangeJournalUnavailable:
+            return False
+        return True
+
+    def feature_name(self):
+        return 'inotify'
+
+inotify_feature = _InotifyFeature()
+
+
+def _future_cutoff(state):
+    # Let files written by the test have their sha1 cached straight away.
+    state._cutoff_time = int(time.time()) + 10
+    return state._cutoff_time
+
+
+class TestRecords(tests.TestCase):
+
+    def test_parse_records(self):
+        self.assertEqual(set(['a', 'd/b']),
+            change_journal.parse_records('D a\nC cookie\nD d/b\nD a\n'))
+
+    def test_parse_records_overflow(self):
+        self.assertIs(None,
+            change_journal.parse_records('D a\nO\nD d/b\n'))
+
+    def test_base_round_trip(self):
+        bytes = change_journal.format_base('sess', 120, '1234/5')
+        self.assertEqual('sess 120 1234/5\n', bytes)
+        self.assertEqual(('sess', 120, '1234/5'),
+                         change_journal.parse_base(bytes))
+
+    def test_parse_invalid_base(self):
+        self.assertIs(None, change_journal.parse_base(''))
+        self.assertIs(None, change_journal.parse_base('sess x 1234/5\n'))
+
+
+class TestCaseWithJournal(tests.TestCaseWithTransport):
+    """A tree with a hand written journal, as a watcher would write it."""
+
+    def setUp(self):
+        super(TestCaseWithJournal, self).setUp()
+        self.overrideAttr(dirstate.DirState, '_sha_cutoff_time',
+                          _future_cutoff)
+        self.tree = self.make_branch_and_tree('.')
+        self.build_tree(['a', 'd/', 'd/b'])
+        self.tree.add(['a', 'd', 'd/b'])
+        self.tree.commit('one')
+        self.control_dir = self.tree._transport.local_abspath('.')
+        self.journal_path = os.path.join(self.control_dir,
+                                         change_journal.JOURNAL_NAME)
+        self.make_journal('session1')
+        orig_wait = change_journal._wait_for_cookie
+        def wait_for_cookie(f, start, cookie, timeout):
+            # Acknowledge the cookie the way a watcher would.
+            self.append('C %s\n' % (cookie,))
+            return orig_wait(f, start, cookie, timeout)
+        self.overrideAttr(change_journal, '_wait_for_cookie', wait_for_cookie)
+
+    def make_journal(self, session, pid=None):
+        if pid is None:
+            pid = os.getpid()
+        f = open(self.journal_path, 'wb')
+        try:
+            f.write('Bazaar change journal 1\npid %d\nsession %s\n'
+                    % (pid, session))
+        finally:
+            f.close()
+
+    def append(self, records):
+        f = open(self.journal_path, 'ab')
+        try:
+            f.write(records)
+        finally:
+            f.close()
+
+    def dead_pid(self):
+        proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+        proc.wait()
+        return proc.pid
+
+    def changed_paths(self, specific_files=None):
+        self.tree.lock_read()
+        try:
+            return sorted(change[1][1] for change in self.tree.iter_changes(
+                self.tree.basis_tree(), specific_files=specific_files))
+        finally:
+            self.tree.unlock()
+
+    def get_base(self):
+        return change_journal.parse_base(
+            self.tree._transport.get_bytes(change_journal.BASE_NAME))
+
+
+class TestReadChanges(TestCaseWithJournal):
+
+    def test_no_journal(self):
+        os.unlink(self.journal_path)
+        self.assertIs(None, change_journal.read_changes(self.control_dir))
+
+    def test_dead_watcher(self):
+        self.make_journal('session1', self.dead_pid())
+        self.assertIs(None, change_journal.read_changes(self.control_dir))
+
+    def test_no_base(self):
+        session, offset, dirty = change_journal.read_changes(
+            self.control_dir)
+        self.assertEqual('session1', session)
+        self.assertEqual(os.path.getsize(self.journal_path), offset)
+        self.assertIs(None, dirty)
+        self.assertEqual([], [name for name in os.listdir(self.control_dir)
+            if name.startswith(change_journal.COOKIE_PREFIX)])
+
+    def test_changes_since_base(self):
+        session, offset, dirty = change_journal.read_changes(
+            self.control_dir)
+        self.append('D a\nD d/b\n')
+        session, offset2, dirty = change_journal.read_changes(
+            self.control_dir, (session, offset))
+        self.assertEqual(set(['a', 'd/b']), dirty)
+        self.assertEqual(os.path.getsize(self.journal_path), offset2)
+
+    def test_other_session(self):
+        session, offset, dirty = change_journal.read_changes(
+            self.control_dir)
+        self.assertIs(None, change_journal.read_changes(
+            self.control_dir, ('session0', offset))[2])
+
+    def test_timeout(self):
+        self.overrideAttr(change_journal, '_wait_for_cookie',
+            lambda f, start, cookie, timeout: None)
+        self.assertIs(None, change_journal.read_changes(self.control_dir,
+                                                        timeout=0))
+
+
+class TestJournalDirReader(TestCaseWithJournal):
+
+    def read_dir(self, dirty):
+        self.tree.lock_read()
+        try:
+            # Bring the saved stat values up to date.
+            list(self.tree.iter_changes(self.tree.basis_tree()))
+            state = self.tree.current_dirstate()
+            reader = change_journal.JournalDirReader(state, dirty)
+            top = reader.top_prefix_to_starting_dir(self.tree.basedir)[4]
+            return dict((relpath, stat_value) for relpath, name, kind,
+                stat_value, abspath in reader.read_dir('', top))
+        finally:
+            self.tree.unlock()
+
+    def test_versioned_paths_use_saved_stat(self):
+        self.build_tree(['unversioned'])
+        stats = self.read_dir(set())
+        self.assertEqual(['.bzr', 'a', 'd', 'unversioned'], sorted(stats))
+        self.assertIsInstance(stats['a'], change_journal._CachedStat)
+        self.assertIsInstance(stats['d'], change_journal._CachedStat)
+        self.assertEqual(os.lstat('a').st_size, stats['a'].st_size)
+        self.assertNotIsInstance(stats['unversioned'],
+                                 change_journal._CachedStat)
+
+    def test_dirty_paths_are_stated(self):
+        stats = self.read_dir(set(['a']))
+        self.assertNotIsInstance(stats['a'], change_journal._CachedStat)
+        self.assertIsInstance(stats['d'], change_journal._CachedStat)
+
+
+class TestIterChangesWithJournal(TestCaseWithJournal):
+
+    def test_complete_walk_records_base(self):
+        self.assertEqual([], self.changed_paths())
+        session, offset, fingerprint = self.get_base()
+        self.assertEqual('session1', session)
+        self.assertEqual(os.path.getsize(self.journal_path), offset)
+
+    def test_partial_walk_records_no_base(self):
+        self.assertEqual([], self.changed_paths(['a']))
+        self.assertFalse(
+            self.tree._transport.has(change_journal.BASE_NAME))
+
+    def test_only_journaled_paths_are_stated(self):
+        self.changed_paths()
+        self.build_tree_contents([('a', 'new content of a\n')])
+        # The watcher has not reported the change, so it is not seen.
+        self.assertEqual([], self.changed_paths())
+        self.append('D a\n')
+        self.assertEqual(['a'], self.changed_paths())
+        # The journal is still trusted after the change has been seen.
+        self.build_tree_contents([('d/b', 'new content of b\n')])
+        self.assertEqual(['a'], self.changed_paths())
+
+    def test_overflow_walks_everything(self):
+        self.changed_paths()
+        self.build_tree_contents([('a', 'new content of a\n')])
+        self.append('O\n')
+        self.assertEqual(['a'], self.changed_paths())
+
+    def test_rewritten_dirstate_walks_everything(self):
+        self.changed_paths()
+        self.build_tree_contents([('a', 'new content of a\n'), ('c', 'c')])
+        self.tree.add(['c'])
+        self.assertEqual(['a', 'c'], self.changed_paths())
+
+    def test_stopped_watcher_walks_everything(self):
+        self.changed_paths()
+        self.build_tree_contents([('a', 'new content of a\n')])
+        self.make_journal('session1', self.dead_pid())
+        self.assertEqual(['a'], self.changed_paths())
+
+    def test_new_session_walks_everything(self):
+        self.changed_paths()
+        self.build_tree_contents([('a', 'new content of a\n')])
+        self.make_journal('session2')
+        self.assertEqual(['a'], self.changed_paths())
+        self.assertEqual('session2', self.get_base()[0])
+
+
+class TestHasChangesWithJournal(TestCaseWithJournal):
+
+    def has_changes(self):
+        self.tree.lock_read()
+        try:
+            return self.tree.has_changes()
+        finally:
+            self.tree.unlock()
+
+    def forbid_walking(self):
+        def iter_changes(*args, **kwargs):
+            self.fail('has_changes walked the tree')
+        self.overrideAttr(self.tree, 'iter_changes', iter_changes)
+
+    def test_unchanged_tree_is_not_walked_again(self):
+        self.assertFalse(self.has_changes())
+        self.assertTrue(
+            self.tree._transport.has(change_journal.CLEAN_NAME))
+        self.forbid_walking()
+        self.assertFalse(self.has_changes())
+
+    def test_journaled_change(self):
+        self.assertFalse(self.has_changes())
+        self.build_tree_contents([('a', 'new content of a\n')])
+        # The watcher has not reported the change, so it is not seen.
+        self.assertFalse(self.has_changes())
+        self.append('D a\n')
+        self.assertTrue(self.has_changes())
+
+    def test_changed_tree_is_not_recorded(self):
+        self.build_tree_contents([('a', 'new content of a\n')])
+        self.append('D a\n')
+        self.assertTrue(self.has_changes())
+        self.assertFalse(
+            self.tree._transport.has(change_journal.CLEAN_NAME))
+
+    def test_change_after_has_changes(self):
+        self.build_tree(['c'])
+        self.tree.lock_write()
+        try:
+            self.assertFalse(self.tree.has_changes())
+            self.tree.add(['c'])
+        finally:
+            self.tree.unlock()
+        self.assertTrue(self.has_changes())
+
+    def test_new_session_walks_everything(self):
+        self.assertFalse(self.has_changes())
+        self.make_journal('session2')
+        self.build_tree_contents([('a', 'new content of a\n')])
+        self.assertTrue(self.has_changes())
+
+
+class TestInotifyWatcher(tests.TestCaseWithTransport):
+
+    _test_needs_features = [inotify_feature]
+
+    def setUp(self):
+        super(TestInotifyWatcher, self).setUp()
+        self.tree = self.make_branch_and_tree('.')
+        self.build_tree(['a', 'd/', 'd/b'])
+        self.tree.add(['a', 'd', 'd/b'])
+        self.tree.commit('one')
+        self.control_dir = self.tree._transport.local_abspath('.')
+        self.watcher = change_journal.InotifyWatcher(self.tree.basedir,
+                                                     self.control_dir)
+        self.watcher.start()
+        self.addCleanup(self.watcher.close)
+
+    def run_watcher(self):
+        thread = threading.Thread(target=self.watcher.run,
+                                  kwargs={'poll_interval': 0.01})
+        thread.start()
+        def stop():
+            self.watcher.stop()
+            thread.join()
+        self.addCleanup(stop)
+
+    def test_journals_changes(self):
+        self.run_watcher()
+        session, offset, dirty = change_journal.read_changes(
+            self.control_dir)
+        self.assertEqual(self.watcher.session, session)
+        self.build_tree_contents([('a', 'new content of a\n')])
+        self.build_tree(['e/', 'e/f'])
+        dirty = change_journal.read_changes(self.control_dir,
+                                            (session, offset))[2]
+        self.assertEqual(set(['a', 'e', 'e/f']), dirty)
+
+    def changed_paths(self):
+        self.tree.lock_read()
+        try:
+            return sorted(change[1][1] for change in self.tree.iter_changes(
+                self.tree.basis_tree()))
+        finally:
+            self.tree.unlock()
+
+    def test_status_sees_changes(self):
+        self.run_watcher()
+        self.assertEqual([], self.changed_paths())
+        self.assertTrue(self.tree._transport.has(change_journal.BASE_NAME))
+        self.build_tree_contents([('d/b', 'new content of b\n')])
+        self.assertEqual(['d/b'], self.changed_paths())
+
+    def test_overflow(self):
+        self.watcher.process_events(change_journal._inotify_event.pack(
+            -1, change_journal.IN_Q_OVERFLOW, 0, 0))
+        journal = self.tree._transport.get_bytes(change_journal.JOURNAL_NAME)
+        self.assertEndsWith(journal, '\nO\n')
+
+    def test_close_removes_journal(self):
+        self.assertTrue(
+            self.tree._transport.has(change_journal.JOURNAL_NAME))
+        self.watcher.close()
+        self.assertFalse(
+            self.tree._transport.has(change_journal.JOURNAL_NAME))
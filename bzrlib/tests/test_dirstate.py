@@ -20,6 +20,7 @@ import os
 import tempfile
 
 from bzrlib import (
+    config,
     controldir,
     dirstate,
     errors,
@@ -1401,6 +1402,118 @@ class TestDirStateHashUpdates(TestCaseWithDirState):
         self.assertEqual(0, len(state._known_hash_changes))
 
 
+class TestDirStateJournal(TestCaseWithDirState):
+
+    def setUp(self):
+        super(TestDirStateJournal, self).setUp()
+        # Let the journal grow as large as the small test dirstates.
+        config.GlobalStack().set('dirstate.journal_ratio', '10')
+        self.tree = self.make_branch_and_tree('.')
+        self.build_tree(['c', 'd'])
+        self.tree.add(['c', 'd'], ['c-id', 'd-id'])
+        self.tree.commit('add c and d')
+        self.path = self.tree._transport.local_abspath('dirstate')
+        self.journal_path = self.path + '.journal'
+
+    def read_file(self, path):
+        f = open(path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def update_hash(self, path):
+        state = InstrumentedDirState.on_file(self.path)
+        state.lock_write()
+        try:
+            state._read_dirblocks_if_needed()
+            state.adjust_time(+20) # Allow things to be cached
+            entry = state._get_entry(0, path_utf8=path)
+            dirstate.update_entry(state, entry, os.path.abspath(path),
+                                  os.lstat(path))
+            state.save()
+        finally:
+            state.unlock()
+
+    def get_details(self, path):
+        state = dirstate.DirState.on_file(self.path)
+        state.lock_read()
+        try:
+            return state._get_entry(0, path_utf8=path)[1][0]
+        finally:
+            state.unlock()
+
+    def test_hash_change_is_journaled(self):
+        content = self.read_file(self.path)
+        self.update_hash('c')
+        self.assertEqual(content, self.read_file(self.path))
+        self.assertPathExists(self.journal_path)
+        details = self.get_details('c')
+        self.assertEqual(osutils.sha_file_by_name('c'), details[1])
+        self.assertEqual(dirstate.pack_stat(os.lstat('c')), details[4])
+
+    def test_appends_to_journal(self):
+        self.update_hash('c')
+        size = os.path.getsize(self.journal_path)
+        self.update_hash('d')
+        self.assertTrue(os.path.getsize(self.journal_path) > size)
+        self.assertEqual(osutils.sha_file_by_name('c'),
+                         self.get_details('c')[1])
+        self.assertEqual(osutils.sha_file_by_name('d'),
+                         self.get_details('d')[1])
+
+    def test_full_save_removes_journal(self):
+        self.update_hash('c')
+        self.tree.rename_one('d', 'e')
+        self.assertPathDoesNotExist(self.journal_path)
+        self.assertEqual(osutils.sha_file_by_name('c'),
+                         self.get_details('c')[1])
+
+    def test_large_journal_is_folded(self):
+        config.GlobalStack().set('dirstate.journal_ratio', '0.01')
+        content = self.read_file(self.path)
+        self.update_hash('c')
+        self.assertNotEqual(content, self.read_file(self.path))
+        self.assertPathDoesNotExist(self.journal_path)
+
+    def test_disabled(self):
+        config.GlobalStack().set('dirstate.journal_ratio', '0')
+        self.update_hash('c')
+        self.assertPathDoesNotExist(self.journal_path)
+        self.assertEqual(osutils.sha_file_by_name('c'),
+                         self.get_details('c')[1])
+
+    def test_journal_for_other_dirstate_is_ignored(self):
+        self.update_hash('c')
+        journal = self.read_file(self.journal_path)
+        self.tree.rename_one('d', 'e')
+        # Leave the journal behind, as a client without journal support
+        # would when rewriting the dirstate.
+        self.build_tree_contents([(self.journal_path, journal)])
+        state = dirstate.DirState.on_file(self.path)
+        state.lock_read()
+        self.addCleanup(state.unlock)
+        state._read_dirblocks_if_needed()
+        self.assertIs(None, state._journal_offset)
+
+    def test_torn_record_is_ignored(self):
+        self.update_hash('c')
+        size = os.path.getsize(self.journal_path)
+        f = open(self.journal_path, 'ab')
+        try:
+            f.write('120 1234\npartial')
+        finally:
+            f.close()
+        self.assertEqual(osutils.sha_file_by_name('c'),
+                         self.get_details('c')[1])
+        self.update_hash('d')
+        self.assertEqual(osutils.sha_file_by_name('d'),
+                         self.get_details('d')[1])
+        journal = self.read_file(self.journal_path)
+        self.assertFalse('partial' in journal)
+        self.assertTrue(len(journal) > size)
+
+
 class TestGetLines(TestCaseWithDirState):
 
     def test_get_line_with_2_rows(self):
@@ -2148,6 +2261,43 @@ class TestBisect(TestCaseWithDirState):
                                    state, ['b'])
 
 
+class TestPartialState(TestCaseWithDirState):
+
+    def assertPartialState(self, expected, loaded_paths, state, paths):
+        partial = state._partial_state(paths)
+        loaded = {}
+        for dirname, block in partial._dirblocks:
+            for entry in block:
+                loaded[osutils.pathjoin(*entry[0][:2])] = entry
+        self.assertEqual(sorted(loaded_paths), sorted(loaded))
+        for path in loaded_paths:
+            self.assertEqual(expected[path], loaded[path])
+        self.assertEqual(dirstate.DirState.NOT_IN_MEMORY,
+                         state._dirblock_state)
+        return partial
+
+    def test_loads_children_and_parents(self):
+        tree, state, expected = self.create_basic_dirstate()
+        partial = self.assertPartialState(expected,
+            ['', 'b', 'b/d', 'b/d/e'], state, ['b/d'])
+        partial._validate()
+
+    def test_loads_renames(self):
+        tree, state, expected = self.create_renamed_dirstate()
+        self.assertPartialState(expected, ['', 'a', 'b', 'b/g'],
+                                state, ['b/g'])
+        self.assertPartialState(expected,
+            ['', 'b', 'b/d', 'b/d/e', 'h', 'h/e'], state, ['h/e'])
+
+    def test_only_saves_hash_changes(self):
+        tree, state, expected = self.create_basic_dirstate()
+        partial = state._partial_state(['a'])
+        partial._mark_modified()
+        state._save_partial_state(partial)
+        self.assertEqual(dirstate.DirState.IN_MEMORY_MODIFIED,
+                         partial._dirblock_state)
+
+
 class TestDirstateValidation(TestCaseWithDirState):
 
     def test_validate_correct_dirstate(self):
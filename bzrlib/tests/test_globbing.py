@@ -312,6 +312,31 @@ class TestGlobster(TestCase):
             self.assertEqual(patterns[x],globster.match(filename))
         self.assertEqual(None,globster.match('foobar.300'))
 
+    def test_literal_patterns(self):
+        globster = Globster([u'*.o', u'node_modules', u'*.py[co]'])
+        self.assertEqual({u'o': u'*.o'}, globster._literal_extensions)
+        self.assertEqual(
+            {u'node_modules': u'node_modules'}, globster._literal_basenames)
+        self.assertEqual(u'*.o', globster.match(u'src/foo.o'))
+        self.assertEqual(u'*.o', globster.match(u'.o'))
+        self.assertEqual(u'node_modules', globster.match(u'a/node_modules'))
+        self.assertEqual(u'*.py[co]', globster.match(u'a/foo.pyc'))
+        self.assertEqual(None, globster.match(u'foo.o/bar'))
+        self.assertEqual(None, globster.match(u'node_modules/bar'))
+        self.assertEqual(None, globster.match(u'foo.os'))
+
+    def test_shortest_literal_extension_wins(self):
+        globster = Globster([u'*.tar.gz', u'foo.gz', u'*.gz'])
+        self.assertEqual(u'*.gz', globster.match(u'a/foo.tar.gz'))
+        self.assertEqual(u'*.gz', globster.match(u'foo.gz'))
+
+    def test_newline_in_filename(self):
+        # '.' in the combined regexes doesn't match a newline.
+        globster = Globster([u'*.o', u'foo*'])
+        self.assertEqual(None, globster.match(u'a\nb/c.o'))
+        self.assertEqual(None, globster.match(u'a/b\nc.o'))
+        self.assertEqual(None, globster.match(u'foo\nbar'))
+
     def test_bad_pattern(self):
         """Ensure that globster handles bad patterns cleanly."""
         patterns = [u'RE:[', u'/home/foo', u'RE:*.cpp']
@@ -712,6 +712,64 @@ class TestGroupCompressVersionedFiles(TestCaseWithGroupCompressVersionedFiles):
             else:
                 self.assertIs(block, record._manager._block)
 
+    def test__insert_record_stream_parallel(self):
+        vf = self.make_test_vf(True, dir='source')
+        def grouped_stream(revision_ids, first_parents=()):
+            parents = first_parents
+            for revision_id in revision_ids:
+                key = (revision_id,)
+                record = versionedfile.FulltextContentFactory(
+                    key, parents, None,
+                    'some content that is\n'
+                    'identical except for\n'
+                    'revision_id:%s\n' % (revision_id,))
+                yield record
+                parents = (key,)
+        vf.insert_record_stream(grouped_stream(['a', 'b', 'c', 'd']))
+        vf.insert_record_stream(grouped_stream(['e', 'f', 'g', 'h'],
+                                               first_parents=(('d',),)))
+        vf.writer.end()
+        vf2 = self.make_test_vf(True, dir='target')
+        # Make every record start a new range
+        vf2._PARALLEL_RANGE_SIZE = 0
+        pool = InlinePool()
+        sha1s = list(vf2._insert_record_stream_parallel(
+            vf.get_record_stream([(r,) for r in 'abcdefgh'],
+                                 'groupcompress', False),
+            pool, max_pending=3))
+        vf2.writer.end()
+        self.assertLength(8, sha1s)
+        self.assertEqual(8, pool.calls)
+        self.assertEqual(vf.get_parent_map([(r,) for r in 'abcdefgh']),
+                         vf2.get_parent_map([(r,) for r in 'abcdefgh']))
+        stream = vf2.get_record_stream([(r,) for r in 'abcdefgh'],
+                                       'unordered', False)
+        blocks = set()
+        for record in stream:
+            blocks.add(id(record._manager._block))
+            self.assertEqual('some content that is\n'
+                             'identical except for\n'
+                             'revision_id:%s\n' % (record.key[0],),
+                             record.get_bytes_as('fulltext'))
+        self.assertLength(8, blocks)
+
+    def test__compress_text_range_matches_serial(self):
+        texts = [(('f-id', 'rev-%d' % i), None,
+                  'common content\nline %d\n' % i) for i in range(10)]
+        vf = self.make_test_vf(True, keylength=2)
+        list(vf._insert_record_stream(
+            [versionedfile.FulltextContentFactory(key, (), sha1, bytes)
+             for key, sha1, bytes in texts], reuse_blocks=False))
+        serial_block = vf._access.get_raw_records(
+            [vf._index.get_build_details([texts[0][0]])[texts[0][0]][0][:3]]
+            ).next()
+        result = groupcompress._compress_text_range(texts,
+            vf._get_compressor_settings())
+        self.assertLength(1, result)
+        block_bytes, entries = result[0]
+        self.assertEqual(serial_block, block_bytes)
+        self.assertEqual([t[0] for t in texts], [e[0] for e in entries])
+
     def test_add_missing_noncompression_parent_unvalidated_index(self):
         unvalidated = self.make_g_index_missing_parent()
         combined = _mod_index.CombinedGraphIndex([unvalidated])
@@ -830,13 +888,215 @@ class TestGroupCompressConfig(tests.TestCaseWithTransport):
             self.assertEqual(vf._DEFAULT_MAX_BYTES_TO_INDEX,
                              gc._delta_index._max_bytes_to_index)
 
+    def test_shared_block_cache_disabled(self):
+        config.GlobalStack().set('bzr.groupcompress.block_cache_size', '0')
+        vf = self.make_test_vf()
+        group_cache = groupcompress.shared_group_cache(vf._access)
+        self.assertIsInstance(group_cache, groupcompress.LRUSizeCache)
+        self.assertIs(None, groupcompress._shared_block_cache)
+
+    def test_shared_block_cache_enabled(self):
+        vf = self.make_test_vf()
+        group_cache = groupcompress.shared_group_cache(vf._access)
+        self.assertIsInstance(group_cache, groupcompress._SharedGroupCache)
+        self.assertIs(groupcompress._shared_block_cache,
+                      group_cache._shared_cache)
+
+
+class TestSharedBlockCache(TestCaseWithGroupCompressVersionedFiles):
+
+    def make_source(self):
+        vf = self.make_test_vf(True, dir='source')
+        vf.add_lines(('a',), (), ['lines\n'])
+        vf.add_lines(('b',), (('a',),), ['lines\n', 'more lines\n'])
+        vf.writer.end()
+        return vf
+
+    def make_block(self, char):
+        block = groupcompress.GroupCompressBlock()
+        block.set_content(char * 300)
+        block.to_bytes()
+        return block
+
+    def test_counters(self):
+        cache = groupcompress._SharedBlockCache(700)
+        block = self.make_block('x')
+        self.assertIs(None, cache.get('key'))
+        cache.add('key', block)
+        self.assertIs(block, cache.get('key'))
+        self.assertEqual((1, 1, 0), (cache.hits, cache.misses,
+                                     cache.evictions))
+        # Adding two more blocks goes over budget, evicting the oldest
+        for key in ('key2', 'key3'):
+            cache.add(key, self.make_block('y'))
+        self.assertEqual(2, cache.evictions)
+        self.assertIs(None, cache.get('key'))
+        self.assertContainsRe(cache.stats_summary(),
+            '^1 hits, 2 misses, 2 evictions, 1 blocks, \d+/700 bytes$')
+
+    def test_shared_between_vfs(self):
+        vf = self.make_source()
+        shared = groupcompress._SharedBlockCache(1024*1024)
+        vf._group_cache = groupcompress._SharedGroupCache(shared, vf._access)
+        list(vf.get_record_stream([('a',), ('b',)], 'unordered', True))
+        self.assertEqual(0, shared.hits)
+        self.assertEqual(2, len(shared))
+        vf2 = groupcompress.GroupCompressVersionedFiles(vf._index,
+            vf._access, _group_cache=groupcompress._SharedGroupCache(
+                shared, vf._access))
+        record = vf2.get_record_stream([('b',)], 'unordered', True).next()
+        # Blocks in the shared cache guard their decompression
+        self.assertIsNot(None, record._manager._block._content_lock)
+        self.assertEqual('lines\nmore lines\n',
+                         record.get_bytes_as('fulltext'))
+        self.assertEqual(2, len(shared))
+        self.assertEqual(1, shared.hits)
+
+
+class TestContentDefinedChunks(tests.TestCase):
+
+    def setUp(self):
+        super(TestContentDefinedChunks, self).setUp()
+        self.overrideAttr(groupcompress, '_CHUNK_MIN_SIZE', 64)
+        self.overrideAttr(groupcompress, '_CHUNK_MAX_SIZE', 1024)
+        self.overrideAttr(groupcompress, '_CHUNK_BOUNDARY_MASK', 0x3)
+
+    def make_text(self, start, count):
+        return ''.join(['line %d of some text\n' % i
+                        for i in xrange(start, start + count)])
+
+    def test_chunks_join_to_text(self):
+        text = self.make_text(0, 1000)
+        chunks = groupcompress._content_defined_chunks(text)
+        self.assertEqual(text, ''.join(chunks))
+        self.assertTrue(len(chunks) > 10)
+        for chunk in chunks:
+            self.assertTrue(len(chunk) <= 1024)
+        for chunk in chunks[:-1]:
+            self.assertTrue(len(chunk) >= 64)
+
+    def test_no_newlines(self):
+        text = 'x' * 2500
+        self.assertEqual(['x' * 1024, 'x' * 1024, 'x' * 452],
+                         groupcompress._content_defined_chunks(text))
+
+    def test_empty(self):
+        self.assertEqual([], groupcompress._content_defined_chunks(''))
+
+    def test_insertion_only_changes_nearby_chunks(self):
+        text = self.make_text(0, 1000)
+        chunks = groupcompress._content_defined_chunks(text)
+        new_chunks = groupcompress._content_defined_chunks(
+            self.make_text(5000, 10) + text)
+        self.assertTrue(len(set(chunks) - set(new_chunks)) <= 2)
+
+
+class TestChunkedGroupCompressVersionedFiles(
+        TestCaseWithGroupCompressVersionedFiles):
+
+    def setUp(self):
+        super(TestChunkedGroupCompressVersionedFiles, self).setUp()
+        self.overrideAttr(groupcompress, '_CHUNKING_MIN_TEXT_SIZE', 1000)
+        self.overrideAttr(groupcompress, '_CHUNK_MIN_SIZE', 64)
+        self.overrideAttr(groupcompress, '_CHUNK_MAX_SIZE', 1024)
+        self.overrideAttr(groupcompress, '_CHUNK_BOUNDARY_MASK', 0x3)
+
+    def make_chunked_vf(self):
+        chunk_store = self.make_test_vf(False, dir='chunks')
+        vf = self.make_test_vf(True, dir='texts')
+        return groupcompress.ChunkedGroupCompressVersionedFiles(vf._index,
+            vf._access, chunk_store)
+
+    def make_lines(self, start, count):
+        return ['line %d of some text\n' % i
+                for i in xrange(start, start + count)]
+
+    def test_small_texts_are_not_chunked(self):
+        vf = self.make_chunked_vf()
+        vf.add_lines(('a',), (), ['small\n'])
+        self.assertEqual(0, len(vf._chunk_store.keys()))
+        record = vf.get_record_stream([('a',)], 'unordered', True).next()
+        self.assertEqual('small\n', record.get_bytes_as('fulltext'))
+
+    def test_round_trip_and_sha1(self):
+        vf = self.make_chunked_vf()
+        lines = self.make_lines(0, 1000)
+        text = ''.join(lines)
+        sha1, length, _ = vf.add_lines(('a',), (), lines)
+        self.assertEqual(sha_string(text), sha1)
+        self.assertEqual(len(text), length)
+        self.assertNotEqual(0, len(vf._chunk_store.keys()))
+        record = vf.get_record_stream([('a',)], 'unordered', True).next()
+        self.assertEqual('fulltext', record.storage_kind)
+        self.assertEqual(text, record.get_bytes_as('fulltext'))
+        self.assertEqual({('a',): sha1}, vf.get_sha1s([('a',)]))
+
+    def test_chunks_shared_between_texts(self):
+        vf = self.make_chunked_vf()
+        lines = self.make_lines(0, 1000)
+        vf.add_lines(('a',), (), lines)
+        chunk_count = len(vf._chunk_store.keys())
+        vf.add_lines(('b',), (), lines)
+        self.assertEqual(chunk_count, len(vf._chunk_store.keys()))
+        # Prepending a few lines only adds the chunks around the change
+        vf.add_lines(('c',), (), self.make_lines(5000, 10) + lines)
+        self.assertTrue(len(vf._chunk_store.keys()) <= chunk_count + 2)
+        texts = dict((r.key, r.get_bytes_as('fulltext')) for r in
+            vf.get_record_stream([('a',), ('b',), ('c',)], 'unordered', True))
+        self.assertEqual(''.join(lines), texts[('b',)])
+        self.assertEqual(''.join(self.make_lines(5000, 10) + lines),
+                         texts[('c',)])
+
+    def test_nostore_sha(self):
+        vf = self.make_chunked_vf()
+        lines = self.make_lines(0, 1000)
+        sha1 = vf.add_lines(('a',), (), lines)[0]
+        self.assertRaises(errors.ExistingContent, vf.add_lines, ('b',), (),
+                          lines, nostore_sha=sha1)
+
+    def test_text_starting_with_signature(self):
+        vf = self.make_chunked_vf()
+        text = groupcompress._CHUNKED_TEXT_SIGNATURE + 'sha1:foo\n'
+        sha1 = vf.add_lines(('a',), (), osutils.split_lines(text))[0]
+        self.assertEqual(sha_string(text), sha1)
+        record = vf.get_record_stream([('a',)], 'unordered', True).next()
+        self.assertEqual(text, record.get_bytes_as('fulltext'))
+
+    def test_missing_chunk(self):
+        vf = self.make_chunked_vf()
+        vf.add_lines(('a',), (), self.make_lines(0, 1000))
+        vf._chunk_store = self.make_test_vf(False, dir='empty')
+        record = vf.get_record_stream([('a',)], 'unordered', True)
+        self.assertRaises(errors.RevisionNotPresent, record.next)
+
+
+class InlinePool(object):
+    """A stand-in for multiprocessing.Pool that runs jobs immediately."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def apply_async(self, func, args):
+        self.calls += 1
+        result = func(*args)
+        class _Result(object):
+            def get(self):
+                return result
+        return _Result()
+
 
 class StubGCVF(object):
     def __init__(self, canned_get_blocks=None):
         self._group_cache = {}
         self._canned_get_blocks = canned_get_blocks or []
+        self._access = StubAccess()
     def _get_blocks(self, read_memos):
         return iter(self._canned_get_blocks)
+
+
+class StubAccess(object):
+    def get_raw_records(self, memos_for_retrieval):
+        return iter([])
     
 
 class Test_BatchingBlockFetcher(TestCaseWithGroupCompressVersionedFiles):
@@ -935,6 +1195,61 @@ class Test_BatchingBlockFetcher(TestCaseWithGroupCompressVersionedFiles):
         self.assertEqual(('key',), factories[0].key)
         self.assertEqual('groupcompress-block', factories[0].storage_kind)
 
+    def make_vf_with_blocks(self, count):
+        vf = self.make_test_vf(False)
+        # Each add_lines call creates a separate block
+        for i in range(count):
+            vf.add_lines(('key%d' % i,), (), ['text %d\n' % i] * 100)
+        vf.writer.end()
+        return vf
+
+    def count_raw_reads(self, vf):
+        calls = []
+        get_raw_records = vf._access.get_raw_records
+        def counting_get_raw_records(memos):
+            memos = list(memos)
+            calls.append(memos)
+            return get_raw_records(memos)
+        vf._access.get_raw_records = counting_get_raw_records
+        return calls
+
+    def test_unordered_reads_blocks_once(self):
+        self.overrideAttr(groupcompress, 'BATCH_SIZE', 1)
+        vf = self.make_vf_with_blocks(5)
+        calls = self.count_raw_reads(vf)
+        keys = [('key%d' % i,) for i in range(5)]
+        texts = dict((r.key, r.get_bytes_as('fulltext')) for r in
+                     vf.get_record_stream(keys, 'unordered', True))
+        self.assertEqual('text 3\n' * 100, texts[('key3',)])
+        self.assertLength(1, calls)
+        self.assertLength(5, calls[0])
+
+    def test_plan_skips_cached_blocks(self):
+        vf = self.make_vf_with_blocks(3)
+        list(vf.get_record_stream([('key1',)], 'unordered', True))
+        calls = self.count_raw_reads(vf)
+        keys = [('key%d' % i,) for i in range(3)]
+        texts = dict((r.key, r.get_bytes_as('fulltext')) for r in
+                     vf.get_record_stream(keys, 'unordered', True))
+        self.assertEqual('text 1\n' * 100, texts[('key1',)])
+        self.assertLength(1, calls)
+        self.assertLength(2, calls[0])
+
+    def test_plan_last_bytes(self):
+        read_memo = ('fake index', 100, 50)
+        locations = {
+            ('key1',): (read_memo + (0, 10), None, None, None),
+            ('key2',): (read_memo + (10, 30), None, None, None)}
+        gcvf = StubGCVF()
+        gcvf._group_cache[read_memo] = groupcompress.GroupCompressBlock()
+        batcher = groupcompress._BatchingBlockFetcher(gcvf, locations)
+        batcher.plan_reads([('key1',), ('key2',)])
+        self.assertEqual({read_memo: 30}, batcher._plan.last_bytes)
+        batcher.add_key(('key1',))
+        self.assertEqual([], list(batcher.yield_factories()))
+        # The block will be decompressed as far as key2 needs
+        self.assertEqual(30, batcher.manager._last_byte)
+
 
 class TestLazyGroupCompress(tests.TestCaseWithTransport):
 
@@ -17,6 +17,7 @@
 """Tests for indices."""
 
 from bzrlib import (
+    bloom,
     errors,
     index,
     tests,
@@ -1520,6 +1521,42 @@ class TestCombinedGraphIndex(tests.TestCaseWithMemoryTransport):
                          parent_map)
         self.assertEqual(set([key3]), missing_keys)
 
+    def make_bloom_filter(self, keys):
+        bloom_filter = bloom.BloomFilter.for_capacity(len(keys), 0.001)
+        for key in keys:
+            bloom_filter.add(key)
+        return bloom_filter
+
+    def test_iter_entries_skips_index_excluded_by_bloom_filter(self):
+        index1 = self.make_index('1', nodes=[(('1',), '', ())])
+        index2 = self.make_index('2', nodes=[(('2',), '', ())])
+        index1._bloom_filter = self.make_bloom_filter([('1',)])
+        c_index = index.CombinedGraphIndex([index1, index2])
+        # Without the filter, reading index1 would raise NoSuchFile
+        self.get_transport().delete('1')
+        self.assertEqual([(index2, ('2',), '')],
+                         list(c_index.iter_entries([('2',)])))
+        self.assertEqual([], list(c_index.iter_entries([('3',)])))
+        self.assertEqual({}, c_index.get_parent_map([('3',)]))
+
+    def test_find_ancestors_skips_index_excluded_by_bloom_filter(self):
+        key1 = ('key-1',)
+        key2 = ('key-2',)
+        key3 = ('key-3',)
+        index1 = self.make_index('12', ref_lists=1, nodes=[
+            (key1, 'value', ([],)),
+            (key2, 'value', ([key1],)),
+            ])
+        index2 = self.make_index('3', ref_lists=1, nodes=[
+            (key3, 'value', ([key2],)),
+            ])
+        index2._bloom_filter = self.make_bloom_filter([key3])
+        c_index = index.CombinedGraphIndex([index2, index1])
+        self.get_transport().delete('3')
+        parent_map, missing_keys = c_index.find_ancestry([key2], 0)
+        self.assertEqual({key1: (), key2: (key1,)}, parent_map)
+        self.assertEqual(set(), missing_keys)
+
     def test__find_ancestors_empty_index(self):
         idx = self.make_index('test', ref_lists=1, key_elements=1, nodes=[])
         parent_map = {}
@@ -23,6 +23,13 @@ from bzrlib import (
     )
 
 
+def load_tests(standard_tests, module, loader):
+    suite, _ = tests.permute_tests_for_extension(
+        standard_tests, loader, 'bzrlib._lru_cache_py',
+        'bzrlib._lru_cache_pyx')
+    return suite
+
+
 def walk_lru(lru):
     """Test helper to walk the LRU list and assert its consistency"""
     node = lru._most_recently_used
@@ -58,18 +65,20 @@ def walk_lru(lru):
 class TestLRUCache(tests.TestCase):
     """Test that LRU cache properly keeps track of entries."""
 
+    module = None # Filled in by test parameterization
+
     def test_cache_size(self):
-        cache = lru_cache.LRUCache(max_cache=10)
+        cache = self.module.LRUCache(max_cache=10)
         self.assertEqual(10, cache.cache_size())
 
-        cache = lru_cache.LRUCache(max_cache=256)
+        cache = self.module.LRUCache(max_cache=256)
         self.assertEqual(256, cache.cache_size())
 
         cache.resize(512)
         self.assertEqual(512, cache.cache_size())
 
     def test_missing(self):
-        cache = lru_cache.LRUCache(max_cache=10)
+        cache = self.module.LRUCache(max_cache=10)
 
         self.assertFalse('foo' in cache)
         self.assertRaises(KeyError, cache.__getitem__, 'foo')
@@ -81,7 +90,7 @@ class TestLRUCache(tests.TestCase):
 
     def test_map_None(self):
         # Make sure that we can properly map None as a key.
-        cache = lru_cache.LRUCache(max_cache=10)
+        cache = self.module.LRUCache(max_cache=10)
         self.assertFalse(None in cache)
         cache[None] = 1
         self.assertEqual(1, cache[None])
@@ -97,13 +106,13 @@ class TestLRUCache(tests.TestCase):
         self.assertEqual([None, 1], [n.key for n in walk_lru(cache)])
 
     def test_add__null_key(self):
-        cache = lru_cache.LRUCache(max_cache=10)
+        cache = self.module.LRUCache(max_cache=10)
         self.assertRaises(ValueError,
             cache.__setitem__, lru_cache._null_key, 1)
 
     def test_overflow(self):
         """Adding extra entries will pop out old ones."""
-        cache = lru_cache.LRUCache(max_cache=1, after_cleanup_count=1)
+        cache = self.module.LRUCache(max_cache=1, after_cleanup_count=1)
 
         cache['foo'] = 'bar'
         # With a max cache of 1, adding 'baz' should pop out 'foo'
@@ -116,7 +125,7 @@ class TestLRUCache(tests.TestCase):
 
     def test_by_usage(self):
         """Accessing entries bumps them up in priority."""
-        cache = lru_cache.LRUCache(max_cache=2)
+        cache = self.module.LRUCache(max_cache=2)
 
         cache['baz'] = 'biz'
         cache['foo'] = 'bar'
@@ -130,13 +139,13 @@ class TestLRUCache(tests.TestCase):
 
     def test_cleanup_function_deprecated(self):
         """Test that per-node cleanup functions are no longer allowed"""
-        cache = lru_cache.LRUCache()
+        cache = self.module.LRUCache()
         self.assertRaises(ValueError, self.applyDeprecated,
             symbol_versioning.deprecated_in((2, 5, 0)),
             cache.add, "key", 1, cleanup=lambda: None)
 
     def test_len(self):
-        cache = lru_cache.LRUCache(max_cache=10, after_cleanup_count=10)
+        cache = self.module.LRUCache(max_cache=10, after_cleanup_count=10)
 
         cache[1] = 10
         cache[2] = 20
@@ -166,7 +175,7 @@ class TestLRUCache(tests.TestCase):
                          [n.key for n in walk_lru(cache)])
 
     def test_cleanup_shrinks_to_after_clean_count(self):
-        cache = lru_cache.LRUCache(max_cache=5, after_cleanup_count=3)
+        cache = self.module.LRUCache(max_cache=5, after_cleanup_count=3)
 
         cache[1] = 10
         cache[2] = 20
@@ -181,16 +190,16 @@ class TestLRUCache(tests.TestCase):
         self.assertEqual(3, len(cache))
 
     def test_after_cleanup_larger_than_max(self):
-        cache = lru_cache.LRUCache(max_cache=5, after_cleanup_count=10)
+        cache = self.module.LRUCache(max_cache=5, after_cleanup_count=10)
         self.assertEqual(5, cache._after_cleanup_count)
 
     def test_after_cleanup_none(self):
-        cache = lru_cache.LRUCache(max_cache=5, after_cleanup_count=None)
+        cache = self.module.LRUCache(max_cache=5, after_cleanup_count=None)
         # By default _after_cleanup_size is 80% of the normal size
         self.assertEqual(4, cache._after_cleanup_count)
 
     def test_cleanup(self):
-        cache = lru_cache.LRUCache(max_cache=5, after_cleanup_count=2)
+        cache = self.module.LRUCache(max_cache=5, after_cleanup_count=2)
 
         # Add these in order
         cache[1] = 10
@@ -205,7 +214,7 @@ class TestLRUCache(tests.TestCase):
         self.assertEqual(2, len(cache))
 
     def test_preserve_last_access_order(self):
-        cache = lru_cache.LRUCache(max_cache=5)
+        cache = self.module.LRUCache(max_cache=5)
 
         # Add these in order
         cache[1] = 10
@@ -224,7 +233,7 @@ class TestLRUCache(tests.TestCase):
         self.assertEqual([2, 3, 5, 4, 1], [n.key for n in walk_lru(cache)])
 
     def test_get(self):
-        cache = lru_cache.LRUCache(max_cache=5)
+        cache = self.module.LRUCache(max_cache=5)
 
         cache[1] = 10
         cache[2] = 20
@@ -237,7 +246,7 @@ class TestLRUCache(tests.TestCase):
         self.assertEqual([1, 2], [n.key for n in walk_lru(cache)])
 
     def test_keys(self):
-        cache = lru_cache.LRUCache(max_cache=5, after_cleanup_count=5)
+        cache = self.module.LRUCache(max_cache=5, after_cleanup_count=5)
 
         cache[1] = 2
         cache[2] = 3
@@ -249,7 +258,7 @@ class TestLRUCache(tests.TestCase):
         self.assertEqual([2, 3, 4, 5, 6], sorted(cache.keys()))
 
     def test_resize_smaller(self):
-        cache = lru_cache.LRUCache(max_cache=5, after_cleanup_count=4)
+        cache = self.module.LRUCache(max_cache=5, after_cleanup_count=4)
         cache[1] = 2
         cache[2] = 3
         cache[3] = 4
@@ -268,7 +277,7 @@ class TestLRUCache(tests.TestCase):
         self.assertEqual([7, 8], sorted(cache.keys()))
 
     def test_resize_larger(self):
-        cache = lru_cache.LRUCache(max_cache=5, after_cleanup_count=4)
+        cache = self.module.LRUCache(max_cache=5, after_cleanup_count=4)
         cache[1] = 2
         cache[2] = 3
         cache[3] = 4
@@ -287,28 +296,51 @@ class TestLRUCache(tests.TestCase):
         cache[11] = 12 # triggers cleanup back to new after_cleanup_count
         self.assertEqual([6, 7, 8, 9, 10, 11], sorted(cache.keys()))
 
+    def test_stats(self):
+        cache = self.module.LRUCache(max_cache=2, after_cleanup_count=2)
+        self.assertEqual({'hits': 0, 'misses': 0, 'evictions': 0,
+                          'entries': 0}, cache.stats())
+        cache[1] = 10
+        cache[2] = 20
+        self.assertEqual(10, cache[1])
+        self.assertEqual(20, cache.get(2))
+        self.assertRaises(KeyError, cache.__getitem__, 3)
+        self.assertIs(None, cache.get(3))
+        # Membership tests are not lookups
+        self.assertTrue(1 in cache)
+        # This pushes out 1
+        cache[3] = 30
+        self.assertEqual({'hits': 2, 'misses': 2, 'evictions': 1,
+                          'entries': 2}, cache.stats())
+        # Clearing the cache does not count as evicting
+        cache.clear()
+        self.assertEqual({'hits': 2, 'misses': 2, 'evictions': 1,
+                          'entries': 0}, cache.stats())
+
 
 class TestLRUSizeCache(tests.TestCase):
 
+    module = None # Filled in by test parameterization
+
     def test_basic_init(self):
-        cache = lru_cache.LRUSizeCache()
+        cache = self.module.LRUSizeCache()
         self.assertEqual(2048, cache._max_cache)
         self.assertEqual(int(cache._max_size*0.8), cache._after_cleanup_size)
         self.assertEqual(0, cache._value_size)
 
     def test_add__null_key(self):
-        cache = lru_cache.LRUSizeCache()
+        cache = self.module.LRUSizeCache()
         self.assertRaises(ValueError,
             cache.__setitem__, lru_cache._null_key, 1)
 
     def test_add_tracks_size(self):
-        cache = lru_cache.LRUSizeCache()
+        cache = self.module.LRUSizeCache()
         self.assertEqual(0, cache._value_size)
         cache['my key'] = 'my value text'
         self.assertEqual(13, cache._value_size)
 
     def test_remove_tracks_size(self):
-        cache = lru_cache.LRUSizeCache()
+        cache = self.module.LRUSizeCache()
         self.assertEqual(0, cache._value_size)
         cache['my key'] = 'my value text'
         self.assertEqual(13, cache._value_size)
@@ -318,7 +350,7 @@ class TestLRUSizeCache(tests.TestCase):
 
     def test_no_add_over_size(self):
         """Adding a large value may not be cached at all."""
-        cache = lru_cache.LRUSizeCache(max_size=10, after_cleanup_size=5)
+        cache = self.module.LRUSizeCache(max_size=10, after_cleanup_size=5)
         self.assertEqual(0, cache._value_size)
         self.assertEqual({}, cache.as_dict())
         cache['test'] = 'key'
@@ -339,7 +371,7 @@ class TestLRUSizeCache(tests.TestCase):
 
     def test_adding_clears_cache_based_on_size(self):
         """The cache is cleared in LRU order until small enough"""
-        cache = lru_cache.LRUSizeCache(max_size=20)
+        cache = self.module.LRUSizeCache(max_size=20)
         cache['key1'] = 'value' # 5 chars
         cache['key2'] = 'value2' # 6 chars
         cache['key3'] = 'value23' # 7 chars
@@ -352,7 +384,7 @@ class TestLRUSizeCache(tests.TestCase):
                          cache.as_dict())
 
     def test_adding_clears_to_after_cleanup_size(self):
-        cache = lru_cache.LRUSizeCache(max_size=20, after_cleanup_size=10)
+        cache = self.module.LRUSizeCache(max_size=20, after_cleanup_size=10)
         cache['key1'] = 'value' # 5 chars
         cache['key2'] = 'value2' # 6 chars
         cache['key3'] = 'value23' # 7 chars
@@ -366,7 +398,7 @@ class TestLRUSizeCache(tests.TestCase):
     def test_custom_sizes(self):
         def size_of_list(lst):
             return sum(len(x) for x in lst)
-        cache = lru_cache.LRUSizeCache(max_size=20, after_cleanup_size=10,
+        cache = self.module.LRUSizeCache(max_size=20, after_cleanup_size=10,
                                        compute_size=size_of_list)
 
         cache['key1'] = ['val', 'ue'] # 5 chars
@@ -380,7 +412,7 @@ class TestLRUSizeCache(tests.TestCase):
         self.assertEqual({'key4':['value', '234']}, cache.as_dict())
 
     def test_cleanup(self):
-        cache = lru_cache.LRUSizeCache(max_size=20, after_cleanup_size=10)
+        cache = self.module.LRUSizeCache(max_size=20, after_cleanup_size=10)
 
         # Add these in order
         cache['key1'] = 'value' # 5 chars
@@ -393,7 +425,7 @@ class TestLRUSizeCache(tests.TestCase):
         self.assertEqual(7, cache._value_size)
 
     def test_keys(self):
-        cache = lru_cache.LRUSizeCache(max_size=10)
+        cache = self.module.LRUSizeCache(max_size=10)
 
         cache[1] = 'a'
         cache[2] = 'b'
@@ -401,7 +433,7 @@ class TestLRUSizeCache(tests.TestCase):
         self.assertEqual([1, 2, 3], sorted(cache.keys()))
 
     def test_resize_smaller(self):
-        cache = lru_cache.LRUSizeCache(max_size=10, after_cleanup_size=9)
+        cache = self.module.LRUSizeCache(max_size=10, after_cleanup_size=9)
         cache[1] = 'abc'
         cache[2] = 'def'
         cache[3] = 'ghi'
@@ -418,7 +450,7 @@ class TestLRUSizeCache(tests.TestCase):
         self.assertEqual([6], sorted(cache.keys()))
 
     def test_resize_larger(self):
-        cache = lru_cache.LRUSizeCache(max_size=10, after_cleanup_size=9)
+        cache = self.module.LRUSizeCache(max_size=10, after_cleanup_size=9)
         cache[1] = 'abc'
         cache[2] = 'def'
         cache[3] = 'ghi'
@@ -433,3 +465,36 @@ class TestLRUSizeCache(tests.TestCase):
         cache[7] = 'stu'
         self.assertEqual([4, 5, 6, 7], sorted(cache.keys()))
 
+    def test_replace_updates_value(self):
+        cache = self.module.LRUSizeCache(max_size=20)
+        cache['key'] = 'value'
+        cache['key'] = 'other value'
+        self.assertEqual('other value', cache['key'])
+        self.assertEqual(11, cache._value_size)
+
+    def test_size_computed_once(self):
+        sizes = []
+        def compute_size(value):
+            sizes.append(value)
+            return len(value)
+        cache = self.module.LRUSizeCache(max_size=20,
+                                         compute_size=compute_size)
+        cache['key1'] = 'value'
+        cache['key2'] = 'value2'
+        cache.clear()
+        self.assertEqual(['value', 'value2'], sizes)
+        self.assertEqual(0, cache._value_size)
+
+    def test_stats(self):
+        cache = self.module.LRUSizeCache(max_size=20, after_cleanup_size=10)
+        cache['key1'] = 'value' # 5 chars
+        cache['key2'] = 'value2' # 6 chars
+        cache['key1']
+        cache.get('key3')
+        cache['key3'] = 'value23' # 7 chars
+        # This goes over the limit, and everything else has to go to get
+        # back under after_cleanup_size
+        cache['key4'] = 'value234' # 8 chars
+        self.assertEqual({'hits': 1, 'misses': 1, 'evictions': 3,
+                          'entries': 1, 'bytes': 8, 'max_bytes': 20},
+                         cache.stats())
@@ -1320,6 +1320,33 @@ class TestBranchGetTagsBytes(RemoteBranchTestCase):
         self.assertEqual({}, result)
 
 
+class TestBranchPrefetchTipAndTags(RemoteBranchTestCase):
+
+    def test_prefetch(self):
+        self.setup_smart_server_with_call_log()
+        local_branch = self.make_branch('.')
+        local_branch.tags.set_tag('tag-1', 'rev-1')
+        branch = Branch.open(self.get_url('.'))
+        self.addCleanup(branch.lock_read().unlock)
+        self.reset_smart_call_log()
+        branch._prefetch_tip_and_tags()
+        self.assertEqual(
+            ['Branch.last_revision_info', 'Branch.get_tags_bytes'],
+            [call.call.method for call in self.hpss_calls])
+        self.assertEqual((0, 'null:'), branch.last_revision_info())
+        self.assertEqual({'tag-1': 'rev-1'}, branch.tags.get_tag_dict())
+        # The prefetched responses were used, no more calls were made.
+        self.assertLength(2, self.hpss_calls)
+
+    def test_prefetch_unlocked(self):
+        self.setup_smart_server_with_call_log()
+        self.make_branch('.')
+        branch = Branch.open(self.get_url('.'))
+        self.reset_smart_call_log()
+        branch._prefetch_tip_and_tags()
+        self.assertLength(0, self.hpss_calls)
+
+
 class TestBranchSetTagsBytes(RemoteBranchTestCase):
 
     def test_trivial(self):
@@ -2404,6 +2431,40 @@ class TestRepositoryGatherStats(TestRemoteRepository):
                          result)
 
 
+class TestRepositoryGatherStorageStats(TestRemoteRepository):
+
+    def test_gather_storage_stats(self):
+        body = ('packs: 2\n'
+                'size: 4096\n'
+                'earliest: 123456.300\n'
+                'latest: 654231.400\n'
+                'index revision: 2 812 -\n'
+                'index text: 3 1520 4000\n')
+        transport_path = 'quack'
+        repo, client = self.setup_fake_client_and_repository(transport_path)
+        client.add_success_response_with_body(body, 'ok')
+        result = repo.gather_storage_stats()
+        self.assertEqual(
+            [('call_expecting_body', 'Repository.gather_storage_stats',
+              ('quack/',))],
+            client._calls)
+        self.assertEqual({'packs': 2, 'size': 4096,
+                          'earliest': 123456.3, 'latest': 654231.4,
+                          'indices': {
+                            'revision': {'records': 2, 'compressed': 812,
+                                         'uncompressed': None},
+                            'text': {'records': 3, 'compressed': 1520,
+                                     'uncompressed': 4000}}},
+                         result)
+
+    def test_unsupported(self):
+        transport_path = 'quack'
+        repo, client = self.setup_fake_client_and_repository(transport_path)
+        client.add_error_response('UnsupportedOperation')
+        self.assertRaises(errors.UnsupportedOperation,
+                          repo.gather_storage_stats)
+
+
 class TestRepositoryBreakLock(TestRemoteRepository):
 
     def test_break_lock(self):
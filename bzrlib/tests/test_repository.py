@@ -47,6 +47,7 @@ from bzrlib import (
     bzrdir,
     controldir,
     errors,
+    groupcompress,
     inventory,
     osutils,
     repository,
@@ -757,6 +758,203 @@ class Test2a(tests.TestCaseWithMemoryTransport):
         self.assertFalse(repo.chk_bytes._index._inconsistency_fatal)
 
 
+class TestDevelopmentChunked(TestCaseWithTransport):
+
+    def setUp(self):
+        super(TestDevelopmentChunked, self).setUp()
+        self.overrideAttr(groupcompress, '_CHUNKING_MIN_TEXT_SIZE', 1000)
+        self.overrideAttr(groupcompress, '_CHUNK_MIN_SIZE', 64)
+        self.overrideAttr(groupcompress, '_CHUNK_MAX_SIZE', 1024)
+        self.overrideAttr(groupcompress, '_CHUNK_BOUNDARY_MASK', 0x3)
+
+    def make_tree_with_copies(self):
+        tree = self.make_branch_and_tree('tree', format='development-chunked')
+        content = ''.join(['line %d of a large file\n' % i
+                           for i in xrange(2000)])
+        self.build_tree_contents([('tree/big', content)])
+        tree.add(['big'], ['big-id'])
+        tree.commit('one', rev_id='one')
+        repo = tree.branch.repository
+        repo.lock_read()
+        chunk_count = len(repo.chk_bytes.keys())
+        repo.unlock()
+        self.build_tree_contents([('tree/copy', content)])
+        tree.add(['copy'], ['copy-id'])
+        tree.rename_one('big', 'renamed')
+        tree.commit('two', rev_id='two')
+        return tree, content, chunk_count
+
+    def test_format(self):
+        tree = self.make_branch_and_tree('tree', format='development-chunked')
+        repo = tree.branch.repository
+        self.assertIsInstance(repo._format,
+                              groupcompress_repo.RepositoryFormat2aChunked)
+        self.assertIsInstance(repo.texts,
+                              groupcompress.ChunkedGroupCompressVersionedFiles)
+        self.assertIs(repo.chk_bytes, repo.texts._chunk_store)
+
+    def test_copies_share_chunks(self):
+        tree, content, chunk_count = self.make_tree_with_copies()
+        repo = tree.branch.repository
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        self.assertTrue(chunk_count > 20)
+        # Only the new inventory pages were added
+        self.assertTrue(len(repo.chk_bytes.keys()) < chunk_count + 10)
+        texts = dict((r.key, r.get_bytes_as('fulltext')) for r in
+            repo.texts.get_record_stream([('big-id', 'one'),
+                ('copy-id', 'two')], 'unordered', True))
+        self.assertEqual(content, texts[('big-id', 'one')])
+        self.assertEqual(content, texts[('copy-id', 'two')])
+        repo.check(['two'])
+
+    def test_fetch_and_pack(self):
+        tree, content, chunk_count = self.make_tree_with_copies()
+        target = self.make_repository('target', format='2a')
+        target.fetch(tree.branch.repository, 'two')
+        target.lock_read()
+        self.addCleanup(target.unlock)
+        self.assertEqual(content, target.revision_tree('two').get_file_text(
+            'copy-id'))
+        chunked = self.make_repository('chunked',
+                                       format='development-chunked')
+        chunked.fetch(target, 'two')
+        chunked.pack()
+        chunked.lock_read()
+        self.addCleanup(chunked.unlock)
+        self.assertEqual(content, chunked.revision_tree('two').get_file_text(
+            'big-id'))
+
+
+class TestCollectGarbage(TestCaseWithTransport):
+
+    def make_uncommitted_repo(self, pack=False):
+        tree = self.make_branch_and_tree('tree', format='2a')
+        self.build_tree_contents([('tree/file', 'content\n' * 100)])
+        tree.add(['file'], ['file-id'])
+        tree.commit('one', rev_id='one')
+        self.build_tree_contents([('tree/file', 'changed\n' * 100)])
+        tree.commit('two', rev_id='two')
+        repo = tree.branch.repository
+        if pack:
+            repo.pack()
+        tree.branch.set_last_revision_info(1, 'one')
+        tree.set_parent_ids(['one'])
+        return repo
+
+    def get_keys(self, repo):
+        repo.lock_read()
+        try:
+            return (repo.revisions.keys(), repo.inventories.keys(),
+                    repo.chk_bytes.keys(), repo.texts.keys())
+        finally:
+            repo.unlock()
+
+    def test_removes_uncommitted(self):
+        repo = self.make_uncommitted_repo()
+        result = repo.collect_garbage(['one'], dead_ratio=0.0)
+        self.assertEqual(1, result['revision'])
+        self.assertEqual(1, result['inventory'])
+        self.assertEqual(1, result['text'])
+        self.assertEqual(1, len(result['packs']))
+        repo = repo.bzrdir.open_repository()
+        revisions, inventories, chks, texts = self.get_keys(repo)
+        self.assertEqual(set([('one',)]), revisions)
+        self.assertEqual(set([('one',)]), inventories)
+        self.assertEqual(set(['one']), set(key[1] for key in texts))
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        self.assertEqual('content\n' * 100,
+                         repo.revision_tree('one').get_file_text('file-id'))
+        repo.check(['one'])
+
+    def test_rewrites_partially_dead_pack(self):
+        repo = self.make_uncommitted_repo(pack=True)
+        result = repo.collect_garbage(['one'], dead_ratio=0.0,
+                                      clean_obsolete_packs=True)
+        self.assertEqual(1, len(result['packs']))
+        self.assertTrue(0 < result['dead_bytes'] < result['total_bytes'])
+        repo = repo.bzrdir.open_repository()
+        revisions, inventories, chks, texts = self.get_keys(repo)
+        self.assertEqual(set([('one',)]), revisions)
+        self.assertEqual(set(['one']), set(key[1] for key in texts))
+        self.assertEqual([], repo._pack_collection._pack_transport.list_dir(
+            '../obsolete_packs'))
+        repo.check(['one'])
+
+    def test_dry_run(self):
+        repo = self.make_uncommitted_repo()
+        before = self.get_keys(repo)
+        result = repo.collect_garbage(['one'], dead_ratio=0.0, dry_run=True)
+        self.assertEqual(1, result['revision'])
+        self.assertEqual(1, len(result['packs']))
+        repo = repo.bzrdir.open_repository()
+        self.assertEqual(before, self.get_keys(repo))
+
+    def test_threshold_skips_packs(self):
+        repo = self.make_uncommitted_repo(pack=True)
+        names = repo._pack_collection.names()
+        result = repo.collect_garbage(['one'], dead_ratio=0.99)
+        self.assertEqual([], result['packs'])
+        self.assertEqual(1, result['revision'])
+        repo = repo.bzrdir.open_repository()
+        revisions = self.get_keys(repo)[0]
+        self.assertEqual(set([('one',), ('two',)]), revisions)
+        self.assertEqual(names, repo._pack_collection.names())
+
+    def test_keeps_everything_reachable(self):
+        repo = self.make_uncommitted_repo()
+        before = self.get_keys(repo)
+        result = repo.collect_garbage(['one', 'two'], dead_ratio=0.0)
+        self.assertEqual([], result['packs'])
+        self.assertEqual(0, result['dead_bytes'])
+        repo = repo.bzrdir.open_repository()
+        self.assertEqual(before, self.get_keys(repo))
+
+    def test_refuses_with_write_group_open(self):
+        repo = self.make_uncommitted_repo()
+        before = self.get_keys(repo)
+        writer = repo.bzrdir.open_repository()
+        writer.lock_write()
+        self.addCleanup(writer.unlock)
+        writer.start_write_group()
+        self.assertRaises(errors.WriteGroupsInProgress, repo.collect_garbage,
+                          ['one'], dead_ratio=0.0)
+        self.assertEqual(before,
+                         self.get_keys(repo.bzrdir.open_repository()))
+        writer.abort_write_group()
+        result = repo.collect_garbage(['one'], dead_ratio=0.0)
+        self.assertEqual(1, len(result['packs']))
+
+    def test_write_group_started_during_sweep(self):
+        repo = self.make_uncommitted_repo(pack=True)
+        before = self.get_keys(repo)
+        names = repo._pack_collection.names()
+        writer = repo.bzrdir.open_repository()
+        writer.lock_write()
+        self.addCleanup(writer.unlock)
+        orig_pack = groupcompress_repo.GCCHKGarbageCollectingPacker.pack
+        def pack_then_write(packer, pb=None):
+            result = orig_pack(packer, pb)
+            writer.start_write_group()
+            return result
+        self.overrideAttr(groupcompress_repo.GCCHKGarbageCollectingPacker,
+                          'pack', pack_then_write)
+        self.assertRaises(errors.WriteGroupsInProgress, repo.collect_garbage,
+                          ['one'], dead_ratio=0.0)
+        writer.abort_write_group()
+        repo = repo.bzrdir.open_repository()
+        self.assertEqual(before, self.get_keys(repo))
+        self.assertEqual(names, repo._pack_collection.names())
+        self.assertEqual([], repo._pack_collection._pack_transport.list_dir(
+            '../upload'))
+
+    def test_unsupported_format(self):
+        repo = self.make_repository('repo', format='pack-0.92')
+        self.assertRaises(errors.UnsupportedOperation, repo.collect_garbage,
+                          [])
+
+
 class TestKnitPackStreamSource(tests.TestCaseWithMemoryTransport):
 
     def test_source_to_exact_pack_092(self):
@@ -1378,6 +1576,91 @@ class TestRepositoryPackCollection(TestCaseWithTransport):
         packs._clear_obsolete_packs()
 
 
+class TestIndexConsolidation(TestCaseWithTransport):
+
+    def make_consolidated_tree(self):
+        """Commit 3 revisions with autopack consolidating after each."""
+        tree = self.make_branch_and_tree('.', format='2a')
+        tree.lock_write()
+        self.addCleanup(tree.unlock)
+        packs = tree.branch.repository._pack_collection
+        packs.config_stack.set('repository.consolidate_indices', True)
+        packs._max_pack_count = lambda x: 1
+        packs.pack_distribution = lambda x: [10]
+        for i in range(3):
+            self.build_tree_contents([('file', 'content %d\n' % i)])
+            if i == 0:
+                tree.add(['file'], ['file-id'])
+            tree.commit('commit %d' % i, rev_id='rev-%d' % i)
+        return tree, packs
+
+    def test_autopack_consolidates_indices(self):
+        tree, packs = self.make_consolidated_tree()
+        names = packs.names()
+        # No pack was rewritten
+        self.assertLength(3, names)
+        self.assertEqual(sorted(name + '.pack' for name in names),
+            sorted(packs._pack_transport.list_dir('.')))
+        self.assertLength(1, packs._consolidations)
+        [(name, (pack_names, sizes))] = packs._consolidations.items()
+        self.assertEqual(sorted(names), sorted(pack_names))
+        self.assertEqual([name], packs._applied_consolidations.keys())
+        combined = packs.revision_index.combined_index
+        self.assertLength(1, combined._indices)
+        self.assertIsInstance(combined._indices[0],
+                              pack_repo.ConsolidatedIndex)
+        # The consolidation of the first two packs was superseded
+        self.assertLength(5, [f for f in
+            packs.transport.list_dir('obsolete_packs')
+            if f.startswith('consolidated-')])
+        self.assertEqual(set([('rev-0',), ('rev-1',), ('rev-2',)]),
+            set(packs.repo.revisions.get_parent_map(
+                [('rev-0',), ('rev-1',), ('rev-2',), ('missing',)])))
+
+    def test_consolidated_indices_used_after_reopening(self):
+        tree, packs = self.make_consolidated_tree()
+        repo = repository.Repository.open('.')
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        repo_packs = repo._pack_collection
+        repo_packs.ensure_loaded()
+        self.assertEqual(packs._consolidations, repo_packs._consolidations)
+        self.assertLength(1, repo_packs.text_index.combined_index._indices)
+        texts = dict((record.key, record.get_bytes_as('fulltext'))
+            for record in repo.texts.get_record_stream(
+                [('file-id', 'rev-0'), ('file-id', 'rev-2')], 'unordered',
+                True))
+        self.assertEqual({('file-id', 'rev-0'): 'content 0\n',
+                          ('file-id', 'rev-2'): 'content 2\n'}, texts)
+        self.assertEqual('content 1\n',
+            repo.revision_tree('rev-1').get_file_text('file-id'))
+
+    def test_removing_member_pack_dissolves_consolidation(self):
+        tree, packs = self.make_consolidated_tree()
+        pack = packs.get_pack_by_name(packs.names()[0])
+        packs._remove_pack_from_memory(pack)
+        self.assertEqual({}, packs._applied_consolidations)
+        combined = packs.revision_index.combined_index
+        self.assertEqual(
+            sorted([packs.get_pack_by_name(name).revision_index
+                    for name in packs.names()]),
+            sorted(combined._indices))
+        self.assertEqual(sorted(packs.names()),
+                         sorted(combined._index_names))
+
+    def test_pack_drops_consolidations(self):
+        tree, packs = self.make_consolidated_tree()
+        tree.branch.repository.pack()
+        self.assertLength(1, packs.names())
+        self.assertEqual({}, packs._consolidations)
+        self.assertEqual([], list(packs._iter_disk_consolidations()))
+        self.assertEqual([], [f for f in packs._index_transport.list_dir('.')
+                              if f.startswith('consolidated-')])
+        self.assertEqual('content 1\n',
+            tree.branch.repository.revision_tree('rev-1').get_file_text(
+                'file-id'))
+
+
 class TestPack(TestCaseWithTransport):
     """Tests for the Pack object."""
 
@@ -1428,6 +1711,42 @@ class TestPack(TestCaseWithTransport):
         self.assertEqual('a_name.pack', pack.file_name())
 
 
+class TestPackStats(tests.TestCase):
+
+    def test_round_trip(self):
+        stats = {'pack_bytes': 1000, 'index_bytes': 200,
+                 'earliest': 1000000000.5, 'latest': 1000001000.25,
+                 'indices': {
+                    'revision': {'records': 2, 'compressed': 300,
+                                 'uncompressed': 600},
+                    'text': {'records': 5, 'compressed': 500,
+                             'uncompressed': None}}}
+        bytes = pack_repo._serialise_pack_stats(stats)
+        self.assertEqualDiff('Bazaar pack stats 1\n'
+                             'pack_bytes 1000\n'
+                             'index_bytes 200\n'
+                             'timestamps 1000000000.500 1000001000.250\n'
+                             'index revision 2 300 600\n'
+                             'index text 5 500 -\n', bytes)
+        self.assertEqual(stats, pack_repo._deserialise_pack_stats(bytes))
+
+    def test_no_timestamps(self):
+        stats = {'pack_bytes': 1000, 'index_bytes': 200,
+                 'earliest': None, 'latest': None, 'indices': {}}
+        self.assertEqual(stats, pack_repo._deserialise_pack_stats(
+            pack_repo._serialise_pack_stats(stats)))
+
+    def test_corrupt(self):
+        self.assertRaises(errors.BzrError,
+                          pack_repo._deserialise_pack_stats, 'garbage\n')
+        self.assertRaises(errors.BzrError,
+                          pack_repo._deserialise_pack_stats,
+                          'Bazaar pack stats 1\npack_bytes x\n')
+        self.assertRaises(errors.BzrError,
+                          pack_repo._deserialise_pack_stats,
+                          'Bazaar pack stats 1\npack_bytes 10\n')
+
+
 class TestNewPack(TestCaseWithTransport):
     """Tests for pack_repo.NewPack."""
 
@@ -1598,6 +1917,28 @@ class TestGCCHKPacker(TestCaseWithTransport):
         # error once fixed.
         packer.pack()
 
+    def test_pack_with_workers(self):
+        b_source = self.make_abc_branch()
+        repo = b_source.repository
+        repo._pack_collection.config_stack.set('repository.pack_workers', 2)
+        repo.lock_read()
+        try:
+            expected = dict((record.key, record.get_bytes_as('fulltext'))
+                for record in repo.texts.get_record_stream(repo.texts.keys(),
+                                                           'unordered', True))
+        finally:
+            repo.unlock()
+        repo.pack()
+        self.assertLength(1, repo._pack_collection.names())
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        actual = dict((record.key, record.get_bytes_as('fulltext'))
+            for record in repo.texts.get_record_stream(repo.texts.keys(),
+                                                       'unordered', True))
+        self.assertEqual(expected, actual)
+        self.assertEqual('new content\n',
+            repo.revision_tree('C').get_file_text('file-id'))
+
     def test_pack_with_missing_inventory(self):
         # Similar to test_pack_with_missing_inventory, but this time, we force
         # the A inventory to actually be gone from the repository.
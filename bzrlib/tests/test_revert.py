@@ -159,3 +159,21 @@ class TestRevert(tests.TestCaseWithTransport):
         self.assertEqual('temp-root-id', tree.get_root_id())
         tree.revert()
         self.assertEqual('initial-root-id', tree.get_root_id())
+
+    def test_revert_observes_sha1(self):
+        tree = self.make_branch_and_tree('.')
+        self.build_tree(['file1'])
+        tree.add(['file1'], ['file1-id'])
+        tree.commit('first')
+        self.build_tree_contents([('file1', 'changed\n')])
+        tree.lock_write()
+        self.addCleanup(tree.unlock)
+        calls = []
+        orig = tree._observed_sha1
+        def _observed_sha1(file_id, path, (sha1, stat_value)):
+            calls.append((path, sha1))
+            orig(file_id, path, (sha1, stat_value))
+        tree._observed_sha1 = _observed_sha1
+        transform.revert(tree, tree.basis_tree(), None)
+        self.assertEqual([('file1', tree.basis_tree().get_file_sha1(
+                         'file1-id'))], calls)
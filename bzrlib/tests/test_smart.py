@@ -2036,6 +2036,44 @@ class TestSmartServerRepositoryGatherStats(tests.TestCaseWithMemoryTransport):
             request.execute('', 'mia', 'yes'))
 
 
+class TestSmartServerRepositoryGatherStorageStats(
+    tests.TestCaseWithMemoryTransport):
+
+    def test_empty(self):
+        backing = self.get_transport()
+        request = smart_repo.SmartServerRepositoryGatherStorageStats(backing)
+        self.make_repository('.', format='2a')
+        self.assertEqual(
+            smart_req.SuccessfulSmartServerResponse(('ok', ),
+                'packs: 0\nsize: 0\n'),
+            request.execute(''))
+
+    def test_indices(self):
+        backing = self.get_transport()
+        request = smart_repo.SmartServerRepositoryGatherStorageStats(backing)
+        tree = self.make_branch_and_memory_tree('.', format='2a')
+        tree.lock_write()
+        tree.add('')
+        tree.commit('a commit')
+        tree.unlock()
+        response = request.execute('')
+        self.assertEqual(('ok', ), response.args)
+        lines = response.body.splitlines()
+        self.assertEqual(['packs: 1', 'index chk', 'index inventory',
+                          'index revision', 'index signature', 'index text'],
+                         [lines[0]] + [line.split(':')[0]
+                                       for line in lines[2:]])
+        self.assertTrue(lines[-2].startswith('index signature: 0 0 '))
+
+    def test_unsupported(self):
+        backing = self.get_transport()
+        request = smart_repo.SmartServerRepositoryGatherStorageStats(backing)
+        self.make_repository('.', format='knit')
+        self.assertEqual(
+            smart_req.FailedSmartServerResponse(('UnsupportedOperation',)),
+            request.execute(''))
+
+
 class TestSmartServerRepositoryIsShared(tests.TestCaseWithMemoryTransport):
 
     def test_is_shared(self):
@@ -2538,6 +2576,8 @@ class TestHandlers(tests.TestCase):
             smart_repo.SmartServerRepositoryBreakLock)
         self.assertHandlerEqual('Repository.gather_stats',
             smart_repo.SmartServerRepositoryGatherStats)
+        self.assertHandlerEqual('Repository.gather_storage_stats',
+            smart_repo.SmartServerRepositoryGatherStorageStats)
         self.assertHandlerEqual('Repository.get_parent_map',
             smart_repo.SmartServerRepositoryGetParentMap)
         self.assertHandlerEqual('Repository.get_physical_lock_status',
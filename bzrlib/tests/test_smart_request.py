@@ -19,12 +19,17 @@
 import threading
 
 from bzrlib import (
+    config,
     errors,
     transport,
     )
 from bzrlib.bzrdir import BzrDir
 from bzrlib.smart import request
-from bzrlib.tests import TestCase, TestCaseWithMemoryTransport
+from bzrlib.tests import (
+    TestCase,
+    TestCaseWithMemoryTransport,
+    TestCaseWithTransport,
+    )
 
 
 class NoBodyRequest(request.SmartServerRequest):
@@ -215,6 +220,68 @@ class TestRequestHanderErrorTranslation(TestCase):
             error(msg))
 
 
+class TestObjectCache(TestCase):
+
+    def test_take_put(self):
+        cache = request._ObjectCache(10)
+        self.assertEqual(None, cache.take('key', lambda obj: 'state'))
+        cache.put('key', 'state', 'obj')
+        self.assertEqual(('state', 'obj'),
+                         cache.take('key', lambda obj: 'state'))
+        # The object is used until it is put back.
+        self.assertEqual(None, cache.take('key', lambda obj: 'state'))
+        self.assertEqual((1, 2), (cache.hits, cache.misses))
+
+    def test_take_changed(self):
+        cache = request._ObjectCache(10)
+        cache.put('key', 'state', 'obj')
+        self.assertEqual(None, cache.take('key', lambda obj: 'new state'))
+        self.assertEqual(None, cache.take('key', lambda obj: 'new state'))
+        self.assertEqual((0, 2), (cache.hits, cache.misses))
+
+
+class TestObjectReuse(TestCaseWithTransport):
+
+    def setUp(self):
+        super(TestObjectReuse, self).setUp()
+        self.backing = self.get_transport()
+        self.overrideAttr(request, '_object_caches',
+                          request._object_caches.__class__())
+
+    def call(self, verb, *args):
+        handler = request.SmartServerRequestHandler(
+            self.backing, request.request_handlers, '/')
+        handler.args_received((verb,) + args)
+        return handler.response.args
+
+    def get_object_cache(self):
+        return request._get_object_cache(self.backing)
+
+    def test_read_requests_reuse_branch(self):
+        tree = self.make_branch_and_tree('.')
+        self.assertEqual(('ok', '0', 'null:'),
+                         self.call('Branch.last_revision_info', ''))
+        self.assertEqual(('ok', '0', 'null:'),
+                         self.call('Branch.last_revision_info', ''))
+        self.assertEqual(1, self.get_object_cache().hits)
+        # A new tip is seen, even by a reused branch.
+        revid = tree.commit('message')
+        self.assertEqual(('ok', '1', revid),
+                         self.call('Branch.last_revision_info', ''))
+
+    def test_disabled(self):
+        config.GlobalStack().set('serve.cached_objects', '0')
+        self.make_branch('.')
+        self.call('Branch.last_revision_info', '')
+        self.assertIs(None, self.get_object_cache())
+
+    def test_other_requests_do_not_reuse(self):
+        self.make_branch('.')
+        self.call('Branch.break_lock', '')
+        self.call('Branch.break_lock', '')
+        self.assertIs(None, request._object_caches.get(self.backing))
+
+
 class TestRequestJail(TestCaseWithMemoryTransport):
 
     def test_jail(self):
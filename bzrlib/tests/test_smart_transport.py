@@ -20,12 +20,15 @@
 from cStringIO import StringIO
 import doctest
 import errno
+import mmap
 import os
 import socket
+import struct
 import subprocess
 import sys
 import threading
 import time
+import zlib
 
 from testtools.matchers import DocTestMatches
 
@@ -36,6 +39,7 @@ from bzrlib import (
         debug,
         errors,
         osutils,
+        pack,
         tests,
         transport as _mod_transport,
         urlutils,
@@ -769,6 +773,46 @@ class TestSmartClientStreamMediumRequest(tests.TestCase):
                 raise
         req = client_medium.get_request()
 
+    def make_pipelined_request(self, client_medium, drained):
+        request = client_medium.get_request()
+        request.finished_writing()
+        def drain():
+            drained.append(request.read_bytes(1))
+            request.finished_reading()
+        request.pipeline(drain)
+        return request
+
+    def test_pipeline_allows_next_request(self):
+        # Once a request is pipelined another one can be made, and reading
+        # the response to that one reads the earlier response first.
+        input = StringIO('ab')
+        client_medium = medium.SmartSimplePipesClientMedium(
+            input, StringIO(), 'base')
+        drained = []
+        first_request = self.make_pipelined_request(client_medium, drained)
+        self.assertIs(None, client_medium._current_request)
+        second_request = client_medium.get_request()
+        second_request.finished_writing()
+        self.assertEqual('b', second_request.read_bytes(1))
+        self.assertEqual(['a'], drained)
+        second_request.finished_reading()
+        self.assertEqual(0, len(client_medium._pipelined_requests))
+        self.assertIs(None, client_medium._current_request)
+
+    def test_pipeline_before_finished_write_errors(self):
+        client_medium = medium.SmartSimplePipesClientMedium(None, None, 'base')
+        request = medium.SmartClientStreamMediumRequest(client_medium)
+        self.assertRaises(errors.WritingNotComplete,
+            request.pipeline, lambda: None)
+
+    def test_reset_loses_pipelined_responses(self):
+        client_medium = medium.SmartSimplePipesClientMedium(
+            StringIO('a'), StringIO(), 'base')
+        request = self.make_pipelined_request(client_medium, [])
+        client_medium.reset()
+        self.assertEqual(0, len(client_medium._pipelined_requests))
+        self.assertRaises(errors.ConnectionReset, request.read_bytes, 1)
+
 
 class RemoteTransportTests(test_smart.TestCaseWithSmartMedium):
 
@@ -1158,6 +1202,15 @@ class TestSmartServerStreamMedium(tests.TestCase):
         data = server.read_bytes(1)
         self.assertEqual('', data)
 
+    def test_socket_build_protocol_with_buffered_request(self):
+        # A request read along with the previous one is served without
+        # waiting for the socket to have more bytes.
+        server, client_sock = self.create_socket_context(None, timeout=0.01)
+        server._push_back(protocol.MESSAGE_VERSION_THREE)
+        server_protocol = server._build_protocol()
+        self.assertIsInstance(server_protocol,
+                              protocol.ProtocolThreeDecoder)
+
     def test_socket_wait_for_bytes_with_timeout_closed(self):
         server, client_sock = self.create_socket_context(None)
         # With the socket closed, this should return right away.
@@ -1260,7 +1313,10 @@ class TestGetProtocolFactoryForBytes(tests.TestCase):
         self.assertEqual('anything\n', remainder)
 
 
-class TestSmartTCPServer(tests.TestCase):
+class SmartTCPServerTestCase(tests.TestCase):
+    """Helpers for exercising a SmartTCPServer (or subclass) directly."""
+
+    server_class = _mod_server.SmartTCPServer
 
     def make_server(self):
         """Create a SmartTCPServer that we can exercise.
@@ -1275,7 +1331,7 @@ class TestSmartTCPServer(tests.TestCase):
         :return: (server, server_thread)
         """
         t = _mod_transport.get_transport_from_url('memory:///')
-        server = _mod_server.SmartTCPServer(t, client_timeout=4.0)
+        server = self.server_class(t, client_timeout=4.0)
         server._ACCEPT_TIMEOUT = 0.1
         # We don't use 'localhost' because that might be an IPv6 address.
         server.start_server('127.0.0.1', 0)
@@ -1331,6 +1387,9 @@ class TestSmartTCPServer(tests.TestCase):
         server._fully_stopped.wait()
         server_thread.join()
 
+
+class TestSmartTCPServer(SmartTCPServerTestCase):
+
     def test_get_error_unexpected(self):
         """Error reported by server with no specific representation"""
         self.overrideEnv('BZR_NO_SMART_VFS', None)
@@ -1481,6 +1540,179 @@ class TestSmartTCPServer(tests.TestCase):
         server_thread.join()
 
 
+class TestSmartEventTCPServer(SmartTCPServerTestCase):
+
+    server_class = _mod_server.SmartEventTCPServer
+
+    def make_handler(self):
+        server = self.server_class(None, client_timeout=4.0)
+        server_sock, client_sock = portable_socket_pair()
+        self.addCleanup(client_sock.close)
+        return server._make_handler(server_sock), client_sock
+
+    def wait_for_connections(self, server, count):
+        """Wait for the event loop to have count open connections."""
+        for i in range(100):
+            if len(server._active_connections) == count:
+                return
+            time.sleep(0.01)
+        self.assertLength(count, server._active_connections)
+
+    def test_process_bytes(self):
+        handler, client_sock = self.make_handler()
+        self.assertTrue(handler.process_bytes('hello\nhello\n'))
+        self.assertFalse(handler.in_request())
+        self.assertEqual('ok\x012\nok\x012\n', client_sock.recv(10))
+
+    def test_process_bytes_of_partial_requests(self):
+        handler, client_sock = self.make_handler()
+        self.assertTrue(handler.process_bytes('hel'))
+        self.assertTrue(handler.in_request())
+        self.assertTrue(handler.process_bytes('lo\nhel'))
+        self.assertEqual('ok\x012\n', client_sock.recv(5))
+        self.assertTrue(handler.process_bytes('lo\n'))
+        self.assertEqual('ok\x012\n', client_sock.recv(5))
+        self.assertFalse(handler.in_request())
+
+    def test_process_bytes_when_stopped(self):
+        handler, client_sock = self.make_handler()
+        self.assertTrue(handler.process_bytes('hel'))
+        handler._stop_gracefully()
+        # The request that was started is still served.
+        self.assertFalse(handler.process_bytes('lo\nhello\n'))
+        self.assertEqual('ok\x012\n', client_sock.recv(10))
+
+    def test_serves_more_clients_than_threads(self):
+        server, server_thread = self.make_server()
+        self.assertEqual(4, server._request_threads)
+        client_socks = [self.connect_to_server(server) for i in range(10)]
+        for client_sock in client_socks:
+            client_sock.send('hel')
+        for client_sock in client_socks:
+            client_sock.send('lo\n')
+            self.assertEqual('ok\x012\n', client_sock.recv(5))
+        self.assertLength(10, server._active_connections)
+        self.shutdown_server_cleanly(server, server_thread)
+
+    def test_serve_closes_out_finished_connections(self):
+        server, server_thread = self.make_server()
+        client_sock = self.connect_to_server(server)
+        self.say_hello(client_sock)
+        self.assertLength(1, server._active_connections)
+        handler = server._active_connections[0][0]
+        self.assertIsInstance(handler,
+                              medium.SmartServerSocketEventMedium)
+        client_sock.close()
+        self.wait_for_connections(server, 0)
+        self.shutdown_server_cleanly(server, server_thread)
+
+    def test_idle_clients_are_disconnected(self):
+        server, server_thread = self.make_server()
+        client_sock = self.connect_to_server(server)
+        self.say_hello(client_sock)
+        handler = server._active_connections[0][0]
+        handler._client_timeout = 0.1
+        self.assertEqual('', client_sock.recv(1))
+        self.wait_for_connections(server, 0)
+        self.assertContainsRe(self.get_log(),
+                              'disconnecting client after 0.1 seconds')
+        self.shutdown_server_cleanly(server, server_thread)
+
+    def test_graceful_shutdown_waits_for_clients_to_stop(self):
+        server, server_thread = self.make_server()
+        server.backing_transport.put_bytes('bigfile',
+            'a'*1024*1024)
+        client_sock = self.connect_to_server(server)
+        self.say_hello(client_sock)
+        idle_client_sock = self.connect_to_server(server)
+        self.say_hello(idle_client_sock)
+        # Start the RPC, but don't finish reading the response
+        client_medium = medium.SmartClientAlreadyConnectedSocketMedium(
+            'base', client_sock)
+        client_client = client._SmartClient(client_medium)
+        resp, response_handler = client_client.call_expecting_body('get',
+            'bigfile')
+        self.assertEqual(('ok',), resp)
+        server._stop_gracefully()
+        self.connect_to_server_and_hangup(server)
+        server._stopped.wait()
+        self.assertRaises(socket.error, self.connect_to_server, server)
+        # The idle client is disconnected, but the other one is still being
+        # served.
+        self.assertEqual('', idle_client_sock.recv(1))
+        server._fully_stopped.wait(0.01)
+        self.assertFalse(server._fully_stopped.isSet())
+        response_handler.read_body_bytes()
+        self.assertEqual('', client_sock.recv(1))
+        server_thread.join()
+        self.assertTrue(server._fully_stopped.isSet())
+        self.assertLength(0, server._active_connections)
+        self.assertContainsRe(self.get_log(),
+            'Stopping SmartServerSocketEventMedium')
+
+    def test_stop_gracefully_tells_handlers_to_stop(self):
+        server, server_thread = self.make_server()
+        client_sock = self.connect_to_server(server)
+        self.say_hello(client_sock)
+        server_handler = server._active_connections[0][0]
+        self.assertFalse(server_handler.finished)
+        server._stop_gracefully()
+        self.assertTrue(server_handler.finished)
+        client_sock.close()
+        self.connect_to_server_and_hangup(server)
+        server_thread.join()
+
+    def test_stop_as_soon_as_started(self):
+        # The listening socket can be closed as soon as the loop starts, and
+        # stopping then leaves no request threads behind.
+        thread_count = threading.activeCount()
+        for i in range(5):
+            t = _mod_transport.get_transport_from_url('memory:///')
+            server = self.server_class(t, client_timeout=4.0)
+            server.start_server('127.0.0.1', 0)
+            server.start_background_thread('-%s' % (self.id(),))
+            server.stop_background_thread()
+        self.assertEqual(thread_count, threading.activeCount())
+        self.assertNotContainsRe(self.get_log(), 'Traceback')
+
+
+class TestWorkerStats(tests.TestCase):
+
+    def make_stats(self, slots=1):
+        size = _mod_server._WorkerStats.size
+        buf = mmap.mmap(-1, slots * size)
+        return [_mod_server._WorkerStats(buf, i * size) for i in range(slots)]
+
+    def test_start_update_and_clear(self):
+        [stats] = self.make_stats()
+        stats.start(123, 10.5)
+        self.assertEqual((123, 10.5, 0, 0), stats.read())
+        stats.update(3, 1)
+        self.assertEqual((123, 10.5, 3, 1), stats.read())
+        stats.clear()
+        self.assertEqual((0, 0.0, 0, 0), stats.read())
+
+    def test_slots_are_independent(self):
+        stats1, stats2 = self.make_stats(2)
+        stats1.start(1, 1.0)
+        stats2.start(2, 2.0)
+        stats2.update(5, 2)
+        self.assertEqual((1, 1.0, 0, 0), stats1.read())
+        self.assertEqual((2, 2.0, 5, 2), stats2.read())
+
+    def test_server_counts_connections(self):
+        [stats] = self.make_stats()
+        stats.start(123, 10.5)
+        server = _mod_server.SmartTCPServer(None, client_timeout=4.0)
+        server._stats = stats
+        server_sock, client_sock = portable_socket_pair()
+        server.serve_conn(server_sock, '-%s' % (self.id(),))
+        self.assertEqual((123, 10.5, 1, 1), stats.read())
+        client_sock.close()
+        server._poll_active_connections(0.1)
+        self.assertEqual((123, 10.5, 1, 0), stats.read())
+
+
 class SmartTCPTests(tests.TestCase):
     """Tests for connection/end to end behaviour using the TCP server.
 
@@ -1490,6 +1722,8 @@ class SmartTCPTests(tests.TestCase):
     the server is obtained by calling self.start_server(readonly=False).
     """
 
+    server_class = _mod_server.SmartTCPServer
+
     def start_server(self, readonly=False, backing_transport=None):
         """Setup the server.
 
@@ -1511,8 +1745,8 @@ class SmartTCPTests(tests.TestCase):
             self.real_backing_transport = self.backing_transport
             self.backing_transport = _mod_transport.get_transport_from_url(
                 "readonly+" + self.backing_transport.abspath('.'))
-        self.server = _mod_server.SmartTCPServer(self.backing_transport,
-                                                 client_timeout=4.0)
+        self.server = self.server_class(self.backing_transport,
+                                        client_timeout=4.0)
         self.server.start_server('127.0.0.1', 0)
         self.server.start_background_thread('-' + self.id())
         self.transport = remote.RemoteTCPTransport(self.server.get_url())
@@ -1579,6 +1813,18 @@ class WritableEndToEndTests(SmartTCPTests):
         fp = self.transport.get("foo")
         self.assertEqual('contents\nof\nfoo\n', fp.read())
 
+    def test_compressed_bodies(self):
+        """Compressible bodies survive being compressed both ways."""
+        self.overrideEnv('BZR_NO_SMART_VFS', None)
+        content = ''.join('line %d\n' % i for i in range(1000))
+        self.assertFalse(self.transport.has('foo'))
+        # The server said it decodes compressed request bodies.
+        self.assertEqual('zlib',
+            self.transport.get_smart_medium()._remote_compression)
+        self.transport.put_bytes('foo', content)
+        self.assertEqual(content, self.backing_transport.get_bytes('foo'))
+        self.assertEqual(content, self.transport.get_bytes('foo'))
+
     def test_get_error_enoent(self):
         """Error reported from server getting nonexistent file."""
         # The path in a raised NoSuchFile exception should be the precise path
@@ -1633,6 +1879,12 @@ class WritableEndToEndTests(SmartTCPTests):
             transport)
 
 
+class EventServerEndToEndTests(WritableEndToEndTests):
+    """The end to end tests, against a server running an event loop."""
+
+    server_class = _mod_server.SmartEventTCPServer
+
+
 class ReadOnlyEndToEndTests(SmartTCPTests):
     """Tests from the client to the server using a readonly backing transport."""
 
@@ -2833,8 +3085,9 @@ class TestProtocolThree(TestSmartProtocol):
         self.assertEqual('aaabbb', smart_protocol.unused_data)
         self.assertEqual(0, smart_protocol.next_read_size())
 
-    def make_protocol_expecting_message_part(self):
-        headers = '\0\0\0\x02de'  # length-prefixed, bencoded empty dict
+    def make_protocol_expecting_message_part(self,
+                                             headers='\0\0\0\x02de'):
+        # headers is length-prefixed, bencoded, by default an empty dict
         message_handler = LoggingMessageHandler()
         smart_protocol = self.server_protocol_class(message_handler)
         smart_protocol.accept_bytes(headers)
@@ -2882,6 +3135,58 @@ class TestProtocolThree(TestSmartProtocol):
         self.assertEqual(
             [('bytes', 'first'), ('bytes', 'second')], event_log)
 
+    def make_protocol_expecting_compressed_part(self):
+        return self.make_protocol_expecting_message_part(
+            '\0\0\0\x16d11:Compression4:zlibe')
+
+    def assertCompressedPartRejected(self, compressed, smart_protocol=None):
+        if smart_protocol is None:
+            smart_protocol, event_log = \
+                self.make_protocol_expecting_compressed_part()
+        else:
+            event_log = smart_protocol.message_handler.event_log
+        smart_protocol.accept_bytes(
+            'z' + struct.pack('!L', len(compressed)) + compressed)
+        [(event, exception)] = event_log
+        self.assertEqual('protocol_error', event)
+        self.assertIsInstance(exception, errors.SmartProtocolError)
+        return exception
+
+    def test_decode_compressed_bytes(self):
+        """The protocol can decode a compressed 'bytes' message part."""
+        smart_protocol, event_log = \
+            self.make_protocol_expecting_compressed_part()
+        compressed = zlib.compress('payload')
+        smart_protocol.accept_bytes(
+            'z' # message part kind
+            + struct.pack('!L', len(compressed)) # length prefix
+            + compressed # payload
+            )
+        self.assertEqual([('bytes', 'payload')], event_log)
+
+    def test_decode_bad_compressed_bytes(self):
+        self.assertCompressedPartRejected('payload')
+        compressed = zlib.compress('payload' * 100)
+        self.assertCompressedPartRejected(compressed[:-3])
+        self.assertCompressedPartRejected(compressed + 'junk')
+
+    def test_decode_oversized_compressed_bytes(self):
+        self.overrideAttr(protocol, '_MAX_DECOMPRESSED_SIZE', 1000)
+        smart_protocol, event_log = \
+            self.make_protocol_expecting_compressed_part()
+        compressed = zlib.compress('a' * 1000)
+        smart_protocol.accept_bytes(
+            'z' + struct.pack('!L', len(compressed)) + compressed)
+        self.assertEqual([('bytes', 'a' * 1000)], event_log)
+        exception = self.assertCompressedPartRejected(
+            zlib.compress('a' * 1001))
+        self.assertContainsRe(str(exception), 'more than 1000 bytes')
+
+    def test_compressed_bytes_need_compression_header(self):
+        smart_protocol, event_log = self.make_protocol_expecting_message_part()
+        self.assertCompressedPartRejected(zlib.compress('payload'),
+                                          smart_protocol)
+
 
 class TestConventionalResponseHandlerBodyStream(tests.TestCase):
 
@@ -2947,6 +3252,9 @@ class FakeResponder(object):
 
     response_sent = False
 
+    def request_headers_received(self, headers):
+        pass
+
     def send_error(self, exc):
         raise exc
 
@@ -3380,6 +3688,84 @@ class TestResponseEncodingProtocolThree(tests.TestCase):
         self.assertEqual(expected_response, out_stream.getvalue())
 
 
+class TestCompressionProtocolThree(tests.TestCase):
+    """Tests for compressing the bytes parts of v3 messages."""
+
+    compressible = 'revision-id-%d\n' * 10 % tuple(range(10)) * 10
+
+    def make_response_encoder(self, request_headers):
+        out_stream = StringIO()
+        response_encoder = protocol.ProtocolThreeResponder(out_stream.write)
+        response_encoder._headers = {}
+        response_encoder.request_headers_received(request_headers)
+        return response_encoder, out_stream
+
+    def send_body(self, body, request_headers={'Compression': 'zlib'}):
+        """Send a response with body, and return the body part sent."""
+        encoder, out_stream = self.make_response_encoder(request_headers)
+        encoder.send_response(
+            _mod_request.SuccessfulSmartServerResponse(('ok',), body=body))
+        prefix = ('bzr message 3 (bzr 1.6)\n'
+                  '\x00\x00\x00\x02de' # empty headers
+                  'oS' # success
+                  's\x00\x00\x00\x06l2:oke') # args ('ok',)
+        response = out_stream.getvalue()
+        self.assertStartsWith(response, prefix)
+        self.assertEndsWith(response, 'e')
+        return response[len(prefix):-1]
+
+    def assertSentAsIs(self, body, request_headers={'Compression': 'zlib'}):
+        self.assertEqual('b' + struct.pack('!L', len(body)) + body,
+                         self.send_body(body, request_headers))
+
+    def test_advertised_in_headers(self):
+        responder = protocol.ProtocolThreeResponder(StringIO().write)
+        self.assertEqual('zlib', responder._headers['Compression'])
+
+    def test_compresses_body_for_peer(self):
+        part = self.send_body(self.compressible)
+        self.assertEqual('z', part[0])
+        (length,) = struct.unpack('!L', part[1:5])
+        self.assertEqual(len(part) - 5, length)
+        self.assertEqual(self.compressible, zlib.decompress(part[5:]))
+
+    def test_not_compressed_without_peer_support(self):
+        self.assertSentAsIs(self.compressible, {})
+        self.assertSentAsIs(self.compressible, {'Compression': 'lz4'})
+
+    def test_small_body_not_compressed(self):
+        self.assertSentAsIs('a' * 100)
+
+    def test_incompressible_body_not_compressed(self):
+        self.assertSentAsIs(zlib.compress(self.compressible * 10))
+
+    def test_compressed_record_not_compressed(self):
+        serialiser = pack.ContainerSerialiser()
+        record = serialiser.bytes_record(
+            'groupcompress-block\n' + self.compressible, [('texts',)])
+        self.assertSentAsIs(record)
+        record = serialiser.bytes_record(
+            'fulltext\n' + self.compressible, [('texts',)])
+        self.assertEqual('z', self.send_body(record)[0])
+
+    def test_requester_compresses_once_told(self):
+        output = StringIO()
+        client_medium = medium.SmartSimplePipesClientMedium(
+            None, output, 'base')
+        requester = protocol.ProtocolThreeRequester(
+            client_medium.get_request())
+        requester.set_headers({'Compression': 'zlib'})
+        requester.set_peer_compression('zlib')
+        requester.call_with_body_bytes(('arg',), self.compressible)
+        decoder = protocol.ProtocolThreeDecoder(LoggingMessageHandler(),
+                                                expect_version_marker=True)
+        decoder.accept_bytes(output.getvalue())
+        self.assertEqual(('bytes', self.compressible),
+                         decoder.message_handler.event_log[2])
+        # The body was not sent as it is.
+        self.assertFalse(self.compressible in output.getvalue())
+
+
 class TestResponseEncoderBufferingProtocolThree(tests.TestCase):
     """Tests for buffering of responses.
 
@@ -3734,6 +4120,7 @@ class Test_SmartClient(tests.TestCase):
         smart_client = client._SmartClient('dummy medium')
         self.assertEqual(
             bzrlib.__version__, smart_client._headers['Software version'])
+        self.assertEqual('zlib', smart_client._headers['Compression'])
         # XXX: need a test that smart_client._headers is passed to the request
         # encoder.
 
@@ -3758,6 +4145,89 @@ class Test_SmartClientRequest(tests.TestCase):
         responder.send_response(response)
         return response_io.getvalue()
 
+    def test_call_pipelined(self):
+        # Both requests are sent before either response is read, and the
+        # responses can be read in any order.
+        response_io = StringIO(
+            self.make_response(('ok',), 'foo content\n')
+            + self.make_response(('ok',), 'bar content\n'))
+        output = StringIO()
+        client_medium = medium.SmartSimplePipesClientMedium(
+            response_io, output, 'base')
+        client_medium._protocol_version = 3
+        client_medium._remote_pipelining = True
+        smart_client = client._SmartClient(client_medium, headers={})
+        foo_call = smart_client.call_pipelined('get', 'foo')
+        bar_call = smart_client.call_pipelined('get', 'bar')
+        self.assertEqual('bzr message 3 (bzr 1.6)\n'
+                         '\x00\x00\x00\x02de'
+                         's\x00\x00\x00\x0cl3:get3:fooee'
+                         'bzr message 3 (bzr 1.6)\n'
+                         '\x00\x00\x00\x02de'
+                         's\x00\x00\x00\x0cl3:get3:baree',
+                         output.getvalue())
+        response, response_handler = bar_call.read_response()
+        self.assertEqual(('ok',), response)
+        self.assertEqual('bar content\n', response_handler.read_body_bytes())
+        response, response_handler = foo_call.read_response()
+        self.assertEqual(('ok',), response)
+        self.assertEqual('foo content\n', response_handler.read_body_bytes())
+        self.assertIs(None, client_medium._current_request)
+
+    def test_call_pipelined_responses_read_together(self):
+        # The start of a response read along with the previous one is kept
+        # for the next response to be read.
+        from StringIO import StringIO as PyStringIO
+        class ReadAllStringIO(PyStringIO):
+            def read(self, count=-1):
+                return PyStringIO.read(self)
+        response_io = ReadAllStringIO(
+            self.make_response(('ok', '1'))
+            + self.make_response(('ok', '2')))
+        client_medium = medium.SmartSimplePipesClientMedium(
+            response_io, StringIO(), 'base')
+        client_medium._protocol_version = 3
+        client_medium._remote_pipelining = True
+        smart_client = client._SmartClient(client_medium, headers={})
+        first_call = smart_client.call_pipelined('hello')
+        second_call = smart_client.call_pipelined('hello')
+        response, response_handler = first_call.read_response()
+        response_handler.cancel_read_body()
+        self.assertEqual(('ok', '1'), response)
+        response, response_handler = second_call.read_response()
+        response_handler.cancel_read_body()
+        self.assertEqual(('ok', '2'), response)
+
+    def test_call_pipelined_server_without_pipelining(self):
+        # Servers that did not say they serve pipelined requests only get the
+        # request when its response is read.
+        response_io = StringIO(self.make_response(('ok',), 'content\n'))
+        output = StringIO()
+        client_medium = medium.SmartSimplePipesClientMedium(
+            response_io, output, 'base')
+        client_medium._protocol_version = 3
+        smart_client = client._SmartClient(client_medium, headers={})
+        pipelined_call = smart_client.call_pipelined('get', 'foo')
+        self.assertEqual('', output.getvalue())
+        response, response_handler = pipelined_call.read_response()
+        self.assertEqual(('ok',), response)
+        self.assertEqual('content\n', response_handler.read_body_bytes())
+
+    def test_call_pipelined_unknown_protocol_version(self):
+        # Until the protocol version is known, the request is only sent when
+        # its response is read.
+        response_io = StringIO(self.make_response(('ok',), 'content\n'))
+        output = StringIO()
+        client_medium = medium.SmartSimplePipesClientMedium(
+            response_io, output, 'base')
+        smart_client = client._SmartClient(client_medium, headers={})
+        pipelined_call = smart_client.call_pipelined('get', 'foo')
+        self.assertEqual('', output.getvalue())
+        response, response_handler = pipelined_call.read_response()
+        self.assertEqual(('ok',), response)
+        self.assertEqual('content\n', response_handler.read_body_bytes())
+        self.assertEqual(3, client_medium._protocol_version)
+
     def test__call_doesnt_retry_append(self):
         response = self.make_response(('appended', '8'))
         output, vendor, smart_client = self.make_client_with_failing_medium(
@@ -22,6 +22,7 @@ import time
 
 from bzrlib import (
     bencode,
+    config,
     errors,
     filters,
     generate_ids,
@@ -258,6 +259,64 @@ class TestTreeTransform(tests.TestCaseWithTransport):
         # But if we have more than that, all files should get the same result
         self.assertEqual(st1.st_mtime, st2.st_mtime)
 
+    def test_create_files_on_threads(self):
+        trans, root, contents, sha1 = self.get_transform_for_sha1_test()
+        dir_id = trans.new_directory('dir', root, 'dir-id')
+        files = []
+        for i in range(50):
+            parent_id = (root, dir_id)[i % 2]
+            trans_id = trans.create_path('file%d' % i, parent_id)
+            trans.version_file('file%d-id' % i, trans_id)
+            if i % 3:
+                files.append((['content %d\n' % i], trans_id, None))
+            else:
+                files.append((iter(contents), trans_id, sha1))
+        trans.create_files(files, workers=4)
+        mtimes = set()
+        for chunks, trans_id, file_sha1 in files:
+            self.assertEqual('file', trans._new_contents[trans_id])
+            name = trans._limbo_name(trans_id)
+            if file_sha1 is None:
+                self.assertFalse(trans_id in trans._observed_sha1s)
+                expected = chunks
+            else:
+                o_sha1, o_st_val = trans._observed_sha1s[trans_id]
+                self.assertEqual(sha1, o_sha1)
+                self.assertEqualStat(o_st_val, osutils.lstat(name))
+                expected = contents
+            self.assertFileEqual(''.join(expected), name)
+            mtimes.add(osutils.lstat(name).st_mtime)
+        # All files get the same mtime, as with create_file.
+        self.assertEqual(1, len(mtimes))
+        trans.apply()
+        self.assertFileEqual('content 1\n', self.wt.abspath('dir/file1'))
+        self.assertFileEqual('content 2\n', self.wt.abspath('file2'))
+        self.assertFileEqual(''.join(contents), self.wt.abspath('dir/file3'))
+
+    def test_create_files_large_files_on_calling_thread(self):
+        trans, root, contents, sha1 = self.get_transform_for_sha1_test()
+        self.overrideAttr(trans, '_max_threaded_write_size', 20)
+        self.overrideAttr(trans, '_pending_write_bytes_per_worker', 30)
+        threaded = []
+        orig_write = trans._write_limbo_file
+        def write_limbo_file(name, chunks, trans_id, want_stat):
+            threaded.append(trans_id)
+            return orig_write(name, chunks, trans_id, want_stat)
+        trans._write_limbo_file = write_limbo_file
+        small = trans.create_path('small', root)
+        large = trans.create_path('large', root)
+        large_contents = ['%d' % i * 10 for i in range(10)]
+        trans.create_files([(['small\n'], small, None),
+                            (iter(large_contents), large, None)] +
+                           [(['%d\n' % i * 10], trans.create_path(
+                               'file%d' % i, root), None)
+                            for i in range(10)], workers=2)
+        self.assertFalse(large in threaded)
+        self.assertEqual(11, len(threaded))
+        self.assertFileEqual(''.join(large_contents),
+                             trans._limbo_name(large))
+        self.assertFileEqual('small\n', trans._limbo_name(small))
+
     def test_change_root_id(self):
         transform, root = self.get_transform()
         self.assertNotEqual('new-root-id', self.wt.get_root_id())
@@ -2272,6 +2331,21 @@ class TestBuildTree(tests.TestCaseWithTransport):
         self.assertEqual(entry1_state, entry1[1][0])
         self.assertEqual(entry2_state, entry2[1][0])
 
+    def test_build_tree_write_workers(self):
+        source = self.make_branch_and_tree('source')
+        paths = ['file%d' % i for i in range(20)]
+        paths += ['dir/', 'dir/file']
+        self.build_tree(['source/' + path for path in paths])
+        source.add([path.rstrip('/') for path in paths])
+        source.commit('new files')
+        config.GlobalStack().set('build_tree.write_workers', '4')
+        target = self.make_branch_and_tree('target')
+        build_tree(source.basis_tree(), target)
+        target.lock_read()
+        self.addCleanup(target.unlock)
+        self.assertEqual([], list(target.iter_changes(source.basis_tree())))
+        self.assertFileEqual('contents of source/dir/file\n', 'target/dir/file')
+
 
 class TestCommitTransform(tests.TestCaseWithTransport):
 
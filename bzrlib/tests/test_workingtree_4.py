@@ -22,6 +22,7 @@ import time
 
 from bzrlib import (
     bzrdir,
+    config,
     dirstate,
     errors,
     inventory,
@@ -688,6 +689,33 @@ class TestWorkingTreeFormat4(TestCaseWithTransport):
             tree_iter_changes, tree, [u'\xa7', u'\u03c0'])
         self.assertEqual(e.paths, [u'\xa7', u'\u03c0'])
 
+    def test_iter_changes_specific_files_reads_part_of_dirstate(self):
+        def sha_cutoff_time(state):
+            state._cutoff_time = time.time() + 60
+        self.overrideAttr(dirstate.DirState, '_sha_cutoff_time',
+                          sha_cutoff_time)
+        config.GlobalStack().set('dirstate.journal_ratio', '10')
+        config.GlobalStack().set('bzr.workingtree.worth_saving_limit', '1')
+        tree = self.make_branch_and_tree('.')
+        self.build_tree(['a', 'b/', 'b/c', 'b/f', 'd/', 'd/e'])
+        tree.add(['a', 'b', 'b/c', 'b/f', 'd', 'd/e'])
+        tree.commit('one')
+        self.build_tree_contents([('b/c', 'new content of c\n'),
+                                  ('d/e', 'new content of e\n')])
+        os.utime('b/f', (1, 1))
+        tree.lock_read()
+        self.addCleanup(tree.unlock)
+        state = tree.current_dirstate()
+        changes = list(tree.iter_changes(tree.basis_tree(),
+                                         specific_files=['b']))
+        self.assertEqual(['b/c'], [c[1][1] for c in changes])
+        self.assertEqual(dirstate.DirState.NOT_IN_MEMORY,
+                         state._dirblock_state)
+        # The sha1 found for b/f was journaled.
+        self.assertPathExists(state._journal_filename)
+        entry = state._get_entry(0, path_utf8='b/f')
+        self.assertEqual(dirstate.pack_stat(os.lstat('b/f')), entry[1][0][4])
+
     def get_tree_with_cachable_file_foo(self):
         tree = self.make_branch_and_tree('.')
         tree.lock_write()
@@ -872,3 +900,55 @@ class TestInventoryCoherency(TestCaseWithTransport):
         tree.unversion(['a-id', 'b-id'])
         self.assertFalse(inv.has_id('a-id'))
         self.assertFalse(inv.has_id('b-id'))
+
+
+class TestSHA1Prefetcher(TestCaseWithTransport):
+
+    def setUp(self):
+        super(TestSHA1Prefetcher, self).setUp()
+        config.GlobalStack().set('dirstate.sha1_workers', 4)
+        self.tree = self.make_branch_and_tree('.')
+        self.names = ['f%02d' % i for i in range(20)]
+        self.build_tree_contents(
+            [(name, 'content of %s\n' % name) for name in self.names])
+        self.tree.add(self.names)
+        self.tree.commit('one')
+        # Give every file a new stat, as restoring a checkout would, and new
+        # content to half of them.
+        for name in self.names[:10]:
+            self.build_tree_contents([(name, 'new content of %s\n' % name)])
+        for name in self.names[10:]:
+            os.utime(name, (1000000000, 1000000000))
+        self.jobs = []
+        orig = workingtree_4.ContentFilterAwareSHA1Provider.stat_and_sha1_job
+        def stat_and_sha1_job(provider, abspath):
+            self.jobs.append(osutils.basename(abspath))
+            return orig(provider, abspath)
+        self.overrideAttr(workingtree_4.ContentFilterAwareSHA1Provider,
+                          'stat_and_sha1_job', stat_and_sha1_job)
+
+    def changed_paths(self):
+        self.tree.lock_read()
+        self.addCleanup(self.tree.unlock)
+        return sorted(change[1][1] for change in
+                      self.tree.iter_changes(self.tree.basis_tree()))
+
+    def test_changed_files_are_hashed_in_threads(self):
+        self.overrideAttr(dirstate.SHA1Prefetcher, 'activation_hashes', 0)
+        self.assertEqual(self.names[:10], self.changed_paths())
+        self.assertEqual(self.names, sorted(self.jobs))
+        # The state gets its own provider back.
+        state = self.tree.current_dirstate()
+        self.assertIsInstance(state._sha1_provider,
+                              workingtree_4.ContentFilterAwareSHA1Provider)
+        self.assertEqual(state._sha1_provider.sha1, state._sha1_file)
+
+    def test_not_activated_for_few_hashes(self):
+        self.assertEqual(self.names[:10], self.changed_paths())
+        self.assertEqual([], self.jobs)
+
+    def test_single_worker(self):
+        config.GlobalStack().set('dirstate.sha1_workers', 1)
+        self.overrideAttr(dirstate.SHA1Prefetcher, 'activation_hashes', 0)
+        self.assertEqual(self.names[:10], self.changed_paths())
+        self.assertEqual([], self.jobs)
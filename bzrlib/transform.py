@@ -16,6 +16,8 @@
 
 from __future__ import absolute_import
 
+import collections
+import itertools
 import os
 import errno
 from stat import S_ISREG, S_IEXEC
@@ -1326,6 +1328,99 @@ class DiskTreeTransform(TreeTransformBase):
         if sha1 is not None:
             self._observed_sha1s[trans_id] = (sha1, osutils.lstat(name))
 
+    # How many files, and how many bytes of their contents, create_files lets
+    # wait for a writer, per thread.
+    _pending_writes_per_worker = 16
+    _pending_write_bytes_per_worker = 4 * 1024 * 1024
+    # Files larger than this are streamed to disk on the calling thread by
+    # create_files, rather than held in memory for a writer.
+    _max_threaded_write_size = 1024 * 1024
+
+    def create_files(self, files, workers=1):
+        """Schedule creation of many new files.
+
+        With more than one worker the files are written into limbo on a pool
+        of threads, while the caller carries on producing contents. File
+        writes release the GIL, so this overlaps them with extracting texts
+        from the repository. Only small files are handed to the threads, and
+        only a bounded number of bytes wait for them at once.
+
+        :param files: An iterable of (contents, trans_id, sha1) tuples, as
+            create_file takes them. It is consumed in the calling thread.
+        :param workers: The number of threads to write the files on.
+        """
+        if workers < 2:
+            for contents, trans_id, sha1 in files:
+                self.create_file(contents, trans_id, sha1=sha1)
+            return
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+        # (trans_id, sha1, size, AsyncResult) in the order they were queued
+        pending = collections.deque()
+        pending_bytes = 0
+        max_pending = workers * self._pending_writes_per_worker
+        max_pending_bytes = workers * self._pending_write_bytes_per_worker
+        max_size = self._max_threaded_write_size
+        try:
+            for contents, trans_id, sha1 in files:
+                # The contents may be a generator over shared state, so read
+                # them here rather than on the writer thread.
+                contents = iter(contents)
+                chunks = []
+                size = 0
+                for chunk in contents:
+                    chunks.append(chunk)
+                    size += len(chunk)
+                    if size > max_size:
+                        break
+                if size > max_size:
+                    self.create_file(itertools.chain(chunks, contents),
+                                     trans_id, sha1=sha1)
+                    continue
+                name = self._limbo_name(trans_id)
+                unique_add(self._new_contents, trans_id, 'file')
+                if self._creation_mtime is None:
+                    self._creation_mtime = time.time()
+                result = pool.apply_async(self._write_limbo_file,
+                    (name, chunks, trans_id, sha1 is not None))
+                pending.append((trans_id, sha1, size, result))
+                pending_bytes += size
+                while (len(pending) > max_pending
+                       or pending_bytes > max_pending_bytes):
+                    pending_bytes -= self._finish_limbo_write(
+                        *pending.popleft())
+            while pending:
+                self._finish_limbo_write(*pending.popleft())
+        finally:
+            # Let queued writes finish before limbo can be cleaned up.
+            pool.close()
+            pool.join()
+
+    def _write_limbo_file(self, name, chunks, trans_id, want_stat):
+        """Write a new file into limbo for create_files.
+
+        This runs on a writer thread, so it must not change the transform.
+        """
+        f = open(name, 'wb')
+        try:
+            f.writelines(chunks)
+        finally:
+            f.close()
+        self._set_mtime(name)
+        self._set_mode(trans_id, None, S_ISREG)
+        if want_stat:
+            return osutils.lstat(name)
+
+    def _finish_limbo_write(self, trans_id, sha1, size, result):
+        """Wait for a file queued by create_files to be written.
+
+        :return: The size of the file.
+        """
+        stat_value = result.get()
+        if sha1 is not None:
+            self._observed_sha1s[trans_id] = (sha1, stat_value)
+        return size
+
     def _read_file_chunks(self, trans_id):
         cur_file = open(self._limbo_name(trans_id), 'rb')
         try:
@@ -2705,14 +2800,19 @@ def _create_files(tt, tree, desired_files, pb, offset, accelerator_tree,
                         pass
             count += 1
         offset += count
-    for count, ((trans_id, tree_path, text_sha1), contents) in enumerate(
-            tree.iter_files_bytes(new_desired_files)):
-        if wt.supports_content_filtering():
-            filters = wt._content_filter_stack(tree_path)
-            contents = filtered_output_bytes(contents, filters,
-                ContentFilterContext(tree_path, tree))
-        tt.create_file(contents, trans_id, sha1=text_sha1)
-        pb.update(gettext('Adding file contents'), count + offset, total)
+    def iter_new_files():
+        for count, ((trans_id, tree_path, text_sha1), contents) in enumerate(
+                tree.iter_files_bytes(new_desired_files)):
+            if wt.supports_content_filtering():
+                filters = wt._content_filter_stack(tree_path)
+                contents = filtered_output_bytes(contents, filters,
+                    ContentFilterContext(tree_path, tree))
+            yield contents, trans_id, text_sha1
+            pb.update(gettext('Adding file contents'), count + offset, total)
+    workers = wt.get_config_stack().get('build_tree.write_workers')
+    if workers == 0:
+        workers = osutils.local_concurrency()
+    tt.create_files(iter_new_files(), workers)
 
 
 def _reparent_children(tt, old_parent, new_parent):
@@ -2950,11 +3050,12 @@ def _alter_files(working_tree, target_tree, tt, pb, specific_files,
                     tt.create_symlink(target_tree.get_symlink_target(file_id),
                                       trans_id)
                 elif target_kind == 'file':
-                    deferred_files.append((file_id, (trans_id, mode_id)))
                     if basis_tree is None:
                         basis_tree = working_tree.basis_tree()
                         basis_tree.lock_read()
                     new_sha1 = target_tree.get_file_sha1(file_id)
+                    deferred_files.append(
+                        (file_id, (trans_id, mode_id, new_sha1)))
                     if (basis_tree.has_id(file_id) and
                         new_sha1 == basis_tree.get_file_sha1(file_id)):
                         if file_id in merge_modified:
@@ -2984,7 +3085,7 @@ def _alter_files(working_tree, target_tree, tt, pb, specific_files,
             if wt_executable != target_executable and target_kind == "file":
                 tt.set_executability(target_executable, trans_id)
         if working_tree.supports_content_filtering():
-            for index, ((trans_id, mode_id), bytes) in enumerate(
+            for index, ((trans_id, mode_id, sha1), bytes) in enumerate(
                 target_tree.iter_files_bytes(deferred_files)):
                 file_id = deferred_files[index][0]
                 # We're reverting a tree to the target tree so using the
@@ -2994,11 +3095,11 @@ def _alter_files(working_tree, target_tree, tt, pb, specific_files,
                 filters = working_tree._content_filter_stack(filter_tree_path)
                 bytes = filtered_output_bytes(bytes, filters,
                     ContentFilterContext(filter_tree_path, working_tree))
-                tt.create_file(bytes, trans_id, mode_id)
+                tt.create_file(bytes, trans_id, mode_id, sha1)
         else:
-            for (trans_id, mode_id), bytes in target_tree.iter_files_bytes(
-                deferred_files):
-                tt.create_file(bytes, trans_id, mode_id)
+            for (trans_id, mode_id, sha1), bytes in \
+                target_tree.iter_files_bytes(deferred_files):
+                tt.create_file(bytes, trans_id, mode_id, sha1)
         tt.fixup_new_roots()
     finally:
         if basis_tree is not None:
@@ -36,6 +36,7 @@ import stat
 from bzrlib import (
     bzrdir,
     cache_utf8,
+    change_journal,
     config,
     conflicts as _mod_conflicts,
     controldir,
@@ -87,6 +88,10 @@ from bzrlib.workingtree import (
 
 class DirStateWorkingTree(InventoryWorkingTree):
 
+    # Applying a delta to the dirstate is cheap, so let huge adds hand
+    # their entries over as they go rather than all at the end.
+    _smart_add_batch_size = 10000
+
     def __init__(self, basedir,
                  branch,
                  _control_files=None,
@@ -122,6 +127,12 @@ class DirStateWorkingTree(InventoryWorkingTree):
         self.views = self._make_views()
         #--- allow tests to select the dirstate iter_changes implementation
         self._iter_changes = dirstate._process_entry
+        # The change journal (session, offset) of the last complete walk
+        # during this lock, if any.
+        self._change_journal_walk = None
+        # The (walk, dirstate fingerprint) of a has_changes() walk during
+        # this lock that found no changes, if any.
+        self._change_journal_clean = None
 
     @needs_tree_write_lock
     def _add(self, files, ids, kinds):
@@ -1194,20 +1205,166 @@ class DirStateWorkingTree(InventoryWorkingTree):
     def supports_tree_reference(self):
         return self._repo_supports_tree_reference
 
+    @needs_read_lock
+    def has_changes(self, _from_tree=None):
+        """See MutableTree.has_changes.
+
+        A tree which a watcher has seen no changes in since an earlier call
+        found it unchanged is known to be unchanged without looking at it.
+        """
+        if _from_tree is not None:
+            return super(DirStateWorkingTree, self).has_changes(_from_tree)
+        if len(self.get_parent_ids()) > 1:
+            return True
+        fingerprint = self._unmodified_state_fingerprint()
+        if (fingerprint is not None
+            and self._change_journal_unchanged(fingerprint)):
+            return False
+        previous_walk = self._change_journal_walk
+        changed = super(DirStateWorkingTree, self).has_changes()
+        walk = self._change_journal_walk
+        if (not changed and fingerprint is not None and walk is not None
+            and walk is not previous_walk):
+            self._change_journal_clean = (walk, fingerprint)
+        return changed
+
+    def _unmodified_state_fingerprint(self):
+        """Return the fingerprint of the saved dirstate.
+
+        :return: None if the dirstate in memory has changes that are not
+            saved yet, beyond cached hashes.
+        """
+        state = self.current_dirstate()
+        if (state._header_state == dirstate.DirState.IN_MEMORY_MODIFIED
+            or state._dirblock_state == dirstate.DirState.IN_MEMORY_MODIFIED):
+            return None
+        return change_journal.read_state_fingerprint(state._filename)
+
+    def _change_journal_unchanged(self, fingerprint):
+        """Does the change journal show the tree still matches its basis?
+
+        :param fingerprint: The fingerprint of the saved dirstate.
+        """
+        try:
+            clean = change_journal.parse_base(
+                self._transport.get_bytes(change_journal.CLEAN_NAME))
+        except errors.NoSuchFile:
+            return False
+        if clean is None or clean[2] != fingerprint:
+            return False
+        changes = change_journal.read_changes(
+            self._transport.local_abspath('.'), clean[:2])
+        if changes is None:
+            return False
+        dirty = changes[2]
+        return dirty is not None and not dirty
+
+    def _change_journal_dir_reader(self, state):
+        """Get a DirReader that trusts the tree's change journal.
+
+        :param state: The dirstate about to be walked.
+        :return: A tuple (dir_reader, walk). dir_reader is None when every
+            path has to be stat()ed. walk is None when there is no running
+            watcher, otherwise the (session, offset) that a complete walk
+            brings the dirstate up to date with.
+        """
+        if not self._transport.has(change_journal.JOURNAL_NAME):
+            return None, None
+        try:
+            base = change_journal.parse_base(
+                self._transport.get_bytes(change_journal.BASE_NAME))
+        except errors.NoSuchFile:
+            base = None
+        changes = change_journal.read_changes(
+            self._transport.local_abspath('.'), base and base[:2])
+        if changes is None:
+            return None, None
+        session, offset, dirty = changes
+        walk = (session, offset)
+        if (dirty is None
+            or state._header_state == dirstate.DirState.IN_MEMORY_MODIFIED
+            or state._dirblock_state == dirstate.DirState.IN_MEMORY_MODIFIED):
+            return None, walk
+        crc = getattr(state, 'crc_expected', None)
+        if (crc is None or base[2] != change_journal.state_fingerprint(crc,
+                state._num_entries, state._journal_offset or 0)):
+            # The dirstate was rewritten since the base was recorded.
+            return None, walk
+        return change_journal.JournalDirReader(state, dirty), walk
+
+    def _record_complete_walk(self, changes, walk):
+        """Yield changes, noting walk once they have all been consumed."""
+        for change in changes:
+            yield change
+        self._change_journal_walk = walk
+
+    def _save_partial_walk(self, changes, state):
+        """Yield changes, then save the hashes cached while finding them.
+
+        :param state: The partially loaded dirstate the changes came from.
+        """
+        for change in changes:
+            yield change
+        self._dirstate._save_partial_state(state)
+
+    def _save_change_journal_base(self, walk):
+        """Record that the saved dirstate is up to date as of walk."""
+        state = self._dirstate
+        if (state._header_state != dirstate.DirState.IN_MEMORY_UNMODIFIED
+            or state._dirblock_state != dirstate.DirState.IN_MEMORY_UNMODIFIED):
+            # Not everything the walk found reached the disk.
+            return
+        fingerprint = change_journal.read_state_fingerprint(state._filename)
+        if fingerprint is None:
+            return
+        try:
+            self._transport.put_bytes(change_journal.BASE_NAME,
+                change_journal.format_base(walk[0], walk[1], fingerprint))
+        except errors.PathError, e:
+            trace.mutter('could not save the change journal base: %s', e)
+
+    def _save_change_journal_clean(self, walk):
+        """Record that the tree matched its basis as of walk."""
+        fingerprint = change_journal.read_state_fingerprint(
+            self._dirstate._filename)
+        if fingerprint is None:
+            return
+        try:
+            self._transport.put_bytes(change_journal.CLEAN_NAME,
+                change_journal.format_base(walk[0], walk[1], fingerprint))
+        except errors.PathError, e:
+            trace.mutter('could not save the change journal clean record: %s',
+                         e)
+
     def unlock(self):
         """Unlock in format 4 trees needs to write the entire dirstate."""
         if self._control_files._lock_count == 1:
             # do non-implementation specific cleanup
             self._cleanup()
 
+            clean = self._change_journal_clean
+            if (clean is not None
+                and self._unmodified_state_fingerprint() != clean[1]):
+                # The tree was changed after it was found unchanged.
+                clean = None
             # eventually we should do signature checking during read locks for
             # dirstate updates.
             if self._control_files._lock_mode == 'w':
                 if self._dirty:
                     self.flush()
             if self._dirstate is not None:
+                walk = self._change_journal_walk
+                if (walk is not None
+                    and self._dirstate._worth_saving_limit != -1):
+                    # Saving the walk lets the next one trust the change
+                    # journal, so even a few hash changes are worth writing.
+                    self._dirstate._worth_saving_limit = 0
                 # This is a no-op if there are no modifications.
                 self._dirstate.save()
+                if walk is not None:
+                    self._save_change_journal_base(walk)
+                if clean is not None:
+                    self._save_change_journal_clean(clean[0])
                 self._dirstate.unlock()
             # TODO: jam 20070301 We shouldn't have to wipe the dirstate at this
             #       point. Instead, it could check if the header has been
@@ -1215,6 +1372,8 @@ class DirStateWorkingTree(InventoryWorkingTree):
             #       the data it has in memory.
             self._dirstate = None
             self._inventory = None
+            self._change_journal_walk = None
+            self._change_journal_clean = None
         # reverse order of locking.
         try:
             return self._control_files.unlock()
@@ -1377,16 +1536,27 @@ class ContentFilterAwareSHA1Provider(dirstate.SHA1Provider):
     def __init__(self, tree):
         self.tree = tree
 
+    def _filters(self, abspath):
+        return self.tree._content_filter_stack(
+            self.tree.relpath(osutils.safe_unicode(abspath)))
+
     def sha1(self, abspath):
         """See dirstate.SHA1Provider.sha1()."""
-        filters = self.tree._content_filter_stack(
-            self.tree.relpath(osutils.safe_unicode(abspath)))
+        filters = self._filters(abspath)
         return _mod_filters.internal_size_sha_file_byname(abspath, filters)[1]
 
     def stat_and_sha1(self, abspath):
         """See dirstate.SHA1Provider.stat_and_sha1()."""
-        filters = self.tree._content_filter_stack(
-            self.tree.relpath(osutils.safe_unicode(abspath)))
+        return self._stat_and_sha1(abspath, self._filters(abspath))
+
+    def stat_and_sha1_job(self, abspath):
+        """See dirstate.SHA1Provider.stat_and_sha1_job()."""
+        if self._filters(abspath):
+            # Filters may call back into the tree, which is not thread safe.
+            return None
+        return lambda: self._stat_and_sha1(abspath, [])
+
+    def _stat_and_sha1(self, abspath, filters):
         file_obj = file(abspath, 'rb', 65000)
         try:
             statvalue = os.fstat(file_obj.fileno())
@@ -2219,7 +2389,15 @@ class InterDirStateTree(InterTree):
 
         # -- get the state object and prepare it.
         state = self.target.current_dirstate()
-        state._read_dirblocks_if_needed()
+        partial_state = None
+        if (specific_files != set([''])
+            and state._lock_state == 'r'
+            and state._dirblock_state == dirstate.DirState.NOT_IN_MEMORY):
+            # Only read the parts of the dirstate the paths need.
+            partial_state = state._partial_state(specific_files)
+            state = partial_state
+        else:
+            state._read_dirblocks_if_needed()
         if require_versioned:
             # -- check all supplied paths are versioned in a search tree. --
             not_versioned = []
@@ -2251,7 +2429,25 @@ class InterDirStateTree(InterTree):
         iter_changes = self.target._iter_changes(include_unchanged,
             use_filesystem_for_exec, search_specific_files, state,
             source_index, target_index, want_unversioned, self.target)
-        return iter_changes.iter_changes()
+        if search_specific_files == set(['']):
+            # A whole tree walk: only stat what the change journal lists.
+            dir_reader, walk = self.target._change_journal_dir_reader(state)
+        else:
+            dir_reader = walk = None
+        prefetcher = state._sha1_prefetcher()
+        if prefetcher is not None:
+            # Hash changed files on several threads.
+            dir_reader = prefetcher.dir_reader(dir_reader)
+        if dir_reader is not None:
+            iter_changes.dir_reader = dir_reader
+        changes = iter_changes.iter_changes()
+        if prefetcher is not None:
+            changes = prefetcher.hashing(changes)
+        if walk is not None:
+            changes = self.target._record_complete_walk(changes, walk)
+        if partial_state is not None:
+            changes = self.target._save_partial_walk(changes, partial_state)
+        return changes
 
     @staticmethod
     def is_compatible(source, target):
@@ -293,6 +293,7 @@ add_pyrex_extension('bzrlib._groupcompress_pyx',
                     extra_source=['bzrlib/diff-delta.c'])
 add_pyrex_extension('bzrlib._knit_load_data_pyx')
 add_pyrex_extension('bzrlib._known_graph_pyx')
+add_pyrex_extension('bzrlib._lru_cache_pyx')
 add_pyrex_extension('bzrlib._rio_pyx')
 if sys.platform == 'win32':
     add_pyrex_extension('bzrlib._dirstate_helpers_pyx',